@@ -0,0 +1,150 @@
+# admission.py
+"""
+Допуск апдейтов к обработчикам опроса — до постановки в пул воркеров.
+
+Три ступени, у каждой свой счётчик в Admission.stats:
+1. throttled — токен-бакет на пользователя (ADMISSION_USER_RATE в секунду,
+   запас ADMISSION_USER_BURST); лишние апдейты отбрасываются молча
+2. coalesced — повторное нажатие той же кнопки (тот же callback_data) в пределах
+   ADMISSION_CALLBACK_WINDOW секунд отбрасывается
+   На отброшенное на 1–2 ступени нажатие кнопки уходит пустой answer_callback_query,
+   чтобы кнопка у пользователя не крутилась до таймаута Telegram
+3. shed — при нагрузке (выполняющиеся + ожидающие обработчики) не меньше
+   ADMISSION_MAX_INFLIGHT апдейт не обрабатывается, пользователь получает
+   короткий заготовленный ответ
+
+Один пользователь расходует только свой бакет, поэтому спам или сбойный клиент
+не занимает воркеры и квоту Telegram API за счёт остальных.
+"""
+
+import os
+import time
+import threading
+from collections import OrderedDict
+
+SHED_TEXT = "⏳ Бот сейчас перегружен. Пожалуйста, повторите через минуту."
+
+class TokenBuckets:
+    """Токен-бакеты по ключу в ограниченном LRU {key: [токены, время обновления]}"""
+
+    def __init__(self, rate, burst, max_size=100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, now=None):
+        """Списывает токен; False, если бакет пуст"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            bucket = self._items.get(key)
+            if bucket is None:
+                bucket = self._items[key] = [self.burst, now]
+                while len(self._items) > self.max_size:
+                    self._items.popitem(last=False)
+            else:
+                self._items.move_to_end(key)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] < 1:
+                return False
+            bucket[0] -= 1
+            return True
+
+    def __len__(self):
+        return len(self._items)
+
+class RecentCallbacks:
+    """Последние нажатия {(user_id, callback_data): время} в ограниченном LRU"""
+
+    def __init__(self, window, max_size=100000):
+        self.window = window
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def seen(self, key, now=None):
+        """True, если такое же нажатие уже было в окне; иначе запоминает его"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            last = self._items.get(key)
+            if last is not None and now - last < self.window:
+                return True
+            self._items[key] = now
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+            return False
+
+class Admission:
+    """Фильтр апдейтов перед обработчиками; 0 в параметре выключает ступень"""
+
+    def __init__(self, user_rate=1.0, user_burst=5, callback_window=1.0, max_inflight=100, max_users=100000):
+        self.buckets = TokenBuckets(user_rate, user_burst, max_users) if user_rate > 0 else None
+        self.callbacks = RecentCallbacks(callback_window, max_users) if callback_window > 0 else None
+        self.max_inflight = max_inflight
+        self.stats = {"admitted": 0, "throttled": 0, "coalesced": 0, "shed": 0}
+        self._stats_lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            user_rate=float(os.getenv("ADMISSION_USER_RATE", "1")),
+            user_burst=float(os.getenv("ADMISSION_USER_BURST", "5")),
+            callback_window=float(os.getenv("ADMISSION_CALLBACK_WINDOW", "1")),
+            max_inflight=int(os.getenv("ADMISSION_MAX_INFLIGHT", "100")),
+        )
+
+    def _count(self, name):
+        with self._stats_lock:
+            self.stats[name] += 1
+
+    def decide(self, update, load=0):
+        """
+        Решение по одному апдейту: "admit", "throttled", "coalesced" или "shed".
+        load — сколько обработчиков сейчас выполняется и ждёт в очереди.
+        """
+        call = getattr(update, "callback_query", None)
+        source = call or getattr(update, "message", None)
+        user = getattr(source, "from_user", None)
+        if user is None:
+            # Прочие типы апдейтов опрос не обрабатывает — пропускаем как есть
+            self._count("admitted")
+            return "admit"
+
+        if self.buckets is not None and not self.buckets.take(user.id):
+            self._count("throttled")
+            return "throttled"
+        if call is not None and self.callbacks is not None and self.callbacks.seen((user.id, call.data)):
+            self._count("coalesced")
+            return "coalesced"
+        if self.max_inflight and load >= self.max_inflight:
+            self._count("shed")
+            return "shed"
+        self._count("admitted")
+        return "admit"
+
+    def filter(self, updates, load=0):
+        """
+        Делит пачку апдейтов на (допущенные, [(апдейт, решение)] — требующие ответа).
+        Ответ нужен сброшенным по нагрузке и любым отброшенным нажатиям кнопок:
+        без answer_callback_query кнопка крутится, пока Telegram не отменит запрос.
+        """
+        admitted, replies = [], []
+        for update in updates:
+            decision = self.decide(update, load)
+            if decision == "admit":
+                admitted.append(update)
+                load += 1
+            elif decision == "shed" or getattr(update, "callback_query", None) is not None:
+                replies.append((update, decision))
+        return admitted, replies
+
+def shed_reply(update, decision="shed"):
+    """Заготовленный ответ на отброшенный апдейт: (метод API, args, kwargs)"""
+    if update.callback_query is not None:
+        # Повтор и превышение лимита — пустой ответ, только чтобы погасить кнопку
+        text = SHED_TEXT if decision == "shed" else None
+        return "answer_callback_query", (update.callback_query.id, text), {}
+    return "send_message", (update.message.chat.id, SHED_TEXT), {}
@@ -0,0 +1,144 @@
+# asgi.py
+"""
+ASGI-версия эндпоинтов server.py для асинхронного рантайма (async_bot.py).
+
+Маршруты те же, содержимое берётся из endpoints.py. Синхронные проверки
+(SQLite database.py) выполняются в пуле потоков, /_diag/db — через db_async.
+
+Запуск отдельно от бота:
+    uvicorn asgi:app --host 0.0.0.0 --port 5008
+"""
+
+import json
+import asyncio
+import logging
+from urllib.parse import parse_qsl
+
+import endpoints
+import http_cache
+
+logger = logging.getLogger(__name__)
+
+async def _home():
+    return endpoints.HOME_HTML, 200
+
+async def _diag_db():
+    try:
+        import db_async
+        import user_cache
+        from routing import router
+        count, last = await db_async.diag_summary()
+        out = endpoints.diag_payload(db_async.engine.dialect.name, count, last)
+        out["routing"] = router.status()
+        out["user_cache"] = user_cache.cache.status()
+        return out, 200
+    except Exception as e:
+        return {"ok": False, "error": str(e)}, 500
+
+def _threaded(func, *args):
+    async def handler():
+        return await asyncio.to_thread(func, *args)
+    return handler
+
+ROUTES = {
+    "/": _home,
+    "/health": _threaded(endpoints.health, "asgi"),
+    "/db-info": _threaded(endpoints.db_info),
+    "/stats": _threaded(endpoints.stats),
+    "/_diag/db": _diag_db,
+    "/_diag/spool": _threaded(endpoints.spool_status),
+    "/test-db": _threaded(endpoints.test_db),
+}
+
+# Эндпоинты с параметрами строки запроса: func(params) в пуле потоков
+QUERY_ROUTES = {
+    "/stats/rollups": endpoints.rollups_report,
+    "/broadcasts": endpoints.broadcasts,
+}
+
+# Отладочные эндпоинты (profiler.py): func(params, token), текстовый ответ
+DEBUG_ROUTES = {
+    "/_debug/profile": endpoints.debug_profile,
+    "/_debug/stacks": lambda params, token: endpoints.debug_stacks(token),
+}
+
+def _debug_token(scope, params):
+    for name, value in scope.get("headers", []):
+        if name == b"x-debug-token":
+            return value.decode("latin-1")
+    return params.get("token")
+
+async def _send_response(send, status, body: bytes, content_type: str = None, headers=()):
+    raw = [(b"content-type", content_type.encode())] if content_type else []
+    raw += [(name.lower().encode(), value.encode("latin-1")) for name, value in headers]
+    raw.append((b"content-length", str(len(body)).encode()))
+    await send({"type": "http.response.start", "status": status, "headers": raw})
+    await send({"type": "http.response.body", "body": body})
+
+def _request_headers(scope):
+    return {name.decode("latin-1").lower(): value.decode("latin-1") for name, value in scope.get("headers", [])}
+
+async def _json_route(scope, send, handler, params):
+    """JSON-ответ через http_cache.py (см. json_response в server.py)"""
+    headers = _request_headers(scope)
+    conditional = scope["path"] not in endpoints.NO_STORE
+    cache_control = "no-cache" if conditional else "no-store"
+    tables = endpoints.cache_tables(scope["path"], params) if conditional else ()
+    tag = None
+    if tables:
+        query = scope.get("query_string", b"").decode("latin-1")
+        key = scope["path"] + "?" + query
+        tag = await asyncio.to_thread(http_cache.validators, tables, key)
+    response = http_cache.lookup(tag, headers, cache_control)
+    if response is None:
+        payload, status = await handler()
+        if isinstance(payload, str):
+            await _send_response(send, status, payload.encode(), "text/html; charset=utf-8")
+            return
+        response = http_cache.render(payload, status, headers, tag, cache_control, conditional)
+    await _send_response(send, response.status, response.body if scope["method"] != "HEAD" else b"",
+                         headers=response.headers)
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def app(scope, receive, send):
+    """ASGI-приложение"""
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    handler = ROUTES.get(scope["path"])
+    params = None
+    if handler is None and scope["path"] in QUERY_ROUTES:
+        params = dict(parse_qsl(scope.get("query_string", b"").decode("latin-1")))
+        handler = _threaded(QUERY_ROUTES[scope["path"]], params)
+    if handler is None and scope["path"] in DEBUG_ROUTES:
+        params = dict(parse_qsl(scope.get("query_string", b"").decode("latin-1")))
+        payload, status = await asyncio.to_thread(
+            DEBUG_ROUTES[scope["path"]], params, _debug_token(scope, params)
+        )
+        if isinstance(payload, str):
+            await _send_response(send, status, payload.encode(), "text/plain; charset=utf-8")
+        else:
+            response = http_cache.render(payload, status, _request_headers(scope), conditional=False)
+            await _send_response(send, response.status, response.body, headers=response.headers)
+        return
+    if handler is None:
+        body = json.dumps({"error": "not found"}).encode()
+        await _send_response(send, 404, body, "application/json")
+        return
+    if scope["method"] not in ("GET", "HEAD"):
+        body = json.dumps({"error": "method not allowed"}).encode()
+        await _send_response(send, 405, body, "application/json")
+        return
+
+    await _json_route(scope, send, handler, params)
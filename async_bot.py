@@ -0,0 +1,257 @@
+# async_bot.py
+"""
+Асинхронный рантайм: AsyncTeleBot + асинхронный движок SQLAlchemy + ASGI-сервер.
+
+Сценарий опроса тот же, что и в bot.py (survey.SurveyHandlers), но каждый
+апдейт обрабатывается корутиной в одном event loop — без потока на запрос,
+поэтому один процесс держит тысячи одновременных незавершённых опросов.
+
+Запуск:
+    python async_bot.py
+"""
+
+import os
+import signal
+import asyncio
+import logging
+
+from dotenv import load_dotenv
+from telebot.async_telebot import AsyncTeleBot
+
+import db
+import database
+import db_async
+import lifecycle
+import polling
+import spool
+import tracing
+import user_cache
+from admission import Admission, shed_reply
+from idempotency import UpdateDeduplicator
+from update_log import UpdateRecorder
+from submission_guard import SubmissionGuard
+from survey import SurveyHandlers, HANDLER_SPECS, run_async, survey_record
+
+# Load environment variables
+load_dotenv()
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+class SurveyAsyncBot(AsyncTeleBot):
+    """
+    AsyncTeleBot, который до запуска обработчиков отбрасывает повторы
+    (idempotency.UpdateDeduplicator) и пропускает апдейты через admission.Admission.
+    recorder (update_log.UpdateRecorder) пишет все полученные апдейты в журнал.
+    """
+
+    deduplicator = None
+    admission = None
+    recorder = None
+
+    async def process_new_updates(self, updates):
+        received = updates or []
+        if self.recorder is not None and received:
+            self.recorder.record(received)
+        for update in received:
+            tracing.begin_update(update)
+        if self.deduplicator is not None and updates:
+            if self.deduplicator.shared is not None:
+                updates = await asyncio.to_thread(self.deduplicator.filter, updates)
+            else:
+                updates = self.deduplicator.filter(updates)
+        if self.admission is not None and updates:
+            updates, replies = self.admission.filter(updates, _inflight)
+            for update, decision in replies:
+                tracing.end_update(update, decision)
+                _send_shed_reply(self, update, decision)
+        if len(updates) != len(received):
+            tracing.end_dropped(received, updates)
+        await super().process_new_updates(updates)
+
+# Ответы на сброшенные по нагрузке апдейты (ссылки держим, пока задачи не завершатся)
+_shed_tasks = set()
+SHED_REPLIES_MAX = 100
+
+def _send_shed_reply(target, update, decision="shed"):
+    """Cheap canned reply for a shed update or an empty answer for a dropped button press."""
+    if len(_shed_tasks) >= SHED_REPLIES_MAX:
+        return
+    method, args, kwargs = shed_reply(update, decision)
+
+    async def send():
+        try:
+            await getattr(target, method)(*args, **kwargs)
+        except Exception as e:
+            logger.warning(f"shed reply failed: {e}")
+
+    task = asyncio.create_task(send())
+    _shed_tasks.add(task)
+    task.add_done_callback(_shed_tasks.discard)
+
+tracing.instrument_sqlalchemy()
+
+bot = SurveyAsyncBot(os.environ.get('TELEGRAM_BOT_TOKEN'))
+bot.deduplicator = UpdateDeduplicator.from_env()
+bot.admission = Admission.from_env()
+bot.recorder = UpdateRecorder.from_env()
+submission_guard = SubmissionGuard.from_env()
+# Автомат и spool как в bot.py; перенос из spool — синхронным движком в потоке
+db_writer = spool.SpooledWriter.from_env(db.save_survey_response)
+survey_handlers = SurveyHandlers()
+user_states = survey_handlers.states
+
+async def save_survey_data(user_id, data, idempotency_key=None):
+    """Save survey data to database (async engine)."""
+    try:
+        full_name, birth_date, citizenship = survey_record(data)
+        new_id = await db_writer.save_async(db_async.save_survey_response, user_id=user_id,
+                                            full_name=full_name, birth_date=birth_date, citizenship=citizenship,
+                                            dedup_key=submission_guard.dedup_key(user_id),
+                                            idempotency_key=idempotency_key)
+        submission_guard.record(user_id)
+        if new_id is None:
+            logger.info(f"Survey data for user {user_id} spooled until the database recovers")
+        else:
+            logger.info(f"Survey data saved successfully for user {user_id} with ID {new_id}")
+        return True
+    except db.DuplicateSubmission:
+        submission_guard.record(user_id)
+        logger.warning(f"Duplicate survey submission ignored for user {user_id}")
+        return True
+    except Exception as e:
+        logger.error(f"Error saving survey data: {e}")
+        return False
+
+async def is_duplicate(user_id):
+    """Async variant of SubmissionGuard.is_duplicate."""
+    answer = submission_guard.cached_answer(user_id)
+    if answer is not None:
+        return answer
+    submitted_at = await db_async.last_submitted_at(user_id, since=submission_guard.window_start())
+    return submission_guard.remember(user_id, submitted_at)
+
+# Обработчики, выполняющиеся прямо сейчас (для корректной остановки)
+_inflight = 0
+_idle = asyncio.Event()
+_idle.set()
+
+SURVEY_EFFECTS = {
+    "save_survey": save_survey_data,
+    "is_duplicate": is_duplicate,
+}
+
+def setup_handlers(target=None, handlers=None):
+    """Register survey handlers on an AsyncTeleBot."""
+    target = bot if target is None else target
+    handlers = survey_handlers if handlers is None else handlers
+
+    for kind, filters, name in HANDLER_SPECS:
+        method = getattr(handlers, name)
+
+        async def callback(update, _method=method, _name=name):
+            global _inflight
+            _inflight += 1
+            _idle.clear()
+            ok = False
+            try:
+                with tracing.resume_update(update), tracing.span("handler." + _name):
+                    await run_async(_method(update), target, SURVEY_EFFECTS)
+                ok = True
+            finally:
+                # Обработанным апдейт считается только после обработчика (idempotency.py)
+                dedup = getattr(target, "deduplicator", None)
+                if dedup is not None:
+                    if dedup.shared is not None:
+                        await asyncio.to_thread(dedup.finish, update, ok)
+                    else:
+                        dedup.finish(update, ok)
+                _inflight -= 1
+                if not _inflight:
+                    _idle.set()
+
+        callback.__name__ = name
+        if kind == "callback_query":
+            target.register_callback_query_handler(callback, **filters)
+        else:
+            target.register_message_handler(callback, **filters)
+
+def create_http_server():
+    """ASGI-сервер с эндпоинтами server.py"""
+    import uvicorn
+    from asgi import app
+
+    port = int(os.environ.get("PORT", 5008))
+    logger.info(f"Запуск ASGI сервера на порту {port}")
+    config = uvicorn.Config(app, host="0.0.0.0", port=port, log_level="info")
+    return uvicorn.Server(config)
+
+# Тот же драйвер, что у bot.py (polling.py): allowed_updates, адаптивный таймаут,
+# накопившаяся очередь разбирается, а не пропускается
+poller = polling.AsyncPoller(bot, name="async-bot")
+
+async def run_polling():
+    """Long polling AsyncTeleBot via polling.AsyncPoller."""
+    try:
+        await bot.remove_webhook()
+    except Exception as _e:
+        logger.warning(f"remove_webhook warn: {_e}")
+    await poller.run()
+
+async def _drain(polling_task):
+    # Отмена run() подтверждает розданные апдейты; затем ждём их обработки
+    await asyncio.gather(polling_task, return_exceptions=True)
+    await poller.wait_idle()
+    await _idle.wait()
+
+async def shutdown(polling_task):
+    """stop_accepting -> drain -> flush -> snapshot (см. lifecycle.py)"""
+    poller.stop()
+    polling_task.cancel()
+    try:
+        await asyncio.wait_for(_drain(polling_task), timeout=lifecycle.SHUTDOWN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning(f"Не все обработчики успели завершиться: in-flight={_inflight}")
+    logger.info(f"admission stats: {bot.admission.stats}")
+    logger.info(f"idempotency stats: {bot.deduplicator.stats}")
+    await asyncio.to_thread(db_writer.flush)
+    await asyncio.to_thread(tracing.flush)
+    if bot.recorder is not None:
+        bot.recorder.close()
+    try:
+        lifecycle.save_states(user_states)
+    except Exception as e:
+        logger.error(f"Error saving survey states: {e}")
+
+def _note_signal(signum, _frame):
+    logger.info(f"Получен сигнал {signal.Signals(signum).name}")
+
+async def main():
+    # Схема создаётся синхронно один раз при старте
+    await asyncio.to_thread(db.init_db)
+    await asyncio.to_thread(database.init_db)
+    for user_id, state in lifecycle.load_states().items():
+        user_states.setdefault(user_id, state)
+    setup_handlers()
+    user_cache.start_channel()
+    db_writer.start()
+
+    # uvicorn сам ловит SIGTERM/SIGINT и завершает serve(); затем останавливаем бота.
+    # Свой обработчик нужен, чтобы повторно поднятый uvicorn сигнал не убил процесс до drain.
+    signal.signal(signal.SIGTERM, _note_signal)
+    signal.signal(signal.SIGINT, _note_signal)
+
+    server = create_http_server()
+    polling_task = asyncio.create_task(run_polling())
+    try:
+        await server.serve()
+    finally:
+        await shutdown(polling_task)
+        await bot.close_session()
+        await db_async.engine.dispose()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,19 +1,22 @@
 import telebot
-from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton
 import os
 import logging
-import re
+import threading
 import time
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import db
+import lifecycle
+import polling
+import spool
+import tracing
+import transport
+from admission import Admission, shed_reply
+from idempotency import UpdateDeduplicator
+from update_log import UpdateRecorder
 from data_generator import PersonalDataGenerator
-
-try:
-    from telebot.apihelper import ApiTelegramException
-except Exception:
-    class ApiTelegramException(Exception):
-        error_code = None
+from submission_guard import SubmissionGuard
+from survey import SurveyHandlers, HANDLER_SPECS, run_sync, survey_record
 
 # Load environment variables
 load_dotenv()
@@ -22,158 +25,123 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class SurveyBot(telebot.TeleBot):
+    """
+    TeleBot, который до постановки в пул воркеров отбрасывает повторы
+    (idempotency.UpdateDeduplicator) и пропускает апдейты через admission.Admission.
+    recorder (update_log.UpdateRecorder) пишет все полученные апдейты в журнал.
+    """
+
+    deduplicator = None
+    admission = None
+    recorder = None
+
+    def process_new_updates(self, updates):
+        if not updates:
+            return
+        received = updates
+        if self.recorder is not None:
+            self.recorder.record(updates)
+        for update in received:
+            tracing.begin_update(update)
+        if self.deduplicator is not None:
+            updates = self.deduplicator.filter(updates)
+        if self.admission is not None and updates:
+            updates, replies = self.admission.filter(updates, self.load())
+            for update, decision in replies:
+                tracing.end_update(update, decision)
+                _send_shed_reply(self, update, decision)
+        if len(updates) != len(received):
+            tracing.end_dropped(received, updates)
+            # Отброшенные апдейты тоже подтверждаем, иначе getUpdates вернёт их снова
+            self.last_update_id = max(self.last_update_id, max(u.update_id for u in received))
+        super().process_new_updates(updates)
+
+    def load(self):
+        """Нагрузка для admission: выполняющиеся и ожидающие в пуле обработчики"""
+        return _inflight + _pending_tasks(self)
+
 # Initialize bot
-bot = telebot.TeleBot(os.environ.get('TELEGRAM_BOT_TOKEN'))
+tracing.instrument_sqlalchemy()
+
+bot = SurveyBot(os.environ.get('TELEGRAM_BOT_TOKEN'), threaded=False)
+# Обработчики на пуле с порядком по пользователю (polling.KeyedPool вместо util.ThreadPool)
+bot.threaded = True
+bot.worker_pool = polling.KeyedPool(bot.exception_handler, polling.POLL_WORKERS)
+# Пул соединений к Telegram API: воркеры обработчиков, поток polling и ответы при сбросе нагрузки
+transport.install(pool_size=bot.worker_pool.num_threads + 2)
+bot.deduplicator = UpdateDeduplicator.from_env()
+bot.admission = Admission.from_env()
+bot.recorder = UpdateRecorder.from_env()
 data_generator = PersonalDataGenerator()
+submission_guard = SubmissionGuard.from_env()
+# Запись анкет через автомат: при недоступной БД — в локальный spool (spool.py)
+db_writer = spool.SpooledWriter.from_env(db.save_survey_response)
 
 # User states for survey
 user_states = {}  # {user_id: {'state': 'waiting_name', 'data': {}}
+survey_handlers = SurveyHandlers(user_states, data_generator)
 
 # Модульный флаг для защиты от двойного запуска
 BOT_RUNNING = False
+# polling.Poller запущенного run_bot
+poller = None
 
-def create_main_menu_keyboard():
-    """Создает главное меню с красивыми кнопками."""
-    keyboard = InlineKeyboardMarkup(row_width=2)
-    
-    keyboard.add(
-        InlineKeyboardButton("📝 Начать опрос", callback_data="start_survey"),
-        InlineKeyboardButton("📚 Справка", callback_data="help_info")
-    )
-    keyboard.add(
-        InlineKeyboardButton("❌ Отменить опрос", callback_data="cancel_survey"),
-        InlineKeyboardButton("🔄 Новый опрос", callback_data="new_survey")
-    )
-    
-    return keyboard
+# Счётчик обработчиков, выполняющихся прямо сейчас (для корректной остановки)
+_inflight = 0
+_inflight_cond = threading.Condition()
+# Запрошена остановка: run_bot не должен (пере)запускать polling
+_stop_requested = threading.Event()
 
-def create_citizenship_keyboard():
-    """Создает клавиатуру для выбора гражданства."""
-    keyboard = InlineKeyboardMarkup(row_width=2)
-    
-    keyboard.add(
-        InlineKeyboardButton("🇷🇺 Россия", callback_data="citizenship_Россия"),
-        InlineKeyboardButton("🇺🇦 Украина", callback_data="citizenship_Украина")
-    )
-    keyboard.add(
-        InlineKeyboardButton("🇧🇾 Беларусь", callback_data="citizenship_Беларусь"),
-        InlineKeyboardButton("🇰🇿 Казахстан", callback_data="citizenship_Казахстан")
-    )
-    keyboard.add(
-        InlineKeyboardButton("🇦🇲 Армения", callback_data="citizenship_Армения"),
-        InlineKeyboardButton("🇦🇿 Азербайджан", callback_data="citizenship_Азербайджан")
-    )
-    keyboard.add(
-        InlineKeyboardButton("🇬🇪 Грузия", callback_data="citizenship_Грузия"),
-        InlineKeyboardButton("🇲🇩 Молдова", callback_data="citizenship_Молдова")
-    )
-    keyboard.add(
-        InlineKeyboardButton("✏️ Другое", callback_data="citizenship_custom")
-    )
-    
-    return keyboard
+# Ответы на сброшенные по нагрузке апдейты уходят отдельным потоком, не занимая воркеры
+_shed_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shed-reply")
+_shed_pending = threading.BoundedSemaphore(100)
 
-def create_date_format_keyboard():
-    """Создает клавиатуру с примерами формата даты."""
-    keyboard = InlineKeyboardMarkup(row_width=2)
-    
-    keyboard.add(
-        InlineKeyboardButton("📅 15.03.1990", callback_data="date_example_15.03.1990"),
-        InlineKeyboardButton("📅 22.07.1985", callback_data="date_example_22.07.1985")
-    )
-    keyboard.add(
-        InlineKeyboardButton("📅 08.12.1995", callback_data="date_example_08.12.1995"),
-        InlineKeyboardButton("📅 30.01.1980", callback_data="date_example_30.01.1980")
-    )
-    keyboard.add(
-        InlineKeyboardButton("✏️ Ввести вручную", callback_data="date_manual")
-    )
-    
-    return keyboard
+def _send_shed_reply(target, update, decision="shed"):
+    """Cheap canned reply for a shed update or an empty answer for a dropped button press."""
+    if not _shed_pending.acquire(blocking=False):
+        return  # очередь ответов тоже переполнена — молча отбрасываем
+    method, args, kwargs = shed_reply(update, decision)
 
-def create_survey_progress_keyboard():
-    """Создает клавиатуру для отображения прогресса опроса."""
-    keyboard = InlineKeyboardMarkup(row_width=1)
-    
-    keyboard.add(
-        InlineKeyboardButton("📊 Показать прогресс", callback_data="show_progress"),
-        InlineKeyboardButton("❌ Отменить опрос", callback_data="cancel_survey"),
-        InlineKeyboardButton("🔄 Начать заново", callback_data="restart_survey")
-    )
-    
-    return keyboard
+    def send():
+        try:
+            getattr(target, method)(*args, **kwargs)
+        except Exception as e:
+            logger.warning(f"shed reply failed: {e}")
+        finally:
+            _shed_pending.release()
 
-def create_new_survey_keyboard():
-    """Создает клавиатуру для завершения опроса с кнопкой нового опроса."""
-    keyboard = InlineKeyboardMarkup(row_width=1)
-    
-    keyboard.add(
-        InlineKeyboardButton("🚀 Начать новый опрос", callback_data="new_survey")
-    )
-    
-    return keyboard
+    _shed_pool.submit(send)
 
-def save_survey_data(user_id, data):
+def save_survey_data(user_id, data, idempotency_key=None, guard=None, tenant_id=None):
     """Save survey data to database."""
+    # Бот-арендатор (tenants.py) передаёт свои guard и tenant_id
+    guard = submission_guard if guard is None else guard
+    if tenant_id is not None and idempotency_key is not None:
+        idempotency_key = f"{tenant_id}:{idempotency_key}"
     try:
         # Сохраняем только данные пользователя в новую БД
-        full_name = data.get('full_name', '')
-        birth_date = data.get('birth_date', '')
-        citizenship = data.get('citizenship', '')
-        
-        # Конвертируем дату из формата ДД.ММ.ГГГГ в формат для PostgreSQL
-        if birth_date:
-            try:
-                # Парсим дату и конвертируем в формат YYYY-MM-DD
-                parsed_date = datetime.strptime(birth_date, '%d.%m.%Y')
-                birth_date = parsed_date.strftime('%Y-%m-%d')
-            except ValueError:
-                logger.error(f"Invalid date format: {birth_date}")
-                birth_date = None
-        
+        full_name, birth_date, citizenship = survey_record(data)
+
         # Сохраняем в базу данных
-        new_id = db.save_survey_response(user_id, full_name, birth_date, citizenship)
-        logger.info(f"Survey data saved successfully for user {user_id} with ID {new_id}")
+        new_id = db_writer.save(user_id=user_id, full_name=full_name, birth_date=birth_date,
+                                citizenship=citizenship, dedup_key=guard.dedup_key(user_id),
+                                idempotency_key=idempotency_key, tenant_id=tenant_id)
+        guard.record(user_id)
+        if new_id is None:
+            logger.info(f"Survey data for user {user_id} spooled until the database recovers")
+        else:
+            logger.info(f"Survey data saved successfully for user {user_id} with ID {new_id}")
+        return True
+    except db.DuplicateSubmission:
+        # Повтор того же апдейта или параллельная отправка в том же окне: запись уже есть
+        guard.record(user_id)
+        logger.warning(f"Duplicate survey submission ignored for user {user_id}")
         return True
     except Exception as e:
         logger.error(f"Error saving survey data: {e}")
         return False
 
-def create_survey_report(data):
-    """Create survey completion report showing only user-entered data."""
-    # Определяем поля, которые пользователь ввел сам
-    user_entered_fields = {
-        'full_name': '👤 ФИО',
-        'birth_date': '📅 Дата рождения', 
-        'citizenship': '🌍 Гражданство'
-    }
-    
-    # Определяем поля, которые заполняются автоматически
-    auto_filled_fields = {
-        'phone_number': '📱 Телефон',
-        'email': '📧 Email',
-        'address': '🏠 Адрес',
-        'passport_series': '📄 Паспорт (серия)',
-        'passport_number': '📄 Паспорт (номер)',
-        'education': '🎓 Образование',
-        'occupation': '💼 Профессия',
-        'income_level': '💰 Уровень дохода',
-        'marital_status': '💍 Семейное положение',
-        'children_count': '👶 Дети'
-    }
-    
-    # Формируем отчет только с данными пользователя
-    report = "🎉 Опрос завершен успешно!\n\n"
-    report += "📋 Введенные вами данные:\n"
-    
-    for field, label in user_entered_fields.items():
-        if field in data and data[field]:
-            report += f"{label}: {data[field]}\n"
-    
-    report += "\n✅ Все данные сохранены в базе данных!"
-    
-    return report
-
 def setup_database():
     """Setup database connection."""
     try:
@@ -185,401 +153,102 @@ def setup_database():
         logger.error(f"Database connection error: {e}")
         return False
 
-def setup_handlers():
+# Побочные эффекты сценария опроса для синхронного рантайма (см. survey.py)
+SURVEY_EFFECTS = {
+    "save_survey": save_survey_data,
+    "is_duplicate": submission_guard.is_duplicate,
+}
+
+def setup_handlers(target=None, handlers=None, effects=None):
     """Setup all bot message handlers."""
-    def handle_start_survey(message, user_id):
-        """Handle start survey button."""
-        user_states[user_id] = {'state': 'waiting_name', 'data': {}}
-        
-        bot.edit_message_text(
-            "📝 Начинаем опрос!\n\n"
-            "🌍 Вопрос 1: Введите ваше полное ФИО\n\n"
-            "Пример: Иванов Иван Иванович",
-            chat_id=message.chat.id,
-            message_id=message.message_id
-        )
-        
-        # Отправляем сообщение с просьбой ввести ФИО
-        bot.send_message(message.chat.id, "✍️ Введите ваше ФИО:")
-
-    def handle_help_info(message):
-        """Handle help info button."""
-        help_text = (
-            "📚 Справка по боту\n\n"
-            "Этот бот предназначен для сбора персональных данных через форму опроса.\n\n"
-            "Команды:\n"
-            "• /start - Начать опрос персональных данных\n"
-            "• /help - Эта справка\n"
-            "• /cancel - Отменить текущий опрос\n\n"
-            "Процесс опроса:\n"
-            "1. Введите ФИО\n"
-            "2. Введите дату рождения (ДД.ММ.ГГГГ)\n"
-            "3. Укажите гражданство\n"
-            "4. Получите отчет с вашими данными"
-        )
-        bot.edit_message_text(help_text, chat_id=message.chat.id, message_id=message.message_id)
-
-    def handle_cancel_survey(message, user_id):
-        """Handle cancel survey button."""
-        if user_id in user_states:
-            del user_states[user_id]
-            bot.edit_message_text("❌ Опрос отменен.", chat_id=message.chat.id, message_id=message.message_id)
-            bot.send_message(message.chat.id, "Используйте /start для начала нового опроса.")
-        else:
-            bot.answer_callback_query(message.id, "❌ У вас нет активного опроса.")
+    target = bot if target is None else target
+    handlers = survey_handlers if handlers is None else handlers
+    effects = SURVEY_EFFECTS if effects is None else effects
 
-    def handle_new_survey(message, user_id):
-        """Handle new survey button."""
-        # Сбрасываем состояние и начинаем заново
-        user_states[user_id] = {'state': 'waiting_name', 'data': {}}
-        
-        bot.edit_message_text(
-            "🔄 Начинаем новый опрос!\n\n"
-            "🌍 Вопрос 1: Введите ваше полное ФИО\n\n"
-            "Пример: Иванов Иван Иванович",
-            chat_id=message.chat.id,
-            message_id=message.message_id
-        )
-        
-        bot.send_message(message.chat.id, "✍️ Введите ваше ФИО:")
+    for kind, filters, name in HANDLER_SPECS:
+        method = getattr(handlers, name)
 
-    def handle_show_progress(message, user_id):
-        """Handle show progress button."""
-        if user_id not in user_states:
-            bot.answer_callback_query(message.id, "❌ У вас нет активного опроса.")
-            return
-        
-        current_state = user_states[user_id]['state']
-        data = user_states[user_id]['data']
-        
-        progress_text = "📊 Прогресс опроса:\n\n"
-        
-        if 'full_name' in data:
-            progress_text += f"✅ ФИО: {data['full_name']}\n"
-        else:
-            progress_text += "❌ ФИО: не заполнено\n"
-        
-        if 'birth_date' in data:
-            progress_text += f"✅ Дата рождения: {data['birth_date']}\n"
-        else:
-            progress_text += "❌ Дата рождения: не заполнено\n"
-        
-        if 'citizenship' in data:
-            progress_text += f"✅ Гражданство: {data['citizenship']}\n"
+        def callback(update, _method=method, _name=name):
+            global _inflight
+            with _inflight_cond:
+                _inflight += 1
+            ok = False
+            try:
+                with tracing.resume_update(update), tracing.span("handler." + _name):
+                    run_sync(_method(update), target, effects)
+                ok = True
+            finally:
+                # Обработанным апдейт считается только после обработчика (idempotency.py)
+                dedup = getattr(target, "deduplicator", None)
+                if dedup is not None:
+                    dedup.finish(update, ok)
+                with _inflight_cond:
+                    _inflight -= 1
+                    _inflight_cond.notify_all()
+
+        callback.__name__ = name
+        if kind == "callback_query":
+            target.register_callback_query_handler(callback, **filters)
         else:
-            progress_text += "❌ Гражданство: не заполнено\n"
-        
-        progress_text += f"\n🎯 Текущий этап: {current_state}"
-        
-        bot.edit_message_text(progress_text, chat_id=message.chat.id, message_id=message.message_id)
+            target.register_message_handler(callback, **filters)
 
-    def handle_restart_survey(message, user_id):
-        """Handle restart survey button."""
-        # Сбрасываем состояние и начинаем заново
-        user_states[user_id] = {'state': 'waiting_name', 'data': {}}
-        
-        bot.edit_message_text(
-            "🔄 Опрос перезапущен!\n\n"
-            "🌍 Вопрос 1: Введите ваше полное ФИО\n\n"
-            "Пример: Иванов Иван Иванович",
-            chat_id=message.chat.id,
-            message_id=message.message_id
-        )
-        
-        bot.send_message(message.chat.id, "✍️ Введите ваше ФИО:")
+def _pending_tasks(target):
+    pool = getattr(target, "worker_pool", None)
+    return 0 if pool is None else pool.tasks.qsize()
 
-    def handle_citizenship_selection(message, user_id, citizenship):
-        """Handle citizenship selection from keyboard."""
-        user_states[user_id]['data']['citizenship'] = citizenship
-        user_states[user_id]['state'] = 'completed'
-        
-        # Генерируем случайные данные
-        full_name = user_states[user_id]['data']['full_name']
-        random_data = data_generator.generate_all_random_data(full_name)
-        
-        # Объединяем все данные
-        all_data = {**user_states[user_id]['data'], **random_data}
-        
-        # Сохраняем в базу данных
-        if save_survey_data(user_id, all_data):
-            # Формируем отчет
-            report = create_survey_report(all_data)
-            bot.edit_message_text("✅ Гражданство выбрано!", chat_id=message.chat.id, message_id=message.message_id)
-            bot.send_message(message.chat.id, report, reply_markup=create_new_survey_keyboard())
-            
-            # Очищаем состояние пользователя
-            del user_states[user_id]
-        else:
-            bot.edit_message_text("❌ Ошибка при сохранении данных.", chat_id=message.chat.id, message_id=message.message_id)
+def drain_handlers(timeout=20.0, target=None):
+    """
+    Ждёт завершения обработчиков: и уже выполняющихся, и стоящих в очереди пула.
+    Возвращает True, если всё успело завершиться до дедлайна.
+    """
+    target = bot if target is None else target
+    deadline = time.monotonic() + timeout
+    with _inflight_cond:
+        while _inflight or _pending_tasks(target):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                logger.warning(f"drain_handlers: timeout, in-flight={_inflight}, queued={_pending_tasks(target)}")
+                return False
+            _inflight_cond.wait(min(remaining, 0.1))
+    return True
 
-    def handle_custom_citizenship(message, user_id):
-        """Handle custom citizenship input request."""
-        user_states[user_id]['state'] = 'waiting_custom_citizenship'
-        
-        bot.edit_message_text(
-            "✏️ Введите ваше гражданство вручную:",
-            chat_id=message.chat.id,
-            message_id=message.message_id
-        )
-
-    def handle_date_example(message, user_id, date_example):
-        """Handle date example selection."""
-        user_states[user_id]['data']['birth_date'] = date_example
-        user_states[user_id]['state'] = 'waiting_citizenship'
-        
-        citizenship_text = (
-            f"✅ Дата рождения выбрана: {date_example}\n\n"
-            f"🌍 Вопрос 3: Укажите ваше гражданство\n\n"
-            "Выберите из списка или введите вручную:"
-        )
-        
-        bot.edit_message_text(citizenship_text, chat_id=message.chat.id, message_id=message.message_id)
-        bot.send_message(message.chat.id, "Выберите гражданство:", reply_markup=create_citizenship_keyboard())
+def stop_bot(timeout=20.0):
+    """Прекращает приём апдейтов и дожидается завершения обработчиков."""
+    _stop_requested.set()
+    return drain_handlers(timeout)
 
-    def handle_date_manual(message, user_id):
-        """Handle manual date input request."""
-        user_states[user_id]['state'] = 'waiting_birth_date'
-        
-        bot.edit_message_text(
-            "✏️ Введите дату рождения в формате ДД.ММ.ГГГГ\n\n"
-            "Пример: 15.03.1990",
-            chat_id=message.chat.id,
-            message_id=message.message_id
-        )
-
-    def handle_name_input(message, text):
-        """Handle full name input."""
-        user_id = message.from_user.id
-        
-        # Проверяем, что введено ФИО (минимум 2 слова)
-        if len(text.split()) < 2:
-            bot.reply_to(message, "❌ Пожалуйста, введите полное ФИО (например: Иванов Иван Иванович)")
-            return
-        
-        # Сохраняем ФИО
-        user_states[user_id]['data']['full_name'] = text
-        user_states[user_id]['state'] = 'waiting_birth_date'
-        
-        bot.reply_to(message, 
-            f"✅ ФИО сохранено: {text}\n\n"
-            f"📅 Вопрос 2: Какая дата рождения?\n"
-            f"Введите в формате ДД.ММ.ГГГГ (например: 15.03.1990)",
-            reply_markup=create_date_format_keyboard()
-        )
-
-    def handle_birth_date_input(message, text):
-        """Handle birth date input."""
-        user_id = message.from_user.id
-        
-        # Проверяем формат даты (ДД.ММ.ГГГГ)
-        date_pattern = r'^\d{2}\.\d{2}\.\d{4}$'
-        if not re.match(date_pattern, text):
-            bot.reply_to(message, "❌ Неверный формат даты! Используйте формат ДД.ММ.ГГГГ (например: 15.03.1990)")
-            return
-        
-        try:
-            # Парсим дату для проверки корректности
-            birth_date = datetime.strptime(text, '%d.%m.%Y')
-            
-            # Проверяем, что дата не в будущем и не слишком старая
-            if birth_date > datetime.now():
-                bot.reply_to(message, "❌ Дата рождения не может быть в будущем!")
-                return
-            
-            if birth_date.year < 1900:
-                bot.reply_to(message, "❌ Дата рождения не может быть раньше 1900 года!")
-                return
-            
-            # Сохраняем дату рождения
-            user_states[user_id]['data']['birth_date'] = text
-            user_states[user_id]['state'] = 'waiting_citizenship'
-            
-            citizenship_text = (
-                f"✅ Дата рождения сохранена: {text}\n\n"
-                f"🌍 Вопрос 3: Укажите ваше гражданство\n\n"
-                "Выберите из списка или введите вручную:"
-            )
-            
-            bot.reply_to(message, citizenship_text, reply_markup=create_citizenship_keyboard())
-            
-        except ValueError:
-            bot.reply_to(message, "❌ Неверная дата! Проверьте правильность введенной даты.")
-
-    def handle_citizenship_input(message, text):
-        """Handle citizenship input."""
-        user_id = message.from_user.id
-        
-        # Проверяем, что введено гражданство
-        if len(text.strip()) < 2:
-            bot.reply_to(message, "❌ Пожалуйста, введите ваше гражданство.")
-            return
-        
-        # Сохраняем гражданство
-        user_states[user_id]['data']['citizenship'] = text.strip()
-        
-        # Генерируем случайные данные
-        full_name = user_states[user_id]['data']['full_name']
-        random_data = data_generator.generate_all_random_data(full_name)
-        
-        # Объединяем все данные
-        all_data = {**user_states[user_id]['data'], **random_data}
-        
-        # Сохраняем в базу данных
-        if save_survey_data(user_id, all_data):
-            # Формируем отчет
-            report = create_survey_report(all_data)
-            bot.reply_to(message, report, reply_markup=create_new_survey_keyboard())
-            
-            # Очищаем состояние пользователя
-            del user_states[user_id]
-        else:
-            bot.reply_to(message, "❌ Ошибка при сохранении данных. Попробуйте еще раз или используйте /cancel")
+def register_shutdown_hooks(manager):
+    """Подключает бота к lifecycle.Lifecycle: остановка polling, drain, снимок состояний."""
+    # polling.Poller выходит после текущего getUpdates, полученное после остановки не раздаёт
+    manager.on("stop_accepting", lambda _timeout: _stop_requested.set(), "bot.stop_polling")
+    manager.on("drain", lambda timeout: drain_handlers(timeout), "bot.drain_handlers")
+    if bot.admission is not None:
+        manager.on("drain", lambda _timeout: logger.info(f"admission stats: {bot.admission.stats}"), "bot.admission_stats")
+    if bot.deduplicator is not None:
+        manager.on("drain", lambda _timeout: logger.info(f"idempotency stats: {bot.deduplicator.stats}"), "bot.idempotency_stats")
+    manager.on("drain", lambda _timeout: logger.info(f"telegram api stats: {transport.stats()}"), "transport.stats")
+    manager.on("flush", db_writer.flush, "spool.flush")
+    manager.on("flush", tracing.flush, "tracing.flush")
+    if bot.recorder is not None:
+        manager.on("flush", bot.recorder.close, "update_log.close")
+    manager.on("snapshot", lambda _timeout: lifecycle.save_states(user_states), "bot.save_states")
 
-    def handle_custom_citizenship_input(message, text):
-        """Handle custom citizenship input."""
-        user_id = message.from_user.id
-        
-        # Проверяем, что введено гражданство
-        if len(text.strip()) < 2:
-            bot.reply_to(message, "❌ Пожалуйста, введите ваше гражданство.")
-            return
-        
-        # Сохраняем гражданство
-        user_states[user_id]['data']['citizenship'] = text.strip()
-        
-        # Генерируем случайные данные
-        full_name = user_states[user_id]['data']['full_name']
-        random_data = data_generator.generate_all_random_data(full_name)
-        
-        # Объединяем все данные
-        all_data = {**user_states[user_id]['data'], **random_data}
-        
-        # Сохраняем в базу данных
-        if save_survey_data(user_id, all_data):
-            # Формируем отчет
-            report = create_survey_report(all_data)
-            bot.reply_to(message, report, reply_markup=create_new_survey_keyboard())
-            
-            # Очищаем состояние пользователя
-            del user_states[user_id]
-        else:
-            bot.reply_to(message, "❌ Ошибка при сохранении данных. Попробуйте еще раз или используйте /cancel")
-    
-    @bot.message_handler(commands=['start'])
-    def start_command(message):
-        """Handle /start command."""
-        user_id = message.from_user.id
-        
-        # Сбрасываем состояние пользователя
-        user_states[user_id] = {'state': 'main_menu', 'data': {}}
-        
-        welcome_text = (
-            "👋 Добро пожаловать в Бот Опроса Персональных Данных!\n\n"
-            "🎯 Я помогу вам заполнить форму опроса с красивым интерфейсом!\n\n"
-            "📋 Что вас ждет:\n"
-            "• 📝 3 простых вопроса\n"
-            "• 🎨 Стильные кнопки для выбора\n"
-            "• 📊 Красивый отчет по завершении\n\n"
-            "Выберите действие:"
-        )
-        
-        bot.reply_to(message, welcome_text, reply_markup=create_main_menu_keyboard())
-    
-    @bot.message_handler(commands=['help'])
-    def help_command(message):
-        """Handle /help command."""
-        help_text = (
-            "📚 Справка по боту\n\n"
-            "Этот бот предназначен для сбора персональных данных через форму опроса.\n\n"
-            "Команды:\n"
-            "• /start - Начать опрос персональных данных\n"
-            "• /help - Эта справка\n"
-            "• /cancel - Отменить текущий опрос\n\n"
-            "Процесс опроса:\n"
-            "1. Введите ФИО\n"
-            "2. Введите дату рождения (ДД.ММ.ГГГГ)\n"
-            "3. Укажите гражданство\n"
-            "4. Получите отчет с вашими данными"
-        )
-        bot.reply_to(message, help_text)
-    
-    @bot.message_handler(commands=['cancel'])
-    def cancel_command(message):
-        """Handle /cancel command."""
-        user_id = message.from_user.id
-        
-        if user_id in user_states:
-            del user_states[user_id]
-            bot.reply_to(message, "❌ Опрос отменен. Используйте /start для начала нового опроса.")
-        else:
-            bot.reply_to(message, "❌ У вас нет активного опроса.")
-    
-    @bot.callback_query_handler(func=lambda call: True)
-    def handle_callback_query(call):
-        """Handle all callback queries from inline keyboards."""
-        user_id = call.from_user.id
-        data = call.data
-        
-        try:
-            if data == "start_survey":
-                handle_start_survey(call.message, user_id)
-            elif data == "help_info":
-                handle_help_info(call.message)
-            elif data == "cancel_survey":
-                handle_cancel_survey(call.message, user_id)
-            elif data == "new_survey":
-                handle_new_survey(call.message, user_id)
-            elif data == "show_progress":
-                handle_show_progress(call.message, user_id)
-            elif data == "restart_survey":
-                handle_restart_survey(call.message, user_id)
-            elif data.startswith("citizenship_"):
-                citizenship = data.replace("citizenship_", "")
-                if citizenship == "custom":
-                    handle_custom_citizenship(call.message, user_id)
-                else:
-                    handle_citizenship_selection(call.message, user_id, citizenship)
-            elif data.startswith("date_example_"):
-                date_example = data.replace("date_example_", "")
-                handle_date_example(call.message, user_id, date_example)
-            elif data == "date_manual":
-                handle_date_manual(call.message, user_id)
-            
-            # Отвечаем на callback query
-            bot.answer_callback_query(call.id)
-            
-        except Exception as e:
-            logger.error(f"Error handling callback query: {e}")
-            bot.answer_callback_query(call.id, "❌ Произошла ошибка")
-    
-    @bot.message_handler(func=lambda message: True)
-    def handle_survey_messages(message):
-        """Handle survey responses."""
-        user_id = message.from_user.id
-        text = message.text.strip()
-        
-        # Проверяем, есть ли активный опрос
-        if user_id not in user_states:
-            bot.reply_to(message, "💬 Используйте /start для начала опроса.")
-            return
-        
-        current_state = user_states[user_id]['state']
-        
-        if current_state == 'waiting_name':
-            handle_name_input(message, text)
-        elif current_state == 'waiting_birth_date':
-            handle_birth_date_input(message, text)
-        elif current_state == 'waiting_citizenship':
-            handle_citizenship_input(message, text)
-        elif current_state == 'waiting_custom_citizenship':
-            handle_custom_citizenship_input(message, text)
-        else:
-            bot.reply_to(message, "❌ Неизвестное состояние. Используйте /start для начала нового опроса.")
+def restore_states():
+    """Восстанавливает незавершённые опросы из снимка, сделанного при остановке."""
+    try:
+        restored = lifecycle.load_states()
+    except Exception as e:
+        logger.error(f"Error restoring survey states: {e}")
+        return 0
+    for user_id, state in restored.items():
+        # Более свежее состояние (если пользователь уже написал) не затираем
+        user_states.setdefault(user_id, state)
+    return len(restored)
 
 # --- универсальный запуск бота ---
 def run_bot():
     """Запуск телеграм-бота."""
-    global BOT_RUNNING
+    global BOT_RUNNING, poller
     if BOT_RUNNING:
         print("run_bot: already running, skip")
         return
@@ -592,7 +261,10 @@ def run_bot():
         else:
             logger.warning("Database connection failed")
         
+        restore_states()
         setup_handlers()
+        # Перенос анкет, оставшихся в spool с прошлого запуска или от сбоя БД
+        db_writer.start()
         
         # Очистка webhook перед запуском polling
         try:
@@ -601,28 +273,31 @@ def run_bot():
         except Exception as _e:
             print("run_bot: remove_webhook warn:", _e)
 
-        # Запуск polling с retry при ошибке 409
-        attempts = 6
-        for i in range(1, attempts + 1):
-            try:
-                print(f"run_bot: starting polling (attempt {i}/{attempts})")
-                bot.infinity_polling(skip_pending=True)
-                print("run_bot: polling finished normally")
-                break
-            except ApiTelegramException as e:
-                code = getattr(e, "error_code", None)
-                if code == 409:
-                    print(f"run_bot: 409 Conflict — retry in 3s (attempt {i}/{attempts})")
-                    time.sleep(3)
-                    continue
-                raise
-            except Exception as e:
-                print("run_bot: unexpected error:", e)
-                time.sleep(3)
-        else:
-            print("run_bot: giving up after retries")
+        # Ошибки getUpdates (включая 409 Conflict) Poller переживает сам, выходит только по stop
+        if _stop_requested.is_set():
+            print("run_bot: stop requested, not starting polling")
+            return
+        poller = polling.Poller(bot, stop_event=_stop_requested)
+        poller.run()
     finally:
         BOT_RUNNING = False
 
+def run_webhook(node):
+    """Запуск в webhook-режиме (cluster.py): апдейты приходят на HTTP-приёмник узла."""
+    if setup_database():
+        logger.info("Database connected successfully")
+    else:
+        logger.warning("Database connection failed")
+    restore_states()
+    setup_handlers()
+    db_writer.start()
+    node.start()
+    # В снимке могли остаться опросы пользователей, которые теперь на других узлах
+    node.hand_off()
+    try:
+        node.set_webhook()
+    except Exception as e:
+        logger.error(f"set_webhook failed: {e}")
+
 if __name__ == "__main__":
     run_bot()
@@ -0,0 +1,149 @@
+# bot_runner.py
+"""
+Отдельный процесс с Telegram-ботом для продакшен-режима (см. run_production.py).
+
+Веб-воркеры gunicorn бота не запускают. Этот процесс становится лидером
+(leader.LeaderLock) и только после этого начинает polling, поэтому при
+любом числе реплик/воркеров поллер ровно один. По SIGTERM прекращает приём
+апдейтов, дожидается обработчиков и сохраняет незавершённые опросы
+(lifecycle.py) в пределах SHUTDOWN_TIMEOUT. С TENANTS_FILE вместо одного
+бота запускаются все боты из файла (tenants.py). С BOT_MODE=webhook лидер
+не выбирается: каждая реплика — узел кластера (cluster.py), принимает
+webhook и пересылает апдейты узлу-владельцу пользователя.
+
+Запуск:
+    python bot_runner.py
+"""
+
+import os
+import sys
+import time
+import signal
+import logging
+import threading
+
+import bot
+import cluster
+import profiler
+import rollups
+import tenants
+import user_cache
+from leader import LeaderLock
+from lifecycle import Lifecycle
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+LEADER_RETRY_SECONDS = float(os.getenv("BOT_LEADER_RETRY_SECONDS", "5"))
+LEADER_CHECK_SECONDS = float(os.getenv("BOT_LEADER_CHECK_SECONDS", "15"))
+
+stop_event = threading.Event()
+
+def _on_signal(signum, _frame):
+    logger.info(f"Получен сигнал {signal.Signals(signum).name}, останавливаю бота")
+    stop_event.set()
+
+def wait_for_leadership(lock):
+    """Ждёт, пока процесс не станет лидером или не придёт сигнал остановки"""
+    while not stop_event.is_set():
+        try:
+            if lock.acquire():
+                logger.info("Процесс стал лидером, запускаю polling")
+                return True
+        except Exception as e:
+            logger.error(f"Ошибка получения блокировки лидера: {e}")
+        logger.info(f"Лидер уже есть, повтор через {LEADER_RETRY_SECONDS} с")
+        stop_event.wait(LEADER_RETRY_SECONDS)
+    return False
+
+def run_node(node):
+    """Webhook-режим: приёмник узла вместо polling, без лидерства"""
+    bot.run_webhook(node)
+    user_cache.start_channel(stop_event=stop_event)
+
+    exit_code = 0
+    refresher_stop = None
+    while not stop_event.wait(1.0):
+        if not node.is_alive():
+            logger.error("Приёмник webhook завершился, выходим для перезапуска супервизором")
+            exit_code = 1
+            break
+        # Агрегаты обновляет один узел — владелец ключа "rollups" на кольце
+        owns_rollups = node.ring.owner("rollups") == node.id
+        if owns_rollups and refresher_stop is None:
+            refresher_stop = threading.Event()
+            rollups.start_refresher(stop_event=refresher_stop)
+        elif not owns_rollups and refresher_stop is not None:
+            refresher_stop.set()
+            refresher_stop = None
+    if refresher_stop is not None:
+        refresher_stop.set()
+
+    manager = Lifecycle()
+    node.register_shutdown_hooks(manager)
+    bot.register_shutdown_hooks(manager)
+    manager.shutdown()
+    return exit_code
+
+def main():
+    signal.signal(signal.SIGTERM, _on_signal)
+    signal.signal(signal.SIGINT, _on_signal)
+    # SIGUSR1/SIGUSR2 — стеки и профиль процесса бота (при заданном DEBUG_TOKEN)
+    profiler.install_signal_handlers()
+
+    node = cluster.Node.from_env(bot.bot, bot.user_states)
+    if node is not None:
+        return run_node(node)
+
+    lock = LeaderLock.from_env()
+    if not wait_for_leadership(lock):
+        return 0
+
+    runtime = tenants.Runtime.from_env()
+    if runtime is not None:
+        runtime.start()
+        poller_alive = runtime.is_alive
+    else:
+        poller = threading.Thread(target=bot.run_bot, name="bot-poller", daemon=True)
+        poller.start()
+        poller_alive = poller.is_alive
+    user_cache.start_channel(stop_event=stop_event)
+    # Агрегаты для /stats обновляет тоже только лидер
+    rollups.start_refresher(stop_event=stop_event)
+
+    exit_code = 0
+    last_check = time.monotonic()
+    while not stop_event.wait(1.0):
+        if not poller_alive():
+            logger.error("Поток polling завершился, выходим для перезапуска супервизором")
+            exit_code = 1
+            break
+        # Без связи с БД (grace-период leader.py) проверяем чаще, чтобы быстрее заметить чужую блокировку
+        interval = LEADER_RETRY_SECONDS if lock.degraded else LEADER_CHECK_SECONDS
+        if time.monotonic() - last_check < interval:
+            continue
+        last_check = time.monotonic()
+        if not lock.check():
+            logger.error("Лидерство потеряно, останавливаю polling")
+            exit_code = 1
+            break
+
+    # Остановка: stop_accepting -> drain -> flush -> snapshot (см. lifecycle.py)
+    manager = Lifecycle()
+    if runtime is not None:
+        runtime.register_shutdown_hooks(manager)
+        manager.shutdown()
+        runtime.join(timeout=5)
+    else:
+        bot.register_shutdown_hooks(manager)
+        manager.shutdown()
+        # Текущий getUpdates может ждать до POLL_TIMEOUT_MAX; поток демонический, долго не ждём
+        poller.join(5)
+    lock.release()
+    return exit_code
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,514 @@
+# broadcast.py
+"""
+Рассылка сообщения всем, кто отвечал на опрос (survey_responses), с
+максимально допустимой Telegram скоростью и продолжением после перезапуска.
+
+- user_id читаются страницами по BROADCAST_PAGE_SIZE (keyset: DISTINCT user_id
+  > курсора по индексу (user_id, id)), вся таблица в память не грузится;
+- сообщения отправляют BROADCAST_WORKERS потоков через общий ограничитель
+  BROADCAST_RATE сообщений в секунду (лимит Telegram на рассылку — ~30/с);
+  429 Too Many Requests приостанавливает всех на retry_after. Каждый
+  пользователь получает одно сообщение, повтор после ошибки — не раньше чем
+  через секунду, так что лимит «1 сообщение в секунду на чат» не нарушается;
+- прогресс (курсор — наибольший user_id, до которого всё отправлено, и
+  счётчики) сохраняется в таблице broadcasts раз в BROADCAST_CHECKPOINT_SECONDS
+  и при остановке; после падения повторно отправятся только сообщения,
+  отправленные после последней отметки;
+- заблокировавшие бота, удалённые и недоступные после BROADCAST_MAX_RETRIES
+  попыток пользователи записываются в broadcast_skips и в следующих рассылках
+  этого бота пропускаются.
+
+Рассылка идёт в отдельном процессе; прогресс и скорость видны в /broadcasts.
+Минимальное время рассылки — число получателей / BROADCAST_RATE
+(1 млн при 30/с — около 9,3 ч); чтобы упираться только в лимит, потоков нужно
+не меньше BROADCAST_RATE × время ответа Telegram API.
+
+    python broadcast.py start new-survey --text "Новый опрос уже доступен: /start"
+    python broadcast.py resume new-survey
+    python broadcast.py status
+    python broadcast.py start acme-news --tenant acme --text-file message.txt
+"""
+
+import os
+import time
+import queue
+import logging
+import threading
+from collections import Counter, deque
+
+from sqlalchemy import (
+    MetaData, Table, Column, Text, BigInteger, Float,
+    select, update, func, or_,
+)
+
+import telebot
+from telebot.apihelper import ApiTelegramException
+
+import transport
+
+logger = logging.getLogger(__name__)
+
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "30"))
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "16"))
+BROADCAST_PAGE_SIZE = int(os.getenv("BROADCAST_PAGE_SIZE", "1000"))
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", "3"))
+BROADCAST_CHECKPOINT_SECONDS = float(os.getenv("BROADCAST_CHECKPOINT_SECONDS", "5"))
+# Рассылка со статусом running без отметки дольше этого считается упавшей
+BROADCAST_STALE_SECONDS = float(os.getenv("BROADCAST_STALE_SECONDS", "120"))
+
+OUTCOMES = ("sent", "blocked", "failed")
+
+metadata = MetaData()
+
+broadcasts_table = Table(
+    "broadcasts", metadata,
+    Column("name", Text, primary_key=True),
+    # "" — единственный бот bot.py, иначе id бота из tenants.py
+    Column("tenant", Text, nullable=False, server_default=""),
+    Column("text", Text, nullable=False),
+    Column("parse_mode", Text, nullable=True),
+    Column("status", Text, nullable=False),  # pending | running | paused | done
+    Column("cursor", BigInteger, nullable=False),
+    Column("total", BigInteger, nullable=False),
+    Column("sent", BigInteger, nullable=False, server_default="0"),
+    Column("blocked", BigInteger, nullable=False, server_default="0"),
+    Column("failed", BigInteger, nullable=False, server_default="0"),
+    Column("rate", Float, nullable=True),  # сообщений в секунду в текущем запуске
+    # Время — unix-секунды: одинаково сравнивается в SQLite и PostgreSQL
+    Column("created_at", Float, nullable=False),
+    Column("heartbeat_at", Float, nullable=True),
+    Column("finished_at", Float, nullable=True),
+)
+
+skips_table = Table(
+    "broadcast_skips", metadata,
+    Column("tenant", Text, primary_key=True),
+    Column("user_id", BigInteger, primary_key=True, autoincrement=False),
+    Column("reason", Text, nullable=False),  # blocked | not_found | failed
+    Column("error", Text, nullable=True),
+    Column("broadcast", Text, nullable=True),
+    Column("recorded_at", Float, nullable=False),
+)
+
+class BroadcastError(Exception):
+    """Рассылку нельзя запустить: нет такой, уже идёт или уже создана"""
+
+def _engine():
+    import db
+    return db.engine
+
+def _insert(conn):
+    if conn.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif conn.dialect.name == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        raise NotImplementedError(f"ON CONFLICT не поддержан для {conn.dialect.name}")
+    return insert
+
+_ready = set()
+
+def ensure_tables(engine):
+    """Создаёт таблицы рассылок (один раз на движок в процессе)"""
+    if id(engine) not in _ready:
+        metadata.create_all(bind=engine)
+        _ready.add(id(engine))
+
+def recipients_stmt(tenant, cursor, limit):
+    """Следующая страница user_id получателей после cursor, без пропускаемых"""
+    from db import SurveyResponse
+    r = SurveyResponse.__table__
+    skipped = select(skips_table.c.user_id).where(
+        skips_table.c.tenant == tenant, skips_table.c.user_id == r.c.user_id
+    ).exists()
+    owner = r.c.tenant_id == tenant if tenant else r.c.tenant_id.is_(None)
+    return (
+        select(r.c.user_id).distinct()
+        .where(owner, r.c.user_id > cursor, ~skipped)
+        .order_by(r.c.user_id)
+        .limit(limit)
+    )
+
+def count_recipients(engine, tenant):
+    from db import SurveyResponse
+    r = SurveyResponse.__table__
+    owner = r.c.tenant_id == tenant if tenant else r.c.tenant_id.is_(None)
+    skipped = select(skips_table.c.user_id).where(
+        skips_table.c.tenant == tenant, skips_table.c.user_id == r.c.user_id
+    ).exists()
+    with engine.connect() as conn:
+        return conn.execute(
+            select(func.count(func.distinct(r.c.user_id))).where(owner, ~skipped)
+        ).scalar() or 0
+
+def create(name, text, tenant="", parse_mode=None, engine=None):
+    """Создаёт рассылку; total — число получателей на момент создания"""
+    engine = engine or _engine()
+    ensure_tables(engine)
+    total = count_recipients(engine, tenant)
+    with engine.begin() as conn:
+        if conn.execute(select(broadcasts_table.c.name).where(broadcasts_table.c.name == name)).first():
+            raise BroadcastError(f"Рассылка {name} уже существует")
+        conn.execute(broadcasts_table.insert().values(
+            name=name, tenant=tenant, text=text, parse_mode=parse_mode, status="pending",
+            cursor=0, total=total, created_at=time.time(),
+        ))
+    logger.info(f"[broadcast] {name}: создана, получателей {total}")
+    return total
+
+def classify(error):
+    """
+    Исход ошибки отправки: "retry_after" (429), "blocked" / "not_found" — больше
+    не писать этому пользователю, "retry" — временная ошибка, "invalid" — ошибка
+    в самом сообщении (разметка, длина), одинаковая для всех получателей.
+    """
+    if not isinstance(error, ApiTelegramException):
+        return "retry"
+    description = (error.description or "").lower()
+    if error.error_code == 429:
+        return "retry_after"
+    if error.error_code == 403:
+        return "blocked"
+    if error.error_code == 400 and ("chat not found" in description or "user not found" in description
+                                    or "peer_id_invalid" in description):
+        return "not_found"
+    if error.error_code >= 500:
+        return "retry"
+    return "invalid"
+
+def retry_after(error, default=1.0):
+    parameters = getattr(error, "result_json", {}).get("parameters") or {}
+    return float(parameters.get("retry_after", default))
+
+class RateLimiter:
+    """Равномерный темп rate событий в секунду на все потоки; pause() — для 429"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+    def pause(self, seconds):
+        with self._lock:
+            self._next = max(self._next, time.monotonic() + seconds)
+
+class Progress:
+    """
+    Курсор непрерывно завершённого префикса: user_id раздаются по возрастанию,
+    завершаются в любом порядке; курсор сдвигается только за теми, до которых
+    всё уже отправлено.
+    """
+
+    def __init__(self, cursor=0):
+        self.cursor = cursor
+        self.pending = Counter()   # исходы в пределах курсора, ещё не записанные в БД
+        self.totals = Counter()    # всё завершённое в этом запуске
+        self._order = deque()
+        self._done = {}
+        self._lock = threading.Lock()
+
+    def dispatch(self, user_id):
+        with self._lock:
+            self._order.append(user_id)
+
+    def complete(self, user_id, outcome):
+        with self._lock:
+            self._done[user_id] = outcome
+            self.totals[outcome] += 1
+            while self._order and self._order[0] in self._done:
+                first = self._order.popleft()
+                self.pending[self._done.pop(first)] += 1
+                self.cursor = first
+
+    def take(self):
+        """(курсор, исходы с прошлой отметки) для записи в БД"""
+        with self._lock:
+            pending, self.pending = self.pending, Counter()
+            return self.cursor, pending
+
+    @property
+    def processed(self):
+        return sum(self.totals.values())
+
+class Broadcast:
+    """Один запуск рассылки: чтение получателей, отправка пулом потоков, отметки"""
+
+    def __init__(self, name, token, engine=None, rate=BROADCAST_RATE, workers=BROADCAST_WORKERS,
+                 page_size=BROADCAST_PAGE_SIZE, max_retries=BROADCAST_MAX_RETRIES,
+                 checkpoint_seconds=BROADCAST_CHECKPOINT_SECONDS, stop_event=None):
+        self.name = name
+        self.engine = engine or _engine()
+        self.sender = telebot.TeleBot(token, threaded=False)
+        self.rate = rate
+        self.limiter = RateLimiter(rate)
+        self.workers = max(1, workers)
+        # Одно keep-alive соединение на поток отправки
+        transport.install(pool_size=self.workers)
+        self.page_size = page_size
+        self.max_retries = max_retries
+        self.checkpoint_seconds = checkpoint_seconds
+        self.stop_event = stop_event or threading.Event()
+        self.job = None
+        self.progress = None
+        self._started = None
+        self._checkpoint_lock = threading.Lock()
+
+    # --- состояние в БД ---
+
+    def _claim(self, force=False):
+        """Переводит рассылку в running; не даёт запустить её дважды"""
+        ensure_tables(self.engine)
+        now = time.time()
+        with self.engine.begin() as conn:
+            job = conn.execute(select(broadcasts_table).where(broadcasts_table.c.name == self.name)).first()
+            if job is None:
+                raise BroadcastError(f"Рассылка {self.name} не найдена")
+            if job.status == "done":
+                raise BroadcastError(f"Рассылка {self.name} уже завершена")
+            stmt = update(broadcasts_table).where(broadcasts_table.c.name == self.name)
+            if not force:
+                stmt = stmt.where(or_(
+                    broadcasts_table.c.status != "running",
+                    broadcasts_table.c.heartbeat_at < now - BROADCAST_STALE_SECONDS,
+                ))
+            claimed = conn.execute(stmt.values(status="running", heartbeat_at=now, rate=None)).rowcount
+            if claimed != 1:
+                raise BroadcastError(f"Рассылка {self.name} уже выполняется другим процессом")
+        return job
+
+    def checkpoint(self, status="running"):
+        """Записывает курсор и счётчики; вызывается из потоков отправки и в конце"""
+        with self._checkpoint_lock:
+            cursor, pending = self.progress.take()
+            elapsed = time.monotonic() - self._started
+            values = {
+                "cursor": cursor,
+                "status": status,
+                "heartbeat_at": time.time(),
+                "rate": round(self.progress.processed / elapsed, 2) if elapsed > 0 else None,
+            }
+            for outcome in OUTCOMES:
+                if pending[outcome]:
+                    values[outcome] = broadcasts_table.c[outcome] + pending[outcome]
+            if status == "done":
+                values["finished_at"] = time.time()
+            with self.engine.begin() as conn:
+                conn.execute(update(broadcasts_table).where(broadcasts_table.c.name == self.name).values(**values))
+            self._last_checkpoint = time.monotonic()
+
+    def _skip(self, user_id, reason, error):
+        """Запоминает пользователя, которому рассылки этого бота больше не отправляются"""
+        with self.engine.begin() as conn:
+            stmt = _insert(conn)(skips_table).values(
+                tenant=self.job.tenant, user_id=user_id, reason=reason,
+                error=str(error)[:500], broadcast=self.name, recorded_at=time.time(),
+            )
+            conn.execute(stmt.on_conflict_do_update(
+                index_elements=[skips_table.c.tenant, skips_table.c.user_id],
+                set_={"reason": stmt.excluded.reason, "error": stmt.excluded.error,
+                      "broadcast": stmt.excluded.broadcast, "recorded_at": stmt.excluded.recorded_at},
+            ))
+
+    # --- отправка ---
+
+    def send(self, user_id):
+        """Отправляет сообщение одному пользователю; возвращает исход из OUTCOMES"""
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            try:
+                self.sender.send_message(user_id, self.job.text, parse_mode=self.job.parse_mode)
+                return "sent"
+            except Exception as e:
+                kind = classify(e)
+                if kind == "retry_after":
+                    # Глобальный лимит: ждут все потоки, попытка не считается
+                    self.limiter.pause(retry_after(e))
+                    continue
+                if kind in ("blocked", "not_found"):
+                    self._skip(user_id, kind, e)
+                    return "blocked"
+                if kind == "invalid":
+                    raise
+                attempt += 1
+                if attempt > self.max_retries:
+                    logger.warning(f"[broadcast] {self.name}: не доставлено {user_id}: {e}")
+                    self._skip(user_id, "failed", e)
+                    return "failed"
+                time.sleep(min(30.0, 2 ** attempt))
+
+    def _worker(self, items):
+        while True:
+            user_id = items.get()
+            if user_id is None:
+                return
+            try:
+                outcome = self.send(user_id)
+            except Exception as e:
+                # Ошибка в тексте рассылки или записи в БД: останавливаемся, пользователь
+                # остаётся за курсором до следующего запуска
+                logger.error(f"[broadcast] {self.name}: ошибка на {user_id}: {e}")
+                self.stop_event.set()
+                continue
+            self.progress.complete(user_id, outcome)
+            if time.monotonic() - self._last_checkpoint >= self.checkpoint_seconds:
+                try:
+                    self.checkpoint()
+                except Exception as e:
+                    logger.error(f"[broadcast] {self.name}: не удалось сохранить прогресс: {e}")
+
+    def _pages(self):
+        """user_id получателей по возрастанию, страницами из БД"""
+        cursor = self.progress.cursor
+        while not self.stop_event.is_set():
+            with self.engine.connect() as conn:
+                page = conn.execute(recipients_stmt(self.job.tenant, cursor, self.page_size)).scalars().all()
+            yield from page
+            if len(page) < self.page_size:
+                return
+            cursor = page[-1]
+
+    def run(self, force=False):
+        """Отправляет рассылку до конца или до stop_event; возвращает итоговый статус"""
+        self.job = self._claim(force)
+        self.progress = Progress(self.job.cursor)
+        self._started = self._last_checkpoint = time.monotonic()
+        logger.info(f"[broadcast] {self.name}: старт с user_id > {self.job.cursor}, "
+                    f"{self.workers} потоков, до {self.rate:g} сообщений/с")
+
+        # Очередь короткая: при остановке потоки дорабатывают только её
+        items = queue.Queue(maxsize=self.workers * 2)
+        threads = [threading.Thread(target=self._worker, args=(items,), name=f"broadcast-{i}", daemon=True)
+                   for i in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        finished = False
+        try:
+            for user_id in self._pages():
+                if self.stop_event.is_set():
+                    break
+                self.progress.dispatch(user_id)
+                items.put(user_id)
+            else:
+                finished = True
+        finally:
+            for _ in threads:
+                items.put(None)
+            for thread in threads:
+                thread.join()
+            # Ошибка в потоке оставляет незавершённого пользователя: курсор до него
+            finished = finished and not self.stop_event.is_set()
+            status = "done" if finished else "paused"
+            self.checkpoint(status)
+
+        totals = self.progress.totals
+        elapsed = time.monotonic() - self._started
+        logger.info(f"[broadcast] {self.name}: {status}, отправлено {totals['sent']}, "
+                    f"заблокировали {totals['blocked']}, ошибок {totals['failed']} за {elapsed:.1f} с")
+        return status
+
+# --- прогресс для /broadcasts ---
+
+def _job_dict(row, now):
+    processed = row.sent + row.blocked + row.failed
+    remaining = max(0, row.total - processed)
+    running = row.status == "running" and row.heartbeat_at and row.heartbeat_at >= now - BROADCAST_STALE_SECONDS
+    return {
+        "name": row.name,
+        "tenant": row.tenant or None,
+        "status": row.status if running or row.status != "running" else "stale",
+        "total": row.total,
+        "sent": row.sent,
+        "blocked": row.blocked,
+        "failed": row.failed,
+        "progress": round(processed / row.total, 4) if row.total else 1.0,
+        "cursor": row.cursor,
+        "rate_per_s": row.rate,
+        "eta_seconds": round(remaining / row.rate) if running and row.rate else None,
+        "created_at": row.created_at,
+        "heartbeat_at": row.heartbeat_at,
+        "finished_at": row.finished_at,
+    }
+
+def status(name=None, engine=None):
+    """Рассылки (или одна) с прогрессом, скоростью и оценкой оставшегося времени"""
+    engine = engine or _engine()
+    ensure_tables(engine)
+    stmt = select(broadcasts_table).order_by(broadcasts_table.c.created_at.desc())
+    if name:
+        stmt = stmt.where(broadcasts_table.c.name == name)
+    with engine.connect() as conn:
+        rows = conn.execute(stmt).all()
+        skips = dict(conn.execute(
+            select(skips_table.c.reason, func.count()).group_by(skips_table.c.reason)
+        ).all())
+    now = time.time()
+    return {"broadcasts": [_job_dict(row, now) for row in rows], "skipped_users": skips}
+
+def _token(tenant):
+    """Токен бота: TELEGRAM_BOT_TOKEN или токен бота-арендатора из TENANTS_FILE"""
+    if not tenant:
+        token = os.getenv("TELEGRAM_BOT_TOKEN", "")
+        if not token:
+            raise BroadcastError("TELEGRAM_BOT_TOKEN не задан")
+        return token
+    import tenants
+    if not tenants.TENANTS_FILE:
+        raise BroadcastError("--tenant требует TENANTS_FILE")
+    for config in tenants.load_configs(tenants.TENANTS_FILE):
+        if config["id"] == tenant:
+            return config["token"]
+    raise BroadcastError(f"Бот {tenant} не найден в {tenants.TENANTS_FILE}")
+
+if __name__ == "__main__":
+    import sys
+    import json
+    import signal
+    import argparse
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Рассылка сообщения всем ответившим на опрос")
+    parser.add_argument("command", choices=["start", "resume", "status"])
+    parser.add_argument("name", nargs="?")
+    parser.add_argument("--text", help="текст сообщения")
+    parser.add_argument("--text-file", help="файл с текстом сообщения")
+    parser.add_argument("--parse-mode", choices=["HTML", "MarkdownV2"])
+    parser.add_argument("--tenant", default="", help="id бота из TENANTS_FILE (tenants.py)")
+    parser.add_argument("--rate", type=float, default=BROADCAST_RATE, help="сообщений в секунду")
+    parser.add_argument("--workers", type=int, default=BROADCAST_WORKERS)
+    parser.add_argument("--force", action="store_true", help="запустить, даже если рассылка помечена running")
+    args = parser.parse_args()
+
+    if args.command == "status":
+        print(json.dumps(status(args.name), ensure_ascii=False, indent=2))
+        sys.exit(0)
+    if not args.name:
+        parser.error("нужно имя рассылки")
+
+    stop = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: stop.set())
+    try:
+        if args.command == "start":
+            text = args.text
+            if args.text_file:
+                with open(args.text_file, encoding="utf-8") as f:
+                    text = f.read()
+            if not text:
+                parser.error("нужен --text или --text-file")
+            create(args.name, text, tenant=args.tenant, parse_mode=args.parse_mode)
+        job = status(args.name)["broadcasts"]
+        tenant = (job[0]["tenant"] or "") if job else args.tenant
+        result = Broadcast(args.name, _token(tenant), rate=args.rate, workers=args.workers,
+                           stop_event=stop).run(force=args.force)
+    except BroadcastError as e:
+        logger.error(str(e))
+        sys.exit(2)
+    sys.exit(0 if result == "done" else 1)
@@ -0,0 +1,610 @@
+# cluster.py
+"""
+Webhook-режим на нескольких узлах с закреплением пользователя за узлом.
+
+Состояние опроса (bot.user_states) живёт в памяти процесса, а порядок
+апдейтов пользователя держит polling.KeyedPool — оба работают, только если
+все апдейты пользователя попадают на один узел. Балансировщик перед
+репликами раскладывает запросы Telegram как угодно, поэтому:
+
+- узлы кластера образуют кольцо согласованного хэширования (HashRing):
+  у каждого узла CLUSTER_VNODES точек, пользователь принадлежит узлу первой
+  точки по часовой стрелке от hash(user_id). При добавлении или удалении узла
+  переезжают только пользователи его участков (~1/N), а не все;
+- апдейт, пришедший на /webhook, обрабатывается на месте, если узел —
+  владелец пользователя, иначе пересылается владельцу на /cluster/update по
+  локальной сети. Пока узлы расходятся во мнении о составе кольца, апдейт
+  пересылается не больше MAX_HOPS раз, затем обрабатывается на месте; если
+  владелец недоступен — тоже на месте, а не теряется;
+- состав кольца: CLUSTER_NODES="id=http://host:port,..." или файл
+  CLUSTER_REGISTRY ({"nodes": {"id": "http://host:port"}}) с внутренними
+  адресами узлов, который перечитывается при изменении раз в
+  CLUSTER_REGISTRY_POLL секунд. После смены состава узел отдаёт незавершённые
+  опросы пользователей, которых он больше не владеет, их новым владельцам
+  (/cluster/states); новый владелец, получивший апдейт раньше передачи,
+  забирает опрос сам (/cluster/take), дождавшись обработчиков пользователя
+  на прежнем узле. CLUSTER_MOVED_SECONDS секунд после смены состава прежний
+  владелец не обрабатывает апдейты ушедших пользователей (по новому кольцу или
+  отданных по /cluster/take), даже пришедшие после MAX_HOPS, а пересылает их
+  новому владельцу с пометкой X-Cluster-Moved; тот обрабатывает их у себя,
+  забрав опрос у отправителя, даже если его кольцо ещё старое: шаг опроса не
+  обрабатывается без состояния ни на одном узле. Плановое выключение узла:
+  убрать его из реестра, дождаться передачи, остановить;
+- /webhook слушается на CLUSTER_LISTEN (туда направлен балансировщик),
+  /cluster/* — на отдельном CLUSTER_INTERNAL_LISTEN, который не должен быть
+  доступен снаружи. Внутренние запросы подписываются CLUSTER_SECRET, запросы
+  Telegram проверяются по WEBHOOK_SECRET (X-Telegram-Bot-Api-Secret-Token);
+  без любого из них узел не запускается.
+
+Включается BOT_MODE=webhook в bot_runner.py: вместо polling с выбором лидера
+каждый узел слушает CLUSTER_LISTEN и CLUSTER_INTERNAL_LISTEN и регистрирует
+webhook WEBHOOK_URL + CLUSTER_WEBHOOK_PATH. Несколько ботов (TENANTS_FILE) в
+этом режиме не поддерживаются.
+
+    python cluster.py owner 123456789    # узел пользователя по текущему составу
+    python cluster.py moved --add n4     # доля пользователей, которые переедут
+"""
+
+import os
+import sys
+import hmac
+import json
+import time
+import bisect
+import hashlib
+import logging
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import lifecycle
+
+logger = logging.getLogger(__name__)
+
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+CLUSTER_NODE_ID = os.getenv("CLUSTER_NODE_ID", "") or os.getenv("HOSTNAME", "") or "node"
+CLUSTER_NODES = os.getenv("CLUSTER_NODES", "")
+CLUSTER_REGISTRY = os.getenv("CLUSTER_REGISTRY", "")
+CLUSTER_REGISTRY_POLL = float(os.getenv("CLUSTER_REGISTRY_POLL", "5"))
+CLUSTER_LISTEN = os.getenv("CLUSTER_LISTEN", "0.0.0.0:8081")
+CLUSTER_INTERNAL_LISTEN = os.getenv("CLUSTER_INTERNAL_LISTEN", "127.0.0.1:8082")
+CLUSTER_VNODES = int(os.getenv("CLUSTER_VNODES", "128"))
+CLUSTER_SECRET = os.getenv("CLUSTER_SECRET", "")
+CLUSTER_FORWARD_TIMEOUT = float(os.getenv("CLUSTER_FORWARD_TIMEOUT", "2"))
+CLUSTER_HANDOFF_WAIT = float(os.getenv("CLUSTER_HANDOFF_WAIT", "5"))
+CLUSTER_MOVED_SECONDS = float(os.getenv("CLUSTER_MOVED_SECONDS", "60"))
+CLUSTER_WEBHOOK_PATH = os.getenv("CLUSTER_WEBHOOK_PATH", "/webhook")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+
+SECRET_HEADER = "X-Cluster-Secret"
+FROM_HEADER = "X-Cluster-From"
+HOPS_HEADER = "X-Cluster-Hops"
+# Отправитель отдал опрос пользователя получателю: без опроса его надо забрать у отправителя
+MOVED_HEADER = "X-Cluster-Moved"
+# Пересылок одного апдейта: владельцу и, если у отправителя был старый состав, ещё раз
+MAX_HOPS = 2
+# Пересылки к узлу, которому отдан опрос, идут и после MAX_HOPS, но не бесконечно
+MAX_MOVED_HOPS = MAX_HOPS + 2
+# Блокировок решения «обработать здесь или отдать» по пользователям (полосы по hash)
+USER_LOCK_STRIPES = 64
+TELEGRAM_SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+class ClusterConfigError(Exception):
+    """Некорректный состав кластера или сочетание настроек"""
+
+def _hash(value):
+    return int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), "big")
+
+class HashRing:
+    """Кольцо согласованного хэширования: nodes {id: url}, vnodes точек на узел"""
+
+    def __init__(self, nodes, vnodes=CLUSTER_VNODES):
+        if not nodes:
+            raise ClusterConfigError("В кольце нет узлов")
+        self.nodes = dict(nodes)
+        self.vnodes = vnodes
+        points = sorted((_hash(f"{node}#{i}"), node) for node in self.nodes for i in range(vnodes))
+        self._keys = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    def owner(self, key):
+        """id узла, которому принадлежит key (user_id)"""
+        i = bisect.bisect(self._keys, _hash(key))
+        return self._owners[i % len(self._owners)]
+
+    def url(self, node):
+        return self.nodes[node]
+
+def parse_nodes(value):
+    """"id=url,id=url" -> {id: url}"""
+    nodes = {}
+    for item in value.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        node, sep, url = item.partition("=")
+        if not sep or not node.strip() or not url.strip():
+            raise ClusterConfigError(f"CLUSTER_NODES: ожидается id=url, получено {item!r}")
+        nodes[node.strip()] = url.strip().rstrip("/")
+    return nodes
+
+def load_registry(path):
+    with open(path, encoding="utf-8") as f:
+        raw = json.load(f)
+    nodes = raw.get("nodes") if isinstance(raw, dict) else None
+    if not isinstance(nodes, dict):
+        raise ClusterConfigError(f"{path}: ожидается {{\"nodes\": {{\"id\": \"url\"}}}}")
+    return {str(node): str(url).rstrip("/") for node, url in nodes.items()}
+
+def update_key(raw):
+    """Пользователь апдейта (from.id), иначе чат; None — апдейт без пользователя"""
+    for kind, payload in raw.items():
+        if kind == "update_id" or not isinstance(payload, dict):
+            continue
+        user = payload.get("from") or payload.get("user")
+        if isinstance(user, dict) and "id" in user:
+            return user["id"]
+        chat = payload.get("chat")
+        if isinstance(chat, dict) and "id" in chat:
+            return chat["id"]
+    return None
+
+class Node:
+    """
+    Узел кластера: HTTP-приёмник webhook и пересланных апдейтов, маршрутизация
+    по кольцу, передача состояний при смене состава.
+    """
+
+    def __init__(self, target, states, node_id=CLUSTER_NODE_ID, nodes=None, registry=CLUSTER_REGISTRY,
+                 listen=CLUSTER_LISTEN, internal_listen=CLUSTER_INTERNAL_LISTEN, secret=CLUSTER_SECRET,
+                 webhook_secret=WEBHOOK_SECRET, forward_timeout=CLUSTER_FORWARD_TIMEOUT, vnodes=CLUSTER_VNODES,
+                 moved_seconds=CLUSTER_MOVED_SECONDS, handoff_wait=CLUSTER_HANDOFF_WAIT):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        # Пустой секрет пропускал бы любой запрос: /cluster/take отдаёт чужие опросы
+        if not secret or not webhook_secret:
+            raise ClusterConfigError("BOT_MODE=webhook требует непустые CLUSTER_SECRET и WEBHOOK_SECRET")
+        if listen == internal_listen:
+            raise ClusterConfigError("CLUSTER_INTERNAL_LISTEN должен отличаться от CLUSTER_LISTEN")
+        self.target = target
+        self.states = states
+        self.id = node_id
+        self.registry = registry
+        self.listen = listen
+        self.internal_listen = internal_listen
+        self.secret = secret
+        self.webhook_secret = webhook_secret
+        self.forward_timeout = forward_timeout
+        self.vnodes = vnodes
+        self.moved_seconds = moved_seconds
+        self.handoff_wait = handoff_wait
+        self.stats = {"local": 0, "forwarded": 0, "received": 0, "forward_failed": 0,
+                      "states_sent": 0, "states_adopted": 0, "rebalances": 0, "moved_forwarded": 0}
+        self._stats_lock = threading.Lock()
+        self._registry_mtime = None
+        self._static = nodes if nodes is not None else (parse_nodes(CLUSTER_NODES) if CLUSTER_NODES else None)
+        self.ring = HashRing(self._load_nodes(), vnodes)
+        # Кольцо до последней смены состава: у кого забирать опросы (claim)
+        self.previous = None
+        # Адреса всех узлов, встречавшихся в составах: отдать опрос могли и ушедшему
+        self.urls = dict(self.ring.nodes)
+        # Кому и когда отданы опросы: {user_id: (node, monotonic)}
+        self.moved = {}
+        self._moved_lock = threading.Lock()
+        self._ring_changed_at = None
+        # Решение обработать апдейт на месте и постановка в пул — под блокировкой
+        # пользователя, как и пометка «опрос отдан»: после пометки новых задач
+        # пользователя в пуле не появится, и settle дождётся всех прежних
+        self._user_locks = [threading.Lock() for _ in range(USER_LOCK_STRIPES)]
+        self.session = requests.Session()
+        # Пул keep-alive соединений к соседям: пересылка — на каждый чужой апдейт
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=32)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.servers = []
+        self.stop_event = threading.Event()
+        self._threads = []
+
+    @classmethod
+    def from_env(cls, target, states):
+        """Узел по BOT_MODE=webhook или None (polling)"""
+        if BOT_MODE != "webhook":
+            return None
+        if os.getenv("TENANTS_FILE"):
+            raise ClusterConfigError("BOT_MODE=webhook не поддерживает TENANTS_FILE")
+        return cls(target, states)
+
+    def _count(self, key, n=1):
+        with self._stats_lock:
+            self.stats[key] += n
+
+    def _load_nodes(self):
+        if self.registry:
+            self._registry_mtime = os.path.getmtime(self.registry)
+            nodes = load_registry(self.registry)
+        elif self._static:
+            nodes = dict(self._static)
+        else:
+            # Один узел: webhook без кластера
+            nodes = {self.id: f"http://{self.internal_listen}"}
+        if self.id not in nodes:
+            logger.warning(f"[cluster] Узел {self.id} не входит в состав {sorted(nodes)}: все апдейты пересылаются")
+        return nodes
+
+    # --- маршрутизация ---
+
+    def owner(self, raw):
+        key = update_key(raw)
+        return self.id if key is None else self.ring.owner(key)
+
+    def process(self, raw, holder=None):
+        """
+        Обработка на этом узле: дедупликация, admission и KeyedPool — как у polling.
+        holder — узел, который отдал сюда опрос пользователя и переслал апдейт.
+        """
+        import telebot
+        key = update_key(raw)
+        if key is not None and key not in self.states:
+            self.claim(key, holder)
+        self.target.process_new_updates([telebot.types.Update.de_json(raw)])
+
+    def forward(self, node, path, body, hops=1, moved=False, read_timeout=None):
+        headers = {"Content-Type": "application/json", SECRET_HEADER: self.secret,
+                   FROM_HEADER: self.id, HOPS_HEADER: str(hops)}
+        if moved:
+            headers[MOVED_HEADER] = "1"
+        response = self.session.post(
+            self.urls[node] + path, data=body, headers=headers,
+            timeout=(self.forward_timeout, read_timeout or self.forward_timeout),
+        )
+        response.raise_for_status()
+        return response
+
+    def moved_to(self, user_id):
+        """
+        Узел, которому недавно отдан опрос пользователя (или которому он достался
+        при последней смене состава), или None
+        """
+        with self._moved_lock:
+            entry = self.moved.get(user_id)
+            if entry is not None and time.monotonic() - entry[1] > self.moved_seconds:
+                del self.moved[user_id]
+                entry = None
+            changed_at = self._ring_changed_at
+        if entry is not None:
+            return entry[0]
+        if changed_at is None or time.monotonic() - changed_at > self.moved_seconds:
+            return None
+        owner = self.ring.owner(user_id)
+        if owner != self.id and self.previous.owner(user_id) == self.id:
+            return owner
+        return None
+
+    def _user_lock(self, user_id):
+        return self._user_locks[hash(user_id) % len(self._user_locks)]
+
+    def _mark_moved(self, user_ids, node):
+        now = time.monotonic()
+        for user_id in user_ids:
+            with self._user_lock(user_id), self._moved_lock:
+                self.moved[user_id] = (node, now)
+
+    def _prune_moved(self):
+        cutoff = time.monotonic() - self.moved_seconds
+        with self._moved_lock:
+            for user_id in [u for u, (_, at) in self.moved.items() if at < cutoff]:
+                del self.moved[user_id]
+
+    def route(self, raw, body=None, hops=0, holder=None):
+        """
+        Апдейт с /webhook (hops=0) или от соседа: на месте, если узел — владелец,
+        иначе владельцу. Возвращает id узла, который его обработал.
+        """
+        if hops:
+            self._count("received")
+        key = update_key(raw)
+        with self._user_lock(key):
+            moved = self.moved_to(key) if key is not None else None
+            owner = self.owner(raw)
+            # Опрос отдан другому узлу: апдейт туда, даже если по своему кольцу
+            # владелец — этот узел или пересылок уже MAX_HOPS, иначе шаг
+            # обработался бы без состояния
+            if moved is not None and moved != self.id and hops < MAX_MOVED_HOPS:
+                target = moved
+            # Отправитель отдал опрос сюда: обрабатываем, забрав опрос у него
+            elif holder is not None:
+                return self._process_here(raw, hops, holder)
+            # Сосед со старым составом кольца прислал не тому узлу: ещё одна пересылка,
+            # дальше — обработка на месте, чтобы расхождение составов не дало цикла
+            elif owner != self.id and hops < MAX_HOPS:
+                target = owner
+            else:
+                return self._process_here(raw, hops, holder)
+        # Пересылка — без блокировки: встречная пересылка того же пользователя не ждёт её.
+        # Получатель может забирать опрос у прежнего владельца (claim): ждём и это
+        try:
+            response = self.forward(target, "/cluster/update", body or json.dumps(raw).encode(), hops + 1,
+                                    moved=target == moved, read_timeout=2 * self.forward_timeout + self.handoff_wait)
+            self._count("moved_forwarded" if target == moved else "forwarded")
+            return response.json().get("node", target)
+        except Exception as e:
+            # Владелец недоступен: лучше обработать здесь, чем потерять апдейт
+            logger.warning(f"[cluster] Пересылка узлу {target} не удалась, обрабатываю на месте: {e}")
+            self._count("forward_failed")
+        with self._user_lock(key):
+            return self._process_here(raw, hops, holder)
+
+    def _process_here(self, raw, hops, holder):
+        if not hops:
+            self._count("local")
+        self.process(raw, holder)
+        return self.id
+
+    # --- смена состава ---
+
+    def set_nodes(self, nodes):
+        """Новый состав кольца; опросы ушедших к другим узлам пользователей передаются им"""
+        old = self.ring
+        ring = HashRing(nodes, self.vnodes)
+        if set(old.nodes.items()) == set(ring.nodes.items()):
+            return 0
+        self.previous, self.ring = old, ring
+        self.urls.update(ring.nodes)
+        with self._moved_lock:
+            self._ring_changed_at = time.monotonic()
+        self._count("rebalances")
+        logger.info(f"[cluster] Состав кольца: {sorted(self.ring.nodes)}")
+        return self.hand_off()
+
+    def claim(self, user_id, holder=None):
+        """
+        Забирает опрос пользователя у прежнего владельца, если узел получил его
+        апдейт раньше, чем прежний владелец узнал о новом составе и передал опросы,
+        или у holder — узла, который переслал апдейт, отдав опрос сюда.
+        """
+        if holder is None:
+            if self.previous is None:
+                return False
+            holder = self.previous.owner(user_id)
+            if self.ring.owner(user_id) != self.id:
+                return False
+        if holder == self.id or holder not in self.urls:
+            return False
+        try:
+            response = self.forward(holder, "/cluster/take", json.dumps({"user_ids": [user_id]}).encode(),
+                                    read_timeout=self.forward_timeout + self.handoff_wait)
+            states = lifecycle.loads_states(response.text)
+        except Exception as e:
+            logger.warning(f"[cluster] Не удалось забрать опрос {user_id} у узла {holder}: {e}")
+            return False
+        return self.adopt(states) > 0
+
+    def settle(self, user_ids, timeout=None):
+        """
+        Ждёт обработчики апдейтов user_ids, уже стоящие в очереди пула
+        (polling.KeyedPool.barrier): опрос передаётся после них, а не посреди.
+        """
+        pool = getattr(self.target, "worker_pool", None)
+        if not user_ids or not hasattr(pool, "barrier"):
+            return True
+        timeout = self.handoff_wait if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        return all(event.wait(max(0.0, deadline - time.monotonic())) for event in pool.barrier(user_ids))
+
+    def take(self, user_ids, node=None):
+        """Отдаёт и удаляет опросы пользователей по запросу нового владельца node"""
+        user_ids = [int(user_id) for user_id in user_ids]
+        # Даже без опроса: следующие апдейты пользователя — к новому владельцу
+        if node is not None and node != self.id:
+            self._mark_moved(user_ids, node)
+        # Опрос отдаётся после уже поставленных в очередь обработчиков пользователя
+        # (новый владелец ждёт их в пределах handoff_wait), а не посреди них
+        self.settle(user_ids)
+        taken = {}
+        for user_id in user_ids:
+            state = self.states.pop(user_id, None)
+            if state is not None:
+                taken[user_id] = state
+        self._count("states_sent", len(taken))
+        return taken
+
+    def hand_off(self):
+        """Отдаёт состояния пользователей, которыми узел больше не владеет; возвращает число переданных"""
+        moving = {}
+        for user_id in list(self.states):
+            owner = self.ring.owner(user_id)
+            if owner != self.id:
+                moving.setdefault(owner, []).append(user_id)
+        for node, user_ids in moving.items():
+            self._mark_moved(user_ids, node)
+        if moving and not self.settle([u for user_ids in moving.values() for u in user_ids]):
+            logger.warning("[cluster] Не все обработчики уходящих пользователей завершились до передачи")
+        sent = 0
+        for node, user_ids in moving.items():
+            batch = {u: self.states[u] for u in user_ids if u in self.states}
+            try:
+                self.forward(node, "/cluster/states", lifecycle.dumps_states(batch).encode())
+            except Exception as e:
+                # Остаются здесь: повтор при следующей смене состава или проверке реестра
+                logger.warning(f"[cluster] Не удалось передать {len(batch)} опросов узлу {node}: {e}")
+                continue
+            for user_id, state in batch.items():
+                # Если пользователь успел написать сюда снова, состояние уже другое — не удаляем
+                if self.states.get(user_id) is state:
+                    self.states.pop(user_id, None)
+            sent += len(batch)
+        if sent:
+            self._count("states_sent", sent)
+            logger.info(f"[cluster] Передано незавершённых опросов: {sent}")
+        return sent
+
+    def adopt(self, states):
+        """Состояния от прежнего владельца; более свежее своё не затирается"""
+        adopted = 0
+        with self._moved_lock:
+            # Опрос вернулся: апдейты пользователя снова обрабатываются здесь
+            for user_id in states:
+                self.moved.pop(user_id, None)
+        for user_id, state in states.items():
+            if user_id not in self.states:
+                self.states[user_id] = state
+                adopted += 1
+        self._count("states_adopted", adopted)
+        return adopted
+
+    def _watch_registry(self):
+        while not self.stop_event.wait(CLUSTER_REGISTRY_POLL):
+            try:
+                if os.path.getmtime(self.registry) != self._registry_mtime:
+                    self.set_nodes(self._load_nodes())
+                elif any(self.ring.owner(u) != self.id for u in list(self.states)):
+                    # Передача не удалась в прошлый раз
+                    self.hand_off()
+                self._prune_moved()
+            except Exception as e:
+                logger.error(f"[cluster] Ошибка чтения реестра {self.registry}: {e}")
+
+    # --- HTTP ---
+
+    def _handler_class(self, internal):
+        """internal: /cluster/* для соседей, иначе только webhook Telegram"""
+        node = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def _reply(self, status, payload):
+                self._send(status, json.dumps(payload, ensure_ascii=False).encode())
+
+            def _send(self, status, data):
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0) or 0))
+                path = self.path.split("?", 1)[0]
+                try:
+                    if not internal and path == CLUSTER_WEBHOOK_PATH:
+                        if not _secret_ok(self.headers.get(TELEGRAM_SECRET_HEADER), node.webhook_secret):
+                            return self._reply(403, {"error": "forbidden"})
+                        return self._reply(200, {"ok": True, "node": node.route(json.loads(body), body)})
+                    if internal and path in ("/cluster/update", "/cluster/states", "/cluster/take"):
+                        if not _secret_ok(self.headers.get(SECRET_HEADER), node.secret):
+                            return self._reply(403, {"error": "forbidden"})
+                        sender = self.headers.get(FROM_HEADER) or None
+                        if path == "/cluster/update":
+                            hops = int(self.headers.get(HOPS_HEADER, "1") or 1)
+                            holder = sender if self.headers.get(MOVED_HEADER) else None
+                            node_id = node.route(json.loads(body), body, hops, holder)
+                            return self._reply(200, {"ok": True, "node": node_id})
+                        if path == "/cluster/take":
+                            taken = node.take(json.loads(body).get("user_ids", []), sender)
+                            return self._send(200, lifecycle.dumps_states(taken).encode())
+                        return self._reply(200, {"adopted": node.adopt(lifecycle.loads_states(body))})
+                    return self._reply(404, {"error": "not found"})
+                except Exception as e:
+                    logger.error(f"[cluster] {path}: {e}")
+                    return self._reply(500, {"error": str(e)})
+
+            def do_GET(self):
+                if internal and self.path.split("?", 1)[0] == "/cluster/status":
+                    return self._reply(200, node.status())
+                return self._reply(404, {"error": "not found"})
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        """HTTP-приёмники webhook и внутренних запросов, слежение за реестром"""
+        threads = []
+        for listen, internal, name in ((self.listen, False, "cluster-webhook"),
+                                       (self.internal_listen, True, "cluster-internal")):
+            host, _, port = listen.rpartition(":")
+            server = ThreadingHTTPServer((host or "0.0.0.0", int(port)), self._handler_class(internal))
+            server.daemon_threads = True
+            self.servers.append(server)
+            threads.append(threading.Thread(target=server.serve_forever, name=name, daemon=True))
+        if self.registry:
+            threads.append(threading.Thread(target=self._watch_registry, name="cluster-registry", daemon=True))
+        for thread in threads:
+            thread.start()
+        self._threads = threads
+        logger.info(f"[cluster] Узел {self.id} слушает webhook {self.listen}, внутренние {self.internal_listen}, "
+                    f"узлов в кольце: {len(self.ring.nodes)}")
+
+    def set_webhook(self, url=WEBHOOK_URL):
+        """Регистрирует webhook балансировщика; allowed_updates — по обработчикам, как у polling"""
+        import polling
+        if not url:
+            logger.warning("[cluster] WEBHOOK_URL не задан, webhook не регистрируется")
+            return False
+        return self.target.set_webhook(
+            url=url.rstrip("/") + CLUSTER_WEBHOOK_PATH, secret_token=self.webhook_secret,
+            allowed_updates=polling.allowed_updates(self.target), drop_pending_updates=False,
+        )
+
+    def is_alive(self):
+        return bool(self._threads) and all(thread.is_alive() for thread in self._threads[:len(self.servers)])
+
+    def stop(self, _timeout=None):
+        """Перестаёт принимать апдейты (этап stop_accepting в lifecycle.py)"""
+        self.stop_event.set()
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+    def register_shutdown_hooks(self, manager):
+        manager.on("stop_accepting", self.stop, "cluster.stop")
+        manager.on("drain", lambda _timeout: logger.info(f"cluster stats: {self.status()}"), "cluster.stats")
+
+    def status(self):
+        with self._stats_lock:
+            stats = dict(self.stats)
+        with self._moved_lock:
+            moved = len(self.moved)
+        return {"node": self.id, "nodes": self.ring.nodes, "vnodes": self.vnodes,
+                "active_surveys": len(self.states), "moved_users": moved, **stats}
+
+def _secret_ok(received, expected):
+    return bool(expected) and hmac.compare_digest((received or "").encode(), expected.encode())
+
+def _current_nodes():
+    if CLUSTER_REGISTRY:
+        return load_registry(CLUSTER_REGISTRY)
+    if CLUSTER_NODES:
+        return parse_nodes(CLUSTER_NODES)
+    raise ClusterConfigError("Не задан CLUSTER_NODES или CLUSTER_REGISTRY")
+
+def moved_share(old, new, samples=100_000):
+    """Доля пользователей, сменивших узел при переходе old -> new (по выборке id)"""
+    return sum(old.owner(u) != new.owner(u) for u in range(1, samples + 1)) / samples
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Кольцо узлов webhook-кластера")
+    sub = parser.add_subparsers(dest="command", required=True)
+    owner_cmd = sub.add_parser("owner", help="узел пользователя")
+    owner_cmd.add_argument("user_id", type=int)
+    moved_cmd = sub.add_parser("moved", help="доля переезжающих пользователей при смене состава")
+    moved_cmd.add_argument("--add", action="append", default=[], help="id добавляемого узла")
+    moved_cmd.add_argument("--remove", action="append", default=[], help="id удаляемого узла")
+    args = parser.parse_args()
+
+    nodes = _current_nodes()
+    ring = HashRing(nodes)
+    if args.command == "owner":
+        node = ring.owner(args.user_id)
+        print(f"{args.user_id} -> {node} ({nodes[node]})")
+    else:
+        changed = {n: u for n, u in nodes.items() if n not in args.remove}
+        changed.update({n: f"http://{n}" for n in args.add})
+        print(f"Переедут {moved_share(ring, HashRing(changed)):.1%} пользователей "
+              f"({len(nodes)} -> {len(changed)} узлов)")
+    sys.exit(0)
@@ -3,10 +3,13 @@ import os
 import logging
 import tempfile
 from pathlib import Path
+from urllib.parse import quote
 from sqlalchemy import create_engine, Column, Integer, String, Date, DateTime, BigInteger
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from datetime import datetime
+from validation import to_date
+import user_cache
 
 logger = logging.getLogger(__name__)
 
@@ -76,9 +79,26 @@ class SurveyResponse(Base):
 # Создаем сессию для работы с БД
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+def _read_sessions(path):
+    """
+    Сессии только для чтения (выгрузки для администратора) на отдельном пуле
+    соединений SQLite в режиме mode=ro: чтение не занимает соединения записи
+    анкет и не может случайно ничего изменить.
+    """
+    read_engine = create_engine(
+        f"sqlite:///file:{quote(str(path))}?mode=ro&uri=true",
+        echo=False,
+        connect_args={"check_same_thread": False, "timeout": 30},
+        pool_pre_ping=True,
+        pool_recycle=3600,
+    )
+    return sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
+
+ReadSessionLocal = _read_sessions(DB_PATH)
+
 def init_db():
     """Создаём таблицу для ответов, если её ещё нет"""
-    global engine, DB_PATH, SessionLocal
+    global engine, DB_PATH, SessionLocal, ReadSessionLocal
     
     try:
         # Проверяем доступность файла базы данных
@@ -112,6 +132,7 @@ def init_db():
             DB_PATH = fallback_path
             engine = create_engine(f"sqlite:///{DB_PATH}", echo=False)
             SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+            ReadSessionLocal = _read_sessions(DB_PATH)
             Base.metadata.create_all(bind=engine)
             logger.info(f"Fallback database created successfully at {fallback_path}")
             return True
@@ -139,27 +160,18 @@ def get_database_info():
         logger.error(f"Error getting database info: {e}")
         return {"error": str(e)}
 
-def save_response(user_id: int, full_name: str, birth_date: str, citizenship: str):
+def save_response(user_id: int, full_name: str, birth_date, citizenship: str):
     """Сохраняем один ответ опроса"""
     session = None
     try:
         # Создаем сессию
         session = SessionLocal()
         
-        # Конвертируем дату из строки в объект Date
-        if birth_date:
-            try:
-                # Если дата уже в формате YYYY-MM-DD
-                if '-' in birth_date:
-                    parsed_date = datetime.strptime(birth_date, '%Y-%m-%d').date()
-                else:
-                    # Если дата в формате ДД.ММ.ГГГГ
-                    parsed_date = datetime.strptime(birth_date, '%d.%m.%Y').date()
-            except ValueError:
-                logger.error(f"Invalid date format: {birth_date}")
-                parsed_date = None
-        else:
-            parsed_date = None
+        # Дата обычно уже date (validation.parse_birth_date); строки YYYY-MM-DD
+        # и ДД.ММ.ГГГГ разбираются по тем же правилам
+        parsed_date = to_date(birth_date)
+        if birth_date and parsed_date is None:
+            logger.error(f"Invalid date format: {birth_date}")
         
         # Создаем новый ответ
         new_response = SurveyResponse(
@@ -175,6 +187,7 @@ def save_response(user_id: int, full_name: str, birth_date: str, citizenship: st
         
         # Получаем ID нового ответа
         new_id = new_response.id
+        user_cache.invalidate(user_id)
         
         logger.info(f"Survey response saved successfully with ID {new_id}")
         
@@ -194,26 +207,25 @@ def save_response(user_id: int, full_name: str, birth_date: str, citizenship: st
         if session:
             session.close()
 
+def _load_user_responses(user_id: int):
+    with ReadSessionLocal() as session:
+        responses = session.query(SurveyResponse).filter(SurveyResponse.user_id == user_id).all()
+    logger.info(f"Retrieved {len(responses)} responses for user {user_id}")
+    return responses
+
 def get_user_responses(user_id: int):
-    """Получаем все ответы пользователя"""
-    session = None
+    """Получаем все ответы пользователя (из кэша user_cache до его следующей записи)"""
     try:
-        session = SessionLocal()
-        responses = session.query(SurveyResponse).filter(SurveyResponse.user_id == user_id).all()
-        logger.info(f"Retrieved {len(responses)} responses for user {user_id}")
-        return responses
+        return user_cache.cache.get_or_load(user_id, "legacy_user_responses", lambda: _load_user_responses(user_id))
     except Exception as e:
         logger.error(f"Error getting user responses: {e}")
         return []
-    finally:
-        if session:
-            session.close()
 
 def get_all_responses():
     """Получаем все ответы (для администратора)"""
     session = None
     try:
-        session = SessionLocal()
+        session = ReadSessionLocal()
         responses = session.query(SurveyResponse).all()
         logger.info(f"Retrieved {len(responses)} total responses")
         return responses
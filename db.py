@@ -3,9 +3,13 @@ import os
 import sys
 import re
 import ssl
-from sqlalchemy import create_engine, text, Integer, Text, Column, DateTime, func
+from sqlalchemy import create_engine, text, Integer, BigInteger, Boolean, Text, Column, Date, DateTime, Index, func, true
+from sqlalchemy.types import TypeDecorator
 from sqlalchemy.orm import sessionmaker, declarative_base
 from urllib.parse import urlparse, urlsplit, urlunsplit, parse_qsl, urlencode
+from validation import to_date
+import user_cache
+import http_cache
 
 # 1) Берём адрес базы из переменной окружения (environment variable)
 DATABASE_URL = os.getenv("DATABASE_URL")
@@ -101,19 +105,95 @@ class Response(Base):
     answer = Column(Text)
     created_at = Column(DateTime, server_default=func.now())
 
+class BirthDate(TypeDecorator):
+    """
+    Дата рождения: DATE в PostgreSQL, текст YYYY-MM-DD в SQLite.
+    Принимает date или строку; читается всегда как date — в том числе из
+    старой TEXT-колонки, пока online_migration.py не переключил её на DATE.
+    """
+    impl = Date
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == "sqlite":
+            return dialect.type_descriptor(Text())
+        return dialect.type_descriptor(Date())
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        parsed = to_date(value)
+        if parsed is None:
+            raise ValueError(f"Некорректная дата рождения: {value!r}")
+        return parsed.isoformat() if dialect.name == "sqlite" else parsed
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        # Нераспознанные старые значения возвращаются как есть
+        return to_date(value) or value
+
 # Модель для survey_responses
 class SurveyResponse(Base):
     __tablename__ = "survey_responses"
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, nullable=False)
+    # Типы BIGINT/DATE в существующих базах PostgreSQL включает online_migration.py
+    user_id = Column(BigInteger, nullable=False)
     full_name = Column(Text, nullable=False)
-    birth_date = Column(Text, nullable=False)  # Храним как текст для совместимости
+    birth_date = Column(BirthDate, nullable=False)
     citizenship = Column(Text, nullable=False)
     created_at = Column(DateTime, server_default=func.now())
+    # Ключ "один ответ на пользователя за окно" (см. submission_guard.py), NULL если политика выключена
+    dedup_key = Column(Text, nullable=True)
+    # Ключ апдейта, завершившего опрос (см. idempotency.py): повторная обработка не создаёт дубль
+    idempotency_key = Column(Text, nullable=True)
+    # Бот-арендатор в мультиарендном режиме (tenants.py); NULL — единственный бот bot.py
+    tenant_id = Column(Text, nullable=True)
+
+    # Индексы для поиска по пользователю и по времени.
+    # Для уже существующих таблиц их создаёт миграция в migrations.py
+    __table_args__ = (
+        Index("ix_survey_responses_user_id_id", "user_id", "id"),
+        Index("ix_survey_responses_created_at", "created_at"),
+        Index("ix_survey_responses_citizenship", "citizenship"),
+        Index("ix_survey_responses_birth_date", "birth_date"),
+        Index("ix_survey_responses_tenant_id_user_id", "tenant_id", "user_id", "id"),
+        Index("ux_survey_responses_dedup_key", "dedup_key", unique=True,
+              postgresql_where=text("dedup_key IS NOT NULL"),
+              sqlite_where=text("dedup_key IS NOT NULL")),
+        Index("ux_survey_responses_idempotency_key", "idempotency_key", unique=True,
+              postgresql_where=text("idempotency_key IS NOT NULL"),
+              sqlite_where=text("idempotency_key IS NOT NULL")),
+    )
+
+# Снимок незавершённых опросов при остановке (см. lifecycle.py)
+class SurveyStateSnapshot(Base):
+    __tablename__ = "survey_state_snapshots"
+    # Бот-арендатор (tenants.py); "" — единственный бот bot.py (NULL в первичном ключе нельзя)
+    tenant_id = Column(Text, primary_key=True, server_default="")
+    user_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    state = Column(Text, nullable=False)  # JSON {'state': ..., 'data': {...}}
+    saved_at = Column(DateTime, server_default=func.now())
+
+# Обработанные апдейты для общей дедупликации между репликами (см. idempotency.py)
+class ProcessedUpdate(Base):
+    __tablename__ = "processed_updates"
+    key = Column(Text, primary_key=True)  # "u:<update_id>" или "c:<callback_query.id>"
+    seen_at = Column(DateTime, server_default=func.now(), index=True)
+    # False — обработчик ещё выполняется; такой ключ можно перезахватить после IDEMPOTENCY_CLAIM_SECONDS
+    done = Column(Boolean, nullable=False, server_default=true())
 
 # 5) Инициализация схемы
 def init_db():
     Base.metadata.create_all(bind=engine)
+    # Версии таблиц для ETag HTTP-ответов (http_cache.py)
+    http_cache.ensure_tables(engine)
+    # Досоздаём то, чего create_all не делает для существующих таблиц
+    from migrations import run_migrations
+    run_migrations(engine)
+    # Секционированная таблица (partitioning.py): секции на месяцы вперёд
+    from partitioning import ensure_partitions
+    ensure_partitions(engine)
 
 # 6) Утилита сохранения
 def save_response(user_id: int, question: str, answer: str):
@@ -121,15 +201,88 @@ def save_response(user_id: int, question: str, answer: str):
         s.add(Response(user_id=user_id, question=question, answer=answer))
         s.commit()
 
+class DuplicateSubmission(Exception):
+    """Ответ с таким dedup_key или idempotency_key уже сохранён"""
+
+def insert_ignore(table, values, returning):
+    """INSERT ... ON CONFLICT DO NOTHING для PostgreSQL и SQLite"""
+    if engine.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif engine.dialect.name == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        raise NotImplementedError(f"ON CONFLICT не поддержан для {engine.dialect.name}")
+    return insert(table).values(**values).on_conflict_do_nothing().returning(returning)
+
+_partitioned = None
+
+def is_partitioned():
+    """survey_responses секционирована (partitioning.py); проверяется один раз на процесс"""
+    global _partitioned
+    if _partitioned is None:
+        from partitioning import is_partitioned as check
+        _partitioned = check(engine)
+    return _partitioned
+
+# Пространство ключей pg_advisory_xact_lock(int, int) для уникальности ключей в секционированной таблице
+KEY_LOCK_NAMESPACE = 7263
+
+def locked_insert(session, values):
+    """
+    Вставка с проверкой dedup_key/idempotency_key для секционированной таблицы,
+    где уникальный индекс по ключу невозможен: ключи блокируются до конца транзакции.
+    Возвращает id или None, если запись с таким ключом уже есть.
+    """
+    from sqlalchemy import select, or_, insert
+    keys = [(col, values[col]) for col in ("dedup_key", "idempotency_key") if values.get(col)]
+    for _, key in sorted(keys, key=lambda item: item[1]):
+        session.execute(text("SELECT pg_advisory_xact_lock(:ns, hashtext(:k))"),
+                        {"ns": KEY_LOCK_NAMESPACE, "k": key})
+    found = session.execute(
+        select(SurveyResponse.id)
+        .where(or_(*[getattr(SurveyResponse, col) == key for col, key in keys]))
+        .limit(1)
+    ).scalar()
+    if found is not None:
+        return None
+    return session.execute(insert(SurveyResponse.__table__).values(**values).returning(SurveyResponse.id)).scalar()
+
 # Утилита сохранения для survey_responses
-def save_survey_response(user_id: int, full_name: str, birth_date: str, citizenship: str):
+def save_survey_response(user_id: int, full_name: str, birth_date, citizenship: str,
+                         dedup_key: str = None, idempotency_key: str = None, tenant_id: str = None):
+    # birth_date — date из validation.parse_birth_date или строка YYYY-MM-DD (см. BirthDate)
+    if dedup_key is None and idempotency_key is None:
+        with SessionLocal() as s:
+            new_response = SurveyResponse(
+                user_id=user_id,
+                full_name=full_name,
+                birth_date=birth_date,
+                citizenship=citizenship,
+                tenant_id=tenant_id,
+            )
+            s.add(new_response)
+            s.commit()
+            new_id = new_response.id
+        user_cache.invalidate(user_id)
+        return new_id
+
+    # С ключом дедупликации вставка атомарна: повтор не создаёт вторую запись
+    values = {
+        "user_id": user_id,
+        "full_name": full_name,
+        "birth_date": birth_date,
+        "citizenship": citizenship,
+        "dedup_key": dedup_key,
+        "idempotency_key": idempotency_key,
+        "tenant_id": tenant_id,
+    }
     with SessionLocal() as s:
-        new_response = SurveyResponse(
-            user_id=user_id,
-            full_name=full_name,
-            birth_date=birth_date,
-            citizenship=citizenship
-        )
-        s.add(new_response)
+        if is_partitioned():
+            new_id = locked_insert(s, values)
+        else:
+            new_id = s.execute(insert_ignore(SurveyResponse.__table__, values, SurveyResponse.id)).scalar()
         s.commit()
-        return new_response.id
+    if new_id is None:
+        raise DuplicateSubmission(idempotency_key or dedup_key)
+    user_cache.invalidate(user_id)
+    return new_id
@@ -0,0 +1,136 @@
+# db_async.py
+"""
+Асинхронный доступ к той же базе, что и db.py, для async_bot.py / asgi.py.
+
+Используется асинхронный движок SQLAlchemy:
+- PostgreSQL через asyncpg (postgresql+pg8000:// -> postgresql+asyncpg://)
+- SQLite через aiosqlite (sqlite:/// -> sqlite+aiosqlite:///)
+Схема, модели и миграции общие с db.py; init_db() по-прежнему синхронный.
+"""
+
+import ssl
+import asyncio
+from sqlalchemy import select, func
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+import db
+import user_cache
+from db import SurveyResponse, DuplicateSubmission, insert_ignore
+
+def _async_url(url: str) -> str:
+    if "+pg8000://" in url:
+        return url.replace("+pg8000://", "+asyncpg://", 1)
+    if url.startswith("sqlite:///"):
+        return url.replace("sqlite:///", "sqlite+aiosqlite:///", 1)
+    return url
+
+async_db_url = _async_url(db.db_url)
+
+async_connect_args = {}
+if "+asyncpg" in async_db_url:
+    async_connect_args = {"ssl": ssl.create_default_context()}
+
+engine = create_async_engine(
+    async_db_url,
+    pool_pre_ping=True,
+    connect_args=async_connect_args,
+)
+AsyncSessionLocal = async_sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
+
+async def _invalidate_user(user_id):
+    """Сброс кэша пользователя; рассылка по каналу — синхронный запрос, поэтому в потоке"""
+    user_cache.cache.invalidate(user_id, publish=False)
+    if user_cache.cache.publisher is not None:
+        await asyncio.to_thread(user_cache.cache.publish, user_id)
+
+async def save_survey_response(user_id: int, full_name: str, birth_date, citizenship: str,
+                               dedup_key: str = None, idempotency_key: str = None, tenant_id: str = None):
+    """Асинхронный аналог db.save_survey_response"""
+    async with AsyncSessionLocal() as s:
+        if dedup_key is None and idempotency_key is None:
+            new_response = SurveyResponse(
+                user_id=user_id,
+                full_name=full_name,
+                birth_date=birth_date,
+                citizenship=citizenship,
+                tenant_id=tenant_id,
+            )
+            s.add(new_response)
+            await s.commit()
+            new_id = new_response.id
+            await _invalidate_user(user_id)
+            return new_id
+
+        values = {
+            "user_id": user_id,
+            "full_name": full_name,
+            "birth_date": birth_date,
+            "citizenship": citizenship,
+            "dedup_key": dedup_key,
+            "idempotency_key": idempotency_key,
+            "tenant_id": tenant_id,
+        }
+        # Проверка секционирования — один синхронный запрос на процесс
+        partitioned = db._partitioned if db._partitioned is not None else await asyncio.to_thread(db.is_partitioned)
+        if partitioned:
+            new_id = await s.run_sync(db.locked_insert, values)
+        else:
+            new_id = (await s.execute(insert_ignore(SurveyResponse.__table__, values, SurveyResponse.id))).scalar()
+        await s.commit()
+    if new_id is None:
+        raise DuplicateSubmission(idempotency_key or dedup_key)
+    await _invalidate_user(user_id)
+    return new_id
+
+async def has_submitted(user_id: int, since=None, tenant_id=None) -> bool:
+    """Асинхронный аналог queries.has_submitted"""
+    from queries import has_submitted_stmt
+    async with AsyncSessionLocal() as s:
+        return bool((await s.execute(has_submitted_stmt(user_id, since, tenant_id))).scalar())
+
+async def last_submitted_at(user_id: int, since=None, tenant_id=None):
+    """Асинхронный аналог queries.last_submitted_at"""
+    from queries import last_submitted_at_stmt
+    async with AsyncSessionLocal() as s:
+        return (await s.execute(last_submitted_at_stmt(user_id, since, tenant_id))).scalar()
+
+_replica_sessions = None
+
+def _replica_session_factory(url):
+    """Асинхронные сессии на реплике чтения (routing.py), создаются при первом обращении"""
+    global _replica_sessions
+    if _replica_sessions is None:
+        replica_url = _async_url(url)
+        connect_args = {"ssl": ssl.create_default_context()} if "+asyncpg" in replica_url else {}
+        replica = create_async_engine(replica_url, pool_pre_ping=True, connect_args=connect_args)
+        _replica_sessions = async_sessionmaker(bind=replica, autoflush=False, expire_on_commit=False)
+    return _replica_sessions
+
+async def read_session_factory():
+    """Фабрика сессий для чтения: реплика, если routing.router её допускает, иначе основная БД"""
+    from routing import router, READ
+    # Проверка отставания синхронная, но кэшируется на REPLICA_CHECK_INTERVAL
+    if router.replica_url and await asyncio.to_thread(router.target, READ) == "replica":
+        return _replica_session_factory(router.replica_url)
+    return AsyncSessionLocal
+
+async def _diag_query(sessions):
+    async with sessions() as s:
+        count = (await s.execute(select(func.count()).select_from(SurveyResponse))).scalar()
+        last = (await s.execute(
+            select(SurveyResponse).order_by(SurveyResponse.id.desc()).limit(1)
+        )).scalars().first()
+    return count, last
+
+async def diag_summary():
+    """count и последняя запись для /_diag/db (с реплики, если она в порядке)"""
+    from sqlalchemy.exc import OperationalError, InterfaceError
+    from routing import router
+    sessions = await read_session_factory()
+    if sessions is AsyncSessionLocal:
+        return await _diag_query(sessions)
+    try:
+        return await _diag_query(sessions)
+    except (OperationalError, InterfaceError) as e:
+        router.mark_replica_down(e)
+    return await _diag_query(AsyncSessionLocal)
@@ -1,8 +1,11 @@
 -- Исправление типов данных для миграции из SQLite
--- user_id должен быть BIGINT для хранения больших Telegram ID
-
--- Изменяем тип user_id на BIGINT
-ALTER TABLE survey_responses ALTER COLUMN user_id TYPE BIGINT;
+-- user_id должен быть BIGINT для хранения больших Telegram ID, birth_date — DATE
+--
+-- Не выполняйте ALTER TABLE survey_responses ALTER COLUMN ... TYPE на рабочей
+-- таблице: он переписывает её целиком под эксклюзивной блокировкой.
+-- Используйте онлайн-миграцию:
+--   python3 online_migration.py run
+--   python3 online_migration.py cleanup
 
 -- Проверяем результат
 SELECT column_name, data_type, is_nullable, column_default
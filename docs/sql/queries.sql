@@ -3,3 +3,17 @@ SELECT id, user_id, full_name, birth_date, citizenship, created_at
 FROM survey_responses
 ORDER BY id DESC
 LIMIT 50;
+
+-- Ответы конкретного пользователя (индекс ix_survey_responses_user_id_id)
+SELECT id, user_id, full_name, birth_date, citizenship, created_at
+FROM survey_responses
+WHERE user_id = :user_id
+ORDER BY id DESC
+LIMIT 20;
+
+-- Ответы за интервал времени (индекс ix_survey_responses_created_at)
+SELECT id, user_id, full_name, birth_date, citizenship, created_at
+FROM survey_responses
+WHERE created_at >= :start AND created_at < :end
+ORDER BY created_at, id
+LIMIT 100;
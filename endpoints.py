@@ -0,0 +1,241 @@
+# endpoints.py
+"""
+Содержимое HTTP-эндпоинтов, общее для Flask (server.py) и ASGI (asgi.py).
+Каждая функция возвращает (payload, status); сериализацией занимается сервер.
+"""
+
+import logging
+
+import database
+from db import save_response
+
+logger = logging.getLogger(__name__)
+
+HOME_HTML = """
+    <h1>🤖 Telegram Questionnaire Bot</h1>
+    <p>Бот работает и готов к использованию!</p>
+    <p><strong>Статус:</strong> ✅ Активен</p>
+    <p><strong>Функции:</strong></p>
+    <ul>
+        <li>📋 Опрос пользователей</li>
+        <li>💾 Сохранение данных в SQLite</li>
+        <li>🌐 Готов к развертыванию на Render</li>
+    </ul>
+    <p><a href="/health">🔍 Проверить здоровье системы</a></p>
+    <p><a href="/db-info">📊 Информация о базе данных</a></p>
+    <p><a href="/test-db">🧪 Тест новой базы данных</a></p>
+    """
+
+# Таблицы, от версий которых зависит ответ маршрута (http_cache.py): ETag и 304
+# без вычисления ответа. Выгрузки и другие маршруты по данным добавляются сюда.
+# /_diag/* сюда не входят: в ответе живое состояние процесса (routing, user_cache),
+# которое меняется без вставок, — ETag у них по телу.
+CACHE_TABLES = {
+    "/stats": ("survey_rollups",),
+    "/stats/rollups": ("survey_rollups",),
+}
+
+# Маршруты с записью: без ETag и кэширования
+NO_STORE = ("/test-db",)
+
+def cache_tables(path, params=None):
+    """Таблицы для условного GET маршрута или () — ETag по телу ответа"""
+    # Агрегаты legacy лежат в другой БД, их версии здесь не видны
+    if path == "/stats/rollups" and params and params.get("source", "db") != "db":
+        return ()
+    return CACHE_TABLES.get(path, ())
+
+def health(server="flask"):
+    """Проверка здоровья всей системы"""
+    try:
+        # Проверяем здоровье базы данных
+        db_health = database.health_check()
+
+        # Общая оценка здоровья
+        overall_status = "healthy" if db_health["status"] == "healthy" else "degraded"
+
+        return {
+            "status": overall_status,
+            "timestamp": database.datetime.now().isoformat(),
+            "database": db_health,
+            "bot": "running",
+            "server": server
+        }, 200
+    except Exception as e:
+        logger.error(f"Health check failed: {e}")
+        return {
+            "status": "unhealthy",
+            "error": str(e),
+            "timestamp": database.datetime.now().isoformat()
+        }, 500
+
+def db_info():
+    """Информация о базе данных"""
+    try:
+        db_info = database.get_database_info()
+        return {
+            "database_info": db_info,
+            "timestamp": database.datetime.now().isoformat()
+        }, 200
+    except Exception as e:
+        logger.error(f"Database info failed: {e}")
+        return {
+            "error": str(e),
+            "timestamp": database.datetime.now().isoformat()
+        }, 500
+
+def stats():
+    """Статистика опросов (по агрегатам rollups.py, без обхода таблицы)"""
+    try:
+        import rollups
+        report = rollups.report("db", top=10)
+        return {
+            "total_responses": report["total_responses"],
+            "unique_users": report["unique_users"],
+            "average_per_user": report["average_per_user"],
+            "top_citizenship": report["citizenship"],
+            "updated_at": report["updated_at"],
+            "timestamp": database.datetime.now().isoformat()
+        }, 200
+    except Exception as e:
+        logger.error(f"Stats failed: {e}")
+        return {
+            "error": str(e),
+            "timestamp": database.datetime.now().isoformat()
+        }, 500
+
+def rollups_report(params):
+    """Отчёт по агрегатам: ?source=db|legacy&bucket=10&start=YYYY-MM-DD&end=YYYY-MM-DD&top=N"""
+    try:
+        import rollups
+        from validation import to_date
+        start, end = params.get("start"), params.get("end")
+        if (start and to_date(start) is None) or (end and to_date(end) is None):
+            return {"error": "start/end: ожидается дата YYYY-MM-DD"}, 400
+        report = rollups.report(
+            params.get("source", "db"),
+            bucket=int(params.get("bucket", 10)),
+            start=to_date(start) if start else None,
+            end=to_date(end) if end else None,
+            top=int(params["top"]) if params.get("top") else None,
+        )
+        return report, 200
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    except Exception as e:
+        logger.error(f"Rollups report failed: {e}")
+        return {"error": str(e)}, 500
+
+def broadcasts(params):
+    """Рассылки (broadcast.py): прогресс, скорость, оценка времени; ?name= — одна"""
+    try:
+        import broadcast
+        return broadcast.status(params.get("name")), 200
+    except Exception as e:
+        logger.error(f"Broadcast status failed: {e}")
+        return {"error": str(e)}, 500
+
+def transport_stats():
+    """Метрики вызовов Telegram API этого процесса по методам (transport.py)"""
+    import transport
+    return {"client": transport.TG_HTTP_CLIENT, "http2": transport.TG_HTTP2, "methods": transport.stats()}, 200
+
+def spool_status():
+    """Автомат записи в БД и анкеты, ожидающие переноса из spool (spool.py)"""
+    import spool
+    try:
+        return {"writers": spool.status()}, 200
+    except Exception as e:
+        logger.error(f"Spool status failed: {e}")
+        return {"error": str(e)}, 500
+
+def diag_payload(dialect, count, last):
+    """Ответ /_diag/db по результатам запросов"""
+    out = {"ok": True, "dialect": dialect, "count": count}
+    if last:
+        out["last"] = {
+            "id": last.id,
+            "user_id": last.user_id,
+            "full_name": last.full_name,
+            "birth_date": str(last.birth_date) if last.birth_date is not None else None,
+            "citizenship": last.citizenship,
+            "created_at": str(getattr(last, "created_at", None)) if getattr(last, "created_at", None) else None,
+        }
+    return out
+
+def diag_db():
+    """Диагностика базы данных survey_responses"""
+    try:
+        from db import engine, SurveyResponse
+        import user_cache
+        from routing import router
+
+        def summary(s):
+            count = s.query(SurveyResponse).count()
+            last = s.query(SurveyResponse).order_by(SurveyResponse.id.desc()).first()
+            return count, last
+
+        count, last = router.read(summary)
+        out = diag_payload(engine.dialect.name, count, last)
+        out["routing"] = router.status()
+        out["user_cache"] = user_cache.cache.status()
+        return out, 200
+    except Exception as e:
+        return {"ok": False, "error": str(e)}, 500
+
+def test_db():
+    """Тестирование новой базы данных (db.py)"""
+    try:
+        # Тестируем сохранение ответа
+        test_user_id = 12345
+        test_question = "Тестовый вопрос"
+        test_answer = "Тестовый ответ"
+
+        save_response(test_user_id, test_question, test_answer)
+
+        return {
+            "status": "success",
+            "message": "Тестовый ответ сохранен в новую базу данных",
+            "user_id": test_user_id,
+            "question": test_question,
+            "answer": test_answer,
+            "timestamp": database.datetime.now().isoformat()
+        }, 200
+    except Exception as e:
+        logger.error(f"Test DB failed: {e}")
+        return {
+            "status": "error",
+            "error": str(e),
+            "timestamp": database.datetime.now().isoformat()
+        }, 500
+
+def debug_profile(params, token):
+    """
+    Сэмплирующий профиль всех потоков процесса (profiler.py).
+    Возвращает (свёрнутые стеки текстом или dict, статус).
+    """
+    import profiler
+    denied = profiler.check_token(token)
+    if denied:
+        return {"error": "not found" if denied == 404 else "forbidden"}, denied
+    try:
+        seconds = float(params.get("seconds", 10))
+        interval = float(params.get("interval", profiler.DEFAULT_INTERVAL))
+    except ValueError:
+        return {"error": "seconds/interval: ожидается число"}, 400
+    idle = params.get("idle", "1") not in ("0", "false", "no")
+    try:
+        counts, samples = profiler.sample(seconds, interval, idle)
+    except profiler.ProfilerBusy:
+        return {"error": "профиль уже снимается"}, 409
+    if params.get("format") == "json":
+        return profiler.summary(counts, samples), 200
+    return profiler.collapsed(counts), 200
+
+def debug_stacks(token):
+    """Текущие стеки всех потоков процесса"""
+    import profiler
+    denied = profiler.check_token(token)
+    if denied:
+        return {"error": "not found" if denied == 404 else "forbidden"}, denied
+    return profiler.dump_stacks(), 200
@@ -0,0 +1,267 @@
+# fake_telegram_api.py
+"""
+Локальная заглушка Telegram Bot API для проверок производительности и бенчмарков.
+
+Отвечает на любые методы /bot<token>/<method> корректными JSON-ответами,
+записывает все исходящие вызовы и отдаёт через getUpdates апдейты,
+поставленные в очередь методом push_updates(). Можно задать искусственную
+задержку ответа и ошибки для отдельных chat_id (например, 403 "bot was blocked").
+
+    with FakeTelegramAPI(latency=0.005) as api:
+        api.install()   # направляет telebot.apihelper на заглушку
+        ...
+"""
+
+import json
+import time
+import threading
+from urllib.parse import parse_qsl, urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BOT_USER = {"id": 100000001, "is_bot": True, "first_name": "FakeBot", "username": "fake_survey_bot"}
+
+class FakeTelegramAPI:
+    """HTTP-сервер в фоне, имитирующий api.telegram.org"""
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0):
+        self.latency = latency
+        self.calls = []
+        self.errors = {}  # {chat_id: (error_code, description)}
+        self._updates = []
+        self._update_id = 0
+        self._message_id = 0
+        self._lock = threading.Lock()
+        self._has_updates = threading.Condition(self._lock)
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    # --- управление ---
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def api_url(self):
+        """Шаблон для telebot.apihelper.API_URL"""
+        return self.url + "/bot{0}/{1}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-telegram-api", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        with self._lock:
+            self._has_updates.notify_all()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def install(self):
+        """Направляет синхронный и асинхронный клиенты telebot на заглушку"""
+        from telebot import apihelper, asyncio_helper
+        apihelper.API_URL = self.api_url
+        asyncio_helper.API_URL = self.api_url
+        return self
+
+    @staticmethod
+    def uninstall():
+        from telebot import apihelper, asyncio_helper
+        apihelper.API_URL = None
+        asyncio_helper.API_URL = None
+
+    # --- апдейты ---
+
+    def next_update_id(self):
+        with self._lock:
+            self._update_id += 1
+            return self._update_id
+
+    def push_updates(self, updates):
+        """Ставит апдейты (dict) в очередь getUpdates; update_id проставляется, если его нет"""
+        with self._lock:
+            for update in updates:
+                if "update_id" not in update:
+                    self._update_id += 1
+                    update = {**update, "update_id": self._update_id}
+                else:
+                    self._update_id = max(self._update_id, update["update_id"])
+                self._updates.append(update)
+            self._has_updates.notify_all()
+
+    def pending_updates(self):
+        with self._lock:
+            return len(self._updates)
+
+    def _get_updates(self, params):
+        offset = int(params.get("offset", 0) or 0)
+        limit = int(params.get("limit", 100) or 100)
+        timeout = float(params.get("timeout", 0) or 0)
+        allowed = params.get("allowed_updates")
+        allowed = set(json.loads(allowed)) if allowed else None
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while True:
+                # Подтверждённые (update_id < offset) апдейты удаляются, как в настоящем API
+                if offset > 0:
+                    self._updates = [u for u in self._updates if u["update_id"] >= offset]
+                elif offset < 0:
+                    self._updates = self._updates[offset:]
+                batch = [u for u in self._updates
+                         if allowed is None or any(k in allowed for k in u if k != "update_id")]
+                if batch or timeout <= 0:
+                    return batch[:limit]
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+                self._has_updates.wait(remaining)
+
+    # --- ответы ---
+
+    def _message(self, params):
+        with self._lock:
+            self._message_id += 1
+            message_id = self._message_id
+        chat_id = params.get("chat_id", 0)
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            pass
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            "text": params.get("text", ""),
+        }
+
+    def respond(self, method, params):
+        """Результат для метода API: (http_status, body)"""
+        chat_id = params.get("chat_id")
+        if chat_id is not None:
+            error = self.errors.get(str(chat_id)) or self.errors.get(_to_int(chat_id))
+            if error:
+                code, description, *rest = error
+                body = {"ok": False, "error_code": code, "description": description}
+                if rest:
+                    body["parameters"] = rest[0]
+                return code, body
+
+        if method == "getUpdates":
+            result = self._get_updates(params)
+        elif method == "getMe":
+            result = BOT_USER
+        elif method in ("sendMessage", "editMessageText", "editMessageReplyMarkup"):
+            result = self._message(params)
+        else:
+            result = True
+        return 200, {"ok": True, "result": result}
+
+    def _handler_class(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Заголовки и тело пишутся отдельно: без TCP_NODELAY keep-alive ждёт delayed ACK (~40 мс)
+            disable_nagle_algorithm = True
+
+            def _handle(self):
+                parts = urlsplit(self.path)
+                method = parts.path.rsplit("/", 1)[-1]
+                params = dict(parse_qsl(parts.query, keep_blank_values=True))
+                length = int(self.headers.get("Content-Length", 0) or 0)
+                if length:
+                    body = self.rfile.read(length)
+                    ctype = self.headers.get("Content-Type", "")
+                    if ctype.startswith("application/json"):
+                        params.update(json.loads(body or b"{}"))
+                    elif ctype.startswith("application/x-www-form-urlencoded"):
+                        params.update(parse_qsl(body.decode(), keep_blank_values=True))
+
+                if method != "getUpdates":
+                    with api._lock:
+                        api.calls.append((time.time(), method, params))
+                    if api.latency:
+                        time.sleep(api.latency)
+
+                status, payload = api.respond(method, params)
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = _handle
+            do_POST = _handle
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return value
+
+# --- генерация апдейтов ---
+
+def user_dict(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "language_code": "ru"}
+
+def message_update(user_id, text, message_id=1, update_id=None):
+    update = {
+        "message": {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": user_dict(user_id),
+            "text": text,
+        }
+    }
+    if text.startswith("/"):
+        command = text.split()[0]
+        update["message"]["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+    if update_id is not None:
+        update["update_id"] = update_id
+    return update
+
+def callback_update(user_id, data, message_id=1, update_id=None, callback_id=None):
+    update = {
+        "callback_query": {
+            "id": callback_id or f"{user_id}-{message_id}-{data}",
+            "from": user_dict(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": BOT_USER,
+                "text": "menu",
+            },
+        }
+    }
+    if update_id is not None:
+        update["update_id"] = update_id
+    return update
+
+def survey_updates(user_id, full_name="Иванов Иван Иванович", birth_date="15.03.1990", citizenship="Россия"):
+    """Апдейты полного прохождения опроса одним пользователем"""
+    return [
+        message_update(user_id, "/start", 1),
+        callback_update(user_id, "start_survey", 2),
+        message_update(user_id, full_name, 3),
+        message_update(user_id, birth_date, 4),
+        callback_update(user_id, f"citizenship_{citizenship}", 5),
+    ]
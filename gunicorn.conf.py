@@ -0,0 +1,34 @@
+# gunicorn.conf.py
+"""
+Конфигурация gunicorn для HTTP-эндпоинтов (wsgi:app) в продакшен-режиме.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+"""
+
+import os
+import multiprocessing
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5008')}"
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get("WEB_THREADS", "2"))
+timeout = int(os.environ.get("WEB_TIMEOUT", "30"))
+# Время на завершение текущих запросов после SIGTERM
+graceful_timeout = int(os.environ.get("SHUTDOWN_TIMEOUT", "25"))
+keepalive = 5
+accesslog = "-"
+loglevel = os.environ.get("LOG_LEVEL", "info").lower()
+
+def on_starting(server):
+    """Схема БД создаётся один раз в мастер-процессе, до запуска воркеров"""
+    import db
+    import database
+    db.init_db()
+    database.init_db()
+    # Соединения не должны наследоваться воркерами после fork
+    db.engine.dispose()
+    database.engine.dispose()
+
+def post_fork(server, worker):
+    """Подписка воркера на общий канал сброса кэша пользователей (USER_CACHE_CHANNEL)"""
+    import user_cache
+    user_cache.start_channel()
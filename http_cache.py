@@ -0,0 +1,334 @@
+# http_cache.py
+"""
+Ответы JSON-эндпоинтов server.py и asgi.py: условный GET, сжатие, быстрый JSON.
+
+Дашборды опрашивают /stats и /_diag/* постоянно, а данные меняются редко:
+- версии таблиц хранятся в table_versions (name, version, updated_at) и
+  увеличиваются в той же транзакции, что и запись (rollups.refresh). Версия
+  ведётся только для таблиц, которые читает какой-нибудь маршрут из
+  endpoints.CACHE_TABLES: лишний bump — запись в горячую строку на каждую
+  вставку. Маршрут, зависящий от таблиц, получает ETag и
+  Last-Modified из их версий до вычисления ответа: совпавший If-None-Match
+  (или If-Modified-Since) отвечается 304 без запросов к данным, а готовое
+  тело для той же версии отдаётся из кэша в памяти (HTTP_CACHE_ENTRIES).
+  Версии читаются не чаще раза в HTTP_VERSION_TTL секунд на процесс —
+  столько может отставать ответ после вставки в другом процессе;
+- у остальных JSON-маршрутов ETag считается по телу: 304 экономит трафик,
+  но не вычисление;
+- тело больше HTTP_COMPRESS_MIN_BYTES сжимается brotli (пакет brotli или
+  brotlicffi) или gzip по Accept-Encoding;
+- JSON сериализует HTTP_JSON_ENCODER: auto (orjson, если установлен, иначе
+  json), orjson, json или "модуль:функция" — функция принимает объект и
+  возвращает bytes. Даты и время — в ISO 8601.
+
+Новый JSON-маршрут (в т.ч. выгрузки) подключается через json_response в
+server.py / _json_route в asgi.py; tables — таблицы, от которых зависит ответ.
+"""
+
+import os
+import gzip
+import json
+import time
+import hashlib
+import logging
+import importlib
+import threading
+from collections import OrderedDict
+from datetime import date, datetime
+from decimal import Decimal
+from email.utils import formatdate, parsedate_to_datetime
+
+from sqlalchemy import MetaData, Table, Column, Text, BigInteger, Float, select
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
+
+logger = logging.getLogger(__name__)
+
+HTTP_JSON_ENCODER = os.getenv("HTTP_JSON_ENCODER", "auto")
+HTTP_COMPRESS_MIN_BYTES = int(os.getenv("HTTP_COMPRESS_MIN_BYTES", "1024"))
+HTTP_GZIP_LEVEL = int(os.getenv("HTTP_GZIP_LEVEL", "6"))
+HTTP_BROTLI_QUALITY = int(os.getenv("HTTP_BROTLI_QUALITY", "5"))
+HTTP_VERSION_TTL = float(os.getenv("HTTP_VERSION_TTL", "1"))
+HTTP_CACHE_ENTRIES = int(os.getenv("HTTP_CACHE_ENTRIES", "128"))
+
+JSON_CONTENT_TYPE = "application/json"
+
+metadata = MetaData()
+
+versions_table = Table(
+    "table_versions", metadata,
+    Column("name", Text, primary_key=True),
+    Column("version", BigInteger, nullable=False),
+    Column("updated_at", Float, nullable=False),
+)
+
+def ensure_tables(engine):
+    metadata.create_all(bind=engine)
+
+def bump_statement(dialect, name):
+    """UPSERT, увеличивающий версию таблицы name; выполняется в транзакции записи"""
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        return None
+    stmt = insert(versions_table).values(name=name, version=1, updated_at=time.time())
+    return stmt.on_conflict_do_update(
+        index_elements=[versions_table.c.name],
+        set_={"version": versions_table.c.version + 1, "updated_at": stmt.excluded.updated_at},
+    )
+
+def bump(conn, name):
+    """
+    Версия name + 1 на соединении или сессии conn в её транзакции; после
+    commit вызывающий сбрасывает кэш версий процесса (invalidate).
+    """
+    dialect = conn.dialect if hasattr(conn, "dialect") else conn.get_bind().dialect
+    stmt = bump_statement(dialect.name, name)
+    if stmt is not None:
+        conn.execute(stmt)
+
+# --- JSON ---
+
+def _default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    return str(value)
+
+def _orjson_encode(payload):
+    return orjson.dumps(payload, default=_default, option=orjson.OPT_NON_STR_KEYS)
+
+def _json_encode(payload):
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":"), default=_default).encode("utf-8")
+
+ENCODERS = {"orjson": _orjson_encode, "json": _json_encode}
+
+def encoder_factory(name):
+    """Функция сериализации по имени из ENCODERS, "auto" или "модуль:функция" """
+    if name == "auto":
+        return _orjson_encode if orjson is not None else _json_encode
+    if name == "orjson" and orjson is None:
+        raise RuntimeError("HTTP_JSON_ENCODER=orjson: пакет orjson не установлен (pip install orjson)")
+    if name in ENCODERS:
+        return ENCODERS[name]
+    module, _, attr = name.partition(":")
+    if not attr:
+        raise ValueError(f"HTTP_JSON_ENCODER: неизвестный сериализатор {name!r}")
+    return getattr(importlib.import_module(module), attr)
+
+encode = encoder_factory(HTTP_JSON_ENCODER)
+
+# --- сжатие ---
+
+def _accepted(accept_encoding):
+    """{кодировка: q} из заголовка Accept-Encoding"""
+    accepted = {}
+    for part in (accept_encoding or "").split(","):
+        name, _, params = part.strip().partition(";")
+        if not name:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip().lower()] = q
+    return accepted
+
+def negotiate(accept_encoding):
+    """br, gzip или None (без сжатия)"""
+    accepted = _accepted(accept_encoding)
+    candidates = (["br"] if brotli is not None else []) + ["gzip"]
+    best = max(candidates, key=lambda e: accepted.get(e, accepted.get("*", 0.0)))
+    return best if accepted.get(best, accepted.get("*", 0.0)) > 0 else None
+
+def compress(body, encoding):
+    if encoding == "br":
+        return brotli.compress(body, quality=HTTP_BROTLI_QUALITY)
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=HTTP_GZIP_LEVEL, mtime=0)
+    return body
+
+# --- версии таблиц и условный GET ---
+
+class Validators:
+    """ETag и Last-Modified ответа"""
+
+    def __init__(self, etag, last_modified=None):
+        self.etag = etag
+        self.last_modified = last_modified
+
+    def headers(self):
+        out = [("ETag", self.etag)]
+        if self.last_modified:
+            out.append(("Last-Modified", formatdate(self.last_modified, usegmt=True)))
+        return out
+
+class VersionCache:
+    """Версии таблиц, прочитанные не позже ttl секунд назад; invalidate() — после своей записи"""
+
+    def __init__(self, ttl=HTTP_VERSION_TTL):
+        self.ttl = ttl
+        self._versions = {}
+        self._read_at = 0.0
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        with self._lock:
+            self._read_at = 0.0
+
+    def get(self, tables):
+        with self._lock:
+            if time.monotonic() - self._read_at < self.ttl and all(t in self._versions for t in tables):
+                return {t: self._versions[t] for t in tables}
+        # Через маршрутизатор чтения: версия и данные ответа — с одной и той же БД
+        from routing import read
+        rows = read(lambda s: s.execute(
+            select(versions_table.c.name, versions_table.c.version, versions_table.c.updated_at)
+        ).all())
+        with self._lock:
+            self._versions = {row.name: (row.version, row.updated_at) for row in rows}
+            for t in tables:
+                # Таблица без вставок — версия 0, иначе каждый запрос шёл бы в БД
+                self._versions.setdefault(t, (0, None))
+            self._read_at = time.monotonic()
+            return {t: self._versions.get(t, (0, None)) for t in tables}
+
+versions = VersionCache()
+
+def invalidate():
+    versions.invalidate()
+
+def _tag(data):
+    return 'W/"' + hashlib.sha1(data).hexdigest()[:20] + '"'
+
+def validators(tables, key):
+    """Validators по версиям tables для ответа key (путь с запросом) или None, если версии недоступны"""
+    try:
+        current = versions.get(tables)
+    except Exception as e:
+        logger.warning(f"Версии таблиц недоступны, ETag по телу ответа: {e}")
+        return None
+    stamp = ";".join(f"{t}={current[t][0]}" for t in sorted(current))
+    modified = [updated for _, updated in current.values() if updated]
+    return Validators(_tag(f"{key}|{stamp}".encode()), max(modified) if modified else None)
+
+def _etag_matches(header, etag):
+    if header.strip() == "*":
+        return True
+    # Слабое сравнение: W/ и сжатие не влияют
+    tags = {t.strip().removeprefix("W/") for t in header.split(",")}
+    return etag.removeprefix("W/") in tags
+
+def not_modified(request_headers, tag):
+    """Можно ли ответить 304 (If-None-Match важнее If-Modified-Since)"""
+    if tag is None:
+        return False
+    if_none_match = request_headers.get("if-none-match")
+    if if_none_match:
+        return _etag_matches(if_none_match, tag.etag)
+    if_modified_since = request_headers.get("if-modified-since")
+    if if_modified_since and tag.last_modified:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(tag.last_modified) <= since
+    return False
+
+# --- ответ ---
+
+class HttpResponse:
+    """status, headers [(имя, значение)], body (bytes)"""
+
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+_bodies = OrderedDict()
+_bodies_lock = threading.Lock()
+stats = {"not_modified": 0, "cache_hits": 0, "rendered": 0, "compressed": 0}
+
+def _count(key):
+    with _bodies_lock:
+        stats[key] += 1
+
+def _common_headers(tag, cache_control):
+    headers = [("Vary", "Accept-Encoding"), ("Cache-Control", cache_control)]
+    if tag is not None:
+        headers += tag.headers()
+    return headers
+
+def lookup(tag, request_headers, cache_control="no-cache"):
+    """304 или готовое тело для версии tag; None — ответ надо вычислить"""
+    if tag is None:
+        return None
+    if not_modified(request_headers, tag):
+        _count("not_modified")
+        return HttpResponse(304, _common_headers(tag, cache_control), b"")
+    encoding = negotiate(request_headers.get("accept-encoding"))
+    with _bodies_lock:
+        cached = _bodies.get((tag.etag, encoding))
+        if cached is not None:
+            _bodies.move_to_end((tag.etag, encoding))
+            stats["cache_hits"] += 1
+    return cached
+
+def render(payload, status, request_headers, tag=None, cache_control="no-cache", conditional=True):
+    """
+    Сериализует payload; без tag ETag считается по телу (conditional=False —
+    без ETag, для эндпоинтов с записью); сжатие по Accept-Encoding.
+    """
+    body = encode(payload)
+    _count("rendered")
+    if status != 200:
+        return HttpResponse(status, [("Content-Type", JSON_CONTENT_TYPE), ("Cache-Control", "no-store")], body)
+    cacheable = tag is not None
+    if tag is None and conditional:
+        tag = Validators(_tag(body))
+        if not_modified(request_headers, tag):
+            _count("not_modified")
+            return HttpResponse(304, _common_headers(tag, cache_control), b"")
+    headers = [("Content-Type", JSON_CONTENT_TYPE)] + _common_headers(tag, cache_control)
+    accepted = negotiate(request_headers.get("accept-encoding"))
+    encoding = accepted if len(body) >= HTTP_COMPRESS_MIN_BYTES else None
+    if encoding:
+        body = compress(body, encoding)
+        headers.append(("Content-Encoding", encoding))
+        _count("compressed")
+    response = HttpResponse(200, headers, body)
+    if cacheable and HTTP_CACHE_ENTRIES > 0:
+        # Ключ — кодировка, выбранная для запроса, как в lookup (маленькое тело хранится несжатым)
+        with _bodies_lock:
+            _bodies[(tag.etag, accepted)] = response
+            while len(_bodies) > HTTP_CACHE_ENTRIES:
+                _bodies.popitem(last=False)
+    return response
+
+def status():
+    with _bodies_lock:
+        return {
+            "encoder": HTTP_JSON_ENCODER if HTTP_JSON_ENCODER != "auto" else ("orjson" if orjson else "json"),
+            "brotli": brotli is not None,
+            "cached_bodies": len(_bodies),
+            **stats,
+        }
@@ -0,0 +1,232 @@
+# idempotency.py
+"""
+Дедупликация апдейтов Telegram до любой работы обработчиков.
+
+Один и тот же апдейт может прийти повторно: ретраи после 409 в run_bot,
+перезапуск polling, повторная доставка вебхука. Ключи апдейта —
+"u:<update_id>" и для нажатий кнопок "c:<callback_query.id>" — проверяются
+в ограниченном LRU в памяти; повтор отбрасывается без обращения к БД.
+
+IDEMPOTENCY_BACKEND=db добавляет общее хранилище для нескольких реплик:
+таблица processed_updates, вставка INSERT ... ON CONFLICT DO NOTHING. Записи
+старше IDEMPOTENCY_TTL_HOURS периодически удаляются.
+
+Ключ захватывается до запуска обработчика, чтобы параллельная повторная
+доставка не выполнилась второй раз, а обработанным помечается после него
+(finish): если обработчик упал, захват снимается и повтор будет обработан.
+Захват в processed_updates, не завершённый за IDEMPOTENCY_CLAIM_SECONDS
+(процесс убит посреди обработчика), может забрать повторная доставка.
+Последний рубеж — idempotency_key в survey_responses (см. survey.idempotency_key).
+"""
+
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+from telebot import util
+
+logger = logging.getLogger(__name__)
+
+# Атрибут message/callback_query с ключами апдейта до finish()
+_ATTR = "_idempotency_keys"
+
+class SeenKeys:
+    """Ограниченное множество недавно обработанных ключей (LRU)"""
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def add(self, key):
+        with self._lock:
+            self._items[key] = None
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def __len__(self):
+        return len(self._items)
+
+class DbSeenKeys:
+    """Общее между репликами хранилище ключей в таблице processed_updates"""
+
+    def __init__(self, ttl_hours=24, prune_interval=600, claim_seconds=30):
+        self.ttl = timedelta(hours=ttl_hours)
+        self.prune_interval = prune_interval
+        self.claim_timeout = timedelta(seconds=claim_seconds)
+        self._last_prune = 0.0
+
+    @staticmethod
+    def _utcnow():
+        # seen_at хранится в UTC без пояса
+        return datetime.now(timezone.utc).replace(tzinfo=None)
+
+    def claim(self, keys):
+        """
+        Захватывает ключи; возвращает те, что до этого не встречались или чей
+        захват не завершился за claim_timeout
+        """
+        from sqlalchemy import update, func
+        from db import SessionLocal, ProcessedUpdate, insert_ignore
+        fresh = set()
+        with SessionLocal() as s:
+            for key in keys:
+                stmt = insert_ignore(ProcessedUpdate.__table__, {"key": key, "done": False}, ProcessedUpdate.key)
+                if s.execute(stmt).scalar() is not None:
+                    fresh.add(key)
+                    continue
+                stale = s.execute(
+                    update(ProcessedUpdate)
+                    .where(ProcessedUpdate.key == key, ProcessedUpdate.done.is_(False),
+                           ProcessedUpdate.seen_at < self._utcnow() - self.claim_timeout)
+                    .values(seen_at=func.now())
+                    .returning(ProcessedUpdate.key)
+                ).scalar()
+                if stale is not None:
+                    fresh.add(key)
+            s.commit()
+        self._maybe_prune()
+        return fresh
+
+    def complete(self, keys):
+        """Обработчик завершился: ключи больше не перезахватываются"""
+        from sqlalchemy import update
+        from db import SessionLocal, ProcessedUpdate
+        with SessionLocal() as s:
+            s.execute(update(ProcessedUpdate).where(ProcessedUpdate.key.in_(keys)).values(done=True))
+            s.commit()
+
+    def release(self, keys):
+        """Обработчик упал: снимает незавершённый захват, повтор будет обработан"""
+        from sqlalchemy import delete
+        from db import SessionLocal, ProcessedUpdate
+        with SessionLocal() as s:
+            s.execute(delete(ProcessedUpdate).where(ProcessedUpdate.key.in_(keys), ProcessedUpdate.done.is_(False)))
+            s.commit()
+
+    def _maybe_prune(self):
+        now = time.monotonic()
+        if now - self._last_prune < self.prune_interval:
+            return
+        self._last_prune = now
+        from sqlalchemy import delete
+        from db import SessionLocal, ProcessedUpdate
+        try:
+            with SessionLocal() as s:
+                s.execute(delete(ProcessedUpdate).where(ProcessedUpdate.seen_at < self._utcnow() - self.ttl))
+                s.commit()
+        except Exception as e:
+            logger.warning(f"Не удалось очистить processed_updates: {e}")
+
+def _payload(update):
+    """message/callback_query и т.п. — то, что получает обработчик"""
+    for kind in util.update_types:
+        payload = getattr(update, kind, None)
+        if payload is not None:
+            return payload
+    return None
+
+def update_keys(update):
+    """Ключи идемпотентности апдейта"""
+    keys = [f"u:{update.update_id}"]
+    call = getattr(update, "callback_query", None)
+    if call is not None:
+        keys.append(f"c:{call.id}")
+    return keys
+
+class UpdateDeduplicator:
+    """
+    Отбрасывает уже обработанные апдейты. namespace отделяет ключи разных ботов
+    (tenants.py): update_id и id callback'ов у каждого бота свои.
+    """
+
+    def __init__(self, max_size=100000, shared=None, namespace=""):
+        self.seen = SeenKeys(max_size)
+        self.shared = shared
+        self.namespace = namespace
+        self.stats = {"processed": 0, "duplicates": 0, "shared_duplicates": 0, "shared_errors": 0, "released": 0}
+        self._stats_lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, namespace=""):
+        shared = None
+        if os.getenv("IDEMPOTENCY_BACKEND", "memory").lower() == "db":
+            shared = DbSeenKeys(ttl_hours=float(os.getenv("IDEMPOTENCY_TTL_HOURS", "24")),
+                                claim_seconds=float(os.getenv("IDEMPOTENCY_CLAIM_SECONDS", "30")))
+        return cls(max_size=int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "100000")), shared=shared, namespace=namespace)
+
+    def _count(self, name, n=1):
+        with self._stats_lock:
+            self.stats[name] += n
+
+    def filter(self, updates):
+        """Возвращает только ещё не обработанные апдейты (в исходном порядке)"""
+        fresh = []
+        batch_keys = set()
+        for update in updates:
+            keys = update_keys(update)
+            if self.namespace:
+                keys = [f"{self.namespace}:{key}" for key in keys]
+            if any(key in self.seen or key in batch_keys for key in keys):
+                self._count("duplicates")
+                continue
+            batch_keys.update(keys)
+            fresh.append((update, keys))
+
+        if self.shared is not None and fresh:
+            try:
+                claimed = self.shared.claim([key for _, keys in fresh for key in keys])
+            except Exception as e:
+                # Общее хранилище недоступно — обрабатываем по локальному кэшу
+                logger.error(f"Общая дедупликация апдейтов недоступна: {e}")
+                self._count("shared_errors")
+            else:
+                before = len(fresh)
+                fresh = [(update, keys) for update, keys in fresh if all(key in claimed for key in keys)]
+                self._count("shared_duplicates", before - len(fresh))
+
+        for update, keys in fresh:
+            for key in keys:
+                self.seen.add(key)
+            payload = _payload(update)
+            if payload is not None:
+                setattr(payload, _ATTR, keys)
+        self._count("processed", len(fresh))
+        return [update for update, _ in fresh]
+
+    def finish(self, payload, ok):
+        """
+        Вызывается обработчиком по завершении (payload — message/callback_query):
+        ok — помечает апдейт обработанным, иначе снимает захват, чтобы повторная
+        доставка не была отброшена как дубль.
+        """
+        keys = getattr(payload, _ATTR, None)
+        if keys is None:
+            return
+        setattr(payload, _ATTR, None)
+        if not ok:
+            for key in keys:
+                self.seen.discard(key)
+            self._count("released")
+        if self.shared is None:
+            return
+        try:
+            if ok:
+                self.shared.complete(keys)
+            else:
+                self.shared.release(keys)
+        except Exception as e:
+            logger.error(f"Не удалось {'завершить' if ok else 'снять'} захват апдейта {keys}: {e}")
+            self._count("shared_errors")
@@ -0,0 +1,199 @@
+# leader.py
+"""
+Выбор единственного процесса, который опрашивает Telegram (getUpdates).
+
+При нескольких репликах или перезапусках два поллера получают 409 Conflict
+и мешают друг другу. LeaderLock гарантирует, что поллер один:
+- PostgreSQL: pg_try_advisory_lock на отдельном соединении (снимается при обрыве соединения)
+- SQLite/локально: эксклюзивная блокировка файла (fcntl.flock)
+
+Кратковременная недоступность БД лидерство не снимает: check() повторяет
+проверку с нарастающей паузой, переподключается и заново берёт блокировку
+(сессию, которая держит её после обрыва, завершает), а без связи с БД
+остаётся лидером BOT_LEADER_GRACE_SECONDS — пока БД недоступна, другой
+процесс блокировку тоже не возьмёт. Отказ — только если блокировку взял
+другой процесс или связи нет дольше grace-периода.
+"""
+
+import os
+import time
+import logging
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+# Произвольная константа для pg_advisory_lock
+DEFAULT_LOCK_KEY = 726351009
+# Сколько лидер без связи с БД продолжает polling
+LEADER_GRACE_SECONDS = float(os.getenv("BOT_LEADER_GRACE_SECONDS", "60"))
+# Попытки в одном check() и пауза перед первым повтором (дальше удваивается)
+LEADER_CHECK_ATTEMPTS = int(os.getenv("BOT_LEADER_CHECK_ATTEMPTS", "3"))
+LEADER_CHECK_BACKOFF = float(os.getenv("BOT_LEADER_CHECK_BACKOFF", "0.5"))
+# Сколько ждать освобождения блокировки после завершения прежней сессии
+TERMINATE_WAIT_SECONDS = 2.0
+
+class LeaderLock:
+    """Блокировка лидера поверх БД или файла"""
+
+    def __init__(self, engine=None, key=DEFAULT_LOCK_KEY, path=None, grace_seconds=LEADER_GRACE_SECONDS,
+                 attempts=LEADER_CHECK_ATTEMPTS, backoff=LEADER_CHECK_BACKOFF):
+        self.engine = engine
+        self.key = key
+        self.path = path or os.getenv("BOT_LEADER_LOCK_FILE", "/tmp/telega_bot_poller.lock")
+        self.grace_seconds = grace_seconds
+        self.attempts = max(1, attempts)
+        self.backoff = backoff
+        self._conn = None
+        self._file = None
+        # pg_backend_pid сессии с блокировкой и момент, с которого связи с БД нет
+        self._pid = None
+        self._lost_at = None
+
+    @classmethod
+    def from_env(cls):
+        from db import engine
+        key = int(os.getenv("BOT_LEADER_LOCK_KEY", DEFAULT_LOCK_KEY))
+        return cls(engine if engine.dialect.name == "postgresql" else None, key=key)
+
+    @property
+    def held(self):
+        return self._conn is not None or self._file is not None
+
+    @property
+    def degraded(self):
+        """Связи с БД нет, лидерство держится на grace-периоде"""
+        return self._lost_at is not None
+
+    def acquire(self) -> bool:
+        """Пытается стать лидером, не блокируясь"""
+        if self.held:
+            return True
+        if self.engine is not None:
+            return self._lock_new_connection()
+
+        import fcntl
+        f = open(self.path, "a+")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        f.seek(0)
+        f.truncate()
+        f.write(str(os.getpid()))
+        f.flush()
+        self._file = f
+        return True
+
+    def _lock_new_connection(self, previous_pid=None):
+        """
+        Берёт блокировку на новом соединении. previous_pid — сессия этого же
+        процесса, оставшаяся на сервере после обрыва: если блокировка за ней,
+        сессия завершается и блокировка берётся заново.
+        """
+        conn = self.engine.connect()
+        try:
+            ok = self._try_lock(conn)
+            if not ok and previous_pid is not None and self._holder(conn) == previous_pid:
+                logger.warning(f"[leader] Блокировку держит прежняя сессия {previous_pid}, завершаю её")
+                conn.execute(text("SELECT pg_terminate_backend(:pid)"), {"pid": previous_pid})
+                deadline = time.monotonic() + TERMINATE_WAIT_SECONDS
+                while not ok and time.monotonic() < deadline:
+                    time.sleep(0.1)
+                    ok = self._try_lock(conn)
+            pid = conn.execute(text("SELECT pg_backend_pid()")).scalar() if ok else None
+            conn.commit()
+        except Exception:
+            conn.close()
+            raise
+        if ok:
+            self._conn, self._pid = conn, pid
+        else:
+            conn.close()
+        return bool(ok)
+
+    def _try_lock(self, conn):
+        return conn.execute(text("SELECT pg_try_advisory_lock(:k)"), {"k": self.key}).scalar()
+
+    def _holder(self, conn):
+        """pid сессии, которая держит блокировку, или None"""
+        return conn.execute(text(
+            "SELECT pid FROM pg_locks WHERE locktype = 'advisory' AND granted "
+            "AND classid::bigint = :hi AND objid::bigint = :lo AND objsubid = 1"
+        ), {"hi": (self.key >> 32) & 0xFFFFFFFF, "lo": self.key & 0xFFFFFFFF}).scalar()
+
+    def _verify(self):
+        """True — блокировка наша, False — её взял другой процесс; ошибка связи — исключение"""
+        if self._conn is not None:
+            try:
+                self._conn.execute(text("SELECT 1"))
+                self._conn.commit()
+                return True
+            except Exception as e:
+                logger.warning(f"[leader] Соединение с блокировкой потеряно: {e}")
+                try:
+                    self._conn.close()
+                except Exception:
+                    pass
+                self._conn = None
+        return self._lock_new_connection(previous_pid=self._pid)
+
+    def check(self) -> bool:
+        """
+        Остаётся ли процесс лидером. Для PostgreSQL проверяет соединение, при
+        ошибке повторяет с паузой и переподключается; без связи с БД отвечает
+        True, пока не истёк grace-период.
+        """
+        if self.engine is None:
+            return self._file is not None
+        if self._conn is None and self._lost_at is None:
+            return False
+        delay = self.backoff
+        for attempt in range(self.attempts):
+            try:
+                ok = self._verify()
+            except Exception as e:
+                logger.warning(f"[leader] Проверка блокировки не удалась ({attempt + 1}/{self.attempts}): {e}")
+                if attempt + 1 < self.attempts:
+                    time.sleep(delay)
+                    delay *= 2
+                continue
+            if not ok:
+                logger.error("[leader] Блокировку взял другой процесс")
+                self._lost_at = None
+                return False
+            if self._lost_at is not None:
+                logger.info(f"[leader] Связь с БД восстановлена через {time.monotonic() - self._lost_at:.1f} с, "
+                            f"блокировка снова удерживается")
+                self._lost_at = None
+            return True
+
+        now = time.monotonic()
+        if self._lost_at is None:
+            self._lost_at = now
+        left = self.grace_seconds - (now - self._lost_at)
+        if left > 0:
+            logger.warning(f"[leader] Нет связи с БД, остаюсь лидером ещё {left:.0f} с")
+            return True
+        logger.error(f"[leader] Нет связи с БД дольше {self.grace_seconds:.0f} с, отказываюсь от лидерства")
+        self._lost_at = None
+        return False
+
+    def release(self):
+        if self._conn is not None:
+            try:
+                self._conn.execute(text("SELECT pg_advisory_unlock(:k)"), {"k": self.key})
+                self._conn.commit()
+            except Exception as e:
+                logger.warning(f"[leader] Ошибка снятия блокировки: {e}")
+            finally:
+                self._conn.close()
+                self._conn = None
+        self._pid = None
+        self._lost_at = None
+        if self._file is not None:
+            import fcntl
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
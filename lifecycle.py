@@ -0,0 +1,226 @@
+# lifecycle.py
+"""
+Корректная остановка процесса при деплое (SIGTERM) и восстановление состояния при старте.
+
+Остановка выполняется по этапам, в общем бюджете времени SHUTDOWN_TIMEOUT:
+1. stop_accepting — перестать принимать апдейты
+2. drain          — дождаться обработчиков (в очереди и выполняющихся)
+3. flush          — дописать отложенные записи в БД
+4. snapshot       — сохранить незавершённые опросы (user_states)
+
+Каждый хук получает оставшееся время в секундах. Ошибка одного хука
+не прерывает остальные этапы.
+
+Снимок состояний хранится в JSON-файле (STATE_SNAPSHOT_PATH) или в таблице
+survey_state_snapshots (STATE_SNAPSHOT_BACKEND=db, строки по (tenant_id, user_id))
+и восстанавливается при старте.
+"""
+
+import os
+import json
+import time
+import signal
+import logging
+import threading
+from datetime import date, datetime, timedelta, timezone
+
+logger = logging.getLogger(__name__)
+
+STAGES = ("stop_accepting", "drain", "flush", "snapshot")
+
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", "25"))
+# С DATABASE_URL (Render и другие платформы с непостоянным диском) снимок — в БД,
+# иначе файл не переживает перезапуск инстанса
+STATE_SNAPSHOT_BACKEND = os.getenv("STATE_SNAPSHOT_BACKEND", "db" if os.getenv("DATABASE_URL") else "file").lower()
+STATE_SNAPSHOT_PATH = os.getenv("STATE_SNAPSHOT_PATH", "survey_states.json")
+# Незавершённые опросы старше этого срока при восстановлении отбрасываются
+STATE_SNAPSHOT_TTL_HOURS = float(os.getenv("STATE_SNAPSHOT_TTL_HOURS", "24"))
+
+class Lifecycle:
+    """Реестр хуков остановки и их выполнение по этапам"""
+
+    def __init__(self, timeout=SHUTDOWN_TIMEOUT):
+        self.timeout = timeout
+        self.hooks = {stage: [] for stage in STAGES}
+        self.stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._done = False
+
+    def on(self, stage, func, name=None):
+        """Регистрирует хук func(timeout) на этапе stage"""
+        if stage not in self.hooks:
+            raise ValueError(f"Неизвестный этап остановки: {stage}")
+        self.hooks[stage].append((name or getattr(func, "__name__", repr(func)), func))
+        return func
+
+    def shutdown(self):
+        """Выполняет все этапы остановки один раз"""
+        with self._lock:
+            if self._done:
+                return
+            self._done = True
+        deadline = time.monotonic() + self.timeout
+        for stage in STAGES:
+            for name, func in self.hooks[stage]:
+                remaining = max(0.0, deadline - time.monotonic())
+                started = time.monotonic()
+                try:
+                    func(remaining)
+                    logger.info(f"[lifecycle] {stage}/{name}: {time.monotonic() - started:.2f} с")
+                except Exception as e:
+                    logger.error(f"[lifecycle] {stage}/{name} ошибка: {e}")
+        self.stopped.set()
+
+    def install_signal_handlers(self, signals=(signal.SIGTERM, signal.SIGINT), then_exit=False):
+        """
+        Запускает shutdown() по сигналу. Если then_exit=True — после остановки
+        завершает процесс (для серверов, которые сами сигналы не обрабатывают).
+        """
+        def handler(signum, _frame):
+            logger.info(f"[lifecycle] Получен сигнал {signal.Signals(signum).name}")
+            self.shutdown()
+            if then_exit:
+                raise SystemExit(0)
+
+        for sig in signals:
+            signal.signal(sig, handler)
+
+# --- снимок состояний опросов ---
+
+# Дата рождения в состоянии — объект date (см. validation.py); в JSON пишется как {"$date": "YYYY-MM-DD"}
+def _json_default(value):
+    if isinstance(value, date):
+        return {"$date": value.isoformat()}
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def _json_object_hook(obj):
+    if len(obj) == 1 and "$date" in obj:
+        return date.fromisoformat(obj["$date"])
+    return obj
+
+def _encode_states(states):
+    return {str(user_id): state for user_id, state in states.items()}
+
+def _decode_states(raw):
+    return {int(user_id): state for user_id, state in raw.items()}
+
+def dumps_states(states):
+    """Состояния опросов в JSON (даты — как в снимке); для передачи между узлами (cluster.py)"""
+    return json.dumps(_encode_states(states), ensure_ascii=False, default=_json_default)
+
+def loads_states(text):
+    return _decode_states(json.loads(text, object_hook=_json_object_hook))
+
+def save_states(states, path=None, backend=None, tenant_id=None):
+    """
+    Сохраняет незавершённые опросы; возвращает количество сохранённых.
+    tenant_id — бот-арендатор (tenants.py), его снимки в БД отдельно от других.
+    """
+    backend = backend or STATE_SNAPSHOT_BACKEND
+    snapshot = dict(states)
+    if backend == "db":
+        return _save_states_db(snapshot, tenant_id or "")
+
+    path = path or STATE_SNAPSHOT_PATH
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({
+            "saved_at": datetime.now(timezone.utc).isoformat(),
+            "states": _encode_states(snapshot),
+        }, f, ensure_ascii=False, default=_json_default)
+        f.flush()
+        os.fsync(f.fileno())
+    # Атомарная замена: при обрыве остаётся либо старый, либо новый снимок
+    os.replace(tmp_path, path)
+    logger.info(f"[lifecycle] Сохранено состояний опросов: {len(snapshot)} -> {path}")
+    return len(snapshot)
+
+def load_states(path=None, backend=None, consume=True, tenant_id=None):
+    """
+    Загружает снимок незавершённых опросов. consume=True удаляет снимок после
+    чтения, чтобы устаревшие состояния не восстановились при следующем рестарте.
+    """
+    backend = backend or STATE_SNAPSHOT_BACKEND
+    if backend == "db":
+        return _load_states_db(consume, tenant_id or "")
+
+    path = path or STATE_SNAPSHOT_PATH
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, encoding="utf-8") as f:
+            raw = json.load(f, object_hook=_json_object_hook)
+    except Exception as e:
+        logger.error(f"[lifecycle] Не удалось прочитать снимок {path}: {e}")
+        return {}
+    finally:
+        if consume and os.path.exists(path):
+            os.remove(path)
+
+    saved_at = datetime.fromisoformat(raw.get("saved_at"))
+    if saved_at.tzinfo is None:
+        # Снимки старых версий писали наивное UTC-время
+        saved_at = saved_at.replace(tzinfo=timezone.utc)
+    if datetime.now(timezone.utc) - saved_at > timedelta(hours=STATE_SNAPSHOT_TTL_HOURS):
+        logger.info("[lifecycle] Снимок состояний устарел, пропускаю")
+        return {}
+    states = _decode_states(raw.get("states", {}))
+    logger.info(f"[lifecycle] Восстановлено состояний опросов: {len(states)}")
+    return states
+
+def _snapshot_cutoff():
+    # saved_at хранится в UTC без пояса
+    return (datetime.now(timezone.utc) - timedelta(hours=STATE_SNAPSHOT_TTL_HOURS)).replace(tzinfo=None)
+
+def _save_states_db(snapshot, tenant_id=""):
+    """
+    UPSERT по (tenant_id, user_id) только для опросов этого процесса: снимки
+    других реплик, узлов кластера и ботов в той же таблице не трогаются.
+    """
+    from sqlalchemy import delete, func
+    from db import SessionLocal, SurveyStateSnapshot, engine
+    if engine.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    table = SurveyStateSnapshot.__table__
+    rows = [
+        {"tenant_id": tenant_id, "user_id": user_id,
+         "state": json.dumps(state, ensure_ascii=False, default=_json_default)}
+        for user_id, state in snapshot.items()
+    ]
+    with SessionLocal() as s:
+        if rows:
+            stmt = insert(table)
+            s.execute(stmt.on_conflict_do_update(
+                index_elements=[table.c.tenant_id, table.c.user_id],
+                set_={"state": stmt.excluded.state, "saved_at": func.now()},
+            ), rows)
+        # Просроченные снимки всё равно не восстановятся
+        s.execute(delete(SurveyStateSnapshot).where(SurveyStateSnapshot.saved_at < _snapshot_cutoff()))
+        s.commit()
+    logger.info(f"[lifecycle] Сохранено состояний опросов в БД: {len(snapshot)}")
+    return len(snapshot)
+
+def _load_states_db(consume, tenant_id=""):
+    """consume удаляет только прочитанные строки: снимок, записанный после чтения, остаётся"""
+    from sqlalchemy import select, delete, bindparam
+    from db import SessionLocal, SurveyStateSnapshot
+    with SessionLocal() as s:
+        rows = s.execute(
+            select(SurveyStateSnapshot.user_id, SurveyStateSnapshot.state, SurveyStateSnapshot.saved_at)
+            .where(SurveyStateSnapshot.tenant_id == tenant_id, SurveyStateSnapshot.saved_at >= _snapshot_cutoff())
+        ).all()
+        states = {row.user_id: json.loads(row.state, object_hook=_json_object_hook) for row in rows}
+        if consume and rows:
+            s.connection().execute(
+                delete(SurveyStateSnapshot.__table__).where(
+                    (SurveyStateSnapshot.tenant_id == tenant_id)
+                    & (SurveyStateSnapshot.user_id == bindparam("b_user_id"))
+                    & (SurveyStateSnapshot.saved_at <= bindparam("b_saved_at"))
+                ),
+                [{"b_user_id": row.user_id, "b_saved_at": row.saved_at} for row in rows],
+            )
+            s.commit()
+    logger.info(f"[lifecycle] Восстановлено состояний опросов из БД: {len(states)}")
+    return states
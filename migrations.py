@@ -0,0 +1,202 @@
+# migrations.py
+"""
+Идемпотентные миграции схемы для db.py.
+
+create_all() создаёт только отсутствующие таблицы и не трогает существующие,
+поэтому индексы и новые колонки для уже развернутых баз добавляются здесь.
+Каждая миграция выполняется один раз и записывается в таблицу schema_migrations.
+
+Запуск вручную:
+    python migrations.py
+"""
+
+import logging
+from sqlalchemy import text, inspect
+
+logger = logging.getLogger(__name__)
+
+# Реестр миграций в порядке применения: [(name, func(engine))]
+MIGRATIONS = []
+
+def migration(name):
+    """Регистрирует функцию как миграцию с указанным именем"""
+    def decorator(func):
+        MIGRATIONS.append((name, func))
+        return func
+    return decorator
+
+def _ensure_migrations_table(engine):
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            " name VARCHAR(200) PRIMARY KEY,"
+            " applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)"
+        ))
+
+def _applied(engine):
+    with engine.connect() as conn:
+        return {row[0] for row in conn.execute(text("SELECT name FROM schema_migrations"))}
+
+def has_table(engine, table):
+    """Проверяет наличие таблицы"""
+    return inspect(engine).has_table(table)
+
+def has_column(engine, table, column):
+    """Проверяет наличие колонки в таблице"""
+    return any(c["name"] == column for c in inspect(engine).get_columns(table))
+
+def _relkind(conn, table):
+    """pg_class.relkind таблицы: 'r' — обычная, 'p' — секционированная родительская"""
+    return conn.execute(text(
+        "SELECT c.relkind FROM pg_class c WHERE c.relname = :t AND pg_table_is_visible(c.oid)"
+    ), {"t": table}).scalar()
+
+def _partitions(conn, table):
+    """Непосредственные секции таблицы, включая секцию по умолчанию"""
+    return conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent "
+        "WHERE p.relname = :t AND pg_table_is_visible(p.oid) ORDER BY c.relname"
+    ), {"t": table}).scalars().all()
+
+def _index_attached(conn, index, parent):
+    return bool(conn.execute(text(
+        "SELECT 1 FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent "
+        "WHERE c.relname = :i AND p.relname = :p AND pg_table_is_visible(c.oid)"
+    ), {"i": index, "p": parent}).scalar())
+
+def _create_partitioned_index(conn, name, table, definition, kind):
+    """
+    CREATE INDEX CONCURRENTLY на секционированной родительской таблице не
+    поддерживается: индекс родителя создаётся ON ONLY (невалидным, без
+    построения), каждая секция индексируется CONCURRENTLY и присоединяется через
+    ATTACH PARTITION — после присоединения всех секций индекс родителя становится
+    валидным. Новые секции получают индекс при создании автоматически.
+    """
+    conn.execute(text(f"CREATE {kind} IF NOT EXISTS {name} ON ONLY {table} {definition}"))
+    for partition in _partitions(conn, table):
+        # Имя индекса секции: имя индекса + суффикс секции (_p2026_01, _default), не длиннее 63
+        suffix = partition[len(table):] if partition.startswith(table) else f"_{partition}"
+        part_index = f"{name[:63 - len(suffix)]}{suffix}"
+        if _relkind(conn, partition) == "p":
+            _create_partitioned_index(conn, part_index, partition, definition, kind)
+        else:
+            conn.execute(text(f"CREATE {kind} CONCURRENTLY IF NOT EXISTS {part_index} ON {partition} {definition}"))
+        if not _index_attached(conn, part_index, name):
+            conn.execute(text(f"ALTER INDEX {name} ATTACH PARTITION {part_index}"))
+
+def create_index(engine, name, table, columns, unique=False, where=None):
+    """
+    Создаёт индекс, если его ещё нет.
+    На PostgreSQL используется CONCURRENTLY, чтобы не блокировать запись в таблицу;
+    для секционированной таблицы (partitioning.py) — по секциям, см. _create_partitioned_index.
+    """
+    cols = ", ".join(columns)
+    kind = "UNIQUE INDEX" if unique else "INDEX"
+    cond = f" WHERE {where}" if where else ""
+    if engine.dialect.name == "postgresql":
+        # CONCURRENTLY нельзя выполнять внутри транзакции
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            if _relkind(conn, table) == "p":
+                _create_partitioned_index(conn, name, table, f"({cols}){cond}", kind)
+            else:
+                conn.execute(text(f"CREATE {kind} CONCURRENTLY IF NOT EXISTS {name} ON {table} ({cols}){cond}"))
+    else:
+        with engine.begin() as conn:
+            conn.execute(text(f"CREATE {kind} IF NOT EXISTS {name} ON {table} ({cols}){cond}"))
+
+# --- миграции ---
+
+@migration("0001_survey_responses_lookup_indexes")
+def _survey_responses_lookup_indexes(engine):
+    # (user_id, id) — поиск ответов пользователя и постраничный вывод по id
+    create_index(engine, "ix_survey_responses_user_id_id", "survey_responses", ["user_id", "id"])
+    create_index(engine, "ix_survey_responses_created_at", "survey_responses", ["created_at"])
+    create_index(engine, "ix_survey_responses_citizenship", "survey_responses", ["citizenship"])
+
+@migration("0002_survey_responses_dedup_key")
+def _survey_responses_dedup_key(engine):
+    if not has_column(engine, "survey_responses", "dedup_key"):
+        with engine.begin() as conn:
+            conn.execute(text("ALTER TABLE survey_responses ADD COLUMN dedup_key TEXT"))
+    create_index(engine, "ux_survey_responses_dedup_key", "survey_responses", ["dedup_key"],
+                 unique=True, where="dedup_key IS NOT NULL")
+
+@migration("0003_survey_responses_idempotency_key")
+def _survey_responses_idempotency_key(engine):
+    if not has_column(engine, "survey_responses", "idempotency_key"):
+        with engine.begin() as conn:
+            conn.execute(text("ALTER TABLE survey_responses ADD COLUMN idempotency_key TEXT"))
+    create_index(engine, "ux_survey_responses_idempotency_key", "survey_responses", ["idempotency_key"],
+                 unique=True, where="idempotency_key IS NOT NULL")
+
+@migration("0004_survey_responses_tenant_id")
+def _survey_responses_tenant_id(engine):
+    if not has_column(engine, "survey_responses", "tenant_id"):
+        with engine.begin() as conn:
+            conn.execute(text("ALTER TABLE survey_responses ADD COLUMN tenant_id TEXT"))
+    create_index(engine, "ix_survey_responses_tenant_id_user_id", "survey_responses", ["tenant_id", "user_id", "id"])
+
+@migration("0005_processed_updates_done")
+def _processed_updates_done(engine):
+    # Таблицы нет (IDEMPOTENCY_BACKEND=memory, отдельная база) — create_all создаст её сразу с done
+    if not has_table(engine, "processed_updates"):
+        return
+    # Старые записи — уже обработанные апдейты, поэтому DEFAULT TRUE
+    if not has_column(engine, "processed_updates", "done"):
+        with engine.begin() as conn:
+            conn.execute(text("ALTER TABLE processed_updates ADD COLUMN done BOOLEAN NOT NULL DEFAULT TRUE"))
+
+@migration("0006_survey_state_snapshots_tenant_id")
+def _survey_state_snapshots_tenant_id(engine):
+    # Снимки опросов ботов-арендаторов: ключ (tenant_id, user_id) вместо user_id
+    table = "survey_state_snapshots"
+    if not has_table(engine, table) or has_column(engine, table, "tenant_id"):
+        return
+    if engine.dialect.name == "postgresql":
+        pkey = inspect(engine).get_pk_constraint(table)["name"]
+        with engine.begin() as conn:
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN tenant_id TEXT NOT NULL DEFAULT ''"))
+            conn.execute(text(f"ALTER TABLE {table} DROP CONSTRAINT {pkey}"))
+            conn.execute(text(f"ALTER TABLE {table} ADD PRIMARY KEY (tenant_id, user_id)"))
+        return
+    # SQLite не меняет первичный ключ: таблица небольшая, пересоздаётся с копированием
+    with engine.begin() as conn:
+        conn.execute(text(
+            f"CREATE TABLE {table}_new ("
+            " tenant_id TEXT NOT NULL DEFAULT '',"
+            " user_id BIGINT NOT NULL,"
+            " state TEXT NOT NULL,"
+            " saved_at DATETIME DEFAULT CURRENT_TIMESTAMP,"
+            " PRIMARY KEY (tenant_id, user_id))"
+        ))
+        conn.execute(text(f"INSERT INTO {table}_new (user_id, state, saved_at) SELECT user_id, state, saved_at FROM {table}"))
+        conn.execute(text(f"DROP TABLE {table}"))
+        conn.execute(text(f"ALTER TABLE {table}_new RENAME TO {table}"))
+
+def run_migrations(engine=None):
+    """Применяет все ещё не применённые миграции"""
+    if engine is None:
+        from db import engine
+    _ensure_migrations_table(engine)
+    done = _applied(engine)
+    applied = []
+    for name, func in MIGRATIONS:
+        if name in done:
+            continue
+        logger.info(f"[migrations] Применяю {name}")
+        func(engine)
+        with engine.begin() as conn:
+            conn.execute(text("INSERT INTO schema_migrations (name) VALUES (:name)"), {"name": name})
+        applied.append(name)
+    return applied
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    from db import engine, Base
+    Base.metadata.create_all(bind=engine)
+    names = run_migrations(engine)
+    print(f"Применено миграций: {len(names)}")
+    for n in names:
+        print(f"  - {n}")
@@ -0,0 +1,443 @@
+# online_migration.py
+"""
+Онлайн-перевод survey_responses на типизированные колонки без долгой блокировки:
+birth_date TEXT -> DATE и user_id INTEGER -> BIGINT (PostgreSQL).
+
+ALTER COLUMN ... TYPE переписывает всю таблицу под ACCESS EXCLUSIVE — на
+большой таблице это простой бота. Вместо этого:
+
+1. prepare  — теневые колонки birth_date_typed DATE / user_id_big BIGINT и
+              триггер двойной записи: каждая вставка/изменение заполняет их
+              сразу, кто бы ни писал (бот, async_bot, скрипты)
+2. backfill — существующие строки (id <= отметки на момент prepare) заполняются
+              пачками с паузой; при настроенной реплике (routing.py) пачки
+              ждут, пока её отставание не станет меньше --max-lag
+3. validate — индексы на теневых колонках (CONCURRENTLY) и проверка
+              NOT NULL через CHECK ... NOT VALID + VALIDATE без блокировки записи
+4. swap     — одна короткая транзакция с lock_timeout: переименование колонок
+              и индексов, удаление триггера; при занятой таблице — повтор
+5. cleanup  — удаление старых колонок birth_date_text / user_id_int
+
+Модель db.SurveyResponse уже описывает итоговые типы и работает на любом шаге,
+поэтому перед swap достаточно, чтобы все процессы работали на текущем коде.
+Состояние хранится в таблице online_migrations, шаги можно прерывать и повторять.
+
+На SQLite типы колонок не переписываются (INTEGER и так 64-битный, дата
+хранится текстом ISO): шаг run только приводит старые даты ДД.ММ.ГГГГ к
+YYYY-MM-DD пачками и создаёт индекс по birth_date.
+
+    python online_migration.py status
+    python online_migration.py run              # prepare + backfill + validate + swap
+    python online_migration.py cleanup
+"""
+
+import os
+import time
+import logging
+from collections import namedtuple
+
+from sqlalchemy import MetaData, Table, Column, Text, BigInteger, DateTime, select, func, text
+from sqlalchemy.exc import DBAPIError
+
+logger = logging.getLogger(__name__)
+
+NAME = "survey_responses_typed_columns"
+TABLE = "survey_responses"
+BATCH_SIZE = int(os.getenv("ONLINE_MIGRATION_BATCH_SIZE", "2000"))
+BATCH_PAUSE = float(os.getenv("ONLINE_MIGRATION_PAUSE", "0.2"))
+MAX_REPLICA_LAG = float(os.getenv("ONLINE_MIGRATION_MAX_LAG", "10"))
+LOCK_TIMEOUT_MS = int(os.getenv("ONLINE_MIGRATION_LOCK_TIMEOUT_MS", "2000"))
+SWAP_ATTEMPTS = 10
+
+PARSE_FUNCTION = "survey_responses_parse_birth_date"
+SYNC_FUNCTION = "survey_responses_typed_sync"
+SYNC_TRIGGER = "survey_responses_typed_sync"
+
+# column — текущее имя, shadow — теневая колонка, old — имя старой колонки после swap,
+# backfill — выражение для заполнения, {value} — значение текущей колонки,
+# indexes — [(итоговое имя, временное имя, колонки на теневой колонке)]: все индексы
+# таблицы по column (db.SurveyResponse и migrations.py), иначе cleanup удалит их вместе
+# со старой колонкой; validate проверяет, что ни один не пропущен
+TypedColumn = namedtuple("TypedColumn", "column type shadow old backfill indexes")
+
+COLUMNS = (
+    TypedColumn(
+        "birth_date", "date", "birth_date_typed", "birth_date_text",
+        f"{PARSE_FUNCTION}({{value}})",
+        [("ix_survey_responses_birth_date", "ix_survey_responses_birth_date_typed", "birth_date_typed")],
+    ),
+    TypedColumn(
+        "user_id", "bigint", "user_id_big", "user_id_int",
+        "{value}",
+        [("ix_survey_responses_user_id_id", "ix_survey_responses_user_id_big_id", "user_id_big, id"),
+         ("ix_survey_responses_tenant_id_user_id", "ix_survey_responses_tenant_id_user_id_big",
+          "tenant_id, user_id_big, id")],
+    ),
+)
+
+metadata = MetaData()
+
+state_table = Table(
+    "online_migrations", metadata,
+    Column("name", Text, primary_key=True),
+    Column("phase", Text, nullable=False),
+    Column("columns", Text, nullable=False),   # колонки, которые переводятся, через запятую
+    Column("max_id", BigInteger, nullable=False),
+    Column("position", BigInteger, nullable=False),
+    Column("updated_at", DateTime, server_default=func.now(), onupdate=func.now()),
+)
+
+class MigrationError(Exception):
+    """Шаг нельзя выполнить в текущем состоянии"""
+
+# --- состояние ---
+
+def get_state(engine):
+    metadata.create_all(bind=engine)
+    with engine.connect() as conn:
+        return conn.execute(select(state_table).where(state_table.c.name == NAME)).first()
+
+def _set_state(conn, **values):
+    conn.execute(state_table.update().where(state_table.c.name == NAME).values(**values))
+
+def _require(state, *phases):
+    if state is None or state.phase not in phases:
+        current = state.phase if state else "не начата"
+        raise MigrationError(f"Шаг недоступен: состояние {current}, нужно {' / '.join(phases)}")
+
+def _columns(state):
+    names = state.columns.split(",") if state.columns else []
+    return [c for c in COLUMNS if c.column in names]
+
+def column_types(conn):
+    return dict(conn.execute(text(
+        "SELECT column_name, data_type FROM information_schema.columns "
+        "WHERE table_name = :t AND table_schema = current_schema()"
+    ), {"t": TABLE}).all())
+
+def pending_columns(engine):
+    """Колонки, тип которых ещё не итоговый"""
+    with engine.connect() as conn:
+        types = column_types(conn)
+    return [c for c in COLUMNS if types.get(c.column) not in (c.type, None)]
+
+def _lock_timeout(conn, ms=LOCK_TIMEOUT_MS):
+    conn.execute(text(f"SET LOCAL lock_timeout = '{int(ms)}ms'"))
+
+def _retry_locked(step, attempts=SWAP_ATTEMPTS):
+    """Повторяет короткую DDL-транзакцию, если таблица занята (lock_timeout)"""
+    for attempt in range(1, attempts + 1):
+        try:
+            return step()
+        except DBAPIError as e:
+            if "lock timeout" not in str(e).lower() or attempt == attempts:
+                raise
+            delay = min(0.5 * 2 ** attempt, 10)
+            logger.warning(f"[online_migration] Таблица занята, повтор {attempt}/{attempts} через {delay:.1f} с")
+            time.sleep(delay)
+
+# --- шаги PostgreSQL ---
+
+def prepare(engine):
+    """Теневые колонки, функции и триггер двойной записи"""
+    from partitioning import is_partitioned
+    if is_partitioned(engine):
+        raise MigrationError("Таблица секционирована: переведите типы до partitioning.py convert")
+    state = get_state(engine)
+    if state is not None and state.phase != "done":
+        logger.info(f"[online_migration] Уже начата, состояние {state.phase}")
+        return state
+    columns = pending_columns(engine)
+    if not columns:
+        logger.info("[online_migration] Колонки уже типизированы")
+        return None
+
+    with engine.begin() as conn:
+        conn.execute(text(f"""
+            CREATE OR REPLACE FUNCTION {PARSE_FUNCTION}(value text) RETURNS date
+            LANGUAGE plpgsql IMMUTABLE AS $$
+            BEGIN
+                IF value ~ '^[0-9]{{4}}-[0-9]{{2}}-[0-9]{{2}}$' THEN
+                    RETURN value::date;
+                ELSIF value ~ '^[0-9]{{2}}[.][0-9]{{2}}[.][0-9]{{4}}$' THEN
+                    RETURN to_date(value, 'DD.MM.YYYY');
+                END IF;
+                RETURN NULL;
+            EXCEPTION WHEN others THEN
+                RETURN NULL;
+            END $$
+        """))
+        assignments = "\n".join(
+            f"NEW.{c.shadow} := {c.backfill.format(value='NEW.' + c.column)};" for c in columns
+        )
+        conn.execute(text(f"""
+            CREATE OR REPLACE FUNCTION {SYNC_FUNCTION}() RETURNS trigger
+            LANGUAGE plpgsql AS $$
+            BEGIN
+                {assignments}
+                RETURN NEW;
+            END $$
+        """))
+
+    def add_columns():
+        with engine.begin() as conn:
+            _lock_timeout(conn)
+            conn.execute(text(f"ALTER TABLE {TABLE} " + ", ".join(
+                f"ADD COLUMN IF NOT EXISTS {c.shadow} {c.type}" for c in columns
+            )))
+            conn.execute(text(f"DROP TRIGGER IF EXISTS {SYNC_TRIGGER} ON {TABLE}"))
+            conn.execute(text(
+                f"CREATE TRIGGER {SYNC_TRIGGER} BEFORE INSERT OR UPDATE OF "
+                f"{', '.join(c.column for c in columns)} ON {TABLE} "
+                f"FOR EACH ROW EXECUTE FUNCTION {SYNC_FUNCTION}()"
+            ))
+    _retry_locked(add_columns)
+
+    # Триггер создан после завершения всех текущих вставок: строки с большим id заполнит он
+    with engine.begin() as conn:
+        max_id = conn.execute(text(f"SELECT COALESCE(MAX(id), 0) FROM {TABLE}")).scalar()
+        values = {"phase": "prepared", "columns": ",".join(c.column for c in columns), "max_id": max_id, "position": 0}
+        if state is None:
+            conn.execute(state_table.insert().values(name=NAME, **values))
+        else:
+            _set_state(conn, **values)
+    logger.info(f"[online_migration] Подготовлено: {', '.join(c.column for c in columns)}, строк до id {max_id}")
+    return get_state(engine)
+
+def _wait_for_replica(max_lag):
+    """Пауза, пока реплика (routing.py) отстаёт больше max_lag секунд"""
+    from routing import router
+    if not router.replica_url or not max_lag:
+        return
+    while True:
+        router.check_replica()
+        if router.lag is None or router.lag <= max_lag:
+            return
+        logger.info(f"[online_migration] Реплика отстаёт на {router.lag:.1f} с, ждём")
+        time.sleep(1)
+
+def backfill(engine, batch_size=BATCH_SIZE, pause=BATCH_PAUSE, max_lag=MAX_REPLICA_LAG):
+    """Заполняет теневые колонки в существующих строках пачками по id"""
+    state = get_state(engine)
+    _require(state, "prepared", "backfilled")
+    columns = _columns(state)
+    assignments = ", ".join(f"{c.shadow} = {c.backfill.format(value=c.column)}" for c in columns)
+    position, max_id = state.position, state.max_id
+    started = time.monotonic()
+    while position < max_id:
+        _wait_for_replica(max_lag)
+        upper = min(position + batch_size, max_id)
+        with engine.begin() as conn:
+            conn.execute(text(
+                f"UPDATE {TABLE} SET {assignments} WHERE id > :lo AND id <= :hi"
+            ), {"lo": position, "hi": upper})
+            _set_state(conn, position=upper)
+        position = upper
+        logger.info(f"[online_migration] Заполнено до id {position} из {max_id}")
+        time.sleep(pause)
+    with engine.begin() as conn:
+        _set_state(conn, phase="backfilled" if state.phase == "prepared" else state.phase)
+    logger.info(f"[online_migration] Заполнение завершено за {time.monotonic() - started:.1f} с")
+
+def _drop_invalid_index(engine, name):
+    """Индекс, оставшийся INVALID после прерванного CREATE INDEX CONCURRENTLY, пересоздаётся"""
+    with engine.connect() as conn:
+        invalid = conn.execute(text(
+            "SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+            "WHERE c.relname = :n AND NOT i.indisvalid AND pg_table_is_visible(c.oid)"
+        ), {"n": name}).scalar()
+    if invalid:
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+
+def indexes_on(conn, column):
+    """Имена индексов таблицы, в которые входит колонка"""
+    return set(conn.execute(text(
+        "SELECT i.relname FROM pg_index x "
+        "JOIN pg_class i ON i.oid = x.indexrelid JOIN pg_class t ON t.oid = x.indrelid "
+        "JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = ANY(x.indkey) "
+        "WHERE t.relname = :t AND pg_table_is_visible(t.oid) AND a.attname = :c"
+    ), {"t": TABLE, "c": column}).scalars())
+
+def invalid_rows(engine, column, limit=10):
+    """id строк, у которых значение не удалось привести к типу"""
+    with engine.connect() as conn:
+        return conn.execute(text(
+            f"SELECT id, {column.column} FROM {TABLE} "
+            f"WHERE {column.shadow} IS NULL AND {column.column} IS NOT NULL ORDER BY id LIMIT :n"
+        ), {"n": limit}).all()
+
+def validate(engine):
+    """Индексы на теневых колонках и проверка NOT NULL без блокировки записи"""
+    state = get_state(engine)
+    _require(state, "backfilled", "validated")
+    for column in _columns(state):
+        with engine.connect() as conn:
+            unknown = indexes_on(conn, column.column) - {final for final, _, _ in column.indexes}
+        if unknown:
+            raise MigrationError(
+                f"Индексы по {column.column} без теневой копии: {', '.join(sorted(unknown))}. "
+                f"Добавьте их в online_migration.COLUMNS, иначе cleanup удалит их со старой колонкой"
+            )
+        bad = invalid_rows(engine, column)
+        if bad:
+            sample = ", ".join(f"id={row[0]}: {row[1]!r}" for row in bad)
+            raise MigrationError(
+                f"{column.column}: значения не приводятся к {column.type} ({sample}). "
+                f"Исправьте их (триггер заполнит {column.shadow}) и повторите validate"
+            )
+        for _, temp_name, columns in column.indexes:
+            _drop_invalid_index(engine, temp_name)
+            with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+                conn.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {temp_name} ON {TABLE} ({columns})"))
+
+        constraint = f"{column.shadow}_not_null"
+
+        def add_check():
+            with engine.begin() as conn:
+                _lock_timeout(conn)
+                exists = conn.execute(text(
+                    "SELECT 1 FROM pg_constraint WHERE conname = :c AND conrelid = CAST(:t AS regclass)"
+                ), {"c": constraint, "t": TABLE}).scalar()
+                if not exists:
+                    conn.execute(text(
+                        f"ALTER TABLE {TABLE} ADD CONSTRAINT {constraint} CHECK ({column.shadow} IS NOT NULL) NOT VALID"
+                    ))
+        _retry_locked(add_check)
+        # VALIDATE берёт SHARE UPDATE EXCLUSIVE: вставки и чтение продолжаются
+        with engine.begin() as conn:
+            conn.execute(text(f"ALTER TABLE {TABLE} VALIDATE CONSTRAINT {constraint}"))
+    with engine.begin() as conn:
+        _set_state(conn, phase="validated")
+    logger.info("[online_migration] Теневые колонки проверены, индексы построены")
+
+def swap(engine, attempts=SWAP_ATTEMPTS):
+    """Короткая транзакция: теневые колонки и индексы получают итоговые имена"""
+    state = get_state(engine)
+    _require(state, "validated")
+    columns = _columns(state)
+
+    def do_swap():
+        with engine.begin() as conn:
+            _lock_timeout(conn)
+            conn.execute(text(f"LOCK TABLE {TABLE} IN ACCESS EXCLUSIVE MODE"))
+            for c in columns:
+                constraint = f"{c.shadow}_not_null"
+                conn.execute(text(f"ALTER TABLE {TABLE} RENAME COLUMN {c.column} TO {c.old}"))
+                conn.execute(text(f"ALTER TABLE {TABLE} ALTER COLUMN {c.old} DROP NOT NULL"))
+                conn.execute(text(f"ALTER TABLE {TABLE} RENAME COLUMN {c.shadow} TO {c.column}"))
+                # Проверенный CHECK позволяет SET NOT NULL без сканирования таблицы
+                conn.execute(text(f"ALTER TABLE {TABLE} ALTER COLUMN {c.column} SET NOT NULL"))
+                conn.execute(text(f"ALTER TABLE {TABLE} DROP CONSTRAINT {constraint}"))
+                for final_name, temp_name, _ in c.indexes:
+                    conn.execute(text(f"DROP INDEX IF EXISTS {final_name}"))
+                    conn.execute(text(f"ALTER INDEX {temp_name} RENAME TO {final_name}"))
+            conn.execute(text(f"DROP TRIGGER IF EXISTS {SYNC_TRIGGER} ON {TABLE}"))
+            _set_state(conn, phase="swapped")
+
+    started = time.monotonic()
+    _retry_locked(do_swap, attempts)
+    logger.info(f"[online_migration] Колонки переключены за {time.monotonic() - started:.2f} с")
+
+def cleanup(engine):
+    """Удаляет старые колонки и служебные функции"""
+    state = get_state(engine)
+    _require(state, "swapped")
+    columns = _columns(state)
+
+    def drop_old():
+        with engine.begin() as conn:
+            _lock_timeout(conn)
+            conn.execute(text(f"ALTER TABLE {TABLE} " + ", ".join(
+                f"DROP COLUMN IF EXISTS {c.old}" for c in columns
+            )))
+            conn.execute(text(f"DROP FUNCTION IF EXISTS {SYNC_FUNCTION}()"))
+            conn.execute(text(f"DROP FUNCTION IF EXISTS {PARSE_FUNCTION}(text)"))
+            _set_state(conn, phase="done")
+    _retry_locked(drop_old)
+    logger.info("[online_migration] Старые колонки удалены")
+
+# --- SQLite ---
+
+def normalize_sqlite(engine, batch_size=BATCH_SIZE, pause=BATCH_PAUSE):
+    """Даты ДД.ММ.ГГГГ -> YYYY-MM-DD пачками по id и индекс по birth_date"""
+    from migrations import create_index
+    with engine.connect() as conn:
+        max_id = conn.execute(text(f"SELECT COALESCE(MAX(id), 0) FROM {TABLE}")).scalar()
+    position = fixed = 0
+    while position < max_id:
+        with engine.begin() as conn:
+            fixed += conn.execute(text(
+                f"UPDATE {TABLE} SET birth_date = "
+                "substr(birth_date, 7, 4) || '-' || substr(birth_date, 4, 2) || '-' || substr(birth_date, 1, 2) "
+                "WHERE id > :lo AND id <= :hi AND birth_date GLOB '[0-9][0-9].[0-9][0-9].[0-9][0-9][0-9][0-9]'"
+            ), {"lo": position, "hi": position + batch_size}).rowcount
+        position += batch_size
+        time.sleep(pause)
+    create_index(engine, "ix_survey_responses_birth_date", TABLE, ["birth_date"])
+    logger.info(f"[online_migration] SQLite: приведено дат {fixed}")
+    return fixed
+
+# --- все шаги ---
+
+def run(engine, batch_size=BATCH_SIZE, pause=BATCH_PAUSE, max_lag=MAX_REPLICA_LAG):
+    """prepare -> backfill -> validate -> swap с продолжением с текущего шага"""
+    if engine.dialect.name == "sqlite":
+        return normalize_sqlite(engine, batch_size, pause)
+    if engine.dialect.name != "postgresql":
+        raise MigrationError(f"Не поддерживается для {engine.dialect.name}")
+    state = get_state(engine)
+    if state is None or state.phase == "done":
+        state = prepare(engine)
+        if state is None:
+            return
+    if state.phase == "prepared":
+        backfill(engine, batch_size, pause, max_lag)
+        state = get_state(engine)
+    if state.phase == "backfilled":
+        validate(engine)
+        state = get_state(engine)
+    if state.phase == "validated":
+        swap(engine)
+    logger.info("[online_migration] Готово; после проверки удалите старые колонки: python online_migration.py cleanup")
+
+def status(engine):
+    if engine.dialect.name != "postgresql":
+        return {"dialect": engine.dialect.name}
+    state = get_state(engine)
+    with engine.connect() as conn:
+        types = column_types(conn)
+    return {
+        "dialect": "postgresql",
+        "phase": state.phase if state else None,
+        "columns": state.columns if state else None,
+        "position": state.position if state else None,
+        "max_id": state.max_id if state else None,
+        "types": {c.column: types.get(c.column) for c in COLUMNS},
+    }
+
+if __name__ == "__main__":
+    import sys
+    import argparse
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Онлайн-перевод birth_date в DATE и user_id в BIGINT")
+    parser.add_argument("command", choices=["status", "run", "prepare", "backfill", "validate", "swap", "cleanup"])
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--pause", type=float, default=BATCH_PAUSE, help="пауза между пачками, с")
+    parser.add_argument("--max-lag", type=float, default=MAX_REPLICA_LAG, help="допустимое отставание реплики, с")
+    args = parser.parse_args()
+
+    from db import engine
+    try:
+        if args.command == "status":
+            print(status(engine))
+        elif args.command == "run":
+            run(engine, args.batch_size, args.pause, args.max_lag)
+        elif args.command == "backfill":
+            backfill(engine, args.batch_size, args.pause, args.max_lag)
+        else:
+            steps = {"prepare": prepare, "validate": validate, "swap": swap, "cleanup": cleanup}
+            steps[args.command](engine)
+    except MigrationError as e:
+        logger.error(str(e))
+        sys.exit(1)
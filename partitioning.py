@@ -0,0 +1,180 @@
+# partitioning.py
+"""
+Секционирование survey_responses по месяцам created_at (только PostgreSQL, по желанию).
+
+Секции survey_responses_pYYYY_MM создаются заранее на PARTITIONS_AHEAD месяцев
+вперёд (db.init_db и retention.py вызывают ensure_partitions); строки вне
+созданных секций попадают в survey_responses_default. Старые секции целиком
+архивируются и удаляются задачей хранения (retention.py).
+
+Перевод существующей таблицы — разовая операция на время окна обслуживания
+(таблица блокируется на время копирования):
+    python partitioning.py convert              # старая таблица остаётся как survey_responses_legacy
+    python partitioning.py convert --drop-legacy
+    python partitioning.py ensure               # досоздать секции вперёд
+
+Ограничение PostgreSQL: уникальный индекс секционированной таблицы обязан
+включать ключ секционирования, поэтому dedup_key и idempotency_key здесь
+индексируются без UNIQUE, а уникальность обеспечивает db.save_survey_response
+через pg_advisory_xact_lock по ключу.
+"""
+
+import os
+import re
+import sys
+import logging
+from datetime import date
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+TABLE = "survey_responses"
+DEFAULT_PARTITION = f"{TABLE}_default"
+PARTITIONS_AHEAD = int(os.getenv("PARTITIONS_AHEAD", "3"))
+_PARTITION_RE = re.compile(rf"^{TABLE}_p(\d{{4}})_(\d{{2}})$")
+
+# Индексы секционированной таблицы (создаются на родителе и наследуются секциями)
+PARTITIONED_INDEXES = (
+    ("ix_survey_responses_user_id_id", "(user_id, id)"),
+    ("ix_survey_responses_created_at", "(created_at)"),
+    ("ix_survey_responses_citizenship", "(citizenship)"),
+    ("ix_survey_responses_tenant_id_user_id", "(tenant_id, user_id, id)"),
+    ("ix_survey_responses_dedup_key", "(dedup_key) WHERE dedup_key IS NOT NULL"),
+    ("ix_survey_responses_idempotency_key", "(idempotency_key) WHERE idempotency_key IS NOT NULL"),
+)
+
+def month_start(value):
+    return date(value.year, value.month, 1)
+
+def add_months(value, months):
+    index = value.year * 12 + value.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+def partition_name(month):
+    return f"{TABLE}_p{month.year:04d}_{month.month:02d}"
+
+def partition_month(name):
+    """Месяц секции по имени или None для посторонних таблиц"""
+    match = _PARTITION_RE.match(name)
+    return date(int(match.group(1)), int(match.group(2)), 1) if match else None
+
+def is_partitioned(engine):
+    if engine.dialect.name != "postgresql":
+        return False
+    with engine.connect() as conn:
+        return bool(conn.execute(text(
+            "SELECT 1 FROM pg_partitioned_table pt JOIN pg_class c ON c.oid = pt.partrelid "
+            "WHERE c.relname = :t AND pg_table_is_visible(c.oid)"
+        ), {"t": TABLE}).scalar())
+
+def list_partitions(conn):
+    """Помесячные секции: [(month, name)] по возрастанию"""
+    rows = conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent "
+        "WHERE p.relname = :t AND pg_table_is_visible(p.oid)"
+    ), {"t": TABLE}).scalars()
+    return sorted((partition_month(name), name) for name in rows if partition_month(name))
+
+def _create_partition(conn, month):
+    conn.execute(text(
+        f"CREATE TABLE IF NOT EXISTS {partition_name(month)} PARTITION OF {TABLE} "
+        f"FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')"
+    ))
+
+def ensure_partitions(engine, months_ahead=PARTITIONS_AHEAD, today=None):
+    """Создаёт секции текущего месяца и months_ahead следующих; возвращает созданные"""
+    if not is_partitioned(engine):
+        return []
+    current = month_start(today or date.today())
+    created = []
+    with engine.begin() as conn:
+        existing = {name for _, name in list_partitions(conn)}
+        for i in range(months_ahead + 1):
+            month = add_months(current, i)
+            if partition_name(month) not in existing:
+                _create_partition(conn, month)
+                created.append(partition_name(month))
+    for name in created:
+        logger.info(f"[partitioning] Создана секция {name}")
+    return created
+
+def convert(engine, months_ahead=PARTITIONS_AHEAD, drop_legacy=False):
+    """Переводит survey_responses в секционированную по месяцам таблицу"""
+    if engine.dialect.name != "postgresql":
+        raise RuntimeError("Секционирование поддерживается только для PostgreSQL")
+    if is_partitioned(engine):
+        logger.info("[partitioning] Таблица уже секционирована")
+        return False
+
+    legacy = f"{TABLE}_legacy"
+    with engine.begin() as conn:
+        conn.execute(text(f"LOCK TABLE {TABLE} IN ACCESS EXCLUSIVE MODE"))
+        sequence = conn.execute(text("SELECT pg_get_serial_sequence(:t, 'id')"), {"t": TABLE}).scalar()
+        first = conn.execute(text(f"SELECT MIN(created_at) FROM {TABLE}")).scalar()
+
+        conn.execute(text(f"ALTER TABLE {TABLE} RENAME TO {legacy}"))
+        # Имена индексов общие для схемы — старые переименовываем, чтобы создать такие же на новой таблице
+        for (index_name,) in conn.execute(text(
+            "SELECT indexname FROM pg_indexes WHERE tablename = :t AND schemaname = current_schema()"
+        ), {"t": legacy}).all():
+            conn.execute(text(f"ALTER INDEX {index_name} RENAME TO {index_name[:50]}_legacy"))
+
+        conn.execute(text(
+            f"CREATE TABLE {TABLE} (LIKE {legacy} INCLUDING DEFAULTS) PARTITION BY RANGE (created_at)"
+        ))
+        conn.execute(text(f"ALTER TABLE {TABLE} ALTER COLUMN created_at SET NOT NULL"))
+        conn.execute(text(f"ALTER TABLE {TABLE} ADD PRIMARY KEY (id, created_at)"))
+        for index_name, definition in PARTITIONED_INDEXES:
+            conn.execute(text(f"CREATE INDEX {index_name} ON {TABLE} {definition}"))
+        if sequence:
+            # Последовательность id переходит к новой таблице и не удалится вместе со старой
+            conn.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY {TABLE}.id"))
+
+        conn.execute(text(f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF {TABLE} DEFAULT"))
+        current = month_start(date.today())
+        month = month_start(first) if first else current
+        while month <= add_months(current, months_ahead):
+            _create_partition(conn, month)
+            month = add_months(month, 1)
+
+        columns = conn.execute(text(
+            "SELECT column_name FROM information_schema.columns "
+            "WHERE table_name = :t AND table_schema = current_schema() ORDER BY ordinal_position"
+        ), {"t": legacy}).scalars().all()
+        # Строки без created_at (если есть) попадают в секцию по умолчанию
+        select_list = ", ".join(
+            "COALESCE(created_at, TIMESTAMP '1970-01-01')" if c == "created_at" else c for c in columns
+        )
+        copied = conn.execute(text(
+            f"INSERT INTO {TABLE} ({', '.join(columns)}) SELECT {select_list} FROM {legacy}"
+        )).rowcount
+        if drop_legacy:
+            conn.execute(text(f"DROP TABLE {legacy}"))
+
+    logger.info(f"[partitioning] survey_responses секционирована, перенесено строк: {copied}")
+    return True
+
+if __name__ == "__main__":
+    import argparse
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Секционирование survey_responses по месяцам (PostgreSQL)")
+    parser.add_argument("command", choices=["convert", "ensure", "status"])
+    parser.add_argument("--months-ahead", type=int, default=PARTITIONS_AHEAD)
+    parser.add_argument("--drop-legacy", action="store_true", help="удалить старую таблицу после переноса")
+    args = parser.parse_args()
+
+    from db import engine
+    if args.command == "convert":
+        convert(engine, args.months_ahead, args.drop_legacy)
+    elif args.command == "ensure":
+        created = ensure_partitions(engine, args.months_ahead)
+        print(f"Создано секций: {len(created)}")
+    else:
+        if not is_partitioned(engine):
+            print("survey_responses не секционирована")
+            sys.exit(0)
+        with engine.connect() as conn:
+            for month, name in list_partitions(conn):
+                print(f"{name}  {month.isoformat()}")
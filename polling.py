@@ -0,0 +1,354 @@
+# polling.py
+"""
+Long polling бота вместо telebot.infinity_polling.
+
+- allowed_updates собирается из зарегистрированных обработчиков: Telegram не
+  присылает типы апдейтов, которые бот всё равно не обработал бы;
+- POLL_LIMIT — сколько апдейтов забирать за один getUpdates (1..100);
+- таймаут long polling адаптивный: пока очередь на стороне Telegram не
+  разобрана (пришла полная пачка), следующий запрос идёт без ожидания; после
+  обрыва соединения (прокси и NAT рвут долгие запросы) таймаут уменьшается
+  вдвое, после успешных ожиданий растёт обратно до POLL_TIMEOUT_MAX;
+- обработчики выполняются на KeyedPool: апдейты одного пользователя идут по
+  порядку в одной очереди, разных пользователей — параллельно на POLL_WORKERS
+  потоках (util.ThreadPool telebot порядок не сохраняет: ответ на кнопку мог
+  обработаться раньше сообщения с ФИО);
+- POLL_DRAIN_BACKLOG=1 обрабатывает накопившееся за время перезапуска вместо
+  пропуска (skip_pending); сообщения из этой очереди старше POLL_BACKLOG_MAX_AGE
+  секунд всё же отбрасываются, чтобы после долгого простоя не отвечать на
+  вчерашние /start. После разбора очереди возраст не проверяется, нажатия
+  кнопок по возрасту не отбрасываются никогда.
+
+Используется bot.run_bot и tenants.py; AsyncPoller — то же для AsyncTeleBot
+(async_bot.py): порядок апдейтов пользователя держит цепочка задач по ключу
+вместо KeyedPool. scripts/polling_bench.py сравнивает с infinity_polling на
+заглушке Telegram API.
+"""
+
+import os
+import time
+import queue
+import asyncio
+import logging
+import threading
+
+from telebot import util
+
+logger = logging.getLogger(__name__)
+
+POLL_WORKERS = int(os.getenv("POLL_WORKERS", "8"))
+POLL_LIMIT = max(1, min(100, int(os.getenv("POLL_LIMIT", "100"))))
+POLL_TIMEOUT_MIN = int(os.getenv("POLL_TIMEOUT_MIN", "1"))
+POLL_TIMEOUT_MAX = int(os.getenv("POLL_TIMEOUT_MAX", "20"))
+POLL_DRAIN_BACKLOG = os.getenv("POLL_DRAIN_BACKLOG", "1") == "1"
+POLL_BACKLOG_MAX_AGE = float(os.getenv("POLL_BACKLOG_MAX_AGE", "600"))
+
+def allowed_updates(target):
+    """Типы апдейтов, для которых у бота есть обработчики"""
+    return [kind for kind in util.update_types if getattr(target, f"{kind}_handlers", None)]
+
+def update_date(update):
+    """
+    Время отправки сообщения (unix) или None. Нажатие кнопки не датируется:
+    callback_query.message.date — время сообщения с клавиатурой, а не нажатия.
+    """
+    payload = update.message or update.edited_message
+    return getattr(payload, "edit_date", None) or getattr(payload, "date", None)
+
+def task_key(obj):
+    """Ключ очереди для аргумента обработчика: пользователь, иначе чат"""
+    user = getattr(obj, "from_user", None)
+    if user is not None:
+        return user.id
+    chat = getattr(obj, "chat", None)
+    return chat.id if chat is not None else None
+
+def update_key(update):
+    """Ключ очереди для апдейта целиком (task_key его содержимого)"""
+    for kind in util.update_types:
+        payload = getattr(update, kind, None)
+        if payload is not None:
+            return task_key(payload)
+    return None
+
+class KeyedPool:
+    """
+    Пул воркеров с сохранением порядка по ключу: задача с ключом k всегда идёт
+    в очередь hash(k) % num_threads. Совместим с util.ThreadPool telebot
+    (TeleBot.worker_pool): put(), tasks.qsize(), close().
+    """
+
+    def __init__(self, exception_handler=None, num_threads=POLL_WORKERS, name="poll-worker"):
+        self.exception_handler = exception_handler
+        self.num_threads = max(1, num_threads)
+        self.queues = [queue.Queue() for _ in range(self.num_threads)]
+        self.workers = [
+            threading.Thread(target=self._run, args=(q,), name=f"{name}-{i}", daemon=True)
+            for i, q in enumerate(self.queues)
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    @property
+    def tasks(self):
+        # bot._pending_tasks читает worker_pool.tasks.qsize()
+        return self
+
+    def qsize(self):
+        return sum(q.qsize() for q in self.queues)
+
+    def put(self, func, *args, **kwargs):
+        key = task_key(args[0]) if args else None
+        self.queues[hash(key) % self.num_threads].put((func, args, kwargs))
+
+    def barrier(self, keys):
+        """События, которые наступят, когда выполнятся задачи ключей keys, поставленные до вызова"""
+        events = []
+        for i in {hash(key) % self.num_threads for key in keys}:
+            event = threading.Event()
+            self.queues[i].put((event.set, (), {}))
+            events.append(event)
+        return events
+
+    def _run(self, tasks):
+        while True:
+            item = tasks.get()
+            if item is None:
+                return
+            func, args, kwargs = item
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                handled = self.exception_handler is not None and self.exception_handler.handle(e)
+                if not handled:
+                    logger.exception(f"Ошибка обработчика: {e}")
+
+    # Интерфейс util.ThreadPool, который вызывает TeleBot
+    def raise_exceptions(self):
+        pass
+
+    def clear_exceptions(self):
+        pass
+
+    def close(self):
+        for q in self.queues:
+            q.put(None)
+        for worker in self.workers:
+            worker.join()
+
+class Poller:
+    """Цикл getUpdates одного бота; апдейты по одному уходят в target.process_new_updates"""
+
+    def __init__(self, target, limit=POLL_LIMIT, timeout_min=POLL_TIMEOUT_MIN, timeout_max=POLL_TIMEOUT_MAX,
+                 drain_backlog=POLL_DRAIN_BACKLOG, backlog_max_age=POLL_BACKLOG_MAX_AGE,
+                 stop_event=None, name="bot"):
+        self.target = target
+        self.limit = limit
+        self.timeout_min = timeout_min
+        self.timeout_max = max(timeout_min, timeout_max)
+        self.timeout = self.timeout_max
+        self.drain_backlog = drain_backlog
+        self.backlog_max_age = backlog_max_age
+        self.stop_event = stop_event or threading.Event()
+        self.name = name
+        self.allowed = None
+        # Идёт разбор накопившегося за простой: только тогда действует backlog_max_age
+        self.draining = False
+        self.stats = {"polls": 0, "empty_polls": 0, "updates": 0, "stale_dropped": 0, "errors": 0}
+
+    def stop(self):
+        self.stop_event.set()
+
+    def _fetch(self, timeout):
+        return self.target.get_updates(
+            offset=self.target.last_update_id + 1, limit=self.limit, timeout=timeout + 10,
+            allowed_updates=self.allowed, long_polling_timeout=timeout,
+        )
+
+    def _start(self):
+        """allowed_updates и пропуск или разбор накопившегося за простой"""
+        self.allowed = allowed_updates(self.target)
+        if self.drain_backlog:
+            self.draining = True
+            logger.info(f"[{self.name}] polling: {self.allowed}, накопившиеся апдейты будут обработаны")
+            return
+        # Как skip_pending: подтверждаем всё, кроме последнего, и пропускаем его
+        pending = self.target.get_updates(offset=-1, limit=1, timeout=10, long_polling_timeout=0)
+        if pending:
+            self.target.last_update_id = pending[-1].update_id
+        logger.info(f"[{self.name}] polling: {self.allowed}, накопившиеся апдейты пропущены")
+
+    def _stale(self, update):
+        if not self.draining or not self.backlog_max_age:
+            return False
+        sent_at = update_date(update)
+        return sent_at is not None and sent_at < time.time() - self.backlog_max_age
+
+    def _adapt(self, updates, timeout, started):
+        """Следующий таймаут по результату getUpdates"""
+        self.stats["polls"] += 1
+        if len(updates) >= self.limit:
+            self.timeout = 0
+        elif updates or self.timeout == 0:
+            self.timeout = self.timeout_min
+        else:
+            self.stats["empty_polls"] += 1
+            # Ожидание дошло до конца без обрыва — можно ждать дольше
+            if time.monotonic() - started >= timeout * 0.9:
+                self.timeout = min(self.timeout_max, max(self.timeout_min, self.timeout * 2))
+
+    def _failed(self, e, errors):
+        """Учёт ошибки getUpdates; возвращает паузу перед повтором"""
+        self.stats["errors"] += 1
+        code = getattr(e, "error_code", None)
+        logger.warning(f"[{self.name}] getUpdates: {e}" + (" (запущен другой поллер?)" if code == 409 else ""))
+        # Обрыв долгого запроса: сокращаем ожидание
+        self.timeout = max(self.timeout_min, self.timeout // 2)
+        return min(30, 2 ** min(errors, 5))
+
+    def poll_once(self):
+        """Один getUpdates и раздача апдейтов; возвращает их число"""
+        # timeout == 0 после полной пачки: в очереди Telegram ещё есть апдейты, не ждём
+        timeout = self.timeout
+        started = time.monotonic()
+        updates = self._fetch(timeout)
+        self._adapt(updates, timeout, started)
+        if not updates or self.stop_event.is_set():
+            return 0
+        self.stats["updates"] += len(updates)
+        # По одному: process_new_updates группирует пачку по типам (сначала все
+        # сообщения, потом все callback), а порядок внутри пользователя важен
+        for update in updates:
+            if self.stop_event.is_set():
+                break
+            if self._stale(update):
+                self.stats["stale_dropped"] += 1
+                self.target.last_update_id = max(self.target.last_update_id, update.update_id)
+                continue
+            self.target.process_new_updates([update])
+        if len(updates) < self.limit:
+            # Неполная пачка — очередь Telegram разобрана, дальше апдейты живые
+            self.draining = False
+        return len(updates)
+
+    def _confirm(self):
+        """Подтверждает розданные апдейты: иначе после перезапуска Telegram пришлёт их снова"""
+        if self.allowed is None:
+            return
+        try:
+            self.target.get_updates(offset=self.target.last_update_id + 1, limit=1, timeout=5,
+                                    allowed_updates=self.allowed, long_polling_timeout=0)
+        except Exception as e:
+            logger.warning(f"[{self.name}] Не удалось подтвердить апдейты при остановке: {e}")
+
+    def run(self):
+        """Polling до stop(); ошибки getUpdates (включая 409) — с паузой и уменьшением таймаута"""
+        errors = 0
+        while not self.stop_event.is_set():
+            try:
+                if self.allowed is None:
+                    self._start()
+                self.poll_once()
+                errors = 0
+            except Exception as e:
+                errors += 1
+                self.stop_event.wait(self._failed(e, errors))
+        self._confirm()
+        logger.info(f"[{self.name}] polling остановлен: {self.stats}")
+
+class AsyncPoller(Poller):
+    """
+    Poller для AsyncTeleBot: те же allowed_updates, адаптивный таймаут и разбор
+    накопившейся очереди. Каждый апдейт обрабатывается своей задачей; задача
+    апдейта пользователя ждёт его предыдущую, поэтому порядок внутри
+    пользователя сохраняется, а разные пользователи идут параллельно.
+    Останавливается отменой задачи run(); wait_idle() дожидается розданных апдейтов.
+    """
+
+    def __init__(self, target, **kwargs):
+        super().__init__(target, **kwargs)
+        # AsyncTeleBot не хранит offset между вызовами get_updates
+        self.last_update_id = 0
+        # Последняя задача каждого ключа (пользователя)
+        self._tails = {}
+
+    async def _fetch(self, timeout):
+        return await self.target.get_updates(
+            offset=self.last_update_id + 1, limit=self.limit, timeout=timeout,
+            allowed_updates=self.allowed, request_timeout=timeout + 10,
+        )
+
+    async def _start(self):
+        self.allowed = allowed_updates(self.target)
+        if self.drain_backlog:
+            self.draining = True
+            logger.info(f"[{self.name}] polling: {self.allowed}, накопившиеся апдейты будут обработаны")
+            return
+        pending = await self.target.get_updates(offset=-1, limit=1, timeout=0, request_timeout=10)
+        if pending:
+            self.last_update_id = pending[-1].update_id
+        logger.info(f"[{self.name}] polling: {self.allowed}, накопившиеся апдейты пропущены")
+
+    def _dispatch(self, update):
+        key = update_key(update)
+        task = asyncio.create_task(self._process(update, self._tails.get(key)))
+        self._tails[key] = task
+        task.add_done_callback(lambda t, k=key: self._tails.pop(k) if self._tails.get(k) is t else None)
+
+    async def _process(self, update, previous):
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            await self.target.process_new_updates([update])
+        except Exception as e:
+            logger.exception(f"[{self.name}] Ошибка обработки апдейта {update.update_id}: {e}")
+
+    async def poll_once(self):
+        timeout = self.timeout
+        started = time.monotonic()
+        updates = await self._fetch(timeout)
+        self._adapt(updates, timeout, started)
+        if not updates or self.stop_event.is_set():
+            return 0
+        self.stats["updates"] += len(updates)
+        for update in updates:
+            if self.stop_event.is_set():
+                break
+            self.last_update_id = max(self.last_update_id, update.update_id)
+            if self._stale(update):
+                self.stats["stale_dropped"] += 1
+                continue
+            self._dispatch(update)
+        if len(updates) < self.limit:
+            self.draining = False
+        return len(updates)
+
+    async def wait_idle(self):
+        """Ждёт обработки всех розданных апдейтов"""
+        while self._tails:
+            await asyncio.wait(list(self._tails.values()))
+
+    async def _confirm(self):
+        if self.allowed is None:
+            return
+        try:
+            await self.target.get_updates(offset=self.last_update_id + 1, limit=1, timeout=0,
+                                          allowed_updates=self.allowed, request_timeout=5)
+        except Exception as e:
+            logger.warning(f"[{self.name}] Не удалось подтвердить апдейты при остановке: {e}")
+
+    async def run(self):
+        errors = 0
+        try:
+            while not self.stop_event.is_set():
+                try:
+                    if self.allowed is None:
+                        await self._start()
+                    await self.poll_once()
+                    errors = 0
+                except Exception as e:
+                    errors += 1
+                    await asyncio.sleep(self._failed(e, errors))
+        finally:
+            await self._confirm()
+            logger.info(f"[{self.name}] polling остановлен: {self.stats}")
@@ -0,0 +1,186 @@
+# profiler.py
+"""
+Профилирование живого процесса по запросу: без DEBUG_TOKEN выключено полностью.
+
+- sample() — сэмплирующий профайлер по всем потокам процесса (поток polling
+  run_bot, воркеры обработчиков, потоки Flask/uvicorn): раз в interval секунд
+  снимает sys._current_frames() и считает одинаковые стеки. Результат —
+  свёрнутые стеки ("поток;функция (файл:строка);... число"), которые без
+  преобразования открываются в flamegraph.pl, speedscope и т.п.
+- dump_stacks() — текущий стек каждого потока.
+
+Пока профиль не запрошен, ничего не работает и не устанавливается (никаких
+sys.setprofile/settrace), поэтому накладных расходов нет.
+
+HTTP: /_debug/profile?seconds=10&interval=0.01&idle=0 и /_debug/stacks
+(server.py, asgi.py) с заголовком X-Debug-Token. Без DEBUG_TOKEN маршруты
+отвечают 404.
+
+Процесс бота в продакшен-режиме (bot_runner.py) HTTP не обслуживает, для него
+install_signal_handlers(): SIGUSR1 пишет стеки в лог, SIGUSR2 пишет профиль
+за PROFILE_SIGNAL_SECONDS секунд в файл в PROFILE_DIR.
+"""
+
+import os
+import sys
+import hmac
+import time
+import signal
+import logging
+import threading
+import traceback
+from collections import Counter
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+DEBUG_TOKEN = os.getenv("DEBUG_TOKEN", "")
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "20"))
+PROFILE_SIGNAL_SECONDS = float(os.getenv("PROFILE_SIGNAL_SECONDS", "10"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/tmp")
+DEFAULT_INTERVAL = 0.01
+MIN_INTERVAL = 0.001
+
+# Листья стеков, где поток просто ждёт (idle=0 их отбрасывает)
+IDLE_LEAVES = {
+    ("threading.py", "wait"),
+    ("threading.py", "_wait_for_tstate_lock"),
+    ("selectors.py", "select"),
+    ("socket.py", "accept"),
+    ("socketserver.py", "serve_forever"),
+    ("queue.py", "get"),
+    ("thread.py", "_worker"),
+    ("base_events.py", "_run_once"),
+}
+
+# Одновременно идёт не больше одного профиля
+_busy = threading.Lock()
+
+class ProfilerBusy(Exception):
+    """Профиль уже снимается"""
+
+def enabled():
+    return bool(DEBUG_TOKEN)
+
+def check_token(provided):
+    """HTTP-статус отказа (404 — выключено, 403 — неверный токен) или None"""
+    if not DEBUG_TOKEN:
+        return 404
+    if not provided or not hmac.compare_digest(str(provided), DEBUG_TOKEN):
+        return 403
+    return None
+
+def _frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def _thread_names():
+    return {t.ident: t.name for t in threading.enumerate()}
+
+def sample(seconds=10.0, interval=DEFAULT_INTERVAL, idle=True):
+    """
+    Сэмплирует стеки всех потоков seconds секунд.
+    Возвращает (Counter {свёрнутый стек: число}, число снимков).
+    """
+    seconds = max(0.0, min(float(seconds), PROFILE_MAX_SECONDS))
+    interval = max(float(interval), MIN_INTERVAL)
+    if not _busy.acquire(blocking=False):
+        raise ProfilerBusy()
+    try:
+        me = threading.get_ident()
+        counts = Counter()
+        labels = {}
+        samples = 0
+        names = _thread_names()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            frames = sys._current_frames()
+            if len(frames) != len(names):
+                names = _thread_names()
+            for ident, frame in frames.items():
+                if ident == me:
+                    continue
+                leaf = frame.f_code
+                if not idle and (os.path.basename(leaf.co_filename), leaf.co_name) in IDLE_LEAVES:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    label = labels.get(code)
+                    if label is None:
+                        label = labels[code] = _frame_label(code)
+                    stack.append(label)
+                    frame = frame.f_back
+                stack.append(names.get(ident, f"thread-{ident}"))
+                counts[";".join(reversed(stack))] += 1
+            samples += 1
+            del frames
+            time.sleep(interval)
+        return counts, samples
+    finally:
+        _busy.release()
+
+def collapsed(counts):
+    """Свёрнутые стеки в формате flamegraph.pl: одна строка на стек"""
+    return "".join(f"{stack} {n}\n" for stack, n in counts.most_common())
+
+def summary(counts, samples, top=30):
+    """Самые частые функции (self — на вершине стека, total — где угодно в стеке)"""
+    own, total = Counter(), Counter()
+    for stack, n in counts.items():
+        frames = stack.split(";")[1:]
+        if not frames:
+            continue
+        own[frames[-1]] += n
+        for frame in set(frames):
+            total[frame] += n
+    return {
+        "samples": samples,
+        "stacks": len(counts),
+        "self": [{"function": f, "count": n} for f, n in own.most_common(top)],
+        "total": [{"function": f, "count": n} for f, n in total.most_common(top)],
+    }
+
+def dump_stacks():
+    """Текущий стек каждого потока (кроме вызывающего) текстом"""
+    me = threading.get_ident()
+    threads = {t.ident: t for t in threading.enumerate()}
+    out = []
+    for ident, frame in sys._current_frames().items():
+        if ident == me:
+            continue
+        thread = threads.get(ident)
+        name = thread.name if thread else f"thread-{ident}"
+        daemon = " daemon" if thread is not None and thread.daemon else ""
+        out.append(f'Thread "{name}" ident={ident}{daemon}\n')
+        out.extend(traceback.format_stack(frame))
+        out.append("\n")
+    return "".join(out)
+
+def profile_filename():
+    return f"profile-{os.getpid()}-{datetime.now():%Y%m%d-%H%M%S}.folded"
+
+# --- сигналы для процесса без HTTP (bot_runner.py) ---
+
+def _on_dump_signal(_signum, _frame):
+    logger.warning("Стеки потоков по SIGUSR1:\n" + dump_stacks())
+
+def _on_profile_signal(_signum, _frame):
+    def run():
+        try:
+            counts, samples = sample(PROFILE_SIGNAL_SECONDS)
+        except ProfilerBusy:
+            logger.warning("Профиль уже снимается")
+            return
+        path = os.path.join(PROFILE_DIR, profile_filename())
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(collapsed(counts))
+        logger.warning(f"Профиль за {PROFILE_SIGNAL_SECONDS} с ({samples} снимков) записан в {path}")
+    threading.Thread(target=run, name="profiler", daemon=True).start()
+
+def install_signal_handlers():
+    """SIGUSR1 — стеки в лог, SIGUSR2 — профиль в файл; только при заданном DEBUG_TOKEN"""
+    if not enabled() or not hasattr(signal, "SIGUSR1"):
+        return False
+    signal.signal(signal.SIGUSR1, _on_dump_signal)
+    signal.signal(signal.SIGUSR2, _on_profile_signal)
+    return True
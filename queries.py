@@ -0,0 +1,104 @@
+# queries.py
+"""
+Запросы чтения к survey_responses.
+
+Выборки идут через routing.read — на реплику, если она настроена и не отстаёт.
+has_submitted и last_submitted_at проверяют только что сохранённое и поэтому всегда читают основную БД.
+Ответы пользователя кэшируются в user_cache до его следующей записи; сразу
+после записи они читаются с основной БД, чтобы не закэшировать отставшую реплику.
+
+Все выборки постраничные и опираются на индексы из migrations.py:
+- ix_survey_responses_user_id_id  — ответы пользователя, постранично по id
+- ix_survey_responses_created_at  — выборка за интервал времени
+- ix_survey_responses_citizenship — фильтр по гражданству
+"""
+
+from sqlalchemy import select, exists, func
+
+from db import SurveyResponse
+import user_cache
+from routing import router, read, write_session
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 500
+
+def _page_size(limit):
+    return max(1, min(int(limit or DEFAULT_PAGE_SIZE), MAX_PAGE_SIZE))
+
+def user_responses_stmt(user_id: int, limit: int = DEFAULT_PAGE_SIZE, before_id: int = None):
+    stmt = select(SurveyResponse).where(SurveyResponse.user_id == user_id)
+    if before_id is not None:
+        stmt = stmt.where(SurveyResponse.id < before_id)
+    return stmt.order_by(SurveyResponse.id.desc()).limit(_page_size(limit))
+
+@user_cache.cached("user_responses")
+def get_user_responses(user_id: int, limit: int = DEFAULT_PAGE_SIZE, before_id: int = None):
+    """
+    Ответы пользователя от новых к старым (keyset-пагинация).
+    Для следующей страницы передайте before_id = id последней записи.
+    """
+    stmt = user_responses_stmt(user_id, limit, before_id)
+    if user_cache.cache.written_within(user_id, router.max_lag):
+        with write_session() as s:
+            return list(s.scalars(stmt))
+    return read(lambda s: list(s.scalars(stmt)))
+
+def responses_between_stmt(start, end, limit: int = 100, after=None, citizenship: str = None):
+    stmt = select(SurveyResponse).where(
+        SurveyResponse.created_at >= start,
+        SurveyResponse.created_at < end,
+    )
+    if citizenship:
+        stmt = stmt.where(SurveyResponse.citizenship == citizenship)
+    if after is not None:
+        after_ts, after_id = after
+        stmt = stmt.where(
+            (SurveyResponse.created_at > after_ts)
+            | ((SurveyResponse.created_at == after_ts) & (SurveyResponse.id > after_id))
+        )
+    return stmt.order_by(SurveyResponse.created_at, SurveyResponse.id).limit(_page_size(limit))
+
+def get_responses_between(start, end, limit: int = 100, after=None, citizenship: str = None):
+    """
+    Ответы с created_at в интервале [start, end) по возрастанию времени.
+    after — курсор (created_at, id) последней записи предыдущей страницы.
+    """
+    stmt = responses_between_stmt(start, end, limit, after, citizenship)
+    return read(lambda s: list(s.scalars(stmt)))
+
+def has_submitted_stmt(user_id: int, since=None, tenant_id=None):
+    cond = SurveyResponse.user_id == user_id
+    if tenant_id is not None:
+        cond = cond & (SurveyResponse.tenant_id == tenant_id)
+    if since is not None:
+        cond = cond & (SurveyResponse.created_at >= since)
+    return select(exists().where(cond))
+
+def has_submitted(user_id: int, since=None, tenant_id=None) -> bool:
+    """Есть ли у пользователя ответ (опционально — не раньше since и только у бота tenant_id)"""
+    with write_session() as s:
+        return bool(s.scalar(has_submitted_stmt(user_id, since, tenant_id)))
+
+def last_submitted_at_stmt(user_id: int, since=None, tenant_id=None):
+    stmt = select(func.max(SurveyResponse.created_at)).where(SurveyResponse.user_id == user_id)
+    if tenant_id is not None:
+        stmt = stmt.where(SurveyResponse.tenant_id == tenant_id)
+    if since is not None:
+        stmt = stmt.where(SurveyResponse.created_at >= since)
+    return stmt
+
+def last_submitted_at(user_id: int, since=None, tenant_id=None):
+    """created_at последнего ответа пользователя (не раньше since) или None"""
+    with write_session() as s:
+        return s.scalar(last_submitted_at_stmt(user_id, since, tenant_id))
+
+def response_to_dict(r):
+    """Представление записи для JSON-ответов"""
+    return {
+        "id": r.id,
+        "user_id": r.user_id,
+        "full_name": r.full_name,
+        "birth_date": str(r.birth_date) if r.birth_date is not None else None,
+        "citizenship": r.citizenship,
+        "created_at": str(r.created_at) if r.created_at else None,
+    }
@@ -2,11 +2,22 @@
 """
 Скрипт для проверки конфигурации Render и тестирования базы данных
 Запускайте этот скрипт для проверки готовности к развертыванию
+
+Этап производительности сравнивает замеры с порогами из perf_thresholds.json
+и проваливает проверку при регрессии больше допуска (tolerance):
+    python render_deploy_check.py              # все проверки
+    python render_deploy_check.py --perf-only  # только производительность
+    python render_deploy_check.py --skip-perf
 """
 
 import os
 import sys
+import json
+import time
 import logging
+import argparse
+import statistics
+import subprocess
 from pathlib import Path
 
 # Настройка логирования
@@ -152,8 +163,181 @@ def check_render_config():
         logger.error(f"❌ Ошибка проверки render.yaml: {e}")
         return False
 
-def main():
+# Пороги производительности (хранятся в репозитории)
+PERF_THRESHOLDS_PATH = Path(__file__).with_name("perf_thresholds.json")
+PERF_IMPORT_RUNS = 3
+PERF_INSERT_SECONDS = 2.0
+PERF_HANDLER_SURVEYS = 50
+PERF_TABLE = "survey_responses_perf"
+
+def _perf_env():
+    """Окружение для замеров: без DATABASE_URL используется локальная SQLite"""
+    env = dict(os.environ)
+    if not env.get("DATABASE_URL"):
+        env["LOCAL_SQLITE"] = "1"
+    return env
+
+def measure_import_times(modules=("server", "bot", "db"), runs=PERF_IMPORT_RUNS):
+    """Медиана времени холодного импорта модуля в отдельном процессе"""
+    code = "import time, importlib, sys; t = time.perf_counter(); importlib.import_module(sys.argv[1]); print(time.perf_counter() - t)"
+    results = {}
+    for module in modules:
+        samples = []
+        for _ in range(runs):
+            out = subprocess.run(
+                [sys.executable, "-c", code, module],
+                env=_perf_env(), capture_output=True, text=True, timeout=120,
+            )
+            if out.returncode != 0:
+                raise RuntimeError(f"import {module}: {out.stderr.strip().splitlines()[-1:]}")
+            samples.append(float(out.stdout.strip().splitlines()[-1]))
+        results[f"import_{module}_s"] = statistics.median(samples)
+    return results
+
+def measure_db_latency():
+    """Подключение и первый запрос на свежем движке (без прогретого пула)"""
+    from sqlalchemy import create_engine, text
+    import db
+
+    engine = create_engine(db.db_url, connect_args=db.connect_args)
+    try:
+        started = time.perf_counter()
+        conn = engine.connect()
+        connected = time.perf_counter()
+        conn.execute(text("SELECT 1")).scalar()
+        queried = time.perf_counter()
+        conn.close()
+    finally:
+        engine.dispose()
+    return {"db_connect_s": connected - started, "db_first_query_s": queried - connected}
+
+def _perf_table():
+    """Копия survey_responses с теми же индексами под другими именами"""
+    from sqlalchemy import MetaData, Table, Index
+    import db
+
+    source = db.SurveyResponse.__table__
+    table = Table(PERF_TABLE, MetaData(), *[c._copy() for c in source.columns])
+    for index in source.indexes:
+        Index(
+            f"{index.name}_perf", *[table.c[c.name] for c in index.columns],
+            unique=index.unique, **index.dialect_kwargs,
+        )
+    return table
+
+def measure_insert_throughput(table, seconds=PERF_INSERT_SECONDS):
+    """Одиночные вставки с коммитом каждой строки, как в save_survey_response"""
+    import db
+
+    count = 0
+    started = time.perf_counter()
+    deadline = started + seconds
+    while time.perf_counter() < deadline:
+        with db.engine.begin() as conn:
+            conn.execute(table.insert().values(
+                user_id=count, full_name="Перф Тест", birth_date="1990-01-01", citizenship="Россия",
+            ))
+        count += 1
+    return {"insert_rows_per_s": count / (time.perf_counter() - started)}
+
+def measure_handler_latency(table, surveys=PERF_HANDLER_SURVEYS):
+    """p95 обработки апдейта полным сценарием опроса против локального fake Telegram API"""
+    import telebot
+    from telebot import types
+    import bot as bot_module
+    from survey import SurveyHandlers, survey_record
+    from validation import iso_date
+    from fake_telegram_api import FakeTelegramAPI, survey_updates
+    import db
+
+    def save_survey(user_id, data, idempotency_key=None):
+        full_name, birth_date, citizenship = survey_record(data)
+        with db.engine.begin() as conn:
+            conn.execute(table.insert().values(
+                user_id=user_id, full_name=full_name, birth_date=iso_date(birth_date), citizenship=citizenship,
+            ))
+        return True
+
+    effects = {"save_survey": save_survey, "is_duplicate": lambda user_id: False}
+    timings = []
+    with FakeTelegramAPI() as api:
+        api.install()
+        try:
+            target = telebot.TeleBot("123456:perf-check", threaded=False)
+            bot_module.setup_handlers(target, SurveyHandlers(), effects=effects)
+            for n in range(surveys):
+                for update in survey_updates(900000 + n):
+                    update["update_id"] = api.next_update_id()
+                    parsed = types.Update.de_json(update)
+                    started = time.perf_counter()
+                    target.process_new_updates([parsed])
+                    timings.append((time.perf_counter() - started) * 1000)
+        finally:
+            api.uninstall()
+    timings.sort()
+    return {"handler_p95_ms": timings[int(len(timings) * 0.95) - 1]}
+
+def compare_with_thresholds(results, thresholds, tolerance):
+    """
+    Сравнивает замеры с порогами. Выход за порог в пределах допуска — предупреждение,
+    больше допуска — регрессия. Возвращает True, если регрессий нет.
+    """
+    ok = True
+    for metric, value in results.items():
+        limits = thresholds.get(metric, {})
+        if "max" in limits:
+            limit, bad, worse = limits["max"], value > limits["max"], value > limits["max"] * (1 + tolerance)
+            sign = "<="
+        elif "min" in limits:
+            limit, bad, worse = limits["min"], value < limits["min"], value < limits["min"] * (1 - tolerance)
+            sign = ">="
+        else:
+            logger.info(f"ℹ️  {metric}: {value:.4g} (порог не задан)")
+            continue
+        if worse:
+            ok = False
+            logger.error(f"❌ {metric}: {value:.4g} (порог {sign} {limit}, допуск {tolerance:.0%})")
+        elif bad:
+            logger.warning(f"⚠️  {metric}: {value:.4g} (порог {sign} {limit}, в пределах допуска)")
+        else:
+            logger.info(f"✅ {metric}: {value:.4g} (порог {sign} {limit})")
+    return ok
+
+def check_performance(tolerance=None):
+    """Проверяем производительность относительно порогов"""
+    logger.info("⏱️  Проверка производительности...")
+
+    with open(PERF_THRESHOLDS_PATH, encoding="utf-8") as f:
+        config = json.load(f)
+    tolerance = config.get("tolerance", 0.2) if tolerance is None else tolerance
+
+    if not os.environ.get("DATABASE_URL"):
+        os.environ.setdefault("LOCAL_SQLITE", "1")
+
+    results = measure_import_times()
+    results.update(measure_db_latency())
+
+    import db
+    table = _perf_table()
+    table.drop(db.engine, checkfirst=True)
+    table.create(db.engine)
+    try:
+        results.update(measure_insert_throughput(table))
+        results.update(measure_handler_latency(table))
+    finally:
+        table.drop(db.engine, checkfirst=True)
+
+    return compare_with_thresholds(results, config.get("metrics", {}), tolerance)
+
+def main(argv=None):
     """Основная функция проверки"""
+    parser = argparse.ArgumentParser(description="Проверка готовности к развертыванию на Render")
+    parser.add_argument("--perf-only", action="store_true", help="только проверка производительности")
+    parser.add_argument("--skip-perf", action="store_true", help="без проверки производительности")
+    parser.add_argument("--tolerance", type=float, default=None,
+                        help="допуск регрессии (доля), по умолчанию из perf_thresholds.json")
+    args = parser.parse_args(argv)
+
     logger.info("🚀 Запуск проверки конфигурации для Render...")
     logger.info("=" * 50)
     
@@ -164,6 +348,10 @@ def main():
         ("Конфигурация Render", check_render_config),
         ("База данных", check_database),
     ]
+    if args.perf_only:
+        checks = []
+    if not args.skip_perf:
+        checks.append(("Производительность", lambda: check_performance(args.tolerance)))
     
     results = []
     for check_name, check_func in checks:
@@ -0,0 +1,303 @@
+# retention.py
+"""
+Хранение survey_responses: ответы старше RETENTION_MONTHS месяцев переносятся
+в сжатые архивные файлы и удаляются из рабочей таблицы, чтобы горячие запросы
+(ORDER BY id DESC, COUNT(*), выгрузки) работали только со свежими данными.
+
+- PostgreSQL с секционированием (partitioning.py): старые помесячные секции
+  целиком выгружаются в архив, отсоединяются и удаляются
+- SQLite и несекционированный PostgreSQL: строки выгружаются в архив, затем
+  удаляются пачками по BATCH_SIZE с паузой, чтобы не блокировать запись анкет
+
+Файл архива пишется во временный файл и переименовывается только после fsync;
+строки удаляются только после того, как опубликованный файл перечитан и в нём
+ровно те id, что будут удалены (число, min, max и сумма). Формат — CSV.gz или
+Parquet (нужен pyarrow). Архив остаётся доступным через iter_archived().
+
+ARCHIVE_DIR — постоянное хранилище (подключённый диск, смонтированный бакет):
+в продакшене (задан DATABASE_URL или RENDER) без него задача не запускается —
+диск контейнера Render стирается при каждом деплое вместе с архивом. Локально
+по умолчанию используется ./archive.
+
+    python retention.py --months 12
+    python retention.py --months 12 --legacy            # questionnaire.db (database.py)
+    python retention.py search --user-id 12345          # поиск по архиву
+"""
+
+import os
+import csv
+import gzip
+import time
+import logging
+from datetime import date, datetime, timezone
+from pathlib import Path
+
+from sqlalchemy import select, delete, func
+
+from partitioning import TABLE, month_start, add_months, is_partitioned, list_partitions, ensure_partitions
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+logger = logging.getLogger(__name__)
+
+RETENTION_MONTHS = int(os.getenv("RETENTION_MONTHS", "12"))
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR")
+LOCAL_ARCHIVE_DIR = "archive"
+ARCHIVE_FORMAT = os.getenv("ARCHIVE_FORMAT", "csv.gz")
+BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "5000"))
+BATCH_PAUSE = float(os.getenv("RETENTION_BATCH_PAUSE", "0.1"))
+
+FORMATS = ("csv.gz", "parquet")
+# Файлы архива таблицы из database.py (questionnaire.db), чтобы не смешивать с db.py
+LEGACY_PREFIX = "questionnaire_survey_responses"
+_INT_COLUMNS = ("id", "user_id")
+
+class RetentionError(Exception):
+    pass
+
+def resolve_archive_dir(archive_dir=None):
+    """Каталог архива; в продакшене без явно заданного ARCHIVE_DIR — RetentionError"""
+    archive_dir = archive_dir or ARCHIVE_DIR
+    if archive_dir:
+        return archive_dir
+    if os.getenv("DATABASE_URL") or os.getenv("RENDER"):
+        raise RetentionError("ARCHIVE_DIR не задан: укажите постоянный каталог (подключённый диск), "
+                             "иначе архив пропадёт вместе с диском контейнера")
+    return LOCAL_ARCHIVE_DIR
+
+# --- архивные файлы ---
+
+def _plain(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+class ArchiveWriter:
+    """Потоковая запись строк в CSV.gz или Parquet с атомарной публикацией файла"""
+
+    def __init__(self, path, columns, fmt=ARCHIVE_FORMAT):
+        if fmt not in FORMATS:
+            raise ValueError(f"Неизвестный формат архива: {fmt}")
+        if fmt == "parquet" and pa is None:
+            raise RuntimeError("Для Parquet установите pyarrow или используйте ARCHIVE_FORMAT=csv.gz")
+        self.path = Path(path)
+        self.tmp_path = self.path.with_name(self.path.name + ".tmp")
+        self.columns = list(columns)
+        self.fmt = fmt
+        self.rows = 0
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        if fmt == "csv.gz":
+            self._file = gzip.open(self.tmp_path, "wt", encoding="utf-8", newline="")
+            self._csv = csv.writer(self._file)
+            self._csv.writerow(self.columns)
+        else:
+            self._schema = pa.schema([
+                (c, pa.int64() if c in _INT_COLUMNS else pa.string()) for c in self.columns
+            ])
+            self._parquet = pq.ParquetWriter(self.tmp_path, self._schema, compression="zstd")
+
+    def write(self, rows):
+        rows = [[_plain(v) for v in row] for row in rows]
+        if self.fmt == "csv.gz":
+            self._csv.writerows(rows)
+        else:
+            table = pa.table({
+                c: [row[i] if c in _INT_COLUMNS or row[i] is None else str(row[i]) for row in rows]
+                for i, c in enumerate(self.columns)
+            }, schema=self._schema)
+            self._parquet.write_table(table)
+        self.rows += len(rows)
+
+    def _finish(self):
+        if self.fmt == "csv.gz":
+            self._file.close()
+        else:
+            self._parquet.close()
+
+    def close(self):
+        self._finish()
+        with open(self.tmp_path, "rb") as f:
+            os.fsync(f.fileno())
+        os.replace(self.tmp_path, self.path)
+        # Переименование тоже должно пережить сбой питания
+        dir_fd = os.open(self.path.parent, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        return self.path
+
+    def abort(self):
+        try:
+            self._finish()
+        finally:
+            self.tmp_path.unlink(missing_ok=True)
+
+def archive_path(archive_dir, stem, fmt):
+    return Path(archive_dir) / f"{stem}.{fmt}"
+
+def _archived_ids(path):
+    """Сводка по id в опубликованном файле архива: (число, min, max, сумма)"""
+    count, low, high, total = 0, None, None, 0
+    if path.name.endswith(".csv.gz"):
+        with gzip.open(path, "rt", encoding="utf-8", newline="") as f:
+            ids = (int(row["id"]) for row in csv.DictReader(f))
+            for value in ids:
+                count, total = count + 1, total + value
+                low = value if low is None else min(low, value)
+                high = value if high is None else max(high, value)
+    else:
+        for value in pq.read_table(path, columns=["id"]).column("id").to_pylist():
+            count, total = count + 1, total + value
+            low = value if low is None else min(low, value)
+            high = value if high is None else max(high, value)
+    return count, low, high, total
+
+def verify_archive(conn, path, id_column, where, from_clause=None):
+    """
+    Сверяет файл архива со строками, которые будут удалены: число, min, max и
+    сумма id должны совпасть. Иначе файл удаляется (строки попадут в архив при
+    следующем запуске) и RetentionError — строки не удаляются.
+    """
+    stmt = select(func.count(), func.min(id_column), func.max(id_column), func.coalesce(func.sum(id_column), 0))
+    stmt = stmt.select_from(from_clause) if from_clause is not None else stmt
+    expected = tuple(conn.execute(stmt.where(where) if where is not None else stmt).one())
+    expected = (int(expected[0]), expected[1], expected[2], int(expected[3]))
+    archived = _archived_ids(Path(path))
+    if archived != expected:
+        Path(path).unlink(missing_ok=True)
+        raise RetentionError(f"Архив {path} не совпадает с таблицей (файл {archived}, таблица {expected}), "
+                             f"строки не удалены")
+
+def _export(engine, stmt, columns, path, fmt, batch_size):
+    """Выгружает результат запроса в архивный файл; возвращает число строк"""
+    writer = ArchiveWriter(path, columns, fmt)
+    try:
+        with engine.connect() as conn:
+            result = conn.execution_options(yield_per=batch_size).execute(stmt)
+            for part in result.partitions():
+                writer.write(part)
+    except Exception:
+        writer.abort()
+        raise
+    writer.close()
+    return writer.rows
+
+# --- задача хранения ---
+
+def archive_partitions(engine, table, cutoff, archive_dir, fmt, batch_size=BATCH_SIZE):
+    """Выгружает и удаляет помесячные секции, целиком лежащие до cutoff"""
+    from sqlalchemy import text, table as table_clause, column
+    moved = 0
+    with engine.connect() as conn:
+        partitions = [(m, n) for m, n in list_partitions(conn) if add_months(m, 1) <= cutoff]
+    for month, name in partitions:
+        columns = [c.name for c in table.columns]
+        stmt = text(f"SELECT {', '.join(columns)} FROM {name} ORDER BY id")
+        path = archive_path(archive_dir, f"{TABLE}_{month.year:04d}_{month.month:02d}", fmt)
+        rows = _export(engine, stmt, columns, path, fmt, batch_size)
+        with engine.begin() as conn:
+            # После DETACH в секцию ничего не пишется: сверка в той же транзакции, что и DROP
+            conn.execute(text(f"ALTER TABLE {TABLE} DETACH PARTITION {name}"))
+            verify_archive(conn, path, column("id"), None, table_clause(name))
+            conn.execute(text(f"DROP TABLE {name}"))
+        logger.info(f"[retention] Секция {name}: {rows} строк -> {path}")
+        moved += rows
+    return moved
+
+def archive_batches(engine, table, cutoff, archive_dir, fmt, batch_size=BATCH_SIZE, pause=BATCH_PAUSE,
+                    prefix=TABLE):
+    """Выгружает строки старше cutoff в архив, затем удаляет их пачками"""
+    old = table.c.created_at < cutoff
+    with engine.connect() as conn:
+        max_id = conn.execute(select(func.max(table.c.id)).where(old)).scalar()
+    if max_id is None:
+        return 0
+
+    # Граница по id фиксирует набор строк: новые анкеты сюда не попадут
+    scope = old & (table.c.id <= max_id)
+    columns = [c.name for c in table.columns]
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S")
+    path = archive_path(archive_dir, f"{prefix}_before_{cutoff:%Y_%m}_{stamp}", fmt)
+    rows = _export(engine, select(*table.columns).where(scope).order_by(table.c.id), columns, path, fmt, batch_size)
+    with engine.connect() as conn:
+        verify_archive(conn, path, table.c.id, scope)
+    logger.info(f"[retention] {table.name}: {rows} строк до {cutoff:%Y-%m-%d} -> {path}")
+
+    deleted = 0
+    while True:
+        ids = select(table.c.id).where(scope).order_by(table.c.id).limit(batch_size).scalar_subquery()
+        with engine.begin() as conn:
+            count = conn.execute(delete(table).where(table.c.id.in_(ids))).rowcount
+        if not count:
+            break
+        deleted += count
+        time.sleep(pause)
+    logger.info(f"[retention] {table.name}: удалено {deleted} строк")
+    return rows
+
+def run_retention(months=RETENTION_MONTHS, archive_dir=ARCHIVE_DIR, fmt=ARCHIVE_FORMAT,
+                  legacy=False, batch_size=BATCH_SIZE, pause=BATCH_PAUSE, today=None):
+    """Переносит в архив ответы старше months месяцев; возвращает число перенесённых строк"""
+    archive_dir = resolve_archive_dir(archive_dir)
+    if legacy:
+        import database
+        engine, table, prefix = database.engine, database.SurveyResponse.__table__, LEGACY_PREFIX
+    else:
+        import db
+        engine, table, prefix = db.engine, db.SurveyResponse.__table__, TABLE
+
+    cutoff_month = add_months(month_start(today or date.today()), -months)
+    cutoff = datetime(cutoff_month.year, cutoff_month.month, 1)
+    moved = 0
+    if not legacy and is_partitioned(engine):
+        ensure_partitions(engine)
+        moved += archive_partitions(engine, table, cutoff_month, archive_dir, fmt, batch_size)
+    # Несекционированная таблица или остатки в секции по умолчанию
+    moved += archive_batches(engine, table, cutoff, archive_dir, fmt, batch_size, pause, prefix)
+    return moved
+
+# --- чтение архива ---
+
+def iter_archived(archive_dir=ARCHIVE_DIR, user_id=None, prefix=TABLE):
+    """Строки из архивных файлов (dict; значения CSV — строки), по желанию для одного пользователя"""
+    archive_dir = resolve_archive_dir(archive_dir)
+    for path in sorted(Path(archive_dir).glob(f"{prefix}_[0-9b]*")):
+        if path.name.endswith(".csv.gz"):
+            with gzip.open(path, "rt", encoding="utf-8", newline="") as f:
+                for row in csv.DictReader(f):
+                    if user_id is None or row["user_id"] == str(user_id):
+                        yield row
+        elif path.name.endswith(".parquet") and pq is not None:
+            for row in pq.read_table(path).to_pylist():
+                if user_id is None or row["user_id"] == int(user_id):
+                    yield row
+
+if __name__ == "__main__":
+    import argparse
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Архивация и удаление старых ответов survey_responses")
+    parser.add_argument("command", nargs="?", default="run", choices=["run", "search"])
+    parser.add_argument("--months", type=int, default=RETENTION_MONTHS, help="сколько месяцев хранить в таблице")
+    parser.add_argument("--archive-dir", default=ARCHIVE_DIR)
+    parser.add_argument("--format", default=ARCHIVE_FORMAT, choices=FORMATS)
+    parser.add_argument("--legacy", action="store_true", help="таблица database.py (questionnaire.db)")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--user-id", type=int, help="для search: ответы пользователя")
+    args = parser.parse_args()
+
+    try:
+        args.archive_dir = resolve_archive_dir(args.archive_dir)
+    except RetentionError as e:
+        parser.error(str(e))
+    if args.command == "search":
+        prefix = LEGACY_PREFIX if args.legacy else TABLE
+        for row in iter_archived(args.archive_dir, args.user_id, prefix):
+            print(row)
+    else:
+        moved = run_retention(args.months, args.archive_dir, args.format, args.legacy, args.batch_size)
+        print(f"Перенесено в архив строк: {moved}")
@@ -0,0 +1,325 @@
+# rollups.py
+"""
+Накопительные агрегаты по survey_responses для отчётов без GROUP BY по всей таблице.
+
+Счётчики хранятся в таблице survey_rollups (kind, key, count):
+- citizenship — число ответов по гражданству
+- birth_year  — по году рождения (интервалы любой ширины собираются при запросе)
+- day         — по дню created_at
+- total       — "responses" и "users" (уникальные user_id, см. survey_rollup_users)
+
+refresh() дочитывает строки с id больше отметки survey_rollup_state.high_water
+и добавляет их к счётчикам в той же транзакции, в которой сдвигает отметку.
+Строки моложе ROLLUP_SETTLE_SECONDS пропускаются до следующего прохода, чтобы
+не обогнать ещё не зафиксированные вставки с меньшим id. Параллельный проход
+(другая реплика) откатывается на сдвиге отметки, счётчики не удваиваются.
+
+Источники: "db" (db.py, дата рождения — текст) и "legacy" (database.py,
+questionnaire.db, дата — Date); агрегаты лежат в той же БД, что и данные.
+Ответы, удалённые задачей хранения (retention.py), в счётчиках остаются;
+rebuild() пересчитывает всё заново только по строкам в таблице.
+
+    python rollups.py refresh
+    python rollups.py rebuild --source legacy
+    python rollups.py report
+"""
+
+import os
+import time
+import logging
+import threading
+from collections import Counter
+from datetime import date
+
+from sqlalchemy import (
+    MetaData, Table, Column, Text, BigInteger, DateTime,
+    select, update, delete, func,
+)
+
+import http_cache
+from validation import to_date
+
+logger = logging.getLogger(__name__)
+
+ROLLUP_BATCH_SIZE = int(os.getenv("ROLLUP_BATCH_SIZE", "5000"))
+ROLLUP_SETTLE_SECONDS = int(os.getenv("ROLLUP_SETTLE_SECONDS", "10"))
+ROLLUP_REFRESH_INTERVAL = float(os.getenv("ROLLUP_REFRESH_INTERVAL", "60"))
+
+SOURCES = ("db", "legacy")
+UNKNOWN = "unknown"
+
+metadata = MetaData()
+
+rollups_table = Table(
+    "survey_rollups", metadata,
+    Column("kind", Text, primary_key=True),
+    Column("key", Text, primary_key=True),
+    Column("count", BigInteger, nullable=False),
+)
+
+state_table = Table(
+    "survey_rollup_state", metadata,
+    Column("name", Text, primary_key=True),
+    Column("high_water", BigInteger, nullable=False),
+    Column("updated_at", DateTime, server_default=func.now(), onupdate=func.now()),
+)
+
+users_table = Table(
+    "survey_rollup_users", metadata,
+    Column("user_id", BigInteger, primary_key=True, autoincrement=False),
+)
+
+STATE_NAME = "survey_responses"
+
+class ConcurrentRefresh(Exception):
+    """Отметку уже сдвинул другой проход"""
+
+def source(name):
+    """(engine, таблица ответов) для источника"""
+    if name == "db":
+        import db
+        return db.engine, db.SurveyResponse.__table__
+    if name == "legacy":
+        import database
+        return database.engine, database.SurveyResponse.__table__
+    raise ValueError(f"Неизвестный источник: {name}")
+
+def _insert(conn):
+    if conn.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif conn.dialect.name == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        raise NotImplementedError(f"ON CONFLICT не поддержан для {conn.dialect.name}")
+    return insert
+
+_ready = set()
+
+def ensure_tables(engine):
+    """Создаёт таблицы агрегатов и строку отметки (один раз на движок в процессе)"""
+    if id(engine) in _ready:
+        return
+    metadata.create_all(bind=engine)
+    http_cache.ensure_tables(engine)
+    with engine.begin() as conn:
+        insert = _insert(conn)
+        conn.execute(insert(state_table).values(name=STATE_NAME, high_water=0).on_conflict_do_nothing())
+    _ready.add(id(engine))
+
+def _settled(conn, table, settle_seconds):
+    """Условие «строка достаточно старая» в часовом поясе БД"""
+    if conn.dialect.name == "sqlite":
+        cutoff = func.datetime("now", f"-{int(settle_seconds)} seconds")
+    else:
+        cutoff = func.now() - func.make_interval(0, 0, 0, 0, 0, 0, int(settle_seconds))
+    return table.c.created_at.is_(None) | (table.c.created_at < cutoff)
+
+def _aggregate(rows):
+    counts = Counter()
+    for row in rows:
+        birth = to_date(row.birth_date)
+        counts[("citizenship", row.citizenship or UNKNOWN)] += 1
+        counts[("birth_year", str(birth.year) if birth else UNKNOWN)] += 1
+        counts[("day", row.created_at.date().isoformat() if row.created_at else UNKNOWN)] += 1
+    counts[("total", "responses")] += len(rows)
+    return counts
+
+def _add_counts(conn, counts):
+    insert = _insert(conn)
+    stmt = insert(rollups_table).values([
+        {"kind": kind, "key": key, "count": n} for (kind, key), n in counts.items()
+    ])
+    conn.execute(stmt.on_conflict_do_update(
+        index_elements=[rollups_table.c.kind, rollups_table.c.key],
+        set_={"count": rollups_table.c["count"] + stmt.excluded["count"]},
+    ))
+
+def _refresh_batch(engine, table, batch_size, settle_seconds):
+    """Один шаг: не больше batch_size строк; возвращает число учтённых строк"""
+    with engine.begin() as conn:
+        high_water = conn.execute(
+            select(state_table.c.high_water).where(state_table.c.name == STATE_NAME)
+        ).scalar()
+        rows = conn.execute(
+            select(table.c.id, table.c.user_id, table.c.citizenship, table.c.birth_date, table.c.created_at)
+            .where(table.c.id > high_water)
+            .order_by(table.c.id)
+            .limit(batch_size)
+        ).all()
+        if settle_seconds and rows:
+            first_fresh = conn.execute(
+                select(func.min(table.c.id))
+                .where(table.c.id > high_water, table.c.id <= rows[-1].id)
+                .where(~_settled(conn, table, settle_seconds))
+            ).scalar()
+            if first_fresh is not None:
+                rows = [row for row in rows if row.id < first_fresh]
+        if not rows:
+            return 0
+
+        # Сдвиг отметки первым: параллельный проход будет ждать и затем не найдёт старую отметку
+        claimed = conn.execute(
+            update(state_table)
+            .where(state_table.c.name == STATE_NAME, state_table.c.high_water == high_water)
+            .values(high_water=rows[-1].id)
+        ).rowcount
+        if claimed != 1:
+            raise ConcurrentRefresh(high_water)
+
+        counts = _aggregate(rows)
+        user_ids = sorted({row.user_id for row in rows})
+        insert = _insert(conn)
+        new_users = conn.execute(
+            insert(users_table).values([{"user_id": u} for u in user_ids]).on_conflict_do_nothing()
+        ).rowcount
+        if new_users:
+            counts[("total", "users")] += new_users
+        _add_counts(conn, counts)
+        # /stats и /stats/rollups: новый ETag (http_cache.py)
+        http_cache.bump(conn, rollups_table.name)
+    http_cache.invalidate()
+    return len(rows)
+
+def refresh(name="db", batch_size=ROLLUP_BATCH_SIZE, settle_seconds=ROLLUP_SETTLE_SECONDS):
+    """Дочитывает новые строки в агрегаты; возвращает число учтённых строк"""
+    engine, table = source(name)
+    ensure_tables(engine)
+    total = 0
+    while True:
+        try:
+            n = _refresh_batch(engine, table, batch_size, settle_seconds)
+        except ConcurrentRefresh:
+            logger.info(f"[rollups] {name}: параллельный проход уже обновляет агрегаты")
+            break
+        total += n
+        if n < batch_size:
+            break
+    if total:
+        logger.info(f"[rollups] {name}: учтено строк {total}")
+    return total
+
+def rebuild(name="db", batch_size=ROLLUP_BATCH_SIZE):
+    """Пересчитывает агрегаты с нуля по строкам таблицы"""
+    engine, _ = source(name)
+    ensure_tables(engine)
+    with engine.begin() as conn:
+        conn.execute(update(state_table).where(state_table.c.name == STATE_NAME).values(high_water=0))
+        conn.execute(delete(rollups_table))
+        conn.execute(delete(users_table))
+        http_cache.bump(conn, rollups_table.name)
+    http_cache.invalidate()
+    return refresh(name, batch_size)
+
+# --- чтение ---
+
+def _read(name, fn):
+    if name == "db":
+        from routing import read
+        return read(lambda s: fn(s.connection()))
+    engine, _ = source(name)
+    with engine.connect() as conn:
+        return fn(conn)
+
+def _kind(conn, kind):
+    return {key: count for key, count in conn.execute(
+        select(rollups_table.c.key, rollups_table.c["count"]).where(rollups_table.c.kind == kind)
+    )}
+
+def birth_year_buckets(years, bucket=10):
+    """{год: n} -> [{"from": год, "to": год, "count": n}] по интервалам ширины bucket"""
+    buckets = Counter()
+    unknown = 0
+    for key, count in years.items():
+        if key == UNKNOWN:
+            unknown += count
+            continue
+        year = int(key)
+        buckets[year - year % bucket] += count
+    out = [{"from": start, "to": start + bucket - 1, "count": buckets[start]} for start in sorted(buckets)]
+    if unknown:
+        out.append({"from": None, "to": None, "count": unknown})
+    return out
+
+def report(name="db", bucket=10, start=None, end=None, top=None):
+    """
+    Отчёт по агрегатам: итоги, гражданство (по убыванию), годы рождения
+    интервалами по bucket лет и ответы по дням в [start, end] (date или ISO-строки).
+    """
+    if name not in SOURCES:
+        raise ValueError(f"Неизвестный источник: {name}")
+    bucket = max(1, int(bucket))
+    start = start.isoformat() if isinstance(start, date) else start
+    end = end.isoformat() if isinstance(end, date) else end
+
+    def query(conn):
+        state = conn.execute(
+            select(state_table.c.high_water, state_table.c.updated_at).where(state_table.c.name == STATE_NAME)
+        ).first()
+        days = select(rollups_table.c.key, rollups_table.c["count"]).where(
+            rollups_table.c.kind == "day", rollups_table.c.key != UNKNOWN
+        )
+        if start:
+            days = days.where(rollups_table.c.key >= start)
+        if end:
+            days = days.where(rollups_table.c.key <= end)
+        return state, _kind(conn, "total"), _kind(conn, "citizenship"), _kind(conn, "birth_year"), \
+            conn.execute(days.order_by(rollups_table.c.key)).all()
+
+    ensure_tables(source(name)[0])
+    state, totals, citizenship, years, days = _read(name, query)
+    responses = totals.get("responses", 0)
+    users = totals.get("users", 0)
+    by_citizenship = sorted(citizenship.items(), key=lambda item: (-item[1], item[0]))
+    if top:
+        by_citizenship = by_citizenship[:int(top)]
+    return {
+        "source": name,
+        "total_responses": responses,
+        "unique_users": users,
+        "average_per_user": round(responses / users, 2) if users else 0,
+        "citizenship": [{"citizenship": key, "count": n} for key, n in by_citizenship],
+        "birth_years": birth_year_buckets(years, bucket),
+        "days": [{"day": key, "count": n} for key, n in days],
+        "high_water": state.high_water if state else 0,
+        "updated_at": str(state.updated_at) if state and state.updated_at else None,
+    }
+
+# --- фоновое обновление ---
+
+def start_refresher(interval=ROLLUP_REFRESH_INTERVAL, sources=("db",), stop_event=None):
+    """Поток, обновляющий агрегаты раз в interval секунд; None, если interval <= 0"""
+    if interval <= 0:
+        return None
+    stop_event = stop_event or threading.Event()
+
+    def loop():
+        while not stop_event.is_set():
+            for name in sources:
+                try:
+                    refresh(name)
+                except Exception as e:
+                    logger.error(f"[rollups] Ошибка обновления агрегатов {name}: {e}")
+            stop_event.wait(interval)
+
+    thread = threading.Thread(target=loop, name="rollups-refresh", daemon=True)
+    thread.start()
+    return thread
+
+if __name__ == "__main__":
+    import json
+    import argparse
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Агрегаты survey_responses по гражданству, году рождения и дням")
+    parser.add_argument("command", choices=["refresh", "rebuild", "report"])
+    parser.add_argument("--source", default="db", choices=SOURCES)
+    parser.add_argument("--bucket", type=int, default=10, help="ширина интервала годов рождения")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    if args.command == "refresh":
+        print(f"Учтено строк: {refresh(args.source)}")
+    elif args.command == "rebuild":
+        print(f"Пересчитано строк: {rebuild(args.source)}")
+    else:
+        print(json.dumps(report(args.source, args.bucket), ensure_ascii=False, indent=2, default=str))
+    logger.info(f"Готово за {time.perf_counter() - started:.3f} с")
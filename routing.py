@@ -0,0 +1,200 @@
+# routing.py
+"""
+Маршрутизация запросов между основной БД и репликой чтения.
+
+Запись анкет всегда идёт в основную БД (db.engine). Чтение для диагностики,
+статистики и выгрузок можно отправить на реплику REPLICA_DATABASE_URL, чтобы
+аналитика не занимала соединения и диск основной БД.
+
+Реплика используется, только если она доступна и отстаёт не больше чем на
+REPLICA_MAX_LAG_SECONDS; иначе чтение идёт в основную БД. Результат проверки
+кэшируется на REPLICA_CHECK_INTERVAL секунд.
+
+Сессии объявляют намерение явно:
+    with read_session() as s: ...    # реплика, если она в порядке
+    with write_session() as s: ...   # всегда основная БД
+    read(lambda s: ...)              # чтение с повтором на основной БД при обрыве реплики
+
+Чтение, которое должно видеть только что записанное (проверка перед вставкой),
+открывается через write_session().
+"""
+
+import os
+import ssl
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError, InterfaceError
+from sqlalchemy.orm import sessionmaker
+
+import db
+
+logger = logging.getLogger(__name__)
+
+REPLICA_DATABASE_URL = os.getenv("REPLICA_DATABASE_URL")
+REPLICA_MAX_LAG_SECONDS = float(os.getenv("REPLICA_MAX_LAG_SECONDS", "30"))
+REPLICA_CHECK_INTERVAL = float(os.getenv("REPLICA_CHECK_INTERVAL", "5"))
+
+READ = "read"
+WRITE = "write"
+
+# Отставание реплики PostgreSQL в секундах; 0, если всё полученное уже применено
+# (иначе при простое основной БД pg_last_xact_replay_timestamp «стареет»)
+_LAG_SQL = text(
+    "SELECT CASE "
+    "WHEN NOT pg_is_in_recovery() THEN 0 "
+    "WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+)
+
+def _connect_args(url):
+    """connect_args по тем же правилам, что и для основного движка в db.py"""
+    if url.startswith("sqlite"):
+        return {"check_same_thread": False}
+    if "+pg8000" in url:
+        return {"ssl_context": ssl.create_default_context()}
+    return {}
+
+class EngineRouter:
+    """Выбор движка по намерению: запись — основная БД, чтение — реплика с проверкой отставания"""
+
+    def __init__(self, primary, replica_url=None, max_lag=30.0, check_interval=5.0):
+        self.primary = primary
+        self.replica_url = db._normalize(replica_url) if replica_url else None
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self._replica = None
+        self._replica_sessions = None
+        self._primary_sessions = sessionmaker(bind=primary, autoflush=False, autocommit=False)
+        self._healthy = False
+        self._checked_at = None
+        self._lock = threading.Lock()
+        self.lag = None
+        self.stats = {"primary_writes": 0, "replica_reads": 0, "primary_reads": 0, "replica_errors": 0}
+
+    @classmethod
+    def from_env(cls):
+        return cls(db.engine, REPLICA_DATABASE_URL, REPLICA_MAX_LAG_SECONDS, REPLICA_CHECK_INTERVAL)
+
+    @property
+    def replica(self):
+        """Движок реплики (создаётся при первом обращении) или None"""
+        if self.replica_url and self._replica is None:
+            with self._lock:
+                if self._replica is None:
+                    self._replica = create_engine(
+                        self.replica_url,
+                        pool_pre_ping=True,
+                        connect_args=_connect_args(self.replica_url),
+                    )
+                    self._replica_sessions = sessionmaker(bind=self._replica, autoflush=False, autocommit=False)
+        return self._replica
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def check_replica(self):
+        """Проверяет доступность и отставание реплики; True, если читать с неё можно"""
+        if self.replica_url is None:
+            return False
+        try:
+            replica = self.replica
+            with replica.connect() as conn:
+                lag = float(conn.execute(_LAG_SQL).scalar()) if replica.dialect.name == "postgresql" else 0.0
+        except Exception as e:
+            if self._healthy or self._checked_at is None:
+                logger.warning(f"Реплика недоступна, чтение идёт в основную БД: {e}")
+            self._count("replica_errors")
+            self.lag = None
+            return False
+        self.lag = lag
+        if lag > self.max_lag:
+            if self._healthy or self._checked_at is None:
+                logger.warning(f"Реплика отстаёт на {lag:.1f} с (лимит {self.max_lag}), чтение идёт в основную БД")
+            return False
+        if not self._healthy and self._checked_at is not None:
+            logger.info(f"Реплика снова используется для чтения (отставание {lag:.1f} с)")
+        return True
+
+    def replica_ok(self):
+        """Результат check_replica, кэшированный на check_interval секунд"""
+        if self.replica_url is None:
+            return False
+        now = time.monotonic()
+        if self._checked_at is None or now - self._checked_at >= self.check_interval:
+            healthy = self.check_replica()
+            self._healthy, self._checked_at = healthy, now
+        return self._healthy
+
+    def target(self, intent=READ):
+        """"replica" или "primary" для данного намерения"""
+        if intent == READ and self.replica_ok():
+            return "replica"
+        return "primary"
+
+    def engine(self, intent=READ):
+        return self.replica if self.target(intent) == "replica" else self.primary
+
+    @contextmanager
+    def session(self, intent=READ):
+        """Сессия на движке, выбранном по намерению"""
+        if intent not in (READ, WRITE):
+            raise ValueError(f"Неизвестное намерение: {intent}")
+        if self.target(intent) == "replica":
+            self._count("replica_reads")
+            factory = self._replica_sessions
+        else:
+            self._count("primary_writes" if intent == WRITE else "primary_reads")
+            factory = self._primary_sessions
+        with factory() as s:
+            yield s
+
+    def mark_replica_down(self, error):
+        """Ошибка соединения с репликой: до следующей проверки читаем с основной БД"""
+        logger.warning(f"Ошибка чтения с реплики, переключаемся на основную БД: {error}")
+        self._count("replica_errors")
+        self._healthy, self._checked_at = False, time.monotonic()
+
+    def read(self, fn):
+        """
+        Выполняет fn(session) на сессии для чтения. Если реплика отвалилась
+        посреди запроса, тот же fn повторяется на основной БД.
+        """
+        if self.target(READ) != "replica":
+            with self.session(READ) as s:
+                return fn(s)
+        try:
+            with self.session(READ) as s:
+                return fn(s)
+        except (OperationalError, InterfaceError) as e:
+            self.mark_replica_down(e)
+        with self.session(READ) as s:
+            return fn(s)
+
+    def status(self):
+        """Сводка для диагностики"""
+        return {
+            "replica_configured": self.replica_url is not None,
+            "replica_in_use": self.replica_ok(),
+            "replica_lag_s": self.lag,
+            "max_lag_s": self.max_lag,
+            **self.stats,
+        }
+
+router = EngineRouter.from_env()
+
+def read_session():
+    """Сессия для чтения: реплика, если она доступна и не отстаёт"""
+    return router.session(READ)
+
+def read(fn):
+    """fn(session) на реплике с откатом на основную БД (см. EngineRouter.read)"""
+    return router.read(fn)
+
+def write_session():
+    """Сессия для записи и чтения своих записей: всегда основная БД"""
+    return router.session(WRITE)
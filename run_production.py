@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# run_production.py
+"""
+Продакшен-запуск: HTTP под gunicorn (N воркеров) + отдельный процесс бота.
+
+- gunicorn -c gunicorn.conf.py wsgi:app — эндпоинты server.py на всех ядрах
+- python bot_runner.py — единственный поллер (выбор лидера в leader.py),
+  перезапускается с задержкой, если упал
+- SIGTERM/SIGINT пересылаются обоим процессам; после SHUTDOWN_TIMEOUT
+  оставшиеся процессы убиваются
+
+BOT_RUNNER=0 отключает процесс бота (например, в дополнительных веб-репликах).
+
+    python run_production.py
+"""
+
+import os
+import sys
+import time
+import signal
+import logging
+import subprocess
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger("run_production")
+
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", "25"))
+BOT_RUNNER = os.getenv("BOT_RUNNER", "1").lower() in ("1", "true", "yes")
+BOT_RESTART_DELAY_MAX = 60
+
+WEB_CMD = [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "wsgi:app"]
+BOT_CMD = [sys.executable, "bot_runner.py"]
+
+class Supervisor:
+    def __init__(self):
+        self.stopping = False
+        self.web = None
+        self.bot = None
+        self.bot_restart_delay = 1
+        self.bot_next_start = 0.0
+        self.bot_started_at = 0.0
+
+    def _on_signal(self, signum, _frame):
+        logger.info(f"Получен сигнал {signal.Signals(signum).name}, останавливаю процессы")
+        self.stopping = True
+
+    def _start_bot(self):
+        logger.info("Запуск процесса бота")
+        self.bot = subprocess.Popen(BOT_CMD)
+        self.bot_started_at = time.monotonic()
+
+    def _watch_bot(self):
+        if self.bot is None or self.bot.poll() is None:
+            return
+        code = self.bot.returncode
+        now = time.monotonic()
+        if self.bot_next_start == 0.0:
+            # Долго проработавший процесс перезапускаем без накопленной задержки
+            if now - self.bot_started_at > BOT_RESTART_DELAY_MAX:
+                self.bot_restart_delay = 1
+            logger.warning(f"Процесс бота завершился с кодом {code}, перезапуск через {self.bot_restart_delay} с")
+            self.bot_next_start = now + self.bot_restart_delay
+            self.bot_restart_delay = min(self.bot_restart_delay * 2, BOT_RESTART_DELAY_MAX)
+        elif now >= self.bot_next_start:
+            self.bot_next_start = 0.0
+            self._start_bot()
+
+    def _shutdown(self):
+        procs = [p for p in (self.bot, self.web) if p is not None and p.poll() is None]
+        for p in procs:
+            p.send_signal(signal.SIGTERM)
+        # Дочерним процессам нужен весь их SHUTDOWN_TIMEOUT плюс запас на выход
+        deadline = time.monotonic() + SHUTDOWN_TIMEOUT + 5
+        for p in procs:
+            try:
+                p.wait(max(0.0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                logger.error(f"Процесс {p.args} не завершился вовремя, kill")
+                p.kill()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._on_signal)
+        signal.signal(signal.SIGINT, self._on_signal)
+
+        logger.info("Запуск gunicorn")
+        self.web = subprocess.Popen(WEB_CMD)
+        if BOT_RUNNER:
+            self._start_bot()
+
+        exit_code = 0
+        while not self.stopping:
+            if self.web.poll() is not None:
+                logger.error(f"gunicorn завершился с кодом {self.web.returncode}")
+                exit_code = self.web.returncode or 1
+                break
+            self._watch_bot()
+            time.sleep(0.5)
+
+        self._shutdown()
+        return exit_code
+
+if __name__ == "__main__":
+    sys.exit(Supervisor().run())
@@ -0,0 +1,448 @@
+#!/usr/bin/env python3
+"""
+Набор бенчмарков горячих мест бота с фиксированным seed.
+
+Результаты сохраняются в JSON (по умолчанию benchmarks/<commit>.json),
+чтобы сравнивать их между коммитами:
+
+    python3 scripts/benchmark.py run
+    python3 scripts/benchmark.py run --only survey,db --output /tmp/new.json
+    python3 scripts/benchmark.py compare benchmarks/abc1234.json /tmp/new.json --fail-on-regression
+
+Все записи идут во временные SQLite-файлы: DATABASE_URL процесса бенчмарка
+игнорируется, чтобы не писать в рабочую базу. Для замера на PostgreSQL
+укажите локальный стенд в BENCH_POSTGRES_URL — таблицы создаются в отдельной
+схеме bench, которая удаляется после прогона.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+from types import SimpleNamespace
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+# Рабочие базы не трогаем: всё во временной папке
+WORKDIR = Path(tempfile.mkdtemp(prefix="bench_"))
+os.environ.pop("DATABASE_URL", None)
+os.environ["LOCAL_SQLITE"] = "1"
+os.environ["DATABASE_PATH"] = str(WORKDIR / "questionnaire.db")
+os.environ.setdefault("STATE_SNAPSHOT_PATH", str(WORKDIR / "survey_states.json"))
+os.chdir(WORKDIR)
+
+import logging
+logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger("benchmark")
+
+SEED = 20240101
+BENCH_SCHEMA = "bench"
+DEFAULT_REPEAT = 5
+
+BENCHMARKS = []
+
+def benchmark(group, name, number=1000):
+    """
+    Регистрирует фабрику бенчмарка. Фабрика получает random.Random(SEED)
+    и возвращает функцию одного замеряемого вызова (или None, если пропустить).
+    """
+    def decorator(factory):
+        BENCHMARKS.append(SimpleNamespace(group=group, name=f"{group}.{name}", number=number, factory=factory))
+        return factory
+    return decorator
+
+# --- вспомогательное ---
+
+class NullBot:
+    """Бот без сети: все вызовы API возвращают None"""
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+def fake_message(user_id, text=""):
+    user = SimpleNamespace(id=user_id, first_name="Bench")
+    return SimpleNamespace(from_user=user, chat=SimpleNamespace(id=user_id), message_id=1, text=text)
+
+def random_name(rnd):
+    last = rnd.choice(["Иванов", "Петров", "Сидоров", "Кузнецов", "Смирнов"])
+    first = rnd.choice(["Иван", "Пётр", "Алексей", "Сергей", "Андрей"])
+    middle = rnd.choice(["Иванович", "Петрович", "Сергеевич", "Андреевич"])
+    return f"{last} {first} {middle}"
+
+def random_birth_date(rnd):
+    return f"{rnd.randint(1, 28):02d}.{rnd.randint(1, 12):02d}.{rnd.randint(1940, 2010)}"
+
+def cycle(items):
+    """Бесконечный перебор заранее сгенерированных входных данных"""
+    n, i = len(items), 0
+    def next_item():
+        nonlocal i
+        item = items[i % n]
+        i += 1
+        return item
+    return next_item
+
+@contextmanager
+def use_engine(module, engine):
+    """Временно подменяет engine/SessionLocal модуля БД"""
+    from sqlalchemy.orm import sessionmaker
+    saved = module.engine, module.SessionLocal
+    module.engine = engine
+    module.SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+    try:
+        yield engine
+    finally:
+        module.engine, module.SessionLocal = saved
+
+def sqlite_engine(name):
+    from sqlalchemy import create_engine
+    return create_engine(f"sqlite:///{WORKDIR / name}", connect_args={"check_same_thread": False})
+
+def postgres_engine():
+    """Движок на локальный стенд PostgreSQL со search_path на схему bench"""
+    url = os.getenv("BENCH_POSTGRES_URL")
+    if not url:
+        return None
+    from sqlalchemy import create_engine, text, event
+    import db
+    url = db._normalize(url)
+    admin = create_engine(url)
+    with admin.begin() as conn:
+        conn.execute(text(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE"))
+        conn.execute(text(f"CREATE SCHEMA {BENCH_SCHEMA}"))
+    admin.dispose()
+
+    engine = create_engine(url)
+
+    @event.listens_for(engine, "connect")
+    def _set_search_path(dbapi_conn, _record):
+        cur = dbapi_conn.cursor()
+        cur.execute(f"SET search_path TO {BENCH_SCHEMA}")
+        cur.close()
+        dbapi_conn.commit()
+
+    return engine
+
+def drop_postgres_schema(engine):
+    from sqlalchemy import text
+    with engine.begin() as conn:
+        conn.execute(text(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE"))
+    engine.dispose()
+
+def prepare_db(engine):
+    """Схема как в db.init_db, но на переданном движке"""
+    import db
+    import http_cache
+    from migrations import run_migrations
+    db.Base.metadata.create_all(bind=engine)
+    http_cache.ensure_tables(engine)
+    run_migrations(engine)
+
+# --- бенчмарки ---
+
+@benchmark("generator", "generate_all_random_data", number=2000)
+def bench_generate_all_random_data(rnd):
+    from data_generator import PersonalDataGenerator
+    generator = PersonalDataGenerator()
+    names = cycle([random_name(rnd) for _ in range(100)])
+    return lambda: generator.generate_all_random_data(names())
+
+@benchmark("survey", "create_survey_report", number=20000)
+def bench_create_survey_report(rnd):
+    from survey import create_survey_report
+    data = cycle([
+        {"full_name": random_name(rnd), "birth_date": random_birth_date(rnd), "citizenship": "Россия"}
+        for _ in range(100)
+    ])
+    return lambda: create_survey_report(data())
+
+@benchmark("survey", "keyboards", number=2000)
+def bench_keyboards(rnd):
+    import survey
+    builders = (
+        survey.create_main_menu_keyboard,
+        survey.create_citizenship_keyboard,
+        survey.create_date_format_keyboard,
+        survey.create_survey_progress_keyboard,
+        survey.create_new_survey_keyboard,
+    )
+
+    def build_all():
+        for build in builders:
+            build().to_json()
+    return build_all
+
+@benchmark("survey", "handle_birth_date_input", number=5000)
+def bench_handle_birth_date_input(rnd):
+    from survey import SurveyHandlers, run_sync
+    handlers = SurveyHandlers()
+    bot = NullBot()
+    # Три четверти корректных дат, остальное — типичные ошибки ввода
+    inputs = cycle([
+        random_birth_date(rnd) if rnd.random() < 0.75 else rnd.choice(["31.02.1990", "1.1.1990", "15.03.2990", "abc"])
+        for _ in range(200)
+    ])
+    message = fake_message(1)
+
+    def run():
+        handlers.states[1] = {"state": "waiting_birth_date", "data": {"full_name": "Иванов Иван"}}
+        run_sync(handlers.handle_birth_date_input(message, inputs()), bot, {})
+    return run
+
+@benchmark("survey", "survey_record", number=20000)
+def bench_survey_record(rnd):
+    # Разбор даты при сохранении анкеты (save_survey_data)
+    from survey import survey_record
+    data = cycle([
+        {"full_name": random_name(rnd), "birth_date": random_birth_date(rnd), "citizenship": "Россия"}
+        for _ in range(200)
+    ])
+    return lambda: survey_record(data())
+
+def _save_survey_response_bench(rnd, engine, dedup):
+    import db
+    prepare_db(engine)
+    rows = cycle([(rnd.randint(1, 10**9), random_name(rnd), "1990-03-15", "Россия") for _ in range(500)])
+    counter = iter(range(10**9))
+
+    def run():
+        user_id, full_name, birth_date, citizenship = rows()
+        with use_engine(db, engine):
+            db.save_survey_response(user_id, full_name, birth_date, citizenship,
+                                    dedup_key=f"bench:{next(counter)}" if dedup else None)
+    return run
+
+@benchmark("db", "save_survey_response_sqlite", number=200)
+def bench_save_survey_response_sqlite(rnd):
+    return _save_survey_response_bench(rnd, sqlite_engine("survey_sqlite.db"), dedup=False)
+
+@benchmark("db", "save_survey_response_sqlite_dedup", number=200)
+def bench_save_survey_response_sqlite_dedup(rnd):
+    return _save_survey_response_bench(rnd, sqlite_engine("survey_sqlite_dedup.db"), dedup=True)
+
+@benchmark("db", "save_survey_response_postgres", number=200)
+def bench_save_survey_response_postgres(rnd):
+    engine = postgres_engine()
+    if engine is None:
+        return None
+    CLEANUP.append(lambda: drop_postgres_schema(engine))
+    return _save_survey_response_bench(rnd, engine, dedup=False)
+
+@benchmark("db", "save_survey_response_postgres_dedup", number=200)
+def bench_save_survey_response_postgres_dedup(rnd):
+    engine = postgres_engine()
+    if engine is None:
+        return None
+    CLEANUP.append(lambda: drop_postgres_schema(engine))
+    return _save_survey_response_bench(rnd, engine, dedup=True)
+
+@benchmark("database", "save_response", number=200)
+def bench_database_save_response(rnd):
+    import database
+    database.init_db()
+    rows = cycle([(rnd.randint(1, 10**9), random_name(rnd), random_birth_date(rnd), "Россия") for _ in range(500)])
+    return lambda: database.save_response(*rows())
+
+@benchmark("database", "get_all_responses_1000", number=20)
+def bench_database_get_all_responses(rnd):
+    import database
+    from sqlalchemy import delete
+    database.init_db()
+    with database.SessionLocal() as s:
+        s.execute(delete(database.SurveyResponse))
+        s.add_all([
+            database.SurveyResponse(
+                user_id=rnd.randint(1, 10**6), full_name=random_name(rnd),
+                birth_date=datetime(1990, 1, 1).date(), citizenship="Россия",
+            )
+            for _ in range(1000)
+        ])
+        s.commit()
+    return database.get_all_responses
+
+@benchmark("rollups", "report_20000", number=200)
+def bench_rollups_report(rnd):
+    # Отчёт /stats/rollups не должен зависеть от размера таблицы
+    import database
+    import rollups
+    from datetime import timedelta
+    from sqlalchemy import delete
+    database.init_db()
+    created = datetime.utcnow() - timedelta(days=1)
+    with database.SessionLocal() as s:
+        s.execute(delete(database.SurveyResponse))
+        s.add_all([
+            database.SurveyResponse(
+                user_id=rnd.randint(1, 10**5), full_name=random_name(rnd),
+                birth_date=datetime(rnd.randint(1940, 2005), 1, 1).date(),
+                citizenship=rnd.choice(["Россия", "Казахстан", "Беларусь", "Армения"]),
+                created_at=created - timedelta(minutes=rnd.randint(0, 60 * 24 * 365)),
+            )
+            for _ in range(20000)
+        ])
+        s.commit()
+    rollups.rebuild("legacy")
+    return lambda: rollups.report("legacy", bucket=10)
+
+def _flask_bench(path):
+    def factory(rnd):
+        import db
+        import database
+        from server import app
+        db.init_db()
+        database.init_db()
+        client = app.test_client()
+
+        def run():
+            response = client.get(path)
+            if response.status_code >= 500:
+                raise RuntimeError(f"{path}: HTTP {response.status_code}")
+        return run
+    return factory
+
+for _path, _name in (("/", "home"), ("/health", "health"), ("/db-info", "db_info"),
+                     ("/stats", "stats"), ("/_diag/db", "diag_db"), ("/test-db", "test_db")):
+    benchmark("flask", _name, number=200)(_flask_bench(_path))
+
+# --- запуск ---
+
+CLEANUP = []
+
+def measure(func, number, repeat):
+    """Время одного вызова (мкс) по каждому из repeat раундов"""
+    for _ in range(min(number, 10)):
+        func()
+    rounds = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        rounds.append((time.perf_counter() - started) / number * 1e6)
+    return rounds
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return "unknown"
+
+def selected(spec, only):
+    if not only:
+        return True
+    return any(spec.name == item or spec.group == item or spec.name.startswith(item + ".") for item in only)
+
+def run(args):
+    only = [item.strip() for item in args.only.split(",")] if args.only else []
+    results = {
+        "commit": git_commit(),
+        "created_at": datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "seed": SEED,
+        "benchmarks": {},
+        "skipped": [],
+    }
+    try:
+        for spec in BENCHMARKS:
+            if not selected(spec, only):
+                continue
+            random.seed(SEED)
+            func = spec.factory(random.Random(SEED))
+            if func is None:
+                print(f"{spec.name:<45} пропущен (нет стенда)")
+                results["skipped"].append(spec.name)
+                continue
+            number = max(1, int(spec.number * args.scale))
+            rounds = measure(func, number, args.repeat)
+            results["benchmarks"][spec.name] = {
+                "number": number,
+                "repeat": args.repeat,
+                "min_us": min(rounds),
+                "median_us": statistics.median(rounds),
+                "mean_us": statistics.fmean(rounds),
+                "stdev_us": statistics.stdev(rounds) if len(rounds) > 1 else 0.0,
+            }
+            print(f"{spec.name:<45} {statistics.median(rounds):>12.1f} мкс  (min {min(rounds):.1f})")
+    finally:
+        for cleanup in CLEANUP:
+            try:
+                cleanup()
+            except Exception as e:
+                logger.warning(f"Очистка не удалась: {e}")
+        shutil.rmtree(WORKDIR, ignore_errors=True)
+
+    output = Path(args.output) if args.output else ROOT / "benchmarks" / f"{results['commit']}.json"
+    output = output if output.is_absolute() else ROOT / output
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"\nРезультаты: {output}")
+    return 0
+
+def compare(args):
+    with open(args.base, encoding="utf-8") as f:
+        base = json.load(f)
+    with open(args.new, encoding="utf-8") as f:
+        new = json.load(f)
+
+    print(f"База: {base.get('commit')} ({base.get('created_at')})  Новый: {new.get('commit')} ({new.get('created_at')})")
+    print(f"{'бенчмарк':<45} {'база, мкс':>12} {'новый, мкс':>12} {'изменение':>10}")
+    regressions = []
+    for name in sorted(set(base["benchmarks"]) | set(new["benchmarks"])):
+        old_result, new_result = base["benchmarks"].get(name), new["benchmarks"].get(name)
+        if old_result is None or new_result is None:
+            side = "только в новом" if old_result is None else "только в базе"
+            print(f"{name:<45} {side:>36}")
+            continue
+        old_value, new_value = old_result[args.metric], new_result[args.metric]
+        change = (new_value - old_value) / old_value if old_value else 0.0
+        mark = ""
+        if change > args.threshold:
+            mark = "  медленнее"
+            regressions.append(name)
+        elif change < -args.threshold:
+            mark = "  быстрее"
+        print(f"{name:<45} {old_value:>12.1f} {new_value:>12.1f} {change:>+10.1%}{mark}")
+
+    if regressions:
+        print(f"\nРегрессии больше {args.threshold:.0%}: {', '.join(regressions)}")
+        if args.fail_on_regression:
+            return 1
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки бота опросов")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_run = sub.add_parser("run", help="запустить бенчмарки и сохранить JSON")
+    p_run.add_argument("--only", help="группы или имена через запятую (generator, survey, db, database, flask)")
+    p_run.add_argument("--output", help="файл результатов (по умолчанию benchmarks/<commit>.json)")
+    p_run.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    p_run.add_argument("--scale", type=float, default=1.0, help="множитель числа вызовов в раунде")
+    p_run.set_defaults(func=run)
+
+    p_cmp = sub.add_parser("compare", help="сравнить два файла результатов")
+    p_cmp.add_argument("base")
+    p_cmp.add_argument("new")
+    p_cmp.add_argument("--metric", default="median_us", choices=["min_us", "median_us", "mean_us"])
+    p_cmp.add_argument("--threshold", type=float, default=0.10, help="порог изменения (доля)")
+    p_cmp.add_argument("--fail-on-regression", action="store_true", help="код возврата 1 при регрессии")
+    p_cmp.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Проверка рассылки (broadcast.py) на локальной заглушке Telegram API.
+
+Во временной SQLite создаются ответы --users пользователей (у части по
+несколько ответов), --blocked из них «заблокировали бота» (403 в заглушке).
+Рассылка прерывается после --interrupt-at отправок (как при SIGTERM) и
+продолжается вторым запуском; затем проверяется, что каждый доступный
+пользователь получил ровно одно сообщение, заблокированные записаны в
+broadcast_skips и вторая рассылка к ним не обращается. Скорость сравнивается
+с теоретическим минимумом получателей / --rate.
+
+    python3 scripts/broadcast_fake.py --users 5000 --rate 1000 --workers 16 --latency 0.01
+    python3 scripts/broadcast_fake.py --users 600 --rate 30              # реальный лимит Telegram
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+from collections import Counter
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+WORKDIR = Path(tempfile.mkdtemp(prefix="broadcast_"))
+os.environ.pop("DATABASE_URL", None)
+os.environ["LOCAL_SQLITE"] = "1"
+os.environ["DATABASE_PATH"] = str(WORKDIR / "questionnaire.db")
+os.chdir(WORKDIR)
+
+import logging
+logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+
+def seed(users, rnd):
+    """Ответы пользователей 1..users; у каждого пятого — повторные ответы"""
+    import db
+    db.init_db()
+    rows = []
+    for user_id in range(1, users + 1):
+        for _ in range(3 if user_id % 5 == 0 else 1):
+            rows.append({"user_id": 1_000_000 + user_id, "full_name": "Иванов Иван",
+                         "birth_date": "1990-03-15", "citizenship": rnd.choice(["Россия", "Беларусь"])})
+    with db.engine.begin() as conn:
+        conn.execute(db.SurveyResponse.__table__.insert(), rows)
+    return [1_000_000 + u for u in range(1, users + 1)]
+
+def run(name, args, stop_after=None, api=None):
+    import broadcast
+    job = broadcast.Broadcast(name, "123456:broadcast", rate=args.rate, workers=args.workers,
+                              checkpoint_seconds=0.5)
+    if stop_after:
+        def watch():
+            while sum(1 for c in api.calls if c[1] == "sendMessage") < stop_after:
+                time.sleep(0.01)
+            job.stop_event.set()
+        threading.Thread(target=watch, daemon=True).start()
+    started = time.perf_counter()
+    status = job.run()
+    return status, time.perf_counter() - started, job.progress.processed
+
+def main():
+    parser = argparse.ArgumentParser(description="Рассылка на заглушке Telegram API")
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--blocked", type=float, default=0.05, help="доля заблокировавших бота")
+    parser.add_argument("--rate", type=float, default=500.0, help="сообщений в секунду")
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=0.01, help="время ответа заглушки, с")
+    parser.add_argument("--interrupt-at", type=float, default=0.4, help="доля рассылки до остановки (0 — без)")
+    parser.add_argument("--keep", action="store_true", help="не удалять временную папку")
+    args = parser.parse_args()
+
+    import broadcast
+    from fake_telegram_api import FakeTelegramAPI
+
+    rnd = random.Random(20240101)
+    problems = 0
+    try:
+        users = seed(args.users, rnd)
+        blocked = set(rnd.sample(users, int(len(users) * args.blocked)))
+        with FakeTelegramAPI(latency=args.latency) as api:
+            api.install()
+            for user_id in blocked:
+                api.errors[user_id] = (403, "Forbidden: bot was blocked by the user")
+            total = broadcast.create("first", "Новый опрос уже доступен: /start")
+            stop_after = int(total * args.interrupt_at) if args.interrupt_at else None
+
+            elapsed = processed = 0.0
+            status, seconds, n = run("first", args, stop_after, api)
+            elapsed, processed = elapsed + seconds, processed + n
+            print(f"Запуск 1: {status}, обработано {n} за {seconds:.2f} с")
+            if status != "done":
+                status, seconds, n = run("first", args)
+                elapsed, processed = elapsed + seconds, processed + n
+                print(f"Запуск 2: {status}, обработано {n} за {seconds:.2f} с")
+
+            sends = Counter(int(c[2]["chat_id"]) for c in api.calls if c[1] == "sendMessage")
+            reachable = set(users) - blocked
+            missing = reachable - set(sends)
+            duplicates = {u: n for u, n in sends.items() if n > 1}
+            job = broadcast.status("first")["broadcasts"][0]
+            minimum = total / args.rate
+            print(f"Получателей {total}: отправлено {job['sent']}, заблокировали {job['blocked']}, "
+                  f"ошибок {job['failed']}, статус {job['status']}")
+            print(f"Время {elapsed:.2f} с при минимуме {minimum:.2f} с ({minimum / elapsed:.0%} от предела), "
+                  f"{processed / elapsed:.1f} сообщений/с")
+            print(f"Не получили: {len(missing)}, получили повторно: {len(duplicates)}")
+            problems += len(missing) + len(duplicates)
+            problems += job["status"] != "done" or job["sent"] != len(reachable) or job["blocked"] != len(blocked)
+
+            # Вторая рассылка: заблокировавшие пропускаются без обращения к API
+            api.calls.clear()
+            second_total = broadcast.create("second", "Напоминание")
+            run("second", args)
+            touched = {int(c[2]["chat_id"]) for c in api.calls if c[1] == "sendMessage"}
+            print(f"Вторая рассылка: получателей {second_total}, обращений к заблокировавшим {len(touched & blocked)}")
+            problems += len(touched & blocked) + (second_total != len(reachable))
+            api.uninstall()
+    finally:
+        if args.keep:
+            print(f"Временная папка: {WORKDIR}")
+        else:
+            shutil.rmtree(WORKDIR, ignore_errors=True)
+    print("OK" if not problems else f"Расхождений: {problems}")
+    return 1 if problems else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Проверка, что online_migration.py не теряет индексы survey_responses.
+
+Без аргументов: схема из db.init_db (create_all + migrations.py) строится во
+временной SQLite, и каждый индекс, в который входят переводимые колонки
+(birth_date, user_id), должен быть в online_migration.COLUMNS — иначе cleanup
+удалит его вместе со старой колонкой.
+
+С --postgres (DATABASE_URL): в отдельной схеме создаётся таблица со старыми
+типами (user_id INTEGER, birth_date TEXT) и всеми индексами, выполняются run и
+cleanup, затем проверяется, что все индексы на месте и построены по новым
+колонкам. Схема удаляется после прогона.
+
+    python3 scripts/check_online_migration.py
+    DATABASE_URL=... python3 scripts/check_online_migration.py --postgres --rows 20000
+"""
+
+import os
+import sys
+import logging
+import argparse
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+if not os.getenv("DATABASE_URL"):
+    os.environ.setdefault("LOCAL_SQLITE", "1")
+
+from sqlalchemy import create_engine, inspect, text
+
+import db
+import http_cache
+import online_migration
+from migrations import run_migrations
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+SCRATCH_SCHEMA = "online_migration_check"
+
+def build_schema(engine):
+    """Схема как в db.init_db"""
+    db.Base.metadata.create_all(bind=engine)
+    http_cache.ensure_tables(engine)
+    run_migrations(engine)
+
+def expected_indexes(engine):
+    """{индекс: колонки} для индексов, затрагивающих переводимые колонки"""
+    migrated = {c.column for c in online_migration.COLUMNS}
+    return {ix["name"]: ix["column_names"] for ix in inspect(engine).get_indexes(online_migration.TABLE)
+            if migrated & set(ix["column_names"])}
+
+def check_coverage(engine):
+    """Индексы по переводимым колонкам без записи в COLUMNS"""
+    covered = {}
+    for column in online_migration.COLUMNS:
+        for final_name, _, _ in column.indexes:
+            covered[final_name] = column.column
+    missing = 0
+    for name, columns in sorted(expected_indexes(engine).items()):
+        ok = all(covered.get(name) == c for c in columns if c in {x.column for x in online_migration.COLUMNS})
+        missing += not ok
+        logger.info(f"{'✅' if ok else '❌'} {name} ({', '.join(columns)})")
+    return missing
+
+def check_postgres(rows):
+    from check_query_plans import _search_path_engine
+    admin = create_engine(db.db_url, connect_args=db.connect_args)
+    with admin.begin() as conn:
+        conn.execute(text(f"DROP SCHEMA IF EXISTS {SCRATCH_SCHEMA} CASCADE"))
+        conn.execute(text(f"CREATE SCHEMA {SCRATCH_SCHEMA}"))
+    engine = _search_path_engine(SCRATCH_SCHEMA)
+    try:
+        build_schema(engine)
+        before = expected_indexes(engine)
+        table = online_migration.TABLE
+        with engine.begin() as conn:
+            # Старые типы, как в базах до online_migration.py
+            conn.execute(text(f"ALTER TABLE {table} ALTER COLUMN user_id TYPE INTEGER, "
+                              f"ALTER COLUMN birth_date TYPE TEXT USING to_char(birth_date, 'DD.MM.YYYY')"))
+            conn.execute(text(
+                f"INSERT INTO {table} (user_id, full_name, birth_date, citizenship, tenant_id) "
+                f"SELECT g % 1000, 'Тестов Тест', '15.03.1990', 'Россия', "
+                f"CASE WHEN g % 2 = 0 THEN 'shop' END FROM generate_series(1, :n) g"
+            ), {"n": rows})
+        online_migration.run(engine, pause=0)
+        online_migration.cleanup(engine)
+        after = expected_indexes(engine)
+        with engine.connect() as conn:
+            types = online_migration.column_types(conn)
+        problems = 0
+        for name, columns in sorted(before.items()):
+            ok = after.get(name) == columns
+            problems += not ok
+            logger.info(f"{'✅' if ok else '❌'} после swap и cleanup: {name} {after.get(name)}")
+        for column in online_migration.COLUMNS:
+            ok = types.get(column.column) == column.type
+            problems += not ok
+            logger.info(f"{'✅' if ok else '❌'} {column.column}: {types.get(column.column)}")
+        return problems
+    finally:
+        engine.dispose()
+        with admin.begin() as conn:
+            conn.execute(text(f"DROP SCHEMA IF EXISTS {SCRATCH_SCHEMA} CASCADE"))
+
+def main():
+    parser = argparse.ArgumentParser(description="Индексы survey_responses после online_migration.py")
+    parser.add_argument("--postgres", action="store_true", help="полный прогон run + cleanup на PostgreSQL")
+    parser.add_argument("--rows", type=int, default=20000)
+    args = parser.parse_args()
+
+    engine = create_engine(f"sqlite:///{Path(tempfile.mkdtemp()) / 'online_migration_check.db'}")
+    build_schema(engine)
+    problems = check_coverage(engine)
+    if args.postgres:
+        problems += check_postgres(args.rows)
+    if problems:
+        logger.error(f"Индексов, которые потеряются: {problems}")
+        return 1
+    logger.info("Все индексы переживают swap и cleanup")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
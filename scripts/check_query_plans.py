@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+Проверка планов запросов из queries.py через EXPLAIN.
+
+Создаёт временную таблицу survey_responses (SQLite-файл во временной папке
+или отдельная схема в PostgreSQL при --postgres), заполняет её большим
+количеством записей, применяет миграции и проверяет, что каждый запрос
+использует ожидаемый индекс. Код возврата 1, если хотя бы один план
+оказался полным сканированием.
+
+С --partitioned (вместе с --postgres) таблица после заполнения переводится в
+секционированную (partitioning.convert), и дополнительно проверяется, что
+migrations.create_index строит на ней валидный индекс со всеми секциями.
+
+    python3 scripts/check_query_plans.py --rows 200000
+    DATABASE_URL=... python3 scripts/check_query_plans.py --postgres
+    DATABASE_URL=... python3 scripts/check_query_plans.py --postgres --partitioned
+"""
+
+import os
+import sys
+import random
+import argparse
+import logging
+import tempfile
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+if not os.getenv("DATABASE_URL"):
+    os.environ.setdefault("LOCAL_SQLITE", "1")
+
+from sqlalchemy import create_engine, text, insert, event
+
+import db
+import queries
+import partitioning
+from migrations import run_migrations, create_index
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+SCRATCH_SCHEMA = "plan_check"
+CITIZENSHIPS = ["Россия", "Украина", "Беларусь", "Казахстан", "Армения", "Грузия", "Молдова"]
+
+def make_engine(use_postgres):
+    if not use_postgres:
+        path = Path(tempfile.mkdtemp()) / "plan_check.db"
+        logger.info(f"Временная SQLite база: {path}")
+        return create_engine(f"sqlite:///{path}")
+    engine = create_engine(db.db_url, connect_args=db.connect_args)
+    with engine.begin() as conn:
+        conn.execute(text(f"DROP SCHEMA IF EXISTS {SCRATCH_SCHEMA} CASCADE"))
+        conn.execute(text(f"CREATE SCHEMA {SCRATCH_SCHEMA}"))
+    # Все запросы и миграции идут во временную схему, рабочая таблица не затрагивается
+    return _search_path_engine(SCRATCH_SCHEMA)
+
+def _search_path_engine(schema):
+    engine = create_engine(db.db_url, connect_args=db.connect_args)
+
+    @event.listens_for(engine, "connect")
+    def _set_search_path(dbapi_conn, _record):
+        cur = dbapi_conn.cursor()
+        cur.execute(f"SET search_path TO {schema}")
+        cur.close()
+        dbapi_conn.commit()
+
+    return engine
+
+def seed(engine, rows, batch_size=10000):
+    db.Base.metadata.create_all(bind=engine, tables=[db.SurveyResponse.__table__])
+    run_migrations(engine)
+    rnd = random.Random(42)
+    start = datetime(2024, 1, 1)
+    table = db.SurveyResponse.__table__
+    logger.info(f"Заполняю {rows} записей...")
+    with engine.begin() as conn:
+        batch = []
+        for i in range(rows):
+            batch.append({
+                "user_id": rnd.randint(1, rows // 3 + 1),
+                "full_name": f"Тестов Тест {i}",
+                "birth_date": "1990-01-01",
+                "citizenship": rnd.choice(CITIZENSHIPS),
+                "created_at": start + timedelta(seconds=i * 30),
+            })
+            if len(batch) >= batch_size:
+                conn.execute(insert(table), batch)
+                batch = []
+        if batch:
+            conn.execute(insert(table), batch)
+        if engine.dialect.name == "postgresql":
+            conn.execute(text("ANALYZE survey_responses"))
+        else:
+            conn.execute(text("ANALYZE"))
+
+def check_partitioned_index(engine):
+    """create_index на секционированной таблице: индекс родителя валиден и есть у каждой секции"""
+    name = "ix_plan_check_full_name"
+    create_index(engine, name, "survey_responses", ["full_name"])
+    with engine.connect() as conn:
+        valid = conn.execute(text(
+            "SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+            "WHERE c.relname = :n AND pg_table_is_visible(c.oid)"
+        ), {"n": name}).scalar()
+        partitions = conn.execute(text(
+            "SELECT count(*) FROM pg_inherits i JOIN pg_class p ON p.oid = i.inhparent "
+            "WHERE p.relname = 'survey_responses' AND pg_table_is_visible(p.oid)"
+        )).scalar()
+        attached = conn.execute(text(
+            "SELECT count(*) FROM pg_inherits i JOIN pg_class p ON p.oid = i.inhparent "
+            "WHERE p.relname = :n AND pg_table_is_visible(p.oid)"
+        ), {"n": name}).scalar()
+    ok = bool(valid) and attached == partitions
+    logger.info(f"{'✅' if ok else '❌'} create_index на секционированной таблице: "
+                f"valid={valid}, секций с индексом {attached}/{partitions}")
+    return not ok
+
+def explain(engine, stmt):
+    sql = str(stmt.compile(engine, compile_kwargs={"literal_binds": True}))
+    prefix = "EXPLAIN QUERY PLAN " if engine.dialect.name == "sqlite" else "EXPLAIN "
+    with engine.connect() as conn:
+        rows = conn.execute(text(prefix + sql)).fetchall()
+    return "\n".join(str(r[-1]) for r in rows)
+
+def main():
+    parser = argparse.ArgumentParser(description="Проверка использования индексов запросами queries.py")
+    parser.add_argument("--rows", type=int, default=200000, help="Сколько записей сгенерировать")
+    parser.add_argument("--postgres", action="store_true", help="Проверять на PostgreSQL из DATABASE_URL")
+    parser.add_argument("--partitioned", action="store_true", help="секционировать таблицу (только с --postgres)")
+    args = parser.parse_args()
+    if args.partitioned and not args.postgres:
+        parser.error("--partitioned требует --postgres")
+
+    engine = make_engine(args.postgres)
+    seed(engine, args.rows)
+    failed = 0
+    if args.partitioned:
+        partitioning.convert(engine, drop_legacy=True)
+        with engine.begin() as conn:
+            conn.execute(text("ANALYZE survey_responses"))
+        failed += check_partitioned_index(engine)
+
+    day = datetime(2024, 1, 10)
+    checks = [
+        ("get_user_responses", queries.user_responses_stmt(1234),
+         "ix_survey_responses_user_id_id"),
+        ("get_user_responses (страница 2)", queries.user_responses_stmt(1234, before_id=50000),
+         "ix_survey_responses_user_id_id"),
+        ("get_responses_between", queries.responses_between_stmt(day, day + timedelta(hours=6)),
+         "ix_survey_responses_created_at"),
+        ("has_submitted", queries.has_submitted_stmt(1234),
+         "ix_survey_responses_user_id_id"),
+    ]
+
+    for name, stmt, index_name in checks:
+        plan = explain(engine, stmt)
+        # У секций свои имена индексов — достаточно, что ни одна секция не читается целиком
+        ok = index_name in plan or (args.partitioned and "Index" in plan and "Seq Scan" not in plan)
+        failed += not ok
+        logger.info(f"{'✅' if ok else '❌'} {name}: ожидается {index_name}")
+        for line in plan.splitlines():
+            logger.info(f"     {line}")
+
+    if args.postgres:
+        with engine.begin() as conn:
+            conn.execute(text(f"DROP SCHEMA IF EXISTS {SCRATCH_SCHEMA} CASCADE"))
+
+    if failed:
+        logger.error(f"Планов без индекса: {failed}")
+        return 1
+    logger.info("Все запросы используют индексы")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""
+Проверка webhook-кластера (cluster.py) на заглушке Telegram API.
+
+Запускаются --nodes процессов bot_runner.run_node, у каждого своя заглушка
+fake_telegram_api.py и свои user_states, база — общая временная SQLite.
+Апдейты опросов --users пользователей отправляются на /webhook случайного
+узла (как балансировщик), апдейты одного пользователя — по порядку. Посреди
+прогона в реестр добавляется ещё один узел: незавершённые опросы переезжают к
+новым владельцам. В конце проверяется, что каждый опрос завершён и каждая
+анкета записана ровно один раз. /webhook и /cluster/* у узла на разных портах,
+в реестре — внутренние адреса.
+
+    python3 scripts/cluster_fake.py --nodes 3 --users 200
+    python3 scripts/cluster_fake.py --no-join      # без смены состава
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import signal
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def write_registry(path, nodes):
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps({"nodes": nodes}))
+    os.replace(tmp, path)
+
+def run_child(node_id, workdir):
+    """Процесс узла: заглушка API и bot_runner.run_node до SIGTERM; статус — в stdout"""
+    from replay_updates import scratch_env
+    scratch_env(workdir)
+    os.environ["STATE_SNAPSHOT_PATH"] = str(workdir / f"states-{node_id}.json")
+    os.environ["SPOOL_DIR"] = str(workdir / f"spool-{node_id}")
+    os.environ["SUBMISSION_WINDOW_SECONDS"] = "0"
+    # Общая SQLite на несколько процессов медленнее PostgreSQL: без сброса по нагрузке
+    os.environ["ADMISSION_MAX_INFLIGHT"] = "100000"
+    os.environ["BOT_MODE"] = "webhook"
+    os.environ["CLUSTER_NODE_ID"] = node_id
+    import logging
+    logging.basicConfig(level=logging.WARNING, format=f'%(asctime)s - {node_id} - %(levelname)s - %(message)s')
+
+    from fake_telegram_api import FakeTelegramAPI
+    api = FakeTelegramAPI(latency=0.005)
+    api.start()
+    api.install()
+    import bot
+    import cluster
+    import bot_runner
+    signal.signal(signal.SIGTERM, lambda *_: bot_runner.stop_event.set())
+    node = cluster.Node.from_env(bot.bot, bot.user_states)
+    code = bot_runner.run_node(node)
+    bot.db_writer.flush(timeout=10)
+    print(json.dumps(node.status()), flush=True)
+    api.stop()
+    return code
+
+WEBHOOK_SECRET = "webhook-fake"
+
+def start_node(node_id, port, internal_url, workdir, registry):
+    env = dict(os.environ, CLUSTER_REGISTRY=str(registry), CLUSTER_LISTEN=f"127.0.0.1:{port}",
+               CLUSTER_INTERNAL_LISTEN=internal_url.split("//", 1)[1], CLUSTER_REGISTRY_POLL="0.3",
+               CLUSTER_SECRET="cluster-fake", WEBHOOK_SECRET=WEBHOOK_SECRET, WEBHOOK_URL="http://lb.local")
+    return subprocess.Popen([sys.executable, __file__, "--child", node_id, "--workdir", str(workdir)],
+                            env=env, stdout=subprocess.PIPE, text=True)
+
+def wait_ready(session, url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if session.get(url + "/cluster/status", timeout=1).ok:
+                return True
+        except Exception:
+            pass
+        time.sleep(0.2)
+    return False
+
+def main():
+    parser = argparse.ArgumentParser(description="Маршрутизация апдейтов webhook-кластера по кольцу")
+    parser.add_argument("--nodes", type=int, default=3)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--senders", type=int, default=16, help="параллельных «пользователей»")
+    parser.add_argument("--pause", type=float, default=0.05, help="пауза пользователя между апдейтами, с")
+    parser.add_argument("--no-join", action="store_true", help="не добавлять узел посреди прогона")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--keep", action="store_true", help="не удалять временную папку")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return run_child(args.child, Path(args.workdir))
+
+    import requests
+    import cluster
+    from fake_telegram_api import survey_updates
+
+    workdir = Path(tempfile.mkdtemp(prefix="cluster_fake_"))
+    registry = workdir / "nodes.json"
+    ids = [f"n{i + 1}" for i in range(args.nodes + (0 if args.no_join else 1))]
+    # В реестре внутренние адреса (/cluster/*), балансировщик шлёт на публичные (/webhook)
+    urls = {node: f"http://127.0.0.1:{free_port()}" for node in ids}
+    public = {node: f"http://127.0.0.1:{free_port()}" for node in ids}
+    initial = {node: urls[node] for node in ids[:args.nodes]}
+    write_registry(registry, initial)
+    session = requests.Session()
+    procs = {}
+    problems = 0
+    try:
+        # По одному: первый узел создаёт схему общей SQLite
+        for node in ids:
+            procs[node] = start_node(node, public[node].rsplit(":", 1)[1], urls[node], workdir, registry)
+            if not wait_ready(session, urls[node]):
+                print(f"Узел {node} не поднялся")
+                return 1
+
+        rnd = random.Random(args.seed)
+        base = 3_000_000
+        lanes = {base + i: survey_updates(base + i) for i in range(args.users)}
+        update_id = iter(range(1, 10**9))
+        lock = threading.Lock()
+        served = Counter()
+        done = Counter()
+        joined = threading.Event()
+
+        def send(user_id):
+            for update in lanes[user_id]:
+                with lock:
+                    update["update_id"] = next(update_id)
+                    entry = rnd.choice(list(registry_nodes()))
+                response = session.post(public[entry] + "/webhook", json=update, timeout=10,
+                                        headers={"X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET})
+                with lock:
+                    served[response.json().get("node") if response.ok else f"HTTP {response.status_code}"] += 1
+                time.sleep(args.pause)
+            with lock:
+                done["users"] += 1
+                if not args.no_join and not joined.is_set() and done["users"] >= args.users // 2:
+                    # Новый узел: реестр меняется, узлы перестраивают кольцо и передают опросы
+                    joined.set()
+                    write_registry(registry, urls)
+
+        def registry_nodes():
+            return urls if joined.is_set() else initial
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(args.senders) as executor:
+            list(executor.map(send, list(lanes)))
+        elapsed = time.perf_counter() - started
+        time.sleep(1.0)
+        # Внутренние маршруты снаружи недоступны, webhook без секрета отклоняется
+        exposed = session.post(public[ids[0]] + "/cluster/take", json={"user_ids": [base]}, timeout=5).status_code
+        unsigned = session.post(public[ids[0]] + "/webhook", json=lanes[base][0], timeout=5).status_code
+
+        statuses = {}
+        for node, proc in procs.items():
+            proc.send_signal(signal.SIGTERM)
+        for node, proc in procs.items():
+            out, _ = proc.communicate(timeout=60)
+            lines = [line for line in out.splitlines() if line.startswith("{")]
+            statuses[node] = json.loads(lines[-1]) if lines else {}
+
+        import sqlite3
+        with sqlite3.connect(workdir / "telega.db") as conn:
+            rows = Counter(user_id for (user_id,) in conn.execute(
+                "SELECT user_id FROM survey_responses WHERE user_id >= ? AND user_id < ?",
+                (base, base + args.users)))
+        missing = args.users - len(rows)
+        duplicates = sum(n - 1 for n in rows.values() if n > 1)
+
+        print(f"Апдейтов {sum(served.values())} за {elapsed:.2f} с, обработали узлы: {dict(sorted(served.items()))}")
+        for node, status in statuses.items():
+            print(f"  {node}: на месте {status.get('local')}, переслано {status.get('forwarded')}, "
+                  f"принято {status.get('received')}, ошибок пересылки {status.get('forward_failed')}, "
+                  f"опросов передано {status.get('states_sent')} / принято {status.get('states_adopted')}, "
+                  f"к новому владельцу {status.get('moved_forwarded')}")
+        if not args.no_join:
+            share = cluster.moved_share(cluster.HashRing(initial), cluster.HashRing(urls))
+            print(f"При добавлении узла переезжает {share:.1%} пользователей (идеал {1 / len(urls):.1%})")
+        print(f"Анкет {sum(rows.values())} из {args.users}: не хватает {missing}, дублей {duplicates}")
+        print(f"Снаружи: /cluster/take -> {exposed}, /webhook без секрета -> {unsigned}")
+        problems = missing + duplicates + sum(1 for key in served if str(key).startswith("HTTP"))
+        problems += (exposed != 404) + (unsigned != 403)
+    finally:
+        for proc in procs.values():
+            if proc.poll() is None:
+                proc.kill()
+        if args.keep:
+            print(f"Временная папка: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    print("OK" if not problems else f"Расхождений: {problems}")
+    return 1 if problems else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
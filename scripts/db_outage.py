@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+"""
+Проверка автомата и spool (spool.py) на имитации падения БД.
+
+--threads потоков сохраняют анкеты через bot.save_survey_data во временную
+SQLite. На время --outage секунд каждая запись в БД «висит» --connect-timeout
+секунд и падает с OperationalError (как pg8000 при недоступном PostgreSQL).
+Затем БД восстанавливается, фоновый перенос отдаёт spool в БД, и
+проверяется, что каждая анкета записана ровно один раз (ни одной
+пропавшей). Часть анкет сохраняется повторно с тем же idempotency_key
+(повторная доставка апдейта). С большим --breaker-reset автомат ещё открыт,
+когда вызывается flush, — он должен сам сделать пробную запись.
+
+Затем проверяется выбор лидера (leader.LeaderLock) на имитации PostgreSQL с
+advisory-блокировками: сбой короче --leader-grace лидерство не снимает (после
+восстановления блокировка берётся заново, прежняя сессия завершается), сбой
+длиннее — снимает, а если за время обрыва блокировку взял другой процесс,
+лидер отказывается от неё сразу после восстановления связи. Второго лидера
+не бывает ни в один момент.
+
+    python3 scripts/db_outage.py --surveys 600 --threads 16 --outage 3
+    python3 scripts/db_outage.py --breaker-reset 60
+    python3 scripts/db_outage.py --leader-grace 5
+    python3 scripts/db_outage.py --no-spool      # как было: ошибки и ожидание таймаута
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+from collections import Counter
+from pathlib import Path
+from types import SimpleNamespace
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+WORKDIR = Path(tempfile.mkdtemp(prefix="db_outage_"))
+os.environ.pop("DATABASE_URL", None)
+os.environ["LOCAL_SQLITE"] = "1"
+os.environ["SPOOL_DIR"] = str(WORKDIR / "spool")
+os.environ["SPOOL_REPLAY_SECONDS"] = "0.5"
+os.environ["SUBMISSION_WINDOW_SECONDS"] = "0"
+os.chdir(WORKDIR)
+
+import logging
+logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+
+class FlakyDatabase:
+    """Обёртка db.save_survey_response: в окне сбоя — ожидание и OperationalError"""
+
+    def __init__(self, save, connect_timeout):
+        self.save = save
+        self.connect_timeout = connect_timeout
+        self.down = threading.Event()
+
+    def __call__(self, **values):
+        if self.down.is_set():
+            from sqlalchemy.exc import OperationalError
+            time.sleep(self.connect_timeout)
+            raise OperationalError("INSERT", {}, ConnectionRefusedError("connection refused"))
+        return self.save(**values)
+
+class FakeAdvisoryServer:
+    """
+    PostgreSQL для LeaderLock: сессии и одна advisory-блокировка. Соединение,
+    оборванное сбоем, остаётся на сервере сессией с блокировкой, пока сервер
+    её не заметит (drop_dead_sessions) или её не завершат (pg_terminate_backend).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.down = threading.Event()
+        self.holder = None
+        self.sessions = set()
+        self.dead = set()
+        self.next_pid = 100
+
+    def engine(self):
+        return FakeEngine(self)
+
+    def drop_dead_sessions(self):
+        with self.lock:
+            for pid in self.dead:
+                self.sessions.discard(pid)
+                if self.holder == pid:
+                    self.holder = None
+            self.dead.clear()
+
+class FakeEngine:
+    """Engine одного процесса; cut — обрыв связи только у него"""
+
+    dialect = SimpleNamespace(name="postgresql")
+
+    def __init__(self, server):
+        self.server = server
+        self.cut = threading.Event()
+
+    def unreachable(self):
+        return self.server.down.is_set() or self.cut.is_set()
+
+    def connect(self):
+        from sqlalchemy.exc import OperationalError
+        if self.unreachable():
+            raise OperationalError("connect", {}, ConnectionRefusedError("connection refused"))
+        with self.server.lock:
+            self.server.next_pid += 1
+            pid = self.server.next_pid
+            self.server.sessions.add(pid)
+        return FakeConnection(self, pid)
+
+class FakeConnection:
+    def __init__(self, engine, pid):
+        self.engine = engine
+        self.server = engine.server
+        self.pid = pid
+        self.broken = False
+
+    def execute(self, stmt, params=None):
+        from sqlalchemy.exc import OperationalError
+        params = params or {}
+        if self.broken or self.engine.unreachable() or self.pid not in self.server.sessions:
+            self.broken = True
+            raise OperationalError(str(stmt), params, ConnectionResetError("server closed the connection"))
+        sql = str(stmt)
+        with self.server.lock:
+            if "pg_try_advisory_lock" in sql:
+                if self.server.holder in (None, self.pid):
+                    self.server.holder = self.pid
+                value = self.server.holder == self.pid
+            elif "pg_advisory_unlock" in sql:
+                value = self.server.holder == self.pid
+                if value:
+                    self.server.holder = None
+            elif "pg_backend_pid" in sql:
+                value = self.pid
+            elif "pg_locks" in sql:
+                value = self.server.holder
+            elif "pg_terminate_backend" in sql:
+                value = params["pid"] in self.server.sessions
+                self.server.sessions.discard(params["pid"])
+                self.server.dead.discard(params["pid"])
+                if self.server.holder == params["pid"]:
+                    self.server.holder = None
+            else:
+                value = 1
+        return SimpleNamespace(scalar=lambda: value)
+
+    def commit(self):
+        pass
+
+    def close(self):
+        with self.server.lock:
+            if self.broken and self.pid in self.server.sessions:
+                # Сервер ещё не знает об обрыве: сессия и её блокировка живы
+                self.server.dead.add(self.pid)
+                return
+            self.server.sessions.discard(self.pid)
+            if self.server.holder == self.pid:
+                self.server.holder = None
+
+def check_leader(grace):
+    """Сценарии сбоя для LeaderLock; возвращает число нарушений"""
+    from leader import LeaderLock
+    problems = 0
+
+    def expect(ok, message):
+        nonlocal problems
+        problems += not ok
+        print(f"{'✅' if ok else '❌'} Лидер: {message}")
+
+    def pair(server):
+        a = LeaderLock(server.engine(), grace_seconds=grace, attempts=2, backoff=0.05)
+        b = LeaderLock(server.engine(), grace_seconds=grace, attempts=2, backoff=0.05)
+        return a, b
+
+    def try_acquire(lock):
+        try:
+            return lock.acquire()
+        except Exception:
+            return False
+
+    # 1. Сбой короче grace-периода: лидер тот же, прежняя сессия завершена
+    server = FakeAdvisoryServer()
+    a, b = pair(server)
+    a.acquire()
+    server.down.set()
+    deadline = time.monotonic() + grace / 2
+    kept = True
+    while time.monotonic() < deadline:
+        kept &= a.check()
+        kept &= not try_acquire(b)
+        time.sleep(0.1)
+    server.down.clear()
+    kept &= a.check() and not try_acquire(b)
+    expect(kept and server.holder == a._pid and not a.degraded,
+           f"сбой {grace / 2:.1f} с < grace {grace:.1f} с — лидерство сохранено, второго лидера нет")
+
+    # 2. Сбой длиннее grace-периода: лидерство снимается через grace
+    server = FakeAdvisoryServer()
+    a, b = pair(server)
+    a.acquire()
+    server.down.set()
+    started = time.monotonic()
+    while a.check() and time.monotonic() - started < grace + 5:
+        time.sleep(0.1)
+    stepped_down = time.monotonic() - started
+    a.release()
+    server.down.clear()
+    server.drop_dead_sessions()
+    expect(grace <= stepped_down < grace + 1 and try_acquire(b),
+           f"сбой дольше grace — отказ через {stepped_down:.1f} с, блокировку берёт другой процесс")
+
+    # 3. Обрыв только у лидера: блокировку взял другой процесс — отказ сразу после восстановления связи
+    server = FakeAdvisoryServer()
+    a, b = pair(server)
+    a.acquire()
+    a.engine.cut.set()
+    server.drop_dead_sessions()
+    kept = a.check()
+    server.drop_dead_sessions()
+    taken = try_acquire(b)
+    a.engine.cut.clear()
+    expect(kept and taken and not a.check() and server.holder == b._pid,
+           "блокировку за время обрыва взял другой процесс — лидер отказывается")
+    return problems
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+def main():
+    parser = argparse.ArgumentParser(description="Автомат и spool записи анкет при падении БД")
+    parser.add_argument("--surveys", type=int, default=600)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--outage", type=float, default=3.0, help="длительность сбоя, с")
+    parser.add_argument("--connect-timeout", type=float, default=0.5, help="ожидание записи при сбое, с")
+    parser.add_argument("--breaker-reset", type=float, default=1.0, help="DB_BREAKER_RESET_SECONDS, с")
+    parser.add_argument("--retry-share", type=float, default=0.1, help="доля повторных сохранений")
+    parser.add_argument("--no-spool", action="store_true", help="без автомата и spool")
+    parser.add_argument("--leader-grace", type=float, default=2.0, help="BOT_LEADER_GRACE_SECONDS, с")
+    parser.add_argument("--keep", action="store_true", help="не удалять временную папку")
+    args = parser.parse_args()
+
+    import db
+    import bot
+    import spool
+
+    problems = 0
+    try:
+        db.init_db()
+        flaky = FlakyDatabase(db.save_survey_response, args.connect_timeout)
+        if args.no_spool:
+            bot.db_writer = spool.SpooledWriter(flaky, None, spool.CircuitBreaker(failures=10**9))
+        else:
+            bot.db_writer = spool.SpooledWriter(flaky, spool.Spool(os.environ["SPOOL_DIR"]),
+                                                spool.CircuitBreaker(reset_seconds=args.breaker_reset),
+                                                replay_seconds=float(os.environ["SPOOL_REPLAY_SECONDS"]))
+            bot.db_writer.start()
+
+        jobs = [(2_000_000 + i, f"m:{2_000_000 + i}:{i}") for i in range(args.surveys)]
+        jobs += jobs[:int(len(jobs) * args.retry_share)]
+        data = {"full_name": "Иванов Иван", "birth_date": "1990-03-15", "citizenship": "Россия"}
+        latencies, outage_latencies, results = [], [], Counter()
+        lock = threading.Lock()
+        cursor = iter(jobs)
+
+        def worker():
+            while True:
+                with lock:
+                    job = next(cursor, None)
+                if job is None:
+                    return
+                user_id, key = job
+                down = flaky.down.is_set()
+                started = time.perf_counter()
+                ok = bot.save_survey_data(user_id, data, idempotency_key=key)
+                elapsed = time.perf_counter() - started
+                with lock:
+                    (outage_latencies if down else latencies).append(elapsed)
+                    results[ok] += 1
+                time.sleep(0.01)
+
+        def outage():
+            time.sleep(0.5)
+            flaky.down.set()
+            time.sleep(args.outage)
+            flaky.down.clear()
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=worker) for _ in range(args.threads)]
+        threading.Thread(target=outage, daemon=True).start()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        submit_seconds = time.perf_counter() - started
+        while flaky.down.is_set():
+            time.sleep(0.05)
+        drained = bot.db_writer.flush(timeout=30)
+
+        with db.SessionLocal() as s:
+            rows = Counter(key for (key,) in s.query(db.SurveyResponse.idempotency_key).all())
+        expected = {key for _, key in jobs}
+        missing = expected - set(rows)
+        duplicates = sum(n - 1 for n in rows.values() if n > 1)
+        status = bot.db_writer.status()
+        print(f"Сохранений {len(jobs)} за {submit_seconds:.2f} с: успешно {results[True]}, ошибок {results[False]}")
+        print(f"Задержка сохранения вне сбоя p50 {percentile(latencies, 0.5) * 1000:.1f} мс, "
+              f"во время сбоя p50 {percentile(outage_latencies, 0.5) * 1000:.1f} мс, "
+              f"p99 {percentile(outage_latencies, 0.99) * 1000:.1f} мс ({len(outage_latencies)} шт.)")
+        print(f"Spool: {status['spooled']} записано, {status['replayed']} перенесено, "
+              f"повторов при переносе {status['replay_duplicates']}, автомат {status['breaker']}")
+        print(f"В БД анкет {sum(rows.values())}: не хватает {len(missing)}, дублей {duplicates}, "
+              f"spool {'пуст' if drained else 'не перенесён'}")
+        problems += duplicates
+        if not args.no_spool:
+            problems += len(missing) + results[False] + (not drained)
+        problems += check_leader(args.leader_grace)
+    finally:
+        if args.keep:
+            print(f"Временная папка: {WORKDIR}")
+        else:
+            shutil.rmtree(WORKDIR, ignore_errors=True)
+    print("OK" if not problems else f"Расхождений: {problems}")
+    return 1 if problems else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
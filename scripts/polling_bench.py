@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк polling на заглушке Telegram API: polling.Poller + KeyedPool против
+telebot polling с util.ThreadPool (как было в bot.run_bot).
+
+--users пользователей проходят опрос (5 апдейтов каждый), апдейты разных
+пользователей перемешаны, порядок внутри пользователя сохранён; к ним
+добавляются апдейты типов без обработчиков (my_chat_member, edited_message).
+Заглушка отвечает с задержкой --latency, как сеть до api.telegram.org.
+
+- burst   — всплеск приходит во время работы: время разбора и апдейты/с;
+- restart — апдейты накопились, пока бот был остановлен (skip_pending против
+  POLL_DRAIN_BACKLOG).
+
+Считается число законченных анкет: апдейт, обработанный не по порядку
+(кнопка гражданства раньше ФИО), ломает опрос пользователя. Апдейты одного
+пользователя KeyedPool выполняет последовательно, поэтому на всплеске он может
+уступать util.ThreadPool в апдейтах/с — зато анкеты не теряются.
+
+С --async сравниваются и драйверы async_bot.py: AsyncTeleBot.infinity_polling
+(skip_pending=True, как было) против polling.AsyncPoller.
+
+    python3 scripts/polling_bench.py --users 300 --workers 8 --latency 0.02
+    python3 scripts/polling_bench.py --scenario restart
+    python3 scripts/polling_bench.py --scenario restart --async
+"""
+
+import sys
+import time
+import json
+import asyncio
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from replay_updates import scratch_env
+
+NOISE_KINDS = ("my_chat_member", "edited_message")
+
+def workload(users, base, rnd):
+    """Перемешанные апдейты опросов users пользователей с id от base плюс лишние типы"""
+    from fake_telegram_api import survey_updates, user_dict
+    lanes = [survey_updates(base + i) for i in range(users)]
+    updates = []
+    while lanes:
+        lane = rnd.choice(lanes)
+        updates.append(lane.pop(0))
+        if not lane:
+            lanes.remove(lane)
+        if rnd.random() < 0.2:
+            user = base + rnd.randrange(users)
+            kind = rnd.choice(NOISE_KINDS)
+            if kind == "my_chat_member":
+                updates.append({"my_chat_member": {
+                    "chat": {"id": user, "type": "private"}, "from": user_dict(user), "date": int(time.time()),
+                    "old_chat_member": {"status": "member", "user": user_dict(1)},
+                    "new_chat_member": {"status": "kicked", "user": user_dict(1)},
+                }})
+            else:
+                updates.append({"edited_message": {
+                    "message_id": 1, "date": int(time.time()), "edit_date": int(time.time()),
+                    "chat": {"id": user, "type": "private"}, "from": user_dict(user), "text": "правка",
+                }})
+    return updates
+
+def completed_surveys(base, users):
+    import db
+    with db.SessionLocal() as s:
+        return s.query(db.SurveyResponse.user_id).filter(
+            db.SurveyResponse.user_id >= base, db.SurveyResponse.user_id < base + users
+        ).distinct().count()
+
+def wait_idle(api, target, timeout, poller=None):
+    """Ждёт, пока заглушка отдала все апдейты и обработчики закончились"""
+    import bot as bot_module
+    import async_bot
+    deadline = time.monotonic() + timeout
+    idle_since = None
+    while time.monotonic() < deadline:
+        if isinstance(target, async_bot.SurveyAsyncBot):
+            busy = async_bot._inflight or (poller is not None and poller._tails)
+        else:
+            busy = bot_module._inflight or bot_module._pending_tasks(target)
+        idle = api.pending_updates() == 0 and not busy
+        if idle:
+            idle_since = idle_since or time.monotonic()
+            if time.monotonic() - idle_since >= 0.3:
+                return idle_since
+        else:
+            idle_since = None
+        time.sleep(0.01)
+    return None
+
+class _IgnoreErrors:
+    def handle(self, exception):
+        return True
+
+def make_bot(driver, workers):
+    import bot as bot_module
+    import polling
+    from survey import SurveyHandlers
+    from idempotency import UpdateDeduplicator
+
+    if driver.startswith("async"):
+        import async_bot
+        target = async_bot.SurveyAsyncBot("123456:bench")
+        target.deduplicator = UpdateDeduplicator()
+        async_bot.setup_handlers(target, SurveyHandlers({}))
+        return target
+    if driver == "telebot":
+        target = bot_module.SurveyBot("123456:bench", num_threads=workers)
+        # Без обработчика исключений ошибка в воркере перезапускает infinity_polling
+        # со skip_pending, и бенчмарк мерил бы потерю апдейтов, а не скорость
+        target.exception_handler = _IgnoreErrors()
+    else:
+        target = bot_module.SurveyBot("123456:bench", threaded=False)
+        target.threaded = True
+        target.worker_pool = polling.KeyedPool(num_threads=workers, name=f"bench-{driver}")
+    target.deduplicator = UpdateDeduplicator()
+    bot_module.setup_handlers(target, SurveyHandlers({}), effects=bot_module.SURVEY_EFFECTS)
+    return target
+
+def run(driver, scenario, args, api, base):
+    import polling
+    from fake_telegram_api import survey_updates
+
+    rnd = random.Random(args.seed)
+    updates = workload(args.users, base, rnd)
+    target = make_bot(driver, args.workers)
+    stop = threading.Event()
+    poller = None
+    if driver.startswith("async"):
+        if driver == "async-poller":
+            poller = polling.AsyncPoller(target, limit=args.limit, stop_event=stop, name=driver)
+            polling_coro = poller.run
+        else:
+            # Как в прежнем async_bot.run_polling
+            def polling_coro():
+                return target.infinity_polling(skip_pending=True, timeout=20)
+
+        async def main_async():
+            task = asyncio.create_task(polling_coro())
+            while not stop.is_set():
+                await asyncio.sleep(0.05)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            await target.close_session()
+
+        loop = threading.Thread(target=asyncio.run, args=(main_async(),), daemon=True)
+    elif driver == "telebot":
+        # Как в прежнем bot.run_bot: infinity_polling(skip_pending=True)
+        loop = threading.Thread(target=target.infinity_polling, kwargs={"skip_pending": True, "timeout": 20},
+                                daemon=True)
+    else:
+        poller = polling.Poller(target, limit=args.limit, stop_event=stop, name=driver)
+        loop = threading.Thread(target=poller.run, daemon=True)
+
+    if scenario == "restart":
+        api.push_updates(updates)
+        started = time.monotonic()
+        loop.start()
+    else:
+        # skip_pending telebot — getUpdates(offset=-1) с long polling: на пустой
+        # очереди он ждёт первый апдейт и подтверждает всё, кроме последнего.
+        # Разовый апдейт до всплеска, чтобы burst мерил скорость, а не эту потерю
+        api.push_updates(survey_updates(1)[:1])
+        loop.start()
+        time.sleep(0.5)
+        started = time.monotonic()
+        api.push_updates(updates)
+    finished = wait_idle(api, target, args.timeout, poller)
+    elapsed = (finished or time.monotonic()) - started
+    handled = sum(1 for u in updates if "message" in u or "callback_query" in u)
+
+    if driver == "telebot":
+        target.stop_polling()
+    else:
+        stop.set()
+    loop.join(25)
+    surveys = completed_surveys(base, args.users)
+    return {
+        "driver": driver,
+        "scenario": scenario,
+        "updates": len(updates),
+        "handled_kinds": handled,
+        "elapsed_s": round(elapsed, 3),
+        "updates_per_s": round(handled / elapsed, 1) if elapsed else None,
+        "timed_out": finished is None,
+        "surveys_completed": surveys,
+        "surveys_expected": args.users,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Poller + KeyedPool против telebot polling на заглушке API")
+    parser.add_argument("--scenario", choices=["burst", "restart", "both"], default="both")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--limit", type=int, default=100, help="POLL_LIMIT для Poller")
+    parser.add_argument("--latency", type=float, default=0.02, help="задержка ответа заглушки, с")
+    parser.add_argument("--timeout", type=float, default=120.0, help="предел ожидания разбора, с")
+    parser.add_argument("--seed", type=int, default=20240101)
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="также драйверы async_bot.py (AsyncTeleBot)")
+    parser.add_argument("--output", help="сохранить результат в JSON")
+    args = parser.parse_args()
+
+    output = Path(args.output).resolve() if args.output else None
+    workdir = Path(tempfile.mkdtemp(prefix="polling_bench_"))
+    scratch_env(workdir)
+    import logging
+    import bot as bot_module
+    from fake_telegram_api import FakeTelegramAPI
+    logging.getLogger().setLevel(logging.WARNING)
+
+    scenarios = ["burst", "restart"] if args.scenario == "both" else [args.scenario]
+    results = []
+    try:
+        bot_module.setup_database()
+        with FakeTelegramAPI(latency=args.latency) as api:
+            api.install()
+            base = 5_000_000
+            for scenario in scenarios:
+                drivers = ("telebot", "poller") + (("async-telebot", "async-poller") if args.use_async else ())
+                for driver in drivers:
+                    result = run(driver, scenario, args, api, base)
+                    results.append(result)
+                    base += args.users
+                    print(f"{scenario:<8} {driver:<13} {result['elapsed_s']:>8.2f} с  "
+                          f"{result['updates_per_s'] or 0:>8.1f} апд/с  "
+                          f"анкет {result['surveys_completed']}/{result['surveys_expected']}"
+                          f"{'  (не дождались)' if result['timed_out'] else ''}")
+            api.uninstall()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+"""
+Воспроизведение записанного потока апдейтов (update_log.py) через обработчики бота.
+
+Апдейты из журнала подаются в SurveyBot.process_new_updates (дедупликация,
+setup_handlers, эффекты bot.SURVEY_EFFECTS) в реальном времени, с ускорением
+или без пауз. Telegram API — локальная заглушка fake_telegram_api.py, БД —
+временная SQLite во временной папке, рабочие базы и DATABASE_URL не трогаются.
+
+Апдейты одного чата обрабатываются по порядку на одной из --workers очередей,
+разные чаты — параллельно. Задержка апдейта считается от момента, когда он
+должен был прийти по журналу, до конца обработки.
+
+    python3 scripts/replay_updates.py updates.jsonl.gz --speed max --output /tmp/base.json
+    python3 scripts/replay_updates.py updates.jsonl.gz --speed 10 --baseline /tmp/base.json --fail-on-diff
+
+Результат (JSON) содержит пропускную способность, распределение задержек,
+исходящие вызовы API по чатам и строки survey_responses; --baseline сравнивает
+их с прошлым прогоном.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+# Параметры исходящих вызовов, которые зависят от порядка выполнения, а не от логики
+VOLATILE_PARAMS = {"message_id", "reply_to_message_id", "callback_query_id", "chat_id",
+                   "allow_sending_without_reply"}
+
+def scratch_env(workdir):
+    """Все записи — во временную папку; журнал воспроизведения не пишется повторно"""
+    os.environ.pop("DATABASE_URL", None)
+    os.environ.pop("REPLICA_DATABASE_URL", None)
+    os.environ.pop("RECORD_UPDATES_PATH", None)
+    os.environ["IDEMPOTENCY_BACKEND"] = "memory"
+    os.environ["LOCAL_SQLITE"] = "1"
+    os.environ["DATABASE_PATH"] = str(workdir / "questionnaire.db")
+    os.environ["STATE_SNAPSHOT_PATH"] = str(workdir / "survey_states.json")
+    os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:replay")
+    os.chdir(workdir)
+
+def chat_of(update):
+    """chat_id апдейта (для callback — id пользователя)"""
+    if "message" in update or "edited_message" in update:
+        message = update.get("message") or update.get("edited_message")
+        return message["chat"]["id"]
+    if "callback_query" in update:
+        return update["callback_query"]["from"]["id"]
+    return 0
+
+def percentiles(values):
+    if not values:
+        return {}
+    values = sorted(values)
+    q = statistics.quantiles(values, n=100, method="inclusive") if len(values) > 1 else values * 99
+    return {
+        "p50": q[49], "p90": q[89], "p95": q[94], "p99": q[98],
+        "max": values[-1], "mean": statistics.fmean(values),
+    }
+
+def build_bot():
+    import logging
+    import bot as bot_module
+    from survey import SurveyHandlers
+    from idempotency import UpdateDeduplicator
+
+    logging.getLogger().setLevel(logging.WARNING)
+    bot_module.setup_database()
+    target = bot_module.SurveyBot(os.environ["TELEGRAM_BOT_TOKEN"], threaded=False)
+    target.deduplicator = UpdateDeduplicator()
+    bot_module.setup_handlers(target, SurveyHandlers(), effects=bot_module.SURVEY_EFFECTS)
+    return target
+
+def replay(target, records, speed, workers):
+    """Подаёт апдейты по расписанию журнала; возвращает (задержки в мс, время прогона)"""
+    from telebot import types
+
+    lanes = [ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"replay-{i}") for i in range(workers)]
+
+    def process(update, due):
+        target.process_new_updates([types.Update.de_json(update)])
+        return (time.perf_counter() - due) * 1000
+
+    futures = []
+    started = time.perf_counter()
+    try:
+        for record in records:
+            due = started + record["t"] / speed if speed else time.perf_counter()
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            lane = lanes[hash(chat_of(record["update"])) % workers]
+            futures.append(lane.submit(process, record["update"], due))
+        latencies = [f.result() for f in futures]
+    finally:
+        for lane in lanes:
+            lane.shutdown(wait=True)
+    return latencies, time.perf_counter() - started
+
+def outbound_calls(api, records):
+    """{chat_id: [[метод, параметры без изменчивых полей], ...]} в порядке вызовов"""
+    callback_chats = {
+        r["update"]["callback_query"]["id"]: chat_of(r["update"])
+        for r in records if "callback_query" in r["update"]
+    }
+    calls = {}
+    for _ts, method, params in sorted(api.calls, key=lambda call: call[0]):
+        chat = params.get("chat_id") or callback_chats.get(params.get("callback_query_id"), "")
+        stable = {k: v for k, v in sorted(params.items()) if k not in VOLATILE_PARAMS}
+        calls.setdefault(str(chat), []).append([method, stable])
+    return calls
+
+def survey_rows():
+    import db
+    with db.SessionLocal() as s:
+        rows = s.query(db.SurveyResponse.user_id, db.SurveyResponse.full_name,
+                       db.SurveyResponse.birth_date, db.SurveyResponse.citizenship).all()
+    return sorted([row.user_id, row.full_name, str(row.birth_date), row.citizenship] for row in rows)
+
+def diff(base, new, show=5):
+    """Расхождения вызовов API и строк БД; возвращает число расхождений"""
+    problems = 0
+    chats = sorted(set(base["calls"]) | set(new["calls"]))
+    changed = [c for c in chats if base["calls"].get(c) != new["calls"].get(c)]
+    print(f"Чатов с другими вызовами API: {len(changed)} из {len(chats)}")
+    for chat in changed[:show]:
+        old, cur = base["calls"].get(chat, []), new["calls"].get(chat, [])
+        i = next((i for i, (a, b) in enumerate(zip(old, cur)) if a != b), min(len(old), len(cur)))
+        print(f"  чат {chat}, вызов #{i}:")
+        print(f"    было:  {json.dumps(old[i], ensure_ascii=False)[:200] if i < len(old) else '—'}")
+        print(f"    стало: {json.dumps(cur[i], ensure_ascii=False)[:200] if i < len(cur) else '—'}")
+    problems += len(changed)
+
+    old_rows = Counter(tuple(r) for r in base["rows"])
+    new_rows = Counter(tuple(r) for r in new["rows"])
+    missing, extra = old_rows - new_rows, new_rows - old_rows
+    print(f"Строк survey_responses: было {len(base['rows'])}, стало {len(new['rows'])}; "
+          f"пропало {sum(missing.values())}, появилось {sum(extra.values())}")
+    for row in list(missing)[:show]:
+        print(f"  - {row}")
+    for row in list(extra)[:show]:
+        print(f"  + {row}")
+    problems += sum(missing.values()) + sum(extra.values())
+
+    for key in ("p50", "p95", "p99"):
+        old, cur = base["latency_ms"].get(key), new["latency_ms"].get(key)
+        if old and cur:
+            print(f"Задержка {key}: {old:.2f} -> {cur:.2f} мс ({(cur - old) / old:+.1%})")
+    old, cur = base["throughput_per_s"], new["throughput_per_s"]
+    if old:
+        print(f"Пропускная способность: {old:.1f} -> {cur:.1f} апд/с ({(cur - old) / old:+.1%})")
+    return problems
+
+def parse_speed(value):
+    if value == "max":
+        return 0.0
+    speed = float(value.rstrip("x"))
+    if speed <= 0:
+        raise argparse.ArgumentTypeError("скорость должна быть больше 0 или max")
+    return speed
+
+def main():
+    parser = argparse.ArgumentParser(description="Воспроизведение журнала апдейтов через обработчики бота")
+    parser.add_argument("log", help="журнал update_log.py (RECORD_UPDATES_PATH)")
+    parser.add_argument("--speed", type=parse_speed, default=1.0,
+                        help="1 — реальное время, 10 (или 10x) — в 10 раз быстрее, max — без пауз")
+    parser.add_argument("--workers", type=int, default=4, help="параллельных очередей (чат всегда в одной)")
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа fake Telegram API, с")
+    parser.add_argument("--limit", type=int, default=0, help="воспроизвести только первые N апдейтов")
+    parser.add_argument("--output", help="сохранить результат в JSON")
+    parser.add_argument("--baseline", help="результат прошлого прогона для сравнения")
+    parser.add_argument("--fail-on-diff", action="store_true", help="код возврата 1 при расхождениях с --baseline")
+    parser.add_argument("--keep", action="store_true", help="не удалять временную папку с БД")
+    args = parser.parse_args()
+
+    log = Path(args.log).resolve()
+    output = Path(args.output).resolve() if args.output else None
+    baseline = Path(args.baseline).resolve() if args.baseline else None
+    workdir = Path(tempfile.mkdtemp(prefix="replay_"))
+    scratch_env(workdir)
+
+    from update_log import read_log
+    from fake_telegram_api import FakeTelegramAPI
+
+    header, records = read_log(log)
+    if args.limit:
+        records = records[:args.limit]
+    print(f"Журнал: {log.name}, запись от {header.get('started_at')}, апдейтов {len(records)}, "
+          f"длительность {records[-1]['t'] if records else 0:.1f} с")
+
+    try:
+        with FakeTelegramAPI(latency=args.latency) as api:
+            api.install()
+            try:
+                target = build_bot()
+                latencies, elapsed = replay(target, records, args.speed, max(1, args.workers))
+            finally:
+                api.uninstall()
+        result = {
+            "log": str(log),
+            "speed": args.speed or "max",
+            "workers": args.workers,
+            "updates": len(records),
+            "elapsed_s": elapsed,
+            "throughput_per_s": len(records) / elapsed if elapsed else 0.0,
+            "latency_ms": percentiles(latencies),
+            "api_calls": len(api.calls),
+            "calls": outbound_calls(api, records),
+            "rows": survey_rows(),
+        }
+    finally:
+        if args.keep:
+            print(f"Временная папка: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    lat = result["latency_ms"]
+    print(f"Обработано {result['updates']} апдейтов за {elapsed:.2f} с: {result['throughput_per_s']:.1f} апд/с, "
+          f"вызовов API {result['api_calls']}, строк в БД {len(result['rows'])}")
+    if lat:
+        print(f"Задержка, мс: p50 {lat['p50']:.2f}  p90 {lat['p90']:.2f}  p95 {lat['p95']:.2f}  "
+              f"p99 {lat['p99']:.2f}  max {lat['max']:.2f}")
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"Результат: {output}")
+
+    if baseline:
+        with open(baseline, encoding="utf-8") as f:
+            problems = diff(json.load(f), result)
+        if problems and args.fail_on_diff:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
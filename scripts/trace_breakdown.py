@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Разбивка времени обработки апдейтов по видам спанов из JSONL-трасс (tracing.py).
+
+Для каждой трассы считается собственное время спанов (длительность минус
+дочерние) и суммируется по виду — первой части имени: telegram, db, effect,
+handler; собственное время корня "update" — это ожидание в очереди пула и
+фильтры до обработчика.
+
+    TRACE_EXPORTER=jsonl TRACE_SAMPLE_RATE=1 python3 bot_runner.py
+    python3 scripts/trace_breakdown.py traces.jsonl
+    python3 scripts/trace_breakdown.py traces.jsonl --by name --top 20
+"""
+
+import sys
+import json
+import argparse
+import statistics
+from collections import defaultdict
+
+def load(path):
+    traces = defaultdict(list)
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                span = json.loads(line)
+                traces[span["trace_id"]].append(span)
+    return traces
+
+def self_times(spans, by):
+    """{вид или имя: собственное время в мс} для одной трассы"""
+    children = defaultdict(float)
+    for span in spans:
+        if span.get("parent_id"):
+            children[span["parent_id"]] += span["duration_ms"]
+    out = defaultdict(float)
+    for span in spans:
+        key = span["name"] if by == "name" else span["name"].split(".", 1)[0]
+        out[key] += max(0.0, span["duration_ms"] - children[span["span_id"]])
+    return out
+
+def percentile(values, q):
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[q - 1]
+
+def main():
+    parser = argparse.ArgumentParser(description="Разбивка времени апдейтов по спанам")
+    parser.add_argument("path", help="JSONL-файл трасс (TRACE_JSONL_PATH)")
+    parser.add_argument("--by", choices=["kind", "name"], default="kind",
+                        help="группировать по виду (telegram/db/...) или полному имени спана")
+    parser.add_argument("--top", type=int, default=0, help="показать только N самых дорогих строк")
+    args = parser.parse_args()
+
+    traces = load(args.path)
+    # Только трассы с корнем: незаконченные при остановке процесса не считаем
+    complete = [spans for spans in traces.values() if any(not s.get("parent_id") for s in spans)]
+    if not complete:
+        print("Нет законченных трасс")
+        return 1
+
+    per_key = defaultdict(list)
+    totals = []
+    for spans in complete:
+        times = self_times(spans, args.by)
+        totals.append(sum(times.values()))
+        for key, ms in times.items():
+            per_key[key].append(ms)
+
+    grand = sum(totals)
+    rows = sorted(per_key.items(), key=lambda item: -sum(item[1]))
+    if args.top:
+        rows = rows[:args.top]
+    print(f"Трасс: {len(complete)}, время на апдейт: p50 {percentile(totals, 50):.1f} мс, "
+          f"p95 {percentile(totals, 95):.1f} мс")
+    print(f"{'спан':<36} {'доля':>7} {'сумма, мс':>12} {'p50, мс':>9} {'p95, мс':>9}")
+    for key, values in rows:
+        # Вид, не встретившийся в трассе, считается за 0 мс
+        padded = values + [0.0] * (len(complete) - len(values))
+        print(f"{key:<36} {sum(values) / grand:>7.1%} {sum(values):>12.1f} "
+              f"{percentile(padded, 50):>9.2f} {percentile(padded, 95):>9.2f}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
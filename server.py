@@ -1,10 +1,14 @@
-from flask import Flask, jsonify
+from flask import Flask, Response, request
 import os
 import threading
 import logging
-from bot import run_bot
+from lifecycle import Lifecycle
 import database
-from db import init_db, save_response
+import endpoints
+import http_cache
+import rollups
+import user_cache
+from db import init_db
 
 # Настройка логирования
 logging.basicConfig(
@@ -15,145 +19,98 @@ logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 
+def json_response(compute, conditional=True, cache_control="no-cache"):
+    """
+    JSON-ответ через http_cache.py: для маршрутов из endpoints.CACHE_TABLES —
+    304 и готовое тело по версиям таблиц до вызова compute(); сжатие, ETag.
+    """
+    if request.path in endpoints.NO_STORE:
+        conditional, cache_control = False, "no-store"
+    tables = endpoints.cache_tables(request.path, request.args) if conditional else ()
+    tag = http_cache.validators(tables, request.full_path) if tables else None
+    response = http_cache.lookup(tag, request.headers, cache_control)
+    if response is None:
+        payload, status = compute()
+        response = http_cache.render(payload, status, request.headers, tag, cache_control, conditional)
+    return Response(response.body, status=response.status, headers=response.headers)
+
 @app.route('/')
 def home():
     """Главная страница с информацией о боте"""
-    return """
-    <h1>🤖 Telegram Questionnaire Bot</h1>
-    <p>Бот работает и готов к использованию!</p>
-    <p><strong>Статус:</strong> ✅ Активен</p>
-    <p><strong>Функции:</strong></p>
-    <ul>
-        <li>📋 Опрос пользователей</li>
-        <li>💾 Сохранение данных в SQLite</li>
-        <li>🌐 Готов к развертыванию на Render</li>
-    </ul>
-    <p><a href="/health">🔍 Проверить здоровье системы</a></p>
-    <p><a href="/db-info">📊 Информация о базе данных</a></p>
-    <p><a href="/test-db">🧪 Тест новой базы данных</a></p>
-    """
+    return endpoints.HOME_HTML
 
 @app.route('/health')
 def health():
     """Проверка здоровья всей системы"""
-    try:
-        # Проверяем здоровье базы данных
-        db_health = database.health_check()
-        
-        # Общая оценка здоровья
-        overall_status = "healthy" if db_health["status"] == "healthy" else "degraded"
-        
-        return jsonify({
-            "status": overall_status,
-            "timestamp": database.datetime.now().isoformat(),
-            "database": db_health,
-            "bot": "running",
-            "server": "flask"
-        })
-    except Exception as e:
-        logger.error(f"Health check failed: {e}")
-        return jsonify({
-            "status": "unhealthy",
-            "error": str(e),
-            "timestamp": database.datetime.now().isoformat()
-        }), 500
+    return json_response(endpoints.health)
 
 @app.route('/db-info')
 def db_info():
     """Информация о базе данных"""
-    try:
-        db_info = database.get_database_info()
-        return jsonify({
-            "database_info": db_info,
-            "timestamp": database.datetime.now().isoformat()
-        })
-    except Exception as e:
-        logger.error(f"Database info failed: {e}")
-        return jsonify({
-            "error": str(e),
-            "timestamp": database.datetime.now().isoformat()
-        }), 500
+    return json_response(endpoints.db_info)
 
 @app.route('/stats')
 def stats():
     """Статистика опросов"""
-    try:
-        from db import init_db
-        init_db()  # Проверяем доступность базы
-        
-        # Пока временная статистика для db.py
-        stats_info = {
-            "total_responses": "N/A (db.py)",
-            "unique_users": "N/A (db.py)",
-            "average_per_user": "N/A (db.py)",
-            "note": "Статистика будет доступна после полной миграции на db.py"
-        }
-        
-        return jsonify({
-            **stats_info,
-            "timestamp": "2025-08-15T00:00:00"
-        })
-    except Exception as e:
-        logger.error(f"Stats failed: {e}")
-        return jsonify({
-            "error": str(e),
-            "timestamp": "2025-08-15T00:00:00"
-        }), 500
+    return json_response(endpoints.stats)
+
+@app.route('/stats/rollups')
+def stats_rollups():
+    """Отчёт по агрегатам: гражданство, годы рождения, дни"""
+    return json_response(lambda: endpoints.rollups_report(request.args))
+
+@app.route('/broadcasts')
+def broadcasts():
+    """Прогресс рассылок"""
+    return json_response(lambda: endpoints.broadcasts(request.args))
 
 @app.route("/_diag/db")
 def diag_db():
     """Диагностика базы данных survey_responses"""
-    try:
-        from db import engine, SessionLocal, SurveyResponse
-        out = {"ok": True, "dialect": engine.dialect.name}
-        s = SessionLocal()
-        try:
-            out["count"] = s.query(SurveyResponse).count()
-            last = s.query(SurveyResponse).order_by(SurveyResponse.id.desc()).first()
-            if last:
-                out["last"] = {
-                    "id": last.id,
-                    "user_id": last.user_id,
-                    "full_name": last.full_name,
-                    "birth_date": last.birth_date,
-                    "citizenship": last.citizenship,
-                    "created_at": str(getattr(last, "created_at", None)) if getattr(last, "created_at", None) else None,
-                }
-        finally:
-            s.close()
-        return jsonify(out), 200
-    except Exception as e:
-        return jsonify({"ok": False, "error": str(e)}), 500
+    return json_response(endpoints.diag_db)
+
+def _debug_token():
+    return request.headers.get("X-Debug-Token") or request.args.get("token")
+
+@app.route('/_diag/transport')
+def diag_transport():
+    """Метрики вызовов Telegram API по методам (бот в этом процессе)"""
+    return json_response(endpoints.transport_stats)
+
+@app.route('/_diag/spool')
+def diag_spool():
+    """Состояние автомата записи в БД и spool анкет"""
+    return json_response(endpoints.spool_status)
+
+@app.route('/_debug/profile')
+def debug_profile():
+    """Профиль всех потоков процесса за ?seconds= секунд (свёрнутые стеки для flamegraph)"""
+    import profiler
+    payload, status = endpoints.debug_profile(request.args, _debug_token())
+    if not isinstance(payload, str):
+        return json_response(lambda: (payload, status), conditional=False)
+    return Response(payload, status=status, mimetype="text/plain", headers={
+        "Content-Disposition": f"attachment; filename={profiler.profile_filename()}",
+    })
+
+@app.route('/_debug/stacks')
+def debug_stacks():
+    """Текущие стеки всех потоков процесса"""
+    payload, status = endpoints.debug_stacks(_debug_token())
+    if not isinstance(payload, str):
+        return json_response(lambda: (payload, status), conditional=False)
+    return Response(payload, status=status, mimetype="text/plain")
 
 @app.route('/test-db')
 def test_db():
     """Тестирование новой базы данных (db.py)"""
-    try:
-        # Тестируем сохранение ответа
-        test_user_id = 12345
-        test_question = "Тестовый вопрос"
-        test_answer = "Тестовый ответ"
-        
-        save_response(test_user_id, test_question, test_answer)
-        
-        return jsonify({
-            "status": "success",
-            "message": "Тестовый ответ сохранен в новую базу данных",
-            "user_id": test_user_id,
-            "question": test_question,
-            "answer": test_answer,
-            "timestamp": database.datetime.now().isoformat()
-        })
-    except Exception as e:
-        logger.error(f"Test DB failed: {e}")
-        return jsonify({
-            "status": "error",
-            "error": str(e),
-            "timestamp": database.datetime.now().isoformat()
-        }), 500
+    return json_response(endpoints.test_db)
 
 def run_flask_server():
     """Запуск Flask сервера"""
+    # Бот импортируется только здесь: wsgi.py (веб-воркеры gunicorn) его не создаёт,
+    # пулы бота, транспорт и spool есть только в процессе, где он запущен
+    import bot
     try:
         # Инициализируем новую базу данных (db.py)
         logger.info("Инициализация новой базы данных (db.py)...")
@@ -168,9 +125,20 @@ def run_flask_server():
             logger.error("Ошибка инициализации старой базы данных")
             return
         
+        # По SIGTERM: остановить polling, дождаться обработчиков, сохранить опросы
+        manager = Lifecycle()
+        bot.register_shutdown_hooks(manager)
+        manager.install_signal_handlers(then_exit=True)
+
+        # Сброс кэша пользователей между процессами (USER_CACHE_CHANNEL=pg)
+        user_cache.start_channel()
+
+        # Агрегаты для /stats обновляются в фоне (ROLLUP_REFRESH_INTERVAL, 0 — выключено)
+        rollups.start_refresher()
+
         # Запускаем бота в отдельном потоке
         logger.info("Запуск Telegram бота в фоновом режиме...")
-        bot_thread = threading.Thread(target=run_bot, daemon=True)
+        bot_thread = threading.Thread(target=bot.run_bot, name="bot-poller", daemon=True)
         bot_thread.start()
         logger.info("Бот запущен в фоновом режиме")
         
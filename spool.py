@@ -0,0 +1,522 @@
+# spool.py
+"""
+Запись анкет при недоступной или медленной БД.
+
+Без этого каждая попытка save_survey_response при упавшем PostgreSQL держит
+поток воркера до таймаута соединения, а пользователь получает «попробуйте
+ещё раз» — при переключении на реплику это секунды задержки на каждого и
+потерянные анкеты.
+
+- CircuitBreaker: после DB_BREAKER_FAILURES подряд ошибок соединения запись
+  в БД не пробуется DB_BREAKER_RESET_SECONDS секунд (open), затем одна
+  пробная запись (half_open) решает, закрыть его или снова открыть;
+- Spool: пока БД недоступна, анкеты дописываются строками JSON в
+  SPOOL_DIR/active-<hostname>-<pid>.jsonl — у каждого процесса свой файл,
+  на котором он держит flock, пока файл открыт. fsync группируется: запись
+  ждёт общий fsync, который выполняется не чаще раза в SPOOL_FSYNC_MS
+  миллисекунд для всех пишущих потоков, и пользователь получает ответ только
+  после него;
+- SpooledWriter.replay_once() (фоновый поток раз в SPOOL_REPLAY_SECONDS и
+  этап flush в lifecycle.py) запечатывает свой активный файл и файлы
+  завершившихся процессов (flock свободен) в segment-*.jsonl и переносит
+  сегменты в БД. Чужой файл, в который ещё пишут, не трогается. У каждой
+  записи есть idempotency_key (если его не было, выдаётся при записи в
+  spool), поэтому повтор сегмента после сбоя посередине или перенос одного
+  сегмента двумя процессами не создаёт дублей: уже записанные дают
+  DuplicateSubmission.
+
+Записи, которые БД отвергла не из-за недоступности (ошибка данных),
+переносятся в SPOOL_DIR/rejected.jsonl. SPOOL_DIR="" отключает spool: при
+открытом автомате запись сразу завершается ошибкой, без ожидания таймаута.
+"""
+
+import os
+import json
+import time
+import uuid
+import socket
+import logging
+import threading
+from datetime import date, datetime
+
+try:
+    import fcntl
+except ImportError:  # Windows: чужие активные файлы запечатываются только с того же хоста по pid
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+DB_BREAKER_FAILURES = int(os.getenv("DB_BREAKER_FAILURES", "3"))
+DB_BREAKER_RESET_SECONDS = float(os.getenv("DB_BREAKER_RESET_SECONDS", "10"))
+SPOOL_DIR = os.getenv("SPOOL_DIR", "spool")
+SPOOL_FSYNC_MS = float(os.getenv("SPOOL_FSYNC_MS", "20"))
+SPOOL_REPLAY_SECONDS = float(os.getenv("SPOOL_REPLAY_SECONDS", "5"))
+# Пауза между пробными записями при flush, пока БД не ответит
+FLUSH_RETRY_SECONDS = 0.5
+
+ACTIVE_PREFIX = "active"
+REJECTED = "rejected.jsonl"
+
+class DatabaseUnavailable(Exception):
+    """Автомат открыт, а spool отключён: запись не выполнялась"""
+
+def is_outage(exc):
+    """Ошибка недоступности БД (соединение, таймаут пула), а не данных или запроса"""
+    from sqlalchemy import exc as sa_exc
+    if isinstance(exc, (sa_exc.OperationalError, sa_exc.InterfaceError, sa_exc.DisconnectionError,
+                        sa_exc.TimeoutError, ConnectionError, TimeoutError)):
+        return True
+    return isinstance(exc, sa_exc.DBAPIError) and exc.connection_invalidated
+
+class CircuitBreaker:
+    """closed -> (failures подряд) -> open -> (reset_seconds) -> half_open -> closed / open"""
+
+    def __init__(self, failures=DB_BREAKER_FAILURES, reset_seconds=DB_BREAKER_RESET_SECONDS, name="db"):
+        self.failures = max(1, failures)
+        self.reset_seconds = reset_seconds
+        self.name = name
+        self.state = "closed"
+        self.consecutive = 0
+        self.opened_at = None
+        self.stats = {"opened": 0, "rejected": 0}
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Можно ли обращаться к БД; в half_open пропускается одна пробная запись"""
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_seconds:
+                self.state = "half_open"
+            if self.state == "half_open" and not self._probing:
+                self._probing = True
+                return True
+            self.stats["rejected"] += 1
+            return False
+
+    def success(self):
+        with self._lock:
+            if self.state != "closed":
+                logger.info(f"[{self.name}] автомат закрыт: БД снова доступна")
+            self.state = "closed"
+            self.consecutive = 0
+            self._probing = False
+
+    def failure(self):
+        with self._lock:
+            self.consecutive += 1
+            self._probing = False
+            if self.state == "half_open" or (self.state == "closed" and self.consecutive >= self.failures):
+                if self.state == "closed":
+                    logger.warning(f"[{self.name}] автомат открыт после {self.consecutive} ошибок подряд")
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                self.stats["opened"] += 1
+
+    def probe(self):
+        """Досрочно переводит открытый автомат в half_open: следующий allow() пропустит пробную запись"""
+        with self._lock:
+            if self.state == "open":
+                self.state = "half_open"
+
+    def status(self):
+        with self._lock:
+            return {"state": self.state, "consecutive_failures": self.consecutive, **self.stats}
+
+def _json_default(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} не сериализуется в spool")
+
+def _lock_file(f, blocking=True):
+    """flock на открытый файл; False — файл держит другой процесс"""
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+    except BlockingIOError:
+        return False
+    return True
+
+def _same_file(f, path):
+    try:
+        return os.fstat(f.fileno()).st_ino == os.stat(path).st_ino
+    except FileNotFoundError:
+        return False
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True
+    return True
+
+class Spool:
+    """
+    Append-only журнал в каталоге: записи процесса дописываются в
+    active-<hostname>-<pid>.jsonl, seal() переименовывает его в
+    segment-<ns>.jsonl для переноса в БД. Файл и каталог создаются при первой
+    записи. Несколько процессов (воркеры gunicorn, реплики на общем диске)
+    пишут каждый в свой файл и не запечатывают чужой, пока он открыт.
+    """
+
+    def __init__(self, directory, fsync_seconds=SPOOL_FSYNC_MS / 1000):
+        self.directory = directory
+        self.fsync_seconds = fsync_seconds
+        self._file = None
+        self._written = 0
+        self._synced = 0
+        self._syncing = False
+        self._cond = threading.Condition()
+
+    @property
+    def active_path(self):
+        # pid берётся при обращении: после fork у воркера свой файл
+        return os.path.join(self.directory, f"{ACTIVE_PREFIX}-{socket.gethostname()}-{os.getpid()}.jsonl")
+
+    def _open_active(self):
+        """
+        Открывает свой активный файл под flock. Если файл успели запечатать
+        (процесс с тем же pid до перезапуска), открывается новый.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.active_path
+        while True:
+            f = open(path, "a", encoding="utf-8")
+            _lock_file(f)
+            if _same_file(f, path):
+                return f
+            f.close()
+
+    def append(self, record):
+        """Дописывает запись и возвращается после fsync (общего с параллельными записями)"""
+        line = json.dumps(record, ensure_ascii=False, separators=(",", ":"), default=_json_default) + "\n"
+        with self._cond:
+            if self._file is None:
+                self._file = self._open_active()
+            self._file.write(line)
+            self._written += 1
+            seq = self._written
+            while self._synced < seq:
+                if not self._syncing:
+                    self._syncing = True
+                    break
+                self._cond.wait()
+            else:
+                return
+        self._sync()
+
+    def _sync(self):
+        # Ведущий поток ждёт окно группировки, чтобы один fsync покрыл записи соседей
+        synced = None
+        try:
+            time.sleep(self.fsync_seconds)
+            with self._cond:
+                target = self._written
+                if self._file is None:
+                    # Файл уже запечатан (seal), fsync выполнен там
+                    synced = target
+                    return
+                self._file.flush()
+                fd = os.dup(self._file.fileno())
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            synced = target
+        finally:
+            with self._cond:
+                self._syncing = False
+                if synced is not None:
+                    self._synced = max(self._synced, synced)
+                self._cond.notify_all()
+
+    def _close_file(self, seal=False):
+        # Вызывается под self._cond: всё записанное — на диск до закрытия.
+        # Запечатывается до снятия flock, чтобы другой процесс не счёл файл брошенным
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            if seal and self._file.tell():
+                self._seal_path(self.active_path)
+            self._file.close()
+            self._file = None
+        self._synced = self._written
+        self._cond.notify_all()
+
+    def _seal_path(self, path):
+        os.replace(path, os.path.join(self.directory, f"segment-{time.time_ns()}-{os.getpid()}.jsonl"))
+
+    def _active_files(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return [os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                if name.startswith(ACTIVE_PREFIX) and name.endswith(".jsonl")]
+
+    def _seal_abandoned(self, path):
+        """Запечатывает активный файл завершившегося процесса (его flock свободен)"""
+        if fcntl is None:
+            host_pid = os.path.basename(path)[len(ACTIVE_PREFIX) + 1:-len(".jsonl")]
+            host, _, pid = host_pid.rpartition("-")
+            if host != socket.gethostname() or not pid.isdigit() or _pid_alive(int(pid)):
+                return
+        try:
+            f = open(path, "a", encoding="utf-8")
+        except FileNotFoundError:
+            return
+        with f:
+            if not _lock_file(f, blocking=False) or not _same_file(f, path):
+                return
+            if f.tell():
+                self._seal_path(path)
+                logger.info(f"spool: запечатан файл завершившегося процесса {os.path.basename(path)}")
+            else:
+                os.remove(path)
+
+    def seal(self):
+        """
+        Запечатывает свой активный файл (если не пуст) и брошенные файлы других
+        процессов; возвращает все сегменты по порядку
+        """
+        with self._cond:
+            self._close_file(seal=True)
+            # Свой файл уже запечатан; остался бы только от прежнего процесса с тем же pid
+            for path in self._active_files():
+                self._seal_abandoned(path)
+        return self.segments()
+
+    def segments(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                      if name.startswith("segment-") and name.endswith(".jsonl"))
+
+    def pending(self):
+        """Записей, ещё не перенесённых в БД (с учётом активных файлов всех процессов)"""
+        total = 0
+        for path in self.segments() + self._active_files():
+            try:
+                with open(path, encoding="utf-8") as f:
+                    total += sum(1 for line in f if line.strip())
+            except FileNotFoundError:
+                # Запечатан или перенесён другим процессом
+                continue
+        return total
+
+    def reject(self, record, error):
+        with self._cond:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(os.path.join(self.directory, REJECTED), "a", encoding="utf-8") as f:
+                f.write(json.dumps({"record": record, "error": error}, ensure_ascii=False) + "\n")
+
+    def close(self):
+        with self._cond:
+            self._close_file()
+
+def read_segment(path):
+    """
+    Записи сегмента; оборванная при падении последняя строка пропускается.
+    Сегмент, уже перенесённый другим процессом, — пустой список.
+    """
+    records = []
+    try:
+        f = open(path, encoding="utf-8")
+    except FileNotFoundError:
+        return records
+    with f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                logger.warning(f"{path}: пропущена повреждённая строка")
+    return records
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+class SpooledWriter:
+    """
+    Обёртка над функцией записи (db.save_survey_response): автомат и spool.
+    save() возвращает id записи, None — если анкета ушла в spool, и, как
+    save_survey_response, бросает DuplicateSubmission для повтора.
+    """
+
+    def __init__(self, save, spool=None, breaker=None, replay_seconds=SPOOL_REPLAY_SECONDS):
+        self.save_func = save
+        self.spool = spool
+        self.breaker = breaker or CircuitBreaker()
+        self.replay_seconds = replay_seconds
+        self.stats = {"written": 0, "spooled": 0, "replayed": 0, "replay_duplicates": 0, "rejected": 0}
+        self._stop = threading.Event()
+        self._thread = None
+        self._replay_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, save):
+        """Один писатель на функцию записи в процессе: второй на том же SPOOL_DIR перепутал бы сегменты"""
+        with _writers_lock:
+            writer = _writers.get(save)
+            if writer is None:
+                writer = _writers[save] = cls(save, Spool(SPOOL_DIR) if SPOOL_DIR else None)
+            return writer
+
+    def _count(self, key, n=1):
+        with self._stats_lock:
+            self.stats[key] += n
+
+    def _to_spool(self, values, error):
+        if self.spool is None:
+            raise DatabaseUnavailable(error)
+        record = dict(values)
+        # Ключ нужен, чтобы повторный перенос сегмента не создал вторую запись
+        record["idempotency_key"] = record.get("idempotency_key") or f"spool:{uuid.uuid4().hex}"
+        record["spooled_at"] = time.time()
+        self.spool.append(record)
+        self._count("spooled")
+        logger.warning(f"БД недоступна ({error}), анкета пользователя {values.get('user_id')} записана в spool")
+        return None
+
+    def save(self, **values):
+        from db import DuplicateSubmission
+        if not self.breaker.allow():
+            return self._to_spool(values, "автомат открыт")
+        try:
+            new_id = self.save_func(**values)
+        except DuplicateSubmission:
+            self.breaker.success()
+            raise
+        except Exception as e:
+            if not is_outage(e):
+                self.breaker.success()
+                raise
+            logger.warning(f"Запись в БД не удалась: {type(e).__name__}: {getattr(e, 'orig', e)}")
+            self.breaker.failure()
+            return self._to_spool(values, type(e).__name__)
+        self.breaker.success()
+        self._count("written")
+        return new_id
+
+    async def save_async(self, save, **values):
+        """То же для асинхронной записи (db_async.save_survey_response); spool — в потоке"""
+        import asyncio
+        from db import DuplicateSubmission
+        if not self.breaker.allow():
+            return await asyncio.to_thread(self._to_spool, values, "автомат открыт")
+        try:
+            new_id = await save(**values)
+        except DuplicateSubmission:
+            self.breaker.success()
+            raise
+        except Exception as e:
+            if not is_outage(e):
+                self.breaker.success()
+                raise
+            logger.warning(f"Запись в БД не удалась: {type(e).__name__}: {getattr(e, 'orig', e)}")
+            self.breaker.failure()
+            return await asyncio.to_thread(self._to_spool, values, type(e).__name__)
+        self.breaker.success()
+        self._count("written")
+        return new_id
+
+    def replay_once(self, deadline=None):
+        """
+        Переносит сегменты spool в БД, пока автомат пропускает запросы.
+        Возвращает True, если spool пуст.
+        """
+        from db import DuplicateSubmission
+        if self.spool is None:
+            return True
+        with self._replay_lock:
+            segments = self.spool.seal()
+            for path in segments:
+                for record in read_segment(path):
+                    if deadline is not None and time.monotonic() >= deadline:
+                        return False
+                    if not self.breaker.allow():
+                        return False
+                    values = {k: v for k, v in record.items() if k != "spooled_at"}
+                    try:
+                        self.save_func(**values)
+                        self._count("replayed")
+                    except DuplicateSubmission:
+                        # Уже записана: прошлый перенос прервался после этой записи
+                        self._count("replay_duplicates")
+                    except Exception as e:
+                        if is_outage(e):
+                            self.breaker.failure()
+                            return False
+                        logger.error(f"spool: запись отвергнута БД и перенесена в {REJECTED}: {e}")
+                        self.spool.reject(record, str(e))
+                        self._count("rejected")
+                    self.breaker.success()
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    # Тот же сегмент параллельно перенёс другой процесс
+                    continue
+                logger.info(f"spool: сегмент {os.path.basename(path)} перенесён в БД")
+            return True
+
+    def _run(self):
+        while not self._stop.wait(self.replay_seconds):
+            try:
+                self.replay_once()
+            except Exception as e:
+                logger.error(f"spool: ошибка переноса: {e}")
+
+    def start(self):
+        """Фоновый перенос; оставшееся от прошлого запуска переносится при первом проходе"""
+        if self.spool is None or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="spool-replay", daemon=True)
+        self._thread.start()
+
+    def flush(self, timeout=5.0):
+        """
+        Этап flush в lifecycle.py: последний перенос в пределах timeout и fsync.
+        Открытый автомат не ждёт reset_seconds: каждая попытка начинается с
+        пробной записи, при успехе spool переносится целиком.
+        """
+        self._stop.set()
+        if self.spool is None:
+            return True
+        deadline = time.monotonic() + timeout
+        if self._thread is not None:
+            self._thread.join(timeout)
+        drained = False
+        try:
+            while True:
+                self.breaker.probe()
+                drained = self.replay_once(deadline=deadline)
+                remaining = deadline - time.monotonic()
+                if drained or remaining <= 0:
+                    break
+                time.sleep(min(FLUSH_RETRY_SECONDS, remaining))
+        finally:
+            self.spool.close()
+        if not drained:
+            logger.warning(f"spool: в {self.spool.directory} остались записи, перенос — при следующем запуске")
+        logger.info(f"spool stats: {self.stats}, автомат: {self.breaker.status()}")
+        return drained
+
+    def status(self):
+        return {
+            "enabled": self.spool is not None,
+            "directory": self.spool.directory if self.spool is not None else None,
+            "pending": self.spool.pending() if self.spool is not None else 0,
+            "breaker": self.breaker.status(),
+            **self.stats,
+        }
+
+def status():
+    """Состояние автоматов и spool писателей процесса (/_diag/spool)"""
+    with _writers_lock:
+        writers = list(_writers.values())
+    return [writer.status() for writer in writers]
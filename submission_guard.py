@@ -0,0 +1,137 @@
+# submission_guard.py
+"""
+Политика "один ответ на пользователя за окно времени".
+
+Включается переменной SUBMISSION_WINDOW_SECONDS (0 — выключено).
+Частый случай (повторное прохождение подряд) отвечается из LRU-кэша в памяти
+без запроса к БД. Промах кэша проверяется индексным запросом queries.has_submitted.
+Гонки между потоками и процессами закрывает уникальный частичный индекс
+по survey_responses.dedup_key: ключ = user_id + номер окна.
+
+Окна неперекрывающиеся (номер окна = floor(unix-время / окно)): только такое
+окно может держать уникальный индекс, поэтому по нему же проверяют и кэш,
+и запрос в БД.
+"""
+
+import os
+import time
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+# Маркер "в БД на момент проверки ответа в окне не было"
+_NOT_SUBMITTED = None
+
+class RecentSubmissions:
+    """Ограниченный LRU-кэш {user_id: (время отправки или None, время проверки)}"""
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            item = self._items.get(user_id)
+            if item is not None:
+                self._items.move_to_end(user_id)
+            return item
+
+    def put(self, user_id, submitted_at, checked_at):
+        with self._lock:
+            self._items[user_id] = (submitted_at, checked_at)
+            self._items.move_to_end(user_id)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def __len__(self):
+        return len(self._items)
+
+class SubmissionGuard:
+    """Проверка повторной отправки анкеты в пределах окна"""
+
+    def __init__(self, window_seconds=0, cache_size=100000, negative_ttl=60, tenant_id=None):
+        self.window = int(window_seconds or 0)
+        # Бот-арендатор (tenants.py): окно и проверка в БД — только по его ответам
+        self.tenant_id = tenant_id
+        # Сколько доверять отрицательному результату проверки в БД
+        self.negative_ttl = negative_ttl
+        self.recent = RecentSubmissions(cache_size)
+        self.stats = {"cache_hits": 0, "db_checks": 0, "rejected": 0}
+
+    @classmethod
+    def from_env(cls, tenant_id=None):
+        return cls(
+            window_seconds=int(os.getenv("SUBMISSION_WINDOW_SECONDS", "0")),
+            cache_size=int(os.getenv("SUBMISSION_CACHE_SIZE", "100000")),
+            tenant_id=tenant_id,
+        )
+
+    @property
+    def enabled(self):
+        return self.window > 0
+
+    def window_number(self, ts):
+        """Номер окна для unix-времени ts"""
+        return int(ts // self.window)
+
+    def dedup_key(self, user_id, now=None):
+        """Ключ для уникального индекса: одна запись на пользователя в окне"""
+        if not self.enabled:
+            return None
+        now = time.time() if now is None else now
+        if self.tenant_id is not None:
+            return f"{self.tenant_id}:{user_id}:{self.window_number(now)}"
+        return f"{user_id}:{self.window_number(now)}"
+
+    def cached_answer(self, user_id):
+        """Ответ из кэша: True/False, или None если нужна проверка в БД"""
+        if not self.enabled:
+            return False
+        now = time.time()
+        cached = self.recent.get(user_id)
+        if cached is None:
+            return None
+        submitted_at, checked_at = cached
+        if submitted_at is not _NOT_SUBMITTED:
+            self.stats["cache_hits"] += 1
+            duplicate = self.window_number(submitted_at) == self.window_number(now)
+            self.stats["rejected"] += duplicate
+            return duplicate
+        if now - checked_at < self.negative_ttl:
+            self.stats["cache_hits"] += 1
+            return False
+        return None
+
+    def window_start(self, now=None):
+        """Начало текущего окна для запроса в БД (created_at хранится в UTC без пояса)"""
+        now = time.time() if now is None else now
+        start = datetime.fromtimestamp(self.window_number(now) * self.window, timezone.utc)
+        return start.replace(tzinfo=None)
+
+    def remember(self, user_id, submitted_at):
+        """Запоминает результат проверки в БД: created_at ответа в окне или None"""
+        now = time.time()
+        submitted = submitted_at is not None
+        self.stats["db_checks"] += 1
+        self.stats["rejected"] += submitted
+        if submitted:
+            # Время самой записи, а не проверки: иначе окно в кэше сдвигается
+            submitted_at = submitted_at.replace(tzinfo=submitted_at.tzinfo or timezone.utc).timestamp()
+        self.recent.put(user_id, submitted_at if submitted else _NOT_SUBMITTED, now)
+        return submitted
+
+    def is_duplicate(self, user_id) -> bool:
+        """Отправлял ли пользователь анкету в текущем окне"""
+        answer = self.cached_answer(user_id)
+        if answer is not None:
+            return answer
+        # Промах кэша — индексный запрос к БД
+        from queries import last_submitted_at
+        return self.remember(user_id, last_submitted_at(user_id, since=self.window_start(), tenant_id=self.tenant_id))
+
+    def record(self, user_id):
+        """Отмечает успешную отправку"""
+        if self.enabled:
+            now = time.time()
+            self.recent.put(user_id, now, now)
@@ -0,0 +1,592 @@
+# survey.py
+"""
+Логика опроса, общая для синхронного (bot.py) и асинхронного (async_bot.py) рантаймов.
+
+Обработчики написаны как генераторы: вместо прямых вызовов бота они отдают (yield)
+действия — вызов метода Telegram API или побочный эффект (сохранение анкеты,
+проверка повторной отправки). Рантайм выполняет действие своим способом
+(синхронно или через await) и возвращает результат в генератор через send().
+Исключения при выполнении действия пробрасываются в генератор через throw().
+"""
+
+import inspect
+import logging
+
+import tracing
+
+from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
+
+from validation import (
+    ValidationError, parse_birth_date, to_date, format_date, normalize_name, normalize_citizenship,
+)
+
+logger = logging.getLogger(__name__)
+
+# --- действия ---
+
+API = "api"
+EFFECT = "effect"
+
+class Action:
+    """Действие, которое обработчик просит выполнить рантайм"""
+    __slots__ = ("kind", "name", "args", "kwargs")
+
+    def __init__(self, kind, name, args, kwargs):
+        self.kind = kind
+        self.name = name
+        self.args = args
+        self.kwargs = kwargs
+
+    def __repr__(self):
+        return f"<Action {self.kind}:{self.name}>"
+
+def api(method, *args, **kwargs):
+    """Вызов метода бота (send_message, edit_message_text, reply_to, ...)"""
+    return Action(API, method, args, kwargs)
+
+def effect(name, *args, **kwargs):
+    """Побочный эффект, реализуемый рантаймом (save_survey, is_duplicate)"""
+    return Action(EFFECT, name, args, kwargs)
+
+# --- выполнение обработчиков ---
+
+def _action_span(action):
+    """Спан telegram.<метод> или effect.<имя> (вне трассы — пустой блок)"""
+    if action.kind == API:
+        return tracing.span("telegram." + action.name, tracing.CLIENT)
+    return tracing.span("effect." + action.name)
+
+def run_sync(gen, bot, effects):
+    """Выполняет генератор-обработчик синхронно"""
+    send, value = gen.send, None
+    while True:
+        try:
+            action = send(value)
+        except StopIteration:
+            return
+        try:
+            with _action_span(action):
+                if action.kind == API:
+                    value = getattr(bot, action.name)(*action.args, **action.kwargs)
+                else:
+                    value = effects[action.name](*action.args, **action.kwargs)
+            send = gen.send
+        except Exception as e:
+            value, send = e, gen.throw
+
+async def run_async(gen, bot, effects):
+    """Выполняет генератор-обработчик в asyncio: вызовы API и эффекты ожидаются через await"""
+    send, value = gen.send, None
+    while True:
+        try:
+            action = send(value)
+        except StopIteration:
+            return
+        try:
+            with _action_span(action):
+                if action.kind == API:
+                    value = await getattr(bot, action.name)(*action.args, **action.kwargs)
+                else:
+                    value = effects[action.name](*action.args, **action.kwargs)
+                    if inspect.isawaitable(value):
+                        value = await value
+            send = gen.send
+        except Exception as e:
+            value, send = e, gen.throw
+
+# Регистрация обработчиков: (тип, фильтры, имя метода SurveyHandlers).
+# Порядок важен: общий обработчик текста должен идти последним.
+HANDLER_SPECS = [
+    ("message", {"commands": ["start"]}, "start_command"),
+    ("message", {"commands": ["help"]}, "help_command"),
+    ("message", {"commands": ["cancel"]}, "cancel_command"),
+    ("callback_query", {"func": lambda call: True}, "callback_query"),
+    ("message", {"func": lambda message: True}, "survey_message"),
+]
+
+# --- клавиатуры и отчёт ---
+
+def create_main_menu_keyboard():
+    """Создает главное меню с красивыми кнопками."""
+    keyboard = InlineKeyboardMarkup(row_width=2)
+
+    keyboard.add(
+        InlineKeyboardButton("📝 Начать опрос", callback_data="start_survey"),
+        InlineKeyboardButton("📚 Справка", callback_data="help_info")
+    )
+    keyboard.add(
+        InlineKeyboardButton("❌ Отменить опрос", callback_data="cancel_survey"),
+        InlineKeyboardButton("🔄 Новый опрос", callback_data="new_survey")
+    )
+
+    return keyboard
+
+def create_citizenship_keyboard():
+    """Создает клавиатуру для выбора гражданства."""
+    keyboard = InlineKeyboardMarkup(row_width=2)
+
+    keyboard.add(
+        InlineKeyboardButton("🇷🇺 Россия", callback_data="citizenship_Россия"),
+        InlineKeyboardButton("🇺🇦 Украина", callback_data="citizenship_Украина")
+    )
+    keyboard.add(
+        InlineKeyboardButton("🇧🇾 Беларусь", callback_data="citizenship_Беларусь"),
+        InlineKeyboardButton("🇰🇿 Казахстан", callback_data="citizenship_Казахстан")
+    )
+    keyboard.add(
+        InlineKeyboardButton("🇦🇲 Армения", callback_data="citizenship_Армения"),
+        InlineKeyboardButton("🇦🇿 Азербайджан", callback_data="citizenship_Азербайджан")
+    )
+    keyboard.add(
+        InlineKeyboardButton("🇬🇪 Грузия", callback_data="citizenship_Грузия"),
+        InlineKeyboardButton("🇲🇩 Молдова", callback_data="citizenship_Молдова")
+    )
+    keyboard.add(
+        InlineKeyboardButton("✏️ Другое", callback_data="citizenship_custom")
+    )
+
+    return keyboard
+
+def create_date_format_keyboard():
+    """Создает клавиатуру с примерами формата даты."""
+    keyboard = InlineKeyboardMarkup(row_width=2)
+
+    keyboard.add(
+        InlineKeyboardButton("📅 15.03.1990", callback_data="date_example_15.03.1990"),
+        InlineKeyboardButton("📅 22.07.1985", callback_data="date_example_22.07.1985")
+    )
+    keyboard.add(
+        InlineKeyboardButton("📅 08.12.1995", callback_data="date_example_08.12.1995"),
+        InlineKeyboardButton("📅 30.01.1980", callback_data="date_example_30.01.1980")
+    )
+    keyboard.add(
+        InlineKeyboardButton("✏️ Ввести вручную", callback_data="date_manual")
+    )
+
+    return keyboard
+
+def create_survey_progress_keyboard():
+    """Создает клавиатуру для отображения прогресса опроса."""
+    keyboard = InlineKeyboardMarkup(row_width=1)
+
+    keyboard.add(
+        InlineKeyboardButton("📊 Показать прогресс", callback_data="show_progress"),
+        InlineKeyboardButton("❌ Отменить опрос", callback_data="cancel_survey"),
+        InlineKeyboardButton("🔄 Начать заново", callback_data="restart_survey")
+    )
+
+    return keyboard
+
+def create_new_survey_keyboard():
+    """Создает клавиатуру для завершения опроса с кнопкой нового опроса."""
+    keyboard = InlineKeyboardMarkup(row_width=1)
+
+    keyboard.add(
+        InlineKeyboardButton("🚀 Начать новый опрос", callback_data="new_survey")
+    )
+
+    return keyboard
+
+def create_survey_report(data):
+    """Create survey completion report showing only user-entered data."""
+    # Определяем поля, которые пользователь ввел сам
+    user_entered_fields = {
+        'full_name': '👤 ФИО',
+        'birth_date': '📅 Дата рождения',
+        'citizenship': '🌍 Гражданство'
+    }
+
+    # Формируем отчет только с данными пользователя
+    report = "🎉 Опрос завершен успешно!\n\n"
+    report += "📋 Введенные вами данные:\n"
+
+    for field, label in user_entered_fields.items():
+        if field in data and data[field]:
+            value = format_date(data[field]) if field == 'birth_date' else data[field]
+            report += f"{label}: {value}\n"
+
+    report += "\n✅ Все данные сохранены в базе данных!"
+
+    return report
+
+def idempotency_key(message):
+    """
+    Ключ сообщения, завершившего опрос: ввод пользователя или клавиатура бота,
+    на которой нажата кнопка. Повторная обработка того же апдейта даёт тот же ключ.
+    """
+    return f"m:{message.chat.id}:{message.message_id}"
+
+def survey_record(data):
+    """Поля анкеты для сохранения в survey_responses: (full_name, birth_date, citizenship)"""
+    full_name = data.get('full_name', '')
+    birth_date = data.get('birth_date', '')
+    citizenship = data.get('citizenship', '')
+
+    # Дата уже разобрана при вводе (validation.parse_birth_date) и хранится как date;
+    # строка возможна только в состояниях, восстановленных из старого снимка
+    if birth_date:
+        parsed_date = to_date(birth_date)
+        if parsed_date is None:
+            logger.error(f"Invalid date format: {birth_date}")
+        birth_date = parsed_date
+
+    return full_name, birth_date, citizenship
+
+# --- тексты ---
+
+HELP_TEXT = (
+    "📚 Справка по боту\n\n"
+    "Этот бот предназначен для сбора персональных данных через форму опроса.\n\n"
+    "Команды:\n"
+    "• /start - Начать опрос персональных данных\n"
+    "• /help - Эта справка\n"
+    "• /cancel - Отменить текущий опрос\n\n"
+    "Процесс опроса:\n"
+    "1. Введите ФИО\n"
+    "2. Введите дату рождения (ДД.ММ.ГГГГ)\n"
+    "3. Укажите гражданство\n"
+    "4. Получите отчет с вашими данными"
+)
+
+WELCOME_TEXT = (
+    "👋 Добро пожаловать в Бот Опроса Персональных Данных!\n\n"
+    "🎯 Я помогу вам заполнить форму опроса с красивым интерфейсом!\n\n"
+    "📋 Что вас ждет:\n"
+    "• 📝 3 простых вопроса\n"
+    "• 🎨 Стильные кнопки для выбора\n"
+    "• 📊 Красивый отчет по завершении\n\n"
+    "Выберите действие:"
+)
+
+DUPLICATE_SUBMISSION_TEXT = (
+    "ℹ️ Вы уже проходили опрос недавно.\n\n"
+    "Повторно пройти его можно будет позже."
+)
+
+SAVE_ERROR_TEXT = "❌ Ошибка при сохранении данных. Попробуйте еще раз или используйте /cancel"
+
+# --- обработчики ---
+
+class SurveyHandlers:
+    """
+    Сценарий опроса. Состояние пользователей хранится в states:
+    {user_id: {'state': 'waiting_name', 'data': {}}}
+    """
+
+    def __init__(self, states=None, data_generator=None):
+        self.states = {} if states is None else states
+        if data_generator is None:
+            from data_generator import PersonalDataGenerator
+            data_generator = PersonalDataGenerator()
+        self.data_generator = data_generator
+
+    # --- вспомогательные шаги ---
+
+    def _reject_duplicate(self, message, user_id):
+        """Reject a new survey if the user already submitted within the window."""
+        if not (yield effect("is_duplicate", user_id)):
+            return False
+        self.states.pop(user_id, None)
+        yield api("edit_message_text", DUPLICATE_SUBMISSION_TEXT,
+                  chat_id=message.chat.id, message_id=message.message_id)
+        return True
+
+    def _begin_survey(self, message, user_id, title):
+        if (yield from self._reject_duplicate(message, user_id)):
+            return
+        self.states[user_id] = {'state': 'waiting_name', 'data': {}}
+
+        yield api("edit_message_text",
+            f"{title}\n\n"
+            "🌍 Вопрос 1: Введите ваше полное ФИО\n\n"
+            "Пример: Иванов Иван Иванович",
+            chat_id=message.chat.id,
+            message_id=message.message_id
+        )
+
+        # Отправляем сообщение с просьбой ввести ФИО
+        yield api("send_message", message.chat.id, "✍️ Введите ваше ФИО:")
+
+    def _complete_survey(self, user_id, message):
+        """Generate filler data and persist; returns (saved, all_data)."""
+        # Генерируем случайные данные
+        full_name = self.states[user_id]['data']['full_name']
+        random_data = self.data_generator.generate_all_random_data(full_name)
+
+        # Объединяем все данные
+        all_data = {**self.states[user_id]['data'], **random_data}
+
+        # Сохраняем в базу данных
+        saved = yield effect("save_survey", user_id, all_data, idempotency_key=idempotency_key(message))
+        if saved:
+            # Очищаем состояние пользователя
+            del self.states[user_id]
+        return saved, all_data
+
+    # --- кнопки ---
+
+    def handle_start_survey(self, message, user_id):
+        """Handle start survey button."""
+        yield from self._begin_survey(message, user_id, "📝 Начинаем опрос!")
+
+    def handle_help_info(self, message):
+        """Handle help info button."""
+        yield api("edit_message_text", HELP_TEXT, chat_id=message.chat.id, message_id=message.message_id)
+
+    def handle_cancel_survey(self, call, user_id):
+        """Handle cancel survey button."""
+        message = call.message
+        if user_id in self.states:
+            del self.states[user_id]
+            yield api("edit_message_text", "❌ Опрос отменен.", chat_id=message.chat.id, message_id=message.message_id)
+            yield api("send_message", message.chat.id, "Используйте /start для начала нового опроса.")
+        else:
+            yield api("answer_callback_query", call.id, "❌ У вас нет активного опроса.")
+
+    def handle_new_survey(self, message, user_id):
+        """Handle new survey button."""
+        # Сбрасываем состояние и начинаем заново
+        yield from self._begin_survey(message, user_id, "🔄 Начинаем новый опрос!")
+
+    def handle_show_progress(self, call, user_id):
+        """Handle show progress button."""
+        message = call.message
+        if user_id not in self.states:
+            yield api("answer_callback_query", call.id, "❌ У вас нет активного опроса.")
+            return
+
+        current_state = self.states[user_id]['state']
+        data = self.states[user_id]['data']
+
+        progress_text = "📊 Прогресс опроса:\n\n"
+
+        if 'full_name' in data:
+            progress_text += f"✅ ФИО: {data['full_name']}\n"
+        else:
+            progress_text += "❌ ФИО: не заполнено\n"
+
+        if 'birth_date' in data:
+            progress_text += f"✅ Дата рождения: {format_date(data['birth_date'])}\n"
+        else:
+            progress_text += "❌ Дата рождения: не заполнено\n"
+
+        if 'citizenship' in data:
+            progress_text += f"✅ Гражданство: {data['citizenship']}\n"
+        else:
+            progress_text += "❌ Гражданство: не заполнено\n"
+
+        progress_text += f"\n🎯 Текущий этап: {current_state}"
+
+        yield api("edit_message_text", progress_text, chat_id=message.chat.id, message_id=message.message_id)
+
+    def handle_restart_survey(self, message, user_id):
+        """Handle restart survey button."""
+        # Сбрасываем состояние и начинаем заново
+        yield from self._begin_survey(message, user_id, "🔄 Опрос перезапущен!")
+
+    def handle_citizenship_selection(self, message, user_id, citizenship):
+        """Handle citizenship selection from keyboard."""
+        self.states[user_id]['data']['citizenship'] = citizenship
+        self.states[user_id]['state'] = 'completed'
+
+        saved, all_data = yield from self._complete_survey(user_id, message)
+        if saved:
+            # Формируем отчет
+            report = create_survey_report(all_data)
+            yield api("edit_message_text", "✅ Гражданство выбрано!", chat_id=message.chat.id, message_id=message.message_id)
+            yield api("send_message", message.chat.id, report, reply_markup=create_new_survey_keyboard())
+        else:
+            yield api("edit_message_text", "❌ Ошибка при сохранении данных.", chat_id=message.chat.id, message_id=message.message_id)
+
+    def handle_custom_citizenship(self, message, user_id):
+        """Handle custom citizenship input request."""
+        self.states[user_id]['state'] = 'waiting_custom_citizenship'
+
+        yield api("edit_message_text",
+            "✏️ Введите ваше гражданство вручную:",
+            chat_id=message.chat.id,
+            message_id=message.message_id
+        )
+
+    def handle_date_example(self, message, user_id, date_example):
+        """Handle date example selection."""
+        try:
+            birth_date = parse_birth_date(date_example)
+        except ValidationError as e:
+            yield api("send_message", message.chat.id, str(e))
+            return
+
+        self.states[user_id]['data']['birth_date'] = birth_date
+        self.states[user_id]['state'] = 'waiting_citizenship'
+
+        citizenship_text = (
+            f"✅ Дата рождения выбрана: {date_example}\n\n"
+            f"🌍 Вопрос 3: Укажите ваше гражданство\n\n"
+            "Выберите из списка или введите вручную:"
+        )
+
+        yield api("edit_message_text", citizenship_text, chat_id=message.chat.id, message_id=message.message_id)
+        yield api("send_message", message.chat.id, "Выберите гражданство:", reply_markup=create_citizenship_keyboard())
+
+    def handle_date_manual(self, message, user_id):
+        """Handle manual date input request."""
+        self.states[user_id]['state'] = 'waiting_birth_date'
+
+        yield api("edit_message_text",
+            "✏️ Введите дату рождения в формате ДД.ММ.ГГГГ\n\n"
+            "Пример: 15.03.1990",
+            chat_id=message.chat.id,
+            message_id=message.message_id
+        )
+
+    # --- ввод текста ---
+
+    def handle_name_input(self, message, text):
+        """Handle full name input."""
+        user_id = message.from_user.id
+
+        # Проверяем, что введено ФИО (минимум 2 слова)
+        try:
+            full_name = normalize_name(text)
+        except ValidationError as e:
+            yield api("reply_to", message, str(e))
+            return
+
+        # Сохраняем ФИО
+        self.states[user_id]['data']['full_name'] = full_name
+        self.states[user_id]['state'] = 'waiting_birth_date'
+
+        yield api("reply_to", message,
+            f"✅ ФИО сохранено: {full_name}\n\n"
+            f"📅 Вопрос 2: Какая дата рождения?\n"
+            f"Введите в формате ДД.ММ.ГГГГ (например: 15.03.1990)",
+            reply_markup=create_date_format_keyboard()
+        )
+
+    def handle_birth_date_input(self, message, text):
+        """Handle birth date input."""
+        user_id = message.from_user.id
+
+        # Формат ДД.ММ.ГГГГ, корректность и диапазон даты — разбор один раз
+        try:
+            birth_date = parse_birth_date(text)
+        except ValidationError as e:
+            yield api("reply_to", message, str(e))
+            return
+
+        # Сохраняем дату рождения (объект date идёт дальше до записи в БД)
+        self.states[user_id]['data']['birth_date'] = birth_date
+        self.states[user_id]['state'] = 'waiting_citizenship'
+
+        citizenship_text = (
+            f"✅ Дата рождения сохранена: {text}\n\n"
+            f"🌍 Вопрос 3: Укажите ваше гражданство\n\n"
+            "Выберите из списка или введите вручную:"
+        )
+
+        yield api("reply_to", message, citizenship_text, reply_markup=create_citizenship_keyboard())
+
+    def handle_citizenship_input(self, message, text):
+        """Handle citizenship input (typed or after the "Другое" button)."""
+        user_id = message.from_user.id
+
+        # Проверяем, что введено гражданство
+        try:
+            citizenship = normalize_citizenship(text)
+        except ValidationError as e:
+            yield api("reply_to", message, str(e))
+            return
+
+        # Сохраняем гражданство
+        self.states[user_id]['data']['citizenship'] = citizenship
+
+        saved, all_data = yield from self._complete_survey(user_id, message)
+        if saved:
+            # Формируем отчет
+            report = create_survey_report(all_data)
+            yield api("reply_to", message, report, reply_markup=create_new_survey_keyboard())
+        else:
+            yield api("reply_to", message, SAVE_ERROR_TEXT)
+
+    # --- точки входа (см. HANDLER_SPECS) ---
+
+    def start_command(self, message):
+        """Handle /start command."""
+        user_id = message.from_user.id
+
+        # Сбрасываем состояние пользователя
+        self.states[user_id] = {'state': 'main_menu', 'data': {}}
+
+        yield api("reply_to", message, WELCOME_TEXT, reply_markup=create_main_menu_keyboard())
+
+    def help_command(self, message):
+        """Handle /help command."""
+        yield api("reply_to", message, HELP_TEXT)
+
+    def cancel_command(self, message):
+        """Handle /cancel command."""
+        user_id = message.from_user.id
+
+        if user_id in self.states:
+            del self.states[user_id]
+            yield api("reply_to", message, "❌ Опрос отменен. Используйте /start для начала нового опроса.")
+        else:
+            yield api("reply_to", message, "❌ У вас нет активного опроса.")
+
+    def callback_query(self, call):
+        """Handle all callback queries from inline keyboards."""
+        user_id = call.from_user.id
+        data = call.data
+
+        try:
+            if data == "start_survey":
+                yield from self.handle_start_survey(call.message, user_id)
+            elif data == "help_info":
+                yield from self.handle_help_info(call.message)
+            elif data == "cancel_survey":
+                yield from self.handle_cancel_survey(call, user_id)
+            elif data == "new_survey":
+                yield from self.handle_new_survey(call.message, user_id)
+            elif data == "show_progress":
+                yield from self.handle_show_progress(call, user_id)
+            elif data == "restart_survey":
+                yield from self.handle_restart_survey(call.message, user_id)
+            elif data.startswith("citizenship_"):
+                citizenship = data.replace("citizenship_", "")
+                if citizenship == "custom":
+                    yield from self.handle_custom_citizenship(call.message, user_id)
+                else:
+                    yield from self.handle_citizenship_selection(call.message, user_id, citizenship)
+            elif data.startswith("date_example_"):
+                date_example = data.replace("date_example_", "")
+                yield from self.handle_date_example(call.message, user_id, date_example)
+            elif data == "date_manual":
+                yield from self.handle_date_manual(call.message, user_id)
+
+            # Отвечаем на callback query
+            yield api("answer_callback_query", call.id)
+
+        except Exception as e:
+            logger.error(f"Error handling callback query: {e}")
+            yield api("answer_callback_query", call.id, "❌ Произошла ошибка")
+
+    def survey_message(self, message):
+        """Handle survey responses."""
+        user_id = message.from_user.id
+        text = message.text.strip()
+
+        # Проверяем, есть ли активный опрос
+        if user_id not in self.states:
+            yield api("reply_to", message, "💬 Используйте /start для начала опроса.")
+            return
+
+        current_state = self.states[user_id]['state']
+
+        if current_state == 'waiting_name':
+            yield from self.handle_name_input(message, text)
+        elif current_state == 'waiting_birth_date':
+            yield from self.handle_birth_date_input(message, text)
+        elif current_state in ('waiting_citizenship', 'waiting_custom_citizenship'):
+            yield from self.handle_citizenship_input(message, text)
+        else:
+            yield api("reply_to", message, "❌ Неизвестное состояние. Используйте /start для начала нового опроса.")
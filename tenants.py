@@ -0,0 +1,247 @@
+# tenants.py
+"""
+Мультиарендный режим: много ботов-опросников (токенов) в одном процессе.
+
+Конфигурация — JSON-файл TENANTS_FILE со списком ботов:
+
+    [
+      {"id": "acme", "token_env": "ACME_BOT_TOKEN"},
+      {"id": "beta", "token_env": "BETA_BOT_TOKEN",
+       "admission": {"user_rate": 2, "user_burst": 10, "max_inflight": 20},
+       "submission_window_seconds": 86400}
+    ]
+
+Общее на все боты процесса:
+- пул воркеров обработчиков (TENANT_WORKERS потоков polling.KeyedPool, порядок
+  апдейтов пользователя сохраняется);
+- движок БД db.engine и его пул соединений;
+- пул HTTP-соединений к Telegram API (transport.py).
+
+Своё у каждого бота:
+- поток long polling и состояния опросов (SurveyHandlers со своим словарём);
+- admission.Admission: лимиты на пользователя и max_inflight — доля общего
+  пула, которую бот может занять (считаются его апдейты в очереди и в работе),
+  чтобы шумный бот не задерживал остальных;
+- дедупликация апдейтов и окно повторной отправки с пространством ключей бота;
+- колонка survey_responses.tenant_id у сохранённых анкет.
+
+Запуск: bot_runner.py переходит в этот режим, если задан TENANTS_FILE.
+Снимок незавершённых опросов при остановке пишется по STATE_SNAPSHOT_BACKEND,
+как у bot.py: в survey_state_snapshots с tenant_id бота или в файл на каждого
+бота (STATE_SNAPSHOT_PATH.<id>).
+"""
+
+import os
+import re
+import json
+import logging
+import threading
+import functools
+
+import telebot
+
+import bot
+import lifecycle
+import polling
+import tracing
+import transport
+from admission import Admission
+from idempotency import UpdateDeduplicator
+from submission_guard import SubmissionGuard
+from survey import SurveyHandlers
+
+logger = logging.getLogger(__name__)
+
+TENANTS_FILE = os.getenv("TENANTS_FILE", "")
+TENANT_WORKERS = int(os.getenv("TENANT_WORKERS", "8"))
+TENANT_POLL_TIMEOUT = int(os.getenv("TENANT_POLL_TIMEOUT", "20"))
+
+_ID_RE = re.compile(r"^[a-z0-9][a-z0-9_-]{0,31}$")
+ADMISSION_KEYS = {"user_rate", "user_burst", "callback_window", "max_inflight"}
+
+class TenantConfigError(ValueError):
+    """Ошибка в TENANTS_FILE"""
+
+def load_configs(path):
+    """Список конфигураций ботов из JSON-файла с проверкой полей"""
+    with open(path, encoding="utf-8") as f:
+        items = json.load(f)
+    if not isinstance(items, list) or not items:
+        raise TenantConfigError(f"{path}: ожидается непустой список ботов")
+    seen = set()
+    configs = []
+    for item in items:
+        tenant_id = str(item.get("id", ""))
+        if not _ID_RE.match(tenant_id):
+            raise TenantConfigError(f"{path}: некорректный id {tenant_id!r} (a-z, 0-9, _ и -, до 32 символов)")
+        if tenant_id in seen:
+            raise TenantConfigError(f"{path}: id {tenant_id!r} повторяется")
+        seen.add(tenant_id)
+        token = item.get("token") or os.getenv(item.get("token_env", ""), "")
+        if not token:
+            raise TenantConfigError(f"{path}: у бота {tenant_id} нет токена (token или token_env)")
+        unknown = set(item.get("admission", {})) - ADMISSION_KEYS
+        if unknown:
+            raise TenantConfigError(f"{path}: неизвестные параметры admission у {tenant_id}: {sorted(unknown)}")
+        configs.append({**item, "id": tenant_id, "token": token})
+    return configs
+
+class _LogExceptions(telebot.ExceptionHandler):
+    """Ошибка обработчика одного бота не должна останавливать общий пул"""
+
+    def handle(self, exception):
+        logger.error(f"Ошибка обработчика: {exception}")
+        return True
+
+class TenantBot(bot.SurveyBot):
+    """SurveyBot на общем пуле воркеров со своим счётчиком апдейтов в работе"""
+
+    def __init__(self, token, tenant_id, pool):
+        super().__init__(token, threaded=False)
+        self.tenant_id = tenant_id
+        self.threaded = True
+        self.worker_pool = pool
+        self.inflight = 0
+        self._inflight_lock = threading.Lock()
+
+    def _exec_task(self, task, *args, **kwargs):
+        with self._inflight_lock:
+            self.inflight += 1
+
+        def run(*args, **kwargs):
+            try:
+                task(*args, **kwargs)
+            finally:
+                with self._inflight_lock:
+                    self.inflight -= 1
+
+        # Аргументы передаются как есть: по первому KeyedPool выбирает очередь пользователя
+        super()._exec_task(run, *args, **kwargs)
+
+    def load(self):
+        """Только апдейты этого бота: max_inflight — его доля общего пула"""
+        return self.inflight
+
+class Tenant:
+    """Бот-арендатор: свои токен, состояния опросов, лимиты и пространство ключей"""
+
+    def __init__(self, config, pool):
+        self.id = config["id"]
+        self.config = config
+        self.bot = TenantBot(config["token"], self.id, pool)
+        self.bot.deduplicator = UpdateDeduplicator.from_env(namespace=self.id)
+        defaults = Admission.from_env()
+        overrides = config.get("admission", {})
+        self.bot.admission = Admission(
+            user_rate=overrides.get("user_rate", defaults.buckets.rate if defaults.buckets else 0),
+            user_burst=overrides.get("user_burst", defaults.buckets.burst if defaults.buckets else 0),
+            callback_window=overrides.get("callback_window", defaults.callbacks.window if defaults.callbacks else 0),
+            max_inflight=overrides.get("max_inflight", defaults.max_inflight),
+        )
+        self.guard = SubmissionGuard.from_env(tenant_id=self.id)
+        if "submission_window_seconds" in config:
+            self.guard.window = int(config["submission_window_seconds"] or 0)
+        self.states = {}
+        self.handlers = SurveyHandlers(self.states, bot.data_generator)
+        self.effects = {
+            "save_survey": functools.partial(bot.save_survey_data, guard=self.guard, tenant_id=self.id),
+            "is_duplicate": self.guard.is_duplicate,
+        }
+        bot.setup_handlers(self.bot, self.handlers, self.effects)
+        self.thread = None
+        self.poller = None
+
+    @property
+    def snapshot_path(self):
+        return f"{lifecycle.STATE_SNAPSHOT_PATH}.{self.id}"
+
+    def restore_states(self):
+        try:
+            restored = lifecycle.load_states(self.snapshot_path, tenant_id=self.id)
+        except Exception as e:
+            logger.error(f"[{self.id}] Не удалось восстановить состояния опросов: {e}")
+            return 0
+        for user_id, state in restored.items():
+            self.states.setdefault(user_id, state)
+        return len(restored)
+
+    def save_states(self):
+        return lifecycle.save_states(self.states, self.snapshot_path, tenant_id=self.id)
+
+    def poll(self, stop_event):
+        """Long polling этого бота (polling.Poller); обработчики — на общем KeyedPool"""
+        try:
+            self.bot.remove_webhook()
+        except Exception as e:
+            logger.warning(f"[{self.id}] remove_webhook: {e}")
+        self.poller = polling.Poller(self.bot, timeout_max=TENANT_POLL_TIMEOUT, stop_event=stop_event, name=self.id)
+        self.poller.run()
+
+    def status(self):
+        return {
+            "id": self.id,
+            "inflight": self.bot.inflight,
+            "active_surveys": len(self.states),
+            "admission": dict(self.bot.admission.stats),
+            "idempotency": dict(self.bot.deduplicator.stats),
+            "polling": dict(self.poller.stats) if self.poller else None,
+        }
+
+class Runtime:
+    """Все боты процесса на общем пуле воркеров, движке БД и пуле HTTP-соединений"""
+
+    def __init__(self, configs, workers=TENANT_WORKERS):
+        self.pool = polling.KeyedPool(_LogExceptions(), num_threads=workers, name="tenant-worker")
+        # Соединений к API — по числу потоков, которые его вызывают: воркеры и поллеры
+        transport.install(pool_size=workers + len(configs))
+        self.tenants = [Tenant(config, self.pool) for config in configs]
+        self.stop_event = threading.Event()
+
+    @classmethod
+    def from_env(cls):
+        """Runtime по TENANTS_FILE или None, если мультиарендный режим не включён"""
+        if not TENANTS_FILE:
+            return None
+        configs = load_configs(TENANTS_FILE)
+        logger.info(f"Мультиарендный режим: {len(configs)} ботов, воркеров {TENANT_WORKERS}")
+        return cls(configs)
+
+    def start(self):
+        bot.setup_database()
+        # Spool анкет общий: записи арендаторов различаются tenant_id
+        bot.db_writer.start()
+        for tenant in self.tenants:
+            restored = tenant.restore_states()
+            if restored:
+                logger.info(f"[{tenant.id}] Восстановлено опросов: {restored}")
+            tenant.thread = threading.Thread(target=tenant.poll, args=(self.stop_event,),
+                                             name=f"poll-{tenant.id}", daemon=True)
+            tenant.thread.start()
+
+    def is_alive(self):
+        return any(t.thread is not None and t.thread.is_alive() for t in self.tenants)
+
+    def join(self, timeout=None):
+        for tenant in self.tenants:
+            if tenant.thread is not None:
+                tenant.thread.join(timeout)
+
+    def drain(self, timeout):
+        # Счётчик выполняющихся обработчиков в bot.py общий, очередь пула — тоже
+        return bot.drain_handlers(timeout, target=self.tenants[0].bot)
+
+    def save_states(self):
+        return sum(tenant.save_states() for tenant in self.tenants)
+
+    def register_shutdown_hooks(self, manager):
+        """stop_accepting -> drain -> flush -> snapshot для всех ботов (см. lifecycle.py)"""
+        manager.on("stop_accepting", lambda _timeout: self.stop_event.set(), "tenants.stop_polling")
+        manager.on("drain", self.drain, "tenants.drain_handlers")
+        manager.on("drain", lambda _timeout: logger.info(f"tenants: {self.status()}"), "tenants.stats")
+        manager.on("drain", lambda _timeout: logger.info(f"telegram api stats: {transport.stats()}"), "transport.stats")
+        manager.on("flush", bot.db_writer.flush, "spool.flush")
+        manager.on("flush", tracing.flush, "tracing.flush")
+        manager.on("snapshot", lambda _timeout: self.save_states(), "tenants.save_states")
+
+    def status(self):
+        return [tenant.status() for tenant in self.tenants]
@@ -0,0 +1,458 @@
+# tracing.py
+"""
+Трассировка обработки апдейта: апдейт → обработчик → БД → ответ в Telegram.
+
+Каждый выбранный апдейт получает корневой спан "update" (от получения в
+process_new_updates до конца обработчика, включая ожидание в очереди пула),
+внутри него:
+- handler.<имя>     — обработчик из setup_handlers()
+- telegram.<метод>  — вызов Telegram API из сценария (survey.run_sync/run_async)
+- effect.<имя>      — побочный эффект сценария (save_survey, is_duplicate)
+- db.<операция>     — каждый execute SQLAlchemy (события движка, см. instrument_sqlalchemy)
+
+Текущий спан хранится в contextvars, поэтому вложенность работает и в потоках
+воркеров TeleBot, и в задачах asyncio. Решение о записи трассы принимается
+один раз на корне (head-based, TRACE_SAMPLE_RATE); в невыбранных трассах
+дочерние спаны не создаются вовсе.
+
+Законченные спаны копятся в очереди и пачками уходят экспортёру из фонового
+потока:
+- TRACE_EXPORTER=jsonl — строка JSON на спан в TRACE_JSONL_PATH
+- TRACE_EXPORTER=otlp  — OTLP/HTTP JSON на OTEL_EXPORTER_OTLP_TRACES_ENDPOINT
+  (или OTEL_EXPORTER_OTLP_ENDPOINT + /v1/traces; Jaeger, Tempo, OTel Collector)
+Свой экспортёр — любой объект с export(spans), см. configure().
+Без TRACE_EXPORTER трассировка выключена.
+
+Текст SQL пишется в атрибут db.statement без параметров (в них ФИО и даты).
+Разбивка времени по видам спанов — scripts/trace_breakdown.py.
+"""
+
+import os
+import json
+import time
+import random
+import logging
+import threading
+import contextvars
+import urllib.request
+from collections import deque
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "").lower()
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.1"))
+TRACE_JSONL_PATH = os.getenv("TRACE_JSONL_PATH", "traces.jsonl")
+TRACE_QUEUE_SIZE = int(os.getenv("TRACE_QUEUE_SIZE", "10000"))
+TRACE_BATCH_SIZE = int(os.getenv("TRACE_BATCH_SIZE", "512"))
+TRACE_FLUSH_INTERVAL = float(os.getenv("TRACE_FLUSH_INTERVAL", "2"))
+TRACE_SQL_MAX_LENGTH = int(os.getenv("TRACE_SQL_MAX_LENGTH", "500"))
+SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "telegram-survey-bot")
+
+# Виды спанов (значения — как SpanKind в OTLP)
+INTERNAL = 1
+CONSUMER = 5
+CLIENT = 3
+
+# Атрибут payload апдейта (message / callback_query), в котором корневой спан
+# ждёт обработчика
+_ATTR = "_trace_span"
+UPDATE_TYPES = ("message", "callback_query")
+
+_current = contextvars.ContextVar("trace_span", default=None)
+
+def _new_id(bits):
+    return f"{random.getrandbits(bits):0{bits // 4}x}"
+
+class Span:
+    """Отрезок работы внутри трассы; время — наносекунды Unix"""
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "kind",
+                 "start_ns", "end_ns", "attributes", "error", "_tracer")
+
+    def __init__(self, tracer, name, trace_id, parent_id=None, kind=INTERNAL, attributes=None):
+        self._tracer = tracer
+        self.trace_id = trace_id
+        self.span_id = _new_id(64)
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.attributes = attributes or {}
+        self.error = None
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def record_error(self, error):
+        self.error = f"{type(error).__name__}: {error}"
+
+    def end(self):
+        """Закрывает спан и отдаёт его на экспорт (повторный вызов ничего не делает)"""
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+            self._tracer.processor.on_end(self)
+
+    @property
+    def duration_ms(self):
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "kind": self.kind,
+            "start_ns": self.start_ns,
+            "end_ns": self.end_ns,
+            "duration_ms": round(self.duration_ms, 3),
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+    def __repr__(self):
+        return f"<Span {self.name} {self.trace_id}/{self.span_id}>"
+
+# --- экспортёры ---
+
+class JsonlExporter:
+    """Спаны строками JSON в локальный файл"""
+
+    def __init__(self, path=TRACE_JSONL_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, spans):
+        lines = "".join(json.dumps(s.to_dict(), ensure_ascii=False, default=str) + "\n" for s in spans)
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(lines)
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+def _otlp_headers(raw):
+    """OTEL_EXPORTER_OTLP_HEADERS: "ключ=значение,ключ2=значение2" """
+    headers = {}
+    for item in (raw or "").split(","):
+        key, sep, value = item.partition("=")
+        if sep and key.strip():
+            headers[key.strip()] = urllib.request.unquote(value.strip())
+    return headers
+
+class OtlpExporter:
+    """OTLP/HTTP с JSON-кодированием (POST /v1/traces), без зависимостей"""
+
+    def __init__(self, endpoint=None, headers=None, service_name=SERVICE_NAME, timeout=5.0):
+        if endpoint is None:
+            endpoint = os.getenv("OTEL_EXPORTER_OTLP_TRACES_ENDPOINT")
+        if endpoint is None:
+            base = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT", "http://localhost:4318")
+            endpoint = base.rstrip("/") + "/v1/traces"
+        self.endpoint = endpoint
+        self.headers = headers if headers is not None else _otlp_headers(os.getenv("OTEL_EXPORTER_OTLP_HEADERS"))
+        self.service_name = service_name
+        self.timeout = timeout
+
+    def _span(self, s):
+        out = {
+            "traceId": s.trace_id,
+            "spanId": s.span_id,
+            "name": s.name,
+            "kind": s.kind,
+            "startTimeUnixNano": str(s.start_ns),
+            "endTimeUnixNano": str(s.end_ns),
+            "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in s.attributes.items()],
+        }
+        if s.parent_id:
+            out["parentSpanId"] = s.parent_id
+        if s.error:
+            out["status"] = {"code": 2, "message": s.error}
+        return out
+
+    def payload(self, spans):
+        return {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": self.service_name}}]},
+            "scopeSpans": [{"scope": {"name": "tracing"}, "spans": [self._span(s) for s in spans]}],
+        }]}
+
+    def export(self, spans):
+        body = json.dumps(self.payload(spans), default=str).encode()
+        request = urllib.request.Request(
+            self.endpoint, data=body, method="POST",
+            headers={"Content-Type": "application/json", **self.headers},
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            response.read()
+
+EXPORTERS = {
+    "jsonl": JsonlExporter,
+    "otlp": OtlpExporter,
+}
+
+class BatchProcessor:
+    """
+    Очередь законченных спанов и фоновый поток, отдающий их экспортёру пачками.
+    При переполнении очереди новые спаны отбрасываются (счётчик dropped):
+    трассировка не должна тормозить обработку апдейтов.
+    """
+
+    def __init__(self, exporter, max_queue=10000, batch_size=512, interval=2.0):
+        self.exporter = exporter
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.interval = interval
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._pid = None
+        self.stats = {"exported": 0, "dropped": 0, "export_errors": 0}
+
+    def on_end(self, span):
+        if self.exporter is None:
+            return
+        with self._cond:
+            if len(self._queue) >= self.max_queue:
+                self.stats["dropped"] += 1
+                return
+            self._queue.append(span)
+            if len(self._queue) >= self.batch_size:
+                self._cond.notify()
+        if self._pid != os.getpid():
+            self._start()
+
+    def _start(self):
+        # Поток создаётся при первом спане и заново в дочернем процессе после fork
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="trace-export", daemon=True)
+            self._thread.start()
+
+    def _take(self):
+        with self._cond:
+            n = min(len(self._queue), self.batch_size)
+            return [self._queue.popleft() for _ in range(n)]
+
+    def _export(self, batch):
+        try:
+            self.exporter.export(batch)
+            self.stats["exported"] += len(batch)
+        except Exception as e:
+            self.stats["export_errors"] += 1
+            logger.warning(f"[tracing] Не удалось выгрузить {len(batch)} спанов: {e}")
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if len(self._queue) < self.batch_size:
+                    self._cond.wait(self.interval)
+            batch = self._take()
+            if batch:
+                self._export(batch)
+
+    def flush(self, timeout=5.0):
+        """Выгружает очередь в вызывающем потоке; True, если успели всё"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            batch = self._take()
+            if not batch:
+                return True
+            self._export(batch)
+        return not self._queue
+
+    def pending(self):
+        return len(self._queue)
+
+class Tracer:
+    """Создание спанов с выборкой на корне и их передача в BatchProcessor"""
+
+    def __init__(self, exporter=None, sample_rate=0.1, **batch_options):
+        self.sample_rate = sample_rate
+        self.processor = BatchProcessor(exporter, **batch_options)
+
+    @classmethod
+    def from_env(cls):
+        exporter = None
+        if TRACE_EXPORTER:
+            factory = EXPORTERS.get(TRACE_EXPORTER)
+            if factory is None:
+                logger.warning(f"[tracing] Неизвестный TRACE_EXPORTER={TRACE_EXPORTER}, трассировка выключена")
+            else:
+                exporter = factory()
+        return cls(exporter, TRACE_SAMPLE_RATE, max_queue=TRACE_QUEUE_SIZE,
+                   batch_size=TRACE_BATCH_SIZE, interval=TRACE_FLUSH_INTERVAL)
+
+    @property
+    def enabled(self):
+        return self.processor.exporter is not None and self.sample_rate > 0
+
+    def start_trace(self, name, kind=INTERNAL, attributes=None):
+        """Корневой спан новой трассы или None, если трасса не выбрана"""
+        if not self.enabled or random.random() >= self.sample_rate:
+            return None
+        return Span(self, name, _new_id(128), None, kind, attributes)
+
+    def start_span(self, name, kind=INTERNAL, attributes=None):
+        """Дочерний спан текущего или None вне выбранной трассы (спан не становится текущим)"""
+        parent = _current.get()
+        if parent is None:
+            return None
+        return Span(self, name, parent.trace_id, parent.span_id, kind, attributes)
+
+tracer = Tracer.from_env()
+
+def configure(exporter=None, sample_rate=None, **batch_options):
+    """Заменяет глобальный трейсер (свой экспортёр с методом export(spans), тесты)"""
+    global tracer
+    tracer = Tracer(exporter, TRACE_SAMPLE_RATE if sample_rate is None else sample_rate, **batch_options)
+    return tracer
+
+def enabled():
+    return tracer.enabled
+
+def current_span():
+    return _current.get()
+
+@contextmanager
+def activate(span):
+    """Делает span текущим и закрывает его на выходе; span=None — ничего не делает"""
+    if span is None:
+        yield None
+        return
+    token = _current.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.record_error(e)
+        raise
+    finally:
+        _current.reset(token)
+        span.end()
+
+def span(name, kind=INTERNAL, **attributes):
+    """Дочерний спан текущего на время блока with (вне трассы — пустой блок)"""
+    return activate(tracer.start_span(name, kind, attributes))
+
+# --- апдейты Telegram ---
+
+def _payload(update):
+    for kind in UPDATE_TYPES:
+        payload = getattr(update, kind, None)
+        if payload is not None:
+            return kind, payload
+    return None, None
+
+def begin_update(update):
+    """Открывает корневой спан апдейта и прикрепляет его к message/callback_query"""
+    if not tracer.enabled:
+        return None
+    kind, payload = _payload(update)
+    if payload is None:
+        return None
+    root = tracer.start_trace("update", CONSUMER, {"update.id": update.update_id, "update.type": kind})
+    if root is not None:
+        setattr(payload, _ATTR, root)
+    return root
+
+def end_update(update, outcome):
+    """Закрывает корневой спан апдейта, не дошедшего до обработчика (повтор, сброс по нагрузке)"""
+    _kind, payload = _payload(update)
+    root = getattr(payload, _ATTR, None)
+    if root is not None:
+        setattr(payload, _ATTR, None)
+        root.set("update.outcome", outcome)
+        root.end()
+
+def end_dropped(received, kept, outcome="duplicate"):
+    """end_update для апдейтов из received, которых нет в kept"""
+    if not tracer.enabled:
+        return
+    kept = {id(u) for u in kept}
+    for update in received:
+        if id(update) not in kept:
+            end_update(update, outcome)
+
+def resume_update(payload):
+    """
+    Контекст обработчика: делает корневой спан апдейта текущим и закрывает его
+    по выходу. Для невыбранных апдейтов — пустой блок.
+    """
+    root = getattr(payload, _ATTR, None)
+    if root is not None:
+        setattr(payload, _ATTR, None)
+        root.set("update.outcome", "handled")
+    return activate(root)
+
+# --- SQLAlchemy ---
+
+_instrumented = False
+
+def _before_execute(conn, _cursor, statement, _parameters, context, executemany):
+    if _current.get() is None:
+        context._trace_span = None
+        return
+    words = statement.split(None, 1)
+    s = tracer.start_span("db." + (words[0].lower() if words else "query"), CLIENT, {
+        "db.system": conn.dialect.name,
+        "db.statement": statement[:TRACE_SQL_MAX_LENGTH],
+    })
+    if executemany:
+        s.set("db.executemany", True)
+    context._trace_span = s
+
+def _after_execute(_conn, cursor, _statement, _parameters, context, _executemany):
+    s = getattr(context, "_trace_span", None)
+    if s is not None:
+        context._trace_span = None
+        if cursor.rowcount is not None and cursor.rowcount >= 0:
+            s.set("db.rows", cursor.rowcount)
+        s.end()
+
+def _on_error(exception_context):
+    context = exception_context.execution_context
+    s = getattr(context, "_trace_span", None) if context is not None else None
+    if s is not None:
+        context._trace_span = None
+        s.record_error(exception_context.original_exception)
+        s.end()
+
+def instrument_sqlalchemy():
+    """
+    Спаны db.* на каждый execute. Слушатели вешаются на класс Engine, поэтому
+    покрывают db.engine, database.engine (и движок, пересозданный при откате
+    на локальный файл в database.init_db), реплику routing.py и синхронную
+    часть db_async.engine. Вне выбранной трассы слушатель только читает contextvar.
+    """
+    global _instrumented
+    if _instrumented or not tracer.enabled:
+        return
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    event.listen(Engine, "before_cursor_execute", _before_execute)
+    event.listen(Engine, "after_cursor_execute", _after_execute)
+    event.listen(Engine, "handle_error", _on_error)
+    _instrumented = True
+
+def flush(timeout=5.0):
+    """Дописывает очередь спанов (этап flush в lifecycle.py)"""
+    done = tracer.processor.flush(timeout)
+    if tracer.enabled:
+        logger.info(f"[tracing] stats: {tracer.processor.stats}")
+    return done
+
+def status():
+    return {
+        "enabled": tracer.enabled,
+        "exporter": type(tracer.processor.exporter).__name__ if tracer.processor.exporter else None,
+        "sample_rate": tracer.sample_rate,
+        "queued": tracer.processor.pending(),
+        **tracer.processor.stats,
+    }
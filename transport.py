@@ -0,0 +1,249 @@
+# transport.py
+"""
+HTTP-транспорт для вызовов Telegram Bot API из telebot (TeleBot / apihelper).
+
+install() подменяет отправку запросов telebot (apihelper.CUSTOM_REQUEST_SENDER):
+- один клиент с пулом keep-alive соединений на процесс, размер пула — по числу
+  потоков, вызывающих API (воркеры обработчиков + polling), вместо сессии
+  requests на каждый поток с пересозданием раз в 10 минут;
+- раздельные таймауты на соединение (TG_CONNECT_TIMEOUT) и ответ
+  (TG_READ_TIMEOUT); для getUpdates telebot сам удлиняет таймаут ответа на
+  время long polling;
+- повтор с экспоненциальной задержкой и случайным разбросом (TG_RETRIES,
+  TG_RETRY_BACKOFF) только там, где запрос точно не выполнен: ошибка
+  соединения (в т.ч. закрытое сервером keep-alive соединение) и ответы
+  502/503/504. Таймаут ответа не повторяется — сообщение могло уйти;
+- метрики по методам API: вызовы, ошибки, повторы, задержки (stats()).
+
+Клиент выбирается TG_HTTP_CLIENT: "requests" (по умолчанию), "httpx" (HTTP/2
+при TG_HTTP2=1, нужны пакеты httpx и h2) или "модуль:фабрика" — фабрика
+принимает (pool_size, http2) и возвращает объект с request(method, url,
+params, files, timeout) -> ответ с status_code, reason, text, json().
+
+Асинхронный бот (async_bot.py) ходит в API через aiohttp asyncio_helper и
+этим модулем не затрагивается.
+"""
+
+import os
+import time
+import random
+import socket
+import logging
+import importlib
+import threading
+from collections import deque
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+logger = logging.getLogger(__name__)
+
+TG_HTTP_CLIENT = os.getenv("TG_HTTP_CLIENT", "requests")
+TG_HTTP2 = os.getenv("TG_HTTP2", "0") == "1"
+TG_POOL_SIZE = int(os.getenv("TG_POOL_SIZE", "0"))  # 0 — по числу воркеров
+TG_CONNECT_TIMEOUT = float(os.getenv("TG_CONNECT_TIMEOUT", "3.05"))
+TG_READ_TIMEOUT = float(os.getenv("TG_READ_TIMEOUT", "10"))
+TG_RETRIES = int(os.getenv("TG_RETRIES", "2"))
+TG_RETRY_BACKOFF = float(os.getenv("TG_RETRY_BACKOFF", "0.2"))
+
+RETRY_STATUSES = (502, 503, 504)
+# Последние задержки на метод для перцентилей
+LATENCY_WINDOW = 512
+
+class RequestsClient:
+    """requests.Session с одним пулом на pool_size соединений для всех потоков"""
+
+    def __init__(self, pool_size, http2=False):
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.connection import HTTPConnection
+
+        if http2:
+            logger.warning("requests не поддерживает HTTP/2, используется HTTP/1.1 (TG_HTTP_CLIENT=httpx)")
+
+        class KeepAliveAdapter(HTTPAdapter):
+            # TCP keepalive: простаивающие соединения не обрывает NAT/балансировщик
+            def init_poolmanager(self, *args, **kwargs):
+                kwargs["socket_options"] = HTTPConnection.default_socket_options + [
+                    (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+                ]
+                super().init_poolmanager(*args, **kwargs)
+
+        self.session = requests.Session()
+        adapter = KeepAliveAdapter(pool_connections=2, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.connection_errors = (requests.exceptions.ConnectionError,)
+
+    def request(self, method, url, params=None, files=None, timeout=None, proxies=None):
+        return self.session.request(method, url, params=params, files=files, timeout=timeout, proxies=proxies)
+
+    def close(self):
+        self.session.close()
+
+class HttpxClient:
+    """httpx.Client, при http2 — HTTP/2: запросы всех потоков мультиплексируются в одном соединении"""
+
+    def __init__(self, pool_size, http2=False):
+        if httpx is None:
+            raise RuntimeError("TG_HTTP_CLIENT=httpx: пакет httpx не установлен (pip install 'httpx[http2]')")
+        self.client = httpx.Client(
+            http2=http2,
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+        )
+        self.connection_errors = (httpx.ConnectError, httpx.RemoteProtocolError, httpx.PoolTimeout)
+
+    def request(self, method, url, params=None, files=None, timeout=None, proxies=None):
+        connect, read = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+        response = self.client.request(
+            method.upper(), url, params=params, files=files,
+            timeout=httpx.Timeout(read, connect=connect),
+        )
+        # telebot.apihelper.ApiHTTPException читает .reason, как у requests
+        response.reason = response.reason_phrase
+        return response
+
+    def close(self):
+        self.client.close()
+
+CLIENTS = {"requests": RequestsClient, "httpx": HttpxClient}
+
+def client_factory(name):
+    """Фабрика клиента по имени из CLIENTS или "модуль:атрибут" """
+    if name in CLIENTS:
+        return CLIENTS[name]
+    module, _, attr = name.partition(":")
+    if not attr:
+        raise ValueError(f"TG_HTTP_CLIENT: неизвестный клиент {name!r}")
+    return getattr(importlib.import_module(module), attr)
+
+class EndpointStats:
+    """Счётчики и задержки одного метода API"""
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.statuses = {}
+        self.recent = deque(maxlen=LATENCY_WINDOW)
+
+    def as_dict(self):
+        recent = sorted(self.recent)
+
+        def pct(q):
+            return round(recent[min(len(recent) - 1, int(len(recent) * q))], 2) if recent else None
+
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "retries": self.retries,
+            "statuses": dict(self.statuses),
+            "mean_ms": round(self.total_ms / self.calls, 2) if self.calls else None,
+            "p50_ms": pct(0.5),
+            "p95_ms": pct(0.95),
+            "p99_ms": pct(0.99),
+            "max_ms": round(self.max_ms, 2),
+        }
+
+class Transport:
+    """Отправитель запросов для apihelper.CUSTOM_REQUEST_SENDER с повторами и метриками"""
+
+    def __init__(self, client, pool_size, retries=TG_RETRIES, backoff=TG_RETRY_BACKOFF):
+        self.client = client
+        self.pool_size = pool_size
+        # Ошибки, при которых запрос заведомо не выполнен (у клиента из TG_HTTP_CLIENT может не быть)
+        self.connection_errors = getattr(client, "connection_errors", ())
+        self.retries = retries
+        self.backoff = backoff
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def _endpoint(self, method_name):
+        with self._lock:
+            stats = self._stats.get(method_name)
+            if stats is None:
+                stats = self._stats[method_name] = EndpointStats()
+            return stats
+
+    def _record(self, stats, elapsed_ms, status=None, error=False, retried=False):
+        with self._lock:
+            if retried:
+                stats.retries += 1
+                return
+            stats.calls += 1
+            stats.errors += bool(error)
+            stats.total_ms += elapsed_ms
+            stats.max_ms = max(stats.max_ms, elapsed_ms)
+            stats.recent.append(elapsed_ms)
+            key = str(status) if status is not None else "error"
+            stats.statuses[key] = stats.statuses.get(key, 0) + 1
+
+    def delay(self, attempt):
+        """Полный разброс: случайно в [0, backoff * 2^attempt], чтобы потоки не повторяли хором"""
+        return random.uniform(0, self.backoff * (2 ** attempt))
+
+    def __call__(self, method, url, params=None, files=None, timeout=None, proxies=None):
+        stats = self._endpoint(url.rsplit("/", 1)[-1])
+        started = time.perf_counter()
+        attempt = 0
+        while True:
+            try:
+                response = self.client.request(method, url, params=params, files=files,
+                                               timeout=timeout, proxies=proxies)
+            except self.connection_errors:
+                # Запрос не дошёл до сервера (или сервер закрыл keep-alive соединение) — повтор безопасен
+                if attempt < self.retries and not files:
+                    self._record(stats, 0, retried=True)
+                    time.sleep(self.delay(attempt))
+                    attempt += 1
+                    continue
+                self._record(stats, (time.perf_counter() - started) * 1000, error=True)
+                raise
+            except Exception:
+                self._record(stats, (time.perf_counter() - started) * 1000, error=True)
+                raise
+            if response.status_code in RETRY_STATUSES and attempt < self.retries and not files:
+                self._record(stats, 0, retried=True)
+                time.sleep(self.delay(attempt))
+                attempt += 1
+                continue
+            self._record(stats, (time.perf_counter() - started) * 1000, status=response.status_code,
+                         error=response.status_code != 200)
+            return response
+
+    def stats(self):
+        with self._lock:
+            return {name: stats.as_dict() for name, stats in sorted(self._stats.items())}
+
+    def close(self):
+        self.client.close()
+
+transport = None
+
+def install(pool_size=None, client=TG_HTTP_CLIENT, http2=TG_HTTP2):
+    """
+    Подключает транспорт к telebot.apihelper. pool_size — число потоков,
+    одновременно вызывающих API; повторный вызов с большим пулом (tenants.py)
+    заменяет клиент, старый закрывается сборщиком мусора.
+    """
+    global transport
+    from telebot import apihelper
+
+    size = TG_POOL_SIZE or pool_size or 10
+    if transport is not None and transport.pool_size >= size:
+        return transport
+    transport = Transport(client_factory(client)(size, http2), size)
+    apihelper.CONNECT_TIMEOUT = TG_CONNECT_TIMEOUT
+    apihelper.READ_TIMEOUT = TG_READ_TIMEOUT
+    apihelper.CUSTOM_REQUEST_SENDER = transport
+    logger.info(f"Telegram API: клиент {client}{' (HTTP/2)' if http2 else ''}, пул {size}, "
+                f"таймауты {TG_CONNECT_TIMEOUT}/{TG_READ_TIMEOUT} с, повторов {TG_RETRIES}")
+    return transport
+
+def stats():
+    """Метрики по методам API или {}, если транспорт не подключён"""
+    return transport.stats() if transport is not None else {}
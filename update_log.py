@@ -0,0 +1,271 @@
+# update_log.py
+"""
+Запись входящих апдейтов Telegram в сжатый журнал для воспроизведения
+(scripts/replay_updates.py).
+
+RECORD_UPDATES_PATH=updates.jsonl.gz включает запись в SurveyBot /
+SurveyAsyncBot: каждый полученный апдейт (до дедупликации и admission, как
+он пришёл от Telegram) пишется строкой JSON в gzip-файл вместе со смещением
+от начала записи — так сохраняется форма реального трафика: всплески,
+брошенные на середине опросы, повторные нажатия кнопок.
+
+Журнал обезличивается при записи (Scrubber):
+- user_id и chat_id заменяются псевдонимами (HMAC со случайной солью записи,
+  соль в файл не пишется), один и тот же пользователь остаётся одним и тем же;
+- имена, username, id callback'ов и chat_instance удаляются или хэшируются;
+- текст сообщений заменяется маской той же длины и того же вида (ФИО
+  остаётся из двух и более слов, дата — корректной/некорректной датой
+  ДД.ММ.ГГГГ с тем же результатом проверки), команды сохраняются;
+- всё, что не входит в белый список полей (контакты, фото, геолокация ...),
+  отбрасывается.
+
+Формат: первая строка — заголовок {"format": ..., "version": 1, ...}, далее
+{"t": секунды от начала, "update": {...}}.
+"""
+
+import os
+import re
+import hmac
+import gzip
+import json
+import time
+import hashlib
+import logging
+import threading
+from datetime import datetime
+
+from validation import (
+    ValidationError, parse_birth_date,
+    DATE_INVALID_ERROR, DATE_FUTURE_ERROR, DATE_TOO_OLD_ERROR,
+)
+
+logger = logging.getLogger(__name__)
+
+RECORD_UPDATES_PATH = os.getenv("RECORD_UPDATES_PATH", "")
+RECORD_FLUSH_SECONDS = float(os.getenv("RECORD_FLUSH_SECONDS", "5"))
+
+FORMAT = "telegram-updates"
+VERSION = 1
+
+UPDATE_KINDS = ("message", "edited_message", "callback_query")
+
+# Поля, которые переживают обезличивание
+MESSAGE_FIELDS = ("message_id", "date", "edit_date", "text", "entities", "chat", "from")
+ENTITY_FIELDS = ("type", "offset", "length")
+
+_DATE_LIKE = re.compile(r"[0-9]{2}\.[0-9]{2}\.[0-9]{4}")
+
+# Замены дат с тем же результатом parse_birth_date
+_DATE_SUBSTITUTES = {
+    DATE_INVALID_ERROR: "31.02.1990",
+    DATE_FUTURE_ERROR: "01.01.2999",
+    DATE_TOO_OLD_ERROR: "01.01.1800",
+}
+
+class Scrubber:
+    """Обезличивание апдейтов с постоянными в пределах одной записи псевдонимами"""
+
+    def __init__(self, salt=None):
+        self.salt = salt if salt is not None else os.urandom(16)
+
+    def _digest(self, value):
+        return hmac.new(self.salt, str(value).encode(), hashlib.sha256).digest()
+
+    def pseudo_id(self, value):
+        """Псевдоним целого id того же знака (группы и каналы — отрицательные)"""
+        if value is None:
+            return None
+        n = int.from_bytes(self._digest(value)[:8], "big") % 9_000_000_000 + 1_000_000_000
+        return -n if int(value) < 0 else n
+
+    def pseudo_str(self, value):
+        return None if value is None else self._digest(value).hex()[:16]
+
+    def fake_date(self, text):
+        """Дата ДД.ММ.ГГГГ с тем же результатом проверки, что и у исходной"""
+        try:
+            parse_birth_date(text)
+        except ValidationError as e:
+            return _DATE_SUBSTITUTES.get(str(e), text)
+        n = int.from_bytes(self._digest(text)[:4], "big")
+        return f"{n % 28 + 1:02d}.{n // 28 % 12 + 1:02d}.{1950 + n // 336 % 55}"
+
+    def text(self, text):
+        """Маска той же длины: буквы -> х/x, цифры -> 0, пробелы и знаки как есть"""
+        if text is None:
+            return None
+        if text.startswith("/"):
+            command, sep, rest = text.partition(" ")
+            return command + sep + self.text(rest) if rest else text
+        if _DATE_LIKE.fullmatch(text.strip()):
+            return text.replace(text.strip(), self.fake_date(text.strip()))
+        out = []
+        for ch in text:
+            if ch.isdigit():
+                out.append("0")
+            elif ch.isalpha():
+                cyrillic = "Ѐ" <= ch <= "ӿ"
+                letter = ("х" if cyrillic else "x")
+                out.append(letter.upper() if ch.isupper() else letter)
+            else:
+                out.append(ch)
+        return "".join(out)
+
+    def user(self, user):
+        if not user:
+            return user
+        return {
+            "id": self.pseudo_id(user.get("id")),
+            "is_bot": user.get("is_bot", False),
+            "first_name": "Bot" if user.get("is_bot") else "User",
+            "language_code": user.get("language_code"),
+        }
+
+    def chat(self, chat):
+        if not chat:
+            return chat
+        return {"id": self.pseudo_id(chat.get("id")), "type": chat.get("type")}
+
+    def message(self, message):
+        if not message:
+            return message
+        out = {k: message[k] for k in MESSAGE_FIELDS if k in message}
+        if "text" in out:
+            out["text"] = self.text(out["text"])
+        if "entities" in out:
+            out["entities"] = [{k: e[k] for k in ENTITY_FIELDS if k in e} for e in out["entities"]]
+        if "chat" in out:
+            out["chat"] = self.chat(out["chat"])
+        if "from" in out:
+            out["from"] = self.user(out["from"])
+        return out
+
+    def callback_query(self, call):
+        return {
+            "id": self.pseudo_str(call.get("id")),
+            "from": self.user(call.get("from")),
+            "chat_instance": self.pseudo_str(call.get("chat_instance")),
+            # data задаётся кнопками бота, персональных данных в ней нет
+            "data": call.get("data"),
+            **({"message": self.message(call["message"])} if call.get("message") else {}),
+        }
+
+    def update(self, update):
+        """Обезличенная копия апдейта (dict); типы вне UPDATE_KINDS — только update_id"""
+        out = {"update_id": update["update_id"]}
+        for kind in UPDATE_KINDS:
+            if update.get(kind):
+                out[kind] = self.callback_query(update[kind]) if kind == "callback_query" else self.message(update[kind])
+        return out
+
+def update_dict(update):
+    """Исходный JSON апдейта из telebot.types.Update (message/callback_query хранят его в .json)"""
+    out = {"update_id": update.update_id}
+    for kind in UPDATE_KINDS:
+        payload = getattr(update, kind, None)
+        raw = getattr(payload, "json", None)
+        if isinstance(raw, str):
+            raw = json.loads(raw)
+        if raw:
+            out[kind] = raw
+    return out
+
+class UpdateRecorder:
+    """
+    Дописывает апдейты в gzip-журнал; потокобезопасен. Файл открывается при
+    первом апдейте: процессы, импортирующие bot.py без polling (воркеры
+    gunicorn), журнал не трогают.
+    """
+
+    def __init__(self, path, scrub=True, flush_seconds=5.0):
+        self.path = path
+        self.scrubber = Scrubber() if scrub else None
+        self.flush_seconds = flush_seconds
+        self.count = 0
+        self._lock = threading.Lock()
+        self._started = None
+        self._flushed = None
+        self._file = None
+        self._closed = False
+
+    def _open(self, now):
+        self._file = gzip.open(self.path, "at", encoding="utf-8")
+        self._started = self._flushed = now
+        self._write({
+            "format": FORMAT, "version": VERSION, "scrubbed": self.scrubber is not None,
+            "started_at": datetime.now().isoformat(timespec="seconds"),
+        })
+
+    @classmethod
+    def from_env(cls):
+        """Рекордер по RECORD_UPDATES_PATH или None"""
+        if not RECORD_UPDATES_PATH:
+            return None
+        logger.info(f"Входящие апдейты записываются в {RECORD_UPDATES_PATH}")
+        return cls(RECORD_UPDATES_PATH, flush_seconds=RECORD_FLUSH_SECONDS)
+
+    def _write(self, record):
+        self._file.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+
+    def record(self, updates):
+        """Пишет пачку telebot.types.Update; ошибки записи не мешают обработке"""
+        now = time.monotonic()
+        try:
+            raws = [update_dict(update) for update in updates]
+            if self.scrubber is not None:
+                raws = [self.scrubber.update(raw) for raw in raws]
+            with self._lock:
+                if self._closed:
+                    return
+                if self._file is None:
+                    self._open(now)
+                t = round(now - self._started, 4)
+                for raw in raws:
+                    self._write({"t": t, "update": raw})
+                self.count += len(raws)
+                # gzip сбрасывается на диск не чаще раза в flush_seconds
+                if now - self._flushed >= self.flush_seconds:
+                    self._file.flush()
+                    self._flushed = now
+        except Exception as e:
+            logger.warning(f"Не удалось записать апдейты в {self.path}: {e}")
+
+    def close(self, _timeout=None):
+        with self._lock:
+            self._closed = True
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+                logger.info(f"Записано апдейтов: {self.count} ({self.path})")
+
+def read_log(path):
+    """
+    (заголовок, список {"t", "update"}) из журнала. Журнал, дописанный после
+    перезапуска, содержит несколько заголовков: их записи идут подряд по времени.
+    """
+    records = []
+    base = last = 0.0
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        header = json.loads(f.readline())
+        if header.get("format") != FORMAT:
+            raise ValueError(f"{path}: не журнал апдейтов")
+        try:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning(f"{path}: пропущена повреждённая строка")
+                    continue
+                if "format" in record:
+                    base = last
+                    continue
+                record["t"] += base
+                last = record["t"]
+                records.append(record)
+        except EOFError:
+            # Процесс остановили без close(): хвост gzip не дописан
+            logger.warning(f"{path}: журнал оборван, прочитано записей: {len(records)}")
+    return header, records
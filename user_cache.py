@@ -0,0 +1,227 @@
+# user_cache.py
+"""
+Кэш чтения по пользователю: ответы пользователя и похожие выборки.
+
+Ограниченный LRU по user_id с TTL. Внутри записи пользователя лежат
+результаты разных запросов ({(имя, аргументы): значение}), поэтому сохранение
+анкеты сбрасывает их все одним invalidate(user_id): db.save_survey_response,
+db_async.save_survey_response и database.save_response вызывают его после
+успешной записи.
+
+Несколько процессов (gunicorn + bot_runner, реплики): USER_CACHE_CHANNEL=pg
+рассылает сброс через PostgreSQL NOTIFY, остальные процессы слушают канал
+в фоновом потоке. Без канала чужие записи видны не позже чем через USER_CACHE_TTL.
+
+Счётчики — UserCache.stats (hits, misses, invalidations, ...), см. /_diag/db.
+"""
+
+import os
+import time
+import logging
+import threading
+import functools
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "60"))
+USER_CACHE_CHANNEL = os.getenv("USER_CACHE_CHANNEL", "").lower()
+USER_CACHE_POLL_SECONDS = float(os.getenv("USER_CACHE_POLL_SECONDS", "1"))
+
+NOTIFY_CHANNEL = "user_cache_invalidate"
+
+class UserCache:
+    """LRU по user_id с TTL; значения — результаты запросов {ключ: (значение, истекает)}"""
+
+    def __init__(self, max_size=10000, ttl=60.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.publisher = None
+        self._users = OrderedDict()
+        # Сбросы по user_id {user_id: (номер, время)}: загрузка, начатая до сброса,
+        # не попадёт в кэш; время нужно для written_within
+        self._writes = OrderedDict()
+        self._epoch = 0
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "expired": 0, "evictions": 0,
+                      "invalidations": 0, "remote_invalidations": 0}
+
+    @property
+    def enabled(self):
+        return self.max_size > 0 and self.ttl > 0
+
+    def get(self, user_id, key, now=None):
+        """(True, значение) при попадании, иначе (False, None)"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            entries = self._users.get(user_id)
+            item = entries.get(key) if entries else None
+            if item is None:
+                self.stats["misses"] += 1
+                return False, None
+            value, expires = item
+            if now >= expires:
+                del entries[key]
+                self.stats["expired"] += 1
+                self.stats["misses"] += 1
+                return False, None
+            self._users.move_to_end(user_id)
+            self.stats["hits"] += 1
+            return True, value
+
+    def put(self, user_id, key, value, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            entries = self._users.get(user_id)
+            if entries is None:
+                entries = self._users[user_id] = {}
+            entries[key] = (value, now + self.ttl)
+            self._users.move_to_end(user_id)
+            while len(self._users) > self.max_size:
+                self._users.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def get_or_load(self, user_id, key, loader):
+        """Значение из кэша или loader() с сохранением (исключения loader не кэшируются)"""
+        if not self.enabled:
+            return loader()
+        with self._lock:
+            generation = self._generation(user_id)
+        hit, value = self.get(user_id, key)
+        if hit:
+            return value
+        value = loader()
+        with self._lock:
+            stale = self._generation(user_id) != generation
+        if not stale:
+            self.put(user_id, key, value)
+        return value
+
+    def _generation(self, user_id):
+        return self._epoch, self._writes.get(user_id, (0, 0.0))[0]
+
+    def written_within(self, user_id, seconds):
+        """Был ли сброс по пользователю (его запись) за последние seconds секунд"""
+        with self._lock:
+            item = self._writes.get(user_id)
+        return item is not None and time.monotonic() - item[1] < seconds
+
+    def invalidate(self, user_id, publish=True, remote=False):
+        """
+        Сбрасывает все значения пользователя и рассылает сброс другим процессам,
+        если канал включён. remote — сброс пришёл из канала.
+        """
+        with self._lock:
+            self._users.pop(user_id, None)
+            self._writes[user_id] = (self._writes.get(user_id, (0, 0.0))[0] + 1, time.monotonic())
+            self._writes.move_to_end(user_id)
+            if len(self._writes) > self.max_size:
+                self._writes.popitem(last=False)
+            self.stats["remote_invalidations" if remote else "invalidations"] += 1
+        if publish and not remote:
+            self.publish(user_id)
+
+    def publish(self, user_id):
+        """Рассылает сброс по каналу (без канала ничего не делает)"""
+        if self.publisher is None:
+            return
+        try:
+            self.publisher(user_id)
+        except Exception as e:
+            logger.warning(f"Не удалось разослать сброс кэша пользователя {user_id}: {e}")
+
+    def clear(self):
+        with self._lock:
+            self._users.clear()
+            self._epoch += 1
+
+    def __len__(self):
+        return len(self._users)
+
+    def status(self):
+        return {"users": len(self._users), "max_size": self.max_size, "ttl_s": self.ttl, **self.stats}
+
+def cached(key):
+    """
+    Декоратор для функций вида f(user_id, *args): результат кэшируется
+    по (key, args) в записи пользователя.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(user_id, *args, **kwargs):
+            cache_key = (key, args, tuple(sorted(kwargs.items())))
+            return cache.get_or_load(user_id, cache_key, lambda: func(user_id, *args, **kwargs))
+        wrapper.uncached = func
+        return wrapper
+    return decorator
+
+# --- общий канал сброса через PostgreSQL LISTEN/NOTIFY ---
+
+def _pg_publisher(engine):
+    from sqlalchemy import text
+
+    def publish(user_id):
+        with engine.begin() as conn:
+            conn.execute(text("SELECT pg_notify(:c, :p)"), {"c": NOTIFY_CHANNEL, "p": str(user_id)})
+    return publish
+
+def _pg_listener(engine, target, stop_event, poll_seconds):
+    """
+    Слушает канал на отдельном соединении. pg8000 складывает уведомления в
+    connection.notifications после любого запроса, поэтому соединение
+    опрашивается пустым запросом раз в poll_seconds.
+    """
+    while not stop_event.is_set():
+        raw = None
+        try:
+            raw = engine.raw_connection()
+            dbapi = raw.driver_connection
+            cur = raw.cursor()
+            cur.execute(f"LISTEN {NOTIFY_CHANNEL}")
+            raw.commit()
+            logger.info("Кэш пользователей: подписка на сбросы через PostgreSQL")
+            while not stop_event.wait(poll_seconds):
+                cur.execute("SELECT 1")
+                raw.commit()
+                while dbapi.notifications:
+                    _pid, _channel, payload = dbapi.notifications.popleft()
+                    try:
+                        target.invalidate(int(payload), remote=True)
+                    except ValueError:
+                        target.clear()
+        except Exception as e:
+            logger.warning(f"Канал сброса кэша пользователей недоступен, повтор: {e}")
+            # Пока канала нет, чужие записи могли пройти незамеченными
+            target.clear()
+            stop_event.wait(5)
+        finally:
+            if raw is not None:
+                # Соединение с LISTEN не возвращается в пул
+                try:
+                    raw.invalidate()
+                except Exception:
+                    pass
+
+def start_channel(target=None, channel=USER_CACHE_CHANNEL, poll_seconds=USER_CACHE_POLL_SECONDS, stop_event=None):
+    """Включает общий канал сброса; None, если канал не настроен или БД не PostgreSQL"""
+    target = target or cache
+    if channel != "pg":
+        return None
+    from db import engine
+    if engine.dialect.name != "postgresql":
+        logger.warning("USER_CACHE_CHANNEL=pg требует PostgreSQL, канал не запущен")
+        return None
+    stop_event = stop_event or threading.Event()
+    target.publisher = _pg_publisher(engine)
+    thread = threading.Thread(
+        target=_pg_listener, args=(engine, target, stop_event, poll_seconds),
+        name="user-cache-listener", daemon=True,
+    )
+    thread.start()
+    return thread
+
+cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+def invalidate(user_id):
+    cache.invalidate(user_id)
@@ -0,0 +1,119 @@
+# validation.py
+"""
+Проверка и нормализация полей анкеты — единые правила для бота и слоёв БД.
+
+Дата рождения разбирается один раз при вводе (parse_birth_date) и дальше
+передаётся как объект date: в состоянии опроса, в отчёте и при сохранении
+повторный разбор строки не нужен. Граница «сегодня» кэшируется до полуночи.
+
+Ошибки ввода — ValidationError с текстом для пользователя.
+"""
+
+import re
+import time
+from datetime import date, datetime, timedelta
+
+MIN_BIRTH_YEAR = 1900
+NAME_MAX_LENGTH = 255        # survey_responses.full_name в database.py
+CITIZENSHIP_MAX_LENGTH = 100  # survey_responses.citizenship в database.py
+
+# ДД.ММ.ГГГГ, только ASCII-цифры (\d пропускает и другие цифры Unicode)
+_DATE_RE = re.compile(r"([0-9]{2})\.([0-9]{2})\.([0-9]{4})")
+
+DATE_FORMAT_ERROR = "❌ Неверный формат даты! Используйте формат ДД.ММ.ГГГГ (например: 15.03.1990)"
+DATE_INVALID_ERROR = "❌ Неверная дата! Проверьте правильность введенной даты."
+DATE_FUTURE_ERROR = "❌ Дата рождения не может быть в будущем!"
+DATE_TOO_OLD_ERROR = f"❌ Дата рождения не может быть раньше {MIN_BIRTH_YEAR} года!"
+NAME_ERROR = "❌ Пожалуйста, введите полное ФИО (например: Иванов Иван Иванович)"
+NAME_TOO_LONG_ERROR = f"❌ ФИО слишком длинное (не более {NAME_MAX_LENGTH} символов)."
+CITIZENSHIP_ERROR = "❌ Пожалуйста, введите ваше гражданство."
+CITIZENSHIP_TOO_LONG_ERROR = f"❌ Гражданство слишком длинное (не более {CITIZENSHIP_MAX_LENGTH} символов)."
+
+class ValidationError(ValueError):
+    """Некорректный ввод; str(e) — сообщение для пользователя"""
+
+# --- «сегодня» с точностью до дня ---
+
+_today = None
+_today_until = 0.0
+
+def today():
+    """date.today(), пересчитывается только после локальной полуночи"""
+    global _today, _today_until
+    now = time.time()
+    if now >= _today_until:
+        current = date.fromtimestamp(now)
+        _today_until = time.mktime((current + timedelta(days=1)).timetuple())
+        _today = current
+    return _today
+
+# --- даты ---
+
+def parse_birth_date(text):
+    """ДД.ММ.ГГГГ -> date с проверкой диапазона; ValidationError при ошибке"""
+    match = _DATE_RE.fullmatch(text)
+    if match is None:
+        raise ValidationError(DATE_FORMAT_ERROR)
+    day, month, year = match.groups()
+    try:
+        value = date(int(year), int(month), int(day))
+    except ValueError:
+        raise ValidationError(DATE_INVALID_ERROR) from None
+    if value > today():
+        raise ValidationError(DATE_FUTURE_ERROR)
+    if value.year < MIN_BIRTH_YEAR:
+        raise ValidationError(DATE_TOO_OLD_ERROR)
+    return value
+
+def to_date(value):
+    """
+    Приводит дату из любого принятого представления к date без проверки диапазона:
+    date/datetime, 'YYYY-MM-DD' или 'ДД.ММ.ГГГГ'. None, если разобрать не удалось.
+    """
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    if not value:
+        return None
+    try:
+        if len(value) == 10 and value[4] == "-":
+            return date.fromisoformat(value)
+        match = _DATE_RE.fullmatch(value)
+        if match:
+            day, month, year = match.groups()
+            return date(int(year), int(month), int(day))
+    except (TypeError, ValueError):
+        pass
+    return None
+
+def iso_date(value):
+    """date -> 'YYYY-MM-DD' для текстовой колонки survey_responses.birth_date; строки без изменений"""
+    return value.isoformat() if isinstance(value, date) else value
+
+def format_date(value):
+    """date -> 'ДД.ММ.ГГГГ' для сообщений пользователю"""
+    if isinstance(value, date):
+        return f"{value.day:02d}.{value.month:02d}.{value.year}"
+    return value
+
+# --- текстовые поля ---
+
+def normalize_name(text):
+    """ФИО: лишние пробелы схлопываются, минимум 2 слова"""
+    words = text.split()
+    if len(words) < 2:
+        raise ValidationError(NAME_ERROR)
+    name = " ".join(words)
+    if len(name) > NAME_MAX_LENGTH:
+        raise ValidationError(NAME_TOO_LONG_ERROR)
+    return name
+
+def normalize_citizenship(text):
+    """Гражданство: лишние пробелы схлопываются, минимум 2 символа"""
+    citizenship = " ".join(text.split())
+    if len(citizenship) < 2:
+        raise ValidationError(CITIZENSHIP_ERROR)
+    if len(citizenship) > CITIZENSHIP_MAX_LENGTH:
+        raise ValidationError(CITIZENSHIP_TOO_LONG_ERROR)
+    return citizenship
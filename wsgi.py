@@ -0,0 +1,8 @@
+# wsgi.py
+"""
+WSGI-точка входа для gunicorn. Бот здесь не запускается — им занимается bot_runner.py.
+"""
+
+from server import app
+
+__all__ = ["app"]